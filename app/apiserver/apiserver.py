@@ -1,26 +1,49 @@
-from waitress import serve
+from waitress.server import create_server, BaseWSGIServer
 from flask import g, Flask, abort, jsonify, request, make_response, Response, send_file
+import json
+from contextlib import closing
 import logging
 import os
+import tempfile
 from Crypto.PublicKey import RSA
 
 from server.flitifyserver import FlitifyServer
-from server.handlers.clienthandler import FileTransferError
+from server.asyncflitifyserver import AsyncFlitifyServer
+from server.handlers.clienthandler import FileTransferError, RangeNotSatisfiableError
+from server.staging import StagingArea, StagedFileNotFoundError, pushToClients
+from apiserver.filecache import FileCache, CachedFile
+import constants
 
 class ApiServer:
-    def __init__(self, server:FlitifyServer, host='localhost', port=37012, secret=None):
+    def __init__(self, server:FlitifyServer | AsyncFlitifyServer, host='localhost', port=37012, secret=None, stagingDir=None,
+                 bulkUploadWorkers=constants.BULK_UPLOAD_WORKERS, fileCacheEntries=constants.FILE_CACHE_ENTRIES,
+                 fileCacheBytes=constants.FILE_CACHE_BYTES, unixSocket=None, sockets=None):
         """
         Initializes the internal API server.
 
         Args:
-            server (FlitifyServer): An instance of FlitifyServer managing connected clients.
+            server (FlitifyServer | AsyncFlitifyServer): The server engine managing connected clients.
             host (str): Host address to bind the server to (defaults to 'localhost'). WARNING! Do not expose to public networks.
             port (int): Port number to listen to (defaults to 37012).
             secret (str, optional): API secret for request authentication.
+            stagingDir (str, optional): Directory of files staged for bulk uploads (defaults to flitify-staging in the temp directory).
+            bulkUploadWorkers (int): Number of uploads a bulk upload runs at once.
+            fileCacheEntries (int): Number of downloaded files cached at most.
+            fileCacheBytes (int): Total size of the downloaded files cached at most.
+            unixSocket (str, optional): Path of a Unix socket to listen on in place of host and port.
+            sockets (list[socket.socket], optional): Listening sockets taken over from the previous server
+                process (see server.handoff), served in place of host and port.
         """
         self.fserver = server
         self.host = host
         self.port = port
+        self.unixSocket = unixSocket
+        self.sockets = sockets
+        # waitress' dispatchers by file descriptor, the listening ones among them
+        self.socketMap = {}
+        self.staging = StagingArea(stagingDir or os.path.join(tempfile.gettempdir(), 'flitify-staging'))
+        self.bulkUploadWorkers = bulkUploadWorkers
+        self.fileCache = FileCache(fileCacheEntries, fileCacheBytes)
         self.app = Flask(__name__)
         self.api_secret = secret or os.getenv("API_SECRET", None)
         self.logger = logging.getLogger('apiserver')
@@ -35,6 +58,82 @@ class ApiServer:
                 return jsonify({'request_status': 'failed', 'reason': 'unauthorized'}), 401
         self._setup_routes()
 
+    def _requestedRange(self) -> tuple[int, int | None, str | int | None]:
+        """
+        Translates the Range and If-Range headers of the current request.
+
+        Returns:
+            tuple: offset (negative for a suffix range), length (None for the rest of
+            the file) and the If-Range validator (ETag or modification time in seconds);
+            0, None, None if the request does not ask for a single byte range
+        """
+        byteRange = request.range
+        if byteRange is None or byteRange.units != 'bytes' or len(byteRange.ranges) != 1:
+            return 0, None, None
+        start, stop = byteRange.ranges[0]
+        ifRange = None
+        if request.headers.get('If-Range', '').startswith('W/'):
+            # Weak validators never match, the whole file is sent
+            ifRange = ''
+        elif request.if_range.etag is not None:
+            ifRange = request.if_range.etag
+        elif request.if_range.date is not None:
+            ifRange = int(request.if_range.date.timestamp())
+        return start, None if stop is None else stop - start, ifRange
+
+    def _requestedETag(self) -> str | None:
+        """
+        Returns:
+            str or None: the ETag in the If-None-Match header of the current request, if it holds exactly one
+        """
+        etags = request.if_none_match.as_set(include_weak=True)
+        return next(iter(etags)) if len(etags) == 1 else None
+
+    def _fileResponse(self, body, length: int, filePath: str, etag: str | None, mtime: float | None, status=200) -> Response:
+        response = Response(body, status=status, direct_passthrough=True)
+        response.headers.set('Content-Type', 'application/octet-stream')
+        if status != 304:
+            response.headers.set('Content-Length', str(length))
+            response.headers.set('Content-Disposition', f'attachment; filename="{filePath.split("/")[-1]}"')
+        if etag is not None:
+            response.headers.set('Accept-Ranges', 'bytes')
+            response.set_etag(etag)
+            response.last_modified = mtime
+        return response
+
+    def _cachingChunks(self, clientId: str, filePath: str, download):
+        """
+        Passes a download through, caching the file once it has been received completely.
+        """
+        chunks = []
+        try:
+            for chunk in download:
+                chunks.append(chunk)
+                yield chunk
+            self.fileCache.put(clientId, filePath, CachedFile(b''.join(chunks), download.etag, download.mtime))
+        finally:
+            download.close()
+
+    def _requestFile(self) -> tuple:
+        """
+        Finds the file sent with the current request: the 'file' part of a multipart form,
+        which the form parser spools to a temporary file, or else the raw request body.
+
+        Returns:
+            tuple: binary file object and size, or None, None if the request holds no file
+        """
+        if request.mimetype == 'multipart/form-data':
+            if 'file' not in request.files:
+                return None, None
+            source = request.files['file'].stream
+            source.seek(0, os.SEEK_END)
+            size = source.tell()
+            source.seek(0)
+            return source, size
+        if request.content_length is None:
+            return None, None
+        return request.stream, request.content_length
+
     def _getClient(self, clientId):
         """
         Retrieves a client instance by its identifier.
@@ -45,10 +144,7 @@ class ApiServer:
         Returns:
             ClientHandler or None: The ClientHandler for a specific client if found, otherwise None.
         """
-        client = self.fserver.getClientById(clientId)
-        if client:
-            return client.getClient()
-        return None
+        return self.fserver.getClientById(clientId)
 
     def _failWithReason(self, reason, error_code=400):
         """
@@ -95,24 +191,77 @@ class ApiServer:
 
         @self.app.route('/<clientId>/getfile')
         def getFile(clientId: str):
+            """
+            Honors a single byte range in the Range header, answering 206 Partial Content,
+            so an interrupted download can be continued. Multiple ranges are not supported
+            and get the whole file.
+
+            Whole files small enough are cached. A cached file, or one the request names
+            in If-None-Match, is revalidated by ETag with the client, which only costs
+            the client a stat(); if unchanged, the answer is 304 Not Modified or the
+            cached copy.
+            """
             filePath = request.args.get('file_path')
             client = self._getClient(clientId)
             if not client:
                 return self._failWithReason('client not found', error_code=404)
             if not filePath:
                 return self._failWithReason('invalid parameters for getfile', error_code=400)
+            offset, length, ifRange = self._requestedRange()
+            ranged = offset != 0 or length is not None
+            cached = None if ranged else self.fileCache.get(clientId, filePath)
             try:
-                fileContent = client.getFile(filePath)
-                if not fileContent:
+                download = client.streamFile(filePath, offset, length, ifRange, cached.etag if cached else self._requestedETag())
+                if download is None:
                     return self._failWithReason('unknown', error_code=504)
+            except RangeNotSatisfiableError as e:
+                response = self._failWithReason('range not satisfiable', error_code=416)
+                response.headers.set('Content-Range', f'bytes */{e.fileSize}')
+                return response
             except FileTransferError as e:
                 return self._failWithReason('file transfer error', error_code=504)
-            # Set response type to downloadable file
-            response = Response(fileContent)
-            response.headers.set('Content-Type', 'application/octet-stream')
-            response.headers.set('Content-Disposition', f'attachment; filename="{filePath.split("/")[-1]}"')
+            except BrokenPipeError:
+                return self._failWithReason('client disconnected', error_code=504)
+            if download.etag is not None and not ranged and request.if_none_match.contains_weak(download.etag):
+                download.close()
+                return self._fileResponse(b'', 0, filePath, download.etag, download.mtime, status=304)
+            if download.notModified:
+                if cached is None or cached.etag != download.etag:
+                    return self._failWithReason('unknown', error_code=504)
+                return self._fileResponse(cached.data, len(cached.data), filePath, cached.etag, cached.mtime)
+            body = download
+            if download.etag is not None and not download.partial and download.length <= self.fileCache.maxEntrySize:
+                body = self._cachingChunks(clientId, filePath, download)
+            # Chunks flow from the client connection straight to the HTTP response;
+            # a transfer breaking off leaves the body shorter than Content-Length
+            response = self._fileResponse(body, download.length, filePath, download.etag, download.mtime)
+            if download.partial:
+                response.status_code = 206
+                end = download.offset + download.length - 1
+                response.headers.set('Content-Range', f'bytes {download.offset}-{end}/{download.fileSize}')
             return response
 
+        @self.app.route('/<clientId>/hash', methods=['GET', 'POST'])
+        def hashFiles(clientId: str):
+            """
+            Digests of files on the client, computed there: one or more 'path' query
+            arguments, or a JSON body with 'paths'; 'algorithm' is sha256 (default) or blake2b.
+            """
+            body = (request.get_json(silent=True) or {}) if request.method == 'POST' else {}
+            paths = body.get('paths') or request.args.getlist('path')
+            algorithm = body.get('algorithm') or request.args.get('algorithm', 'sha256')
+            if not paths or not isinstance(paths, list) or not all(isinstance(path, str) for path in paths):
+                return self._failWithReason('invalid parameters for hash', error_code=400)
+            if algorithm not in constants.HASH_ALGORITHMS:
+                return self._failWithReason(f'algorithm must be one of {constants.HASH_ALGORITHMS}', error_code=400)
+            client = self._getClient(clientId)
+            if not client:
+                return self._failWithReason('client not found', error_code=404)
+            hashes = client.hashFiles(paths, algorithm)
+            if hashes is None:
+                return self._failWithReason('client hash_file failed', error_code=500)
+            return jsonify({'request_status': 'ok', 'algorithm': algorithm, 'hashes': hashes})
+
         @self.app.route('/<clientId>/listdir')
         def listDirectory(clientId: str):
             path = request.args.get('path', '/')
@@ -144,21 +293,107 @@ class ApiServer:
 
         @self.app.route('/<clientId>/uploadfile', methods=['POST'])
         def uploadFile(clientId: str):
-            if 'file' not in request.files or 'path' not in request.form:
+            """
+            Accepts either a multipart form with 'file' and 'path' (the file part is
+            spooled to a temporary file by the form parser), or the raw file as the
+            request body with the destination in the 'path' query argument. Both are
+            streamed to the client from there without being read into memory.
+
+            With the 'resume' query argument set, an interrupted upload is kept on the
+            client and sending the same file again only transfers the missing part.
+            With 'delta' set, an existing file is replaced, transferring only the parts
+            that differ from the client's version.
+            """
+            source, size = self._requestFile()
+            # Only form bodies are parsed, a raw body stays unread for streaming
+            path = request.form.get('path') if request.mimetype == 'multipart/form-data' else request.args.get('path')
+            if source is None or not path:
                 return self._failWithReason('Missing file or path', error_code=400)
-            file = request.files['file']
-            path = request.form['path']
-            file_bytes = file.read()
+            resume = request.args.get('resume', '').lower() in ('1', 'true')
+            delta = request.args.get('delta', '').lower() in ('1', 'true')
             client = self._getClient(clientId)
             if not client:
                 return self._failWithReason('client not found', error_code=404)
-            success = client.uploadFile(path, file_bytes)
+            if delta:
+                success = client.uploadDelta(path, source, size)
+            else:
+                success = client.uploadStream(path, source, size, resume)
+            self.fileCache.invalidate(clientId, path)
             if not success:
                 return self._failWithReason('upload failed on client', error_code=504)
             return jsonify({'request_status': 'ok'})
 
+        @self.app.route('/staging', methods=['POST'])
+        def stageFile():
+            """
+            Stores a file for bulk uploads, sent like to uploadfile. Returns its SHA-256,
+            which identifies it in bulkupload requests.
+            """
+            source, size = self._requestFile()
+            if source is None:
+                return self._failWithReason('Missing file', error_code=400)
+            try:
+                digest, size = self.staging.store(source, size)
+            except OSError as e:
+                self.logger.error(f'Staging a file failed: {e}')
+                return self._failWithReason('staging failed', error_code=500)
+            return jsonify({'request_status': 'ok', 'hash': digest, 'size': size})
+
+        @self.app.route('/staging/<digest>', methods=['DELETE'])
+        def unstageFile(digest: str):
+            try:
+                self.staging.remove(digest)
+            except StagedFileNotFoundError:
+                return self._failWithReason('file not staged', error_code=404)
+            return jsonify({'request_status': 'ok'})
+
+        @self.app.route('/bulkupload', methods=['POST'])
+        def bulkUpload():
+            """
+            Uploads a staged file to many clients. Expects a JSON body with the 'hash'
+            of the staged file, the destination 'path', the 'clients' to upload to and
+            optionally 'delta' to replace existing files with delta uploads.
+
+            The response is streamed as JSON lines: one per client with its 'client_id'
+            and 'status' ('ok', 'failed' or 'offline') as its upload finishes, then a
+            summary with the number of clients per status.
+            """
+            body = request.get_json(silent=True) or {}
+            path, clientIds = body.get('path'), body.get('clients')
+            if not path or not isinstance(clientIds, list) or not all(isinstance(clientId, str) for clientId in clientIds):
+                return self._failWithReason('invalid parameters for bulkupload', error_code=400)
+            try:
+                stagedPath = self.staging.path(body.get('hash'))
+            except StagedFileNotFoundError:
+                return self._failWithReason('file not staged', error_code=404)
+            results = pushToClients(self.fserver, stagedPath, body['hash'], path, list(dict.fromkeys(clientIds)),
+                                    bool(body.get('delta')), self.bulkUploadWorkers)
+
+            def lines():
+                counts = {}
+                with closing(results):
+                    for result in results:
+                        counts[result['status']] = counts.get(result['status'], 0) + 1
+                        yield json.dumps(result) + '\n'
+                yield json.dumps({'request_status': 'ok', 'summary': counts}) + '\n'
+            return Response(lines(), mimetype='application/x-ndjson')
+
     def start(self):
         """
         Starts the API server using the Waitress WSGI server.
         """
-        serve(self.app, host=self.host, port=self.port)
+        if self.sockets:
+            server = create_server(self.app, map=self.socketMap, sockets=self.sockets)
+        elif self.unixSocket is not None:
+            server = create_server(self.app, map=self.socketMap, unix_socket=self.unixSocket, unix_socket_perms='600')
+        else:
+            server = create_server(self.app, map=self.socketMap, host=self.host, port=self.port)
+        server.print_listen('Serving on http://{}:{}')
+        server.run()
+
+    def listeningSockets(self) -> list:
+        """
+        Returns:
+            list[socket.socket]: the sockets the running server accepts connections on
+        """
+        return [dispatcher.socket for dispatcher in list(self.socketMap.values()) if isinstance(dispatcher, BaseWSGIServer)]
@@ -0,0 +1,66 @@
+import threading
+from collections import OrderedDict
+
+import constants
+
+class CachedFile:
+    """
+    A file held by the FileCache, with the validator it was downloaded under.
+    """
+    def __init__(self, data: bytes, etag: str, mtime: float | None):
+        self.data = data
+        self.etag = etag
+        self.mtime = mtime
+
+class FileCache:
+    """
+    Least recently used cache of files downloaded from clients, keyed by client ID
+    and path, bounded both in the number of entries and in their total size. Entries
+    are only served after the client confirmed, by ETag, that the file is unchanged.
+    Thread-safe.
+
+    Args:
+        maxEntries (int): number of files kept at most
+        maxBytes (int): total size of the files kept at most
+        maxEntrySize (int, optional): larger files are not cached; defaults to an eighth of maxBytes
+    """
+    def __init__(self, maxEntries=constants.FILE_CACHE_ENTRIES, maxBytes=constants.FILE_CACHE_BYTES, maxEntrySize: int = None):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.maxEntrySize = maxBytes // 8 if maxEntrySize is None else min(maxEntrySize, maxBytes)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def get(self, clientId: str, path: str) -> CachedFile | None:
+        with self.lock:
+            entry = self.entries.get((clientId, path))
+            if entry is not None:
+                self.entries.move_to_end((clientId, path))
+            return entry
+
+    def put(self, clientId: str, path: str, entry: CachedFile) -> bool:
+        """
+        Stores a file, evicting the least recently used ones as needed.
+
+        Returns:
+            bool: False if the file is too large to be cached
+        """
+        if len(entry.data) > self.maxEntrySize:
+            return False
+        with self.lock:
+            self._remove((clientId, path))
+            self.entries[(clientId, path)] = entry
+            self.size += len(entry.data)
+            while len(self.entries) > self.maxEntries or self.size > self.maxBytes:
+                self._remove(next(iter(self.entries)))
+        return True
+
+    def invalidate(self, clientId: str, path: str):
+        with self.lock:
+            self._remove((clientId, path))
+
+    def _remove(self, key: tuple):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= len(entry.data)
@@ -0,0 +1,171 @@
+import http.client
+import json
+import queue
+import socket
+import threading
+import urllib.parse
+from contextlib import closing
+
+from flask import request, Response
+
+from apiserver.apiserver import ApiServer
+from server.staging import StagedFileNotFoundError
+from server.workerpool import WorkerPool
+import constants
+
+# Headers that only concern one connection and are not forwarded
+HOP_BY_HOP_HEADERS = {'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization', 'te', 'trailers',
+                      'transfer-encoding', 'upgrade', 'host'}
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTP connection to a server listening on a Unix socket.
+
+    Args:
+        path (str): path of the socket
+    """
+    def __init__(self, path: str):
+        super().__init__('localhost', blocksize=constants.WORKER_RELAY_SIZE)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+    def abort(self):
+        """ Breaks off a request from another thread, waking up a blocked read. """
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+class RoutingApiServer(ApiServer):
+    """
+    API server of a server running worker processes (see WorkerPool). Requests for
+    a client are forwarded, streamed both ways, to the API server of the worker the
+    client is connected to; bulk uploads are split by worker and their results
+    merged. Staged files are stored here, in the staging directory the workers share.
+
+    Args:
+        workers (WorkerPool): the worker processes
+        **kwargs: as for ApiServer
+    """
+    def __init__(self, workers: WorkerPool, **kwargs):
+        self.workers = workers
+        super().__init__(workers, **kwargs)
+
+    def _setup_routes(self):
+        super()._setup_routes()
+        for rule in self.app.url_map.iter_rules():
+            if 'clientId' in rule.arguments:
+                self.app.view_functions[rule.endpoint] = self._forward
+        self.app.view_functions['bulkUpload'] = self._bulkUpload
+
+    def _forward(self, clientId: str, **kwargs):
+        """
+        Forwards the current request to the worker the client is connected to.
+        """
+        worker = self.workers.ownerOf(clientId)
+        if worker is None:
+            return self._failWithReason('client not found', error_code=404)
+        url = urllib.parse.quote(request.path)
+        if request.query_string:
+            url += '?' + request.query_string.decode()
+        headers = {name: value for name, value in request.headers.items() if name.lower() not in HOP_BY_HOP_HEADERS}
+        connection = UnixHTTPConnection(self.workers.socketPath(worker))
+        try:
+            # The request body is read as it is sent, not buffered here
+            connection.request(request.method, url, request.stream if request.content_length else None, headers)
+            response = connection.getresponse()
+        except OSError as e:
+            connection.close()
+            self.logger.error(f'Forwarding {request.path} to worker {worker} failed: {e}')
+            return self._failWithReason('worker unavailable', error_code=502)
+
+        def chunks():
+            try:
+                while chunk := response.read(constants.WORKER_RELAY_SIZE):
+                    yield chunk
+            finally:
+                connection.close()
+        headers = [(name, value) for name, value in response.getheaders() if name.lower() not in HOP_BY_HOP_HEADERS]
+        return Response(chunks(), status=response.status, headers=headers, direct_passthrough=True)
+
+    def _bulkUpload(self):
+        """
+        Sends each worker a bulk upload for its clients and merges the results they
+        stream back, in the format of ApiServer's bulkupload.
+        """
+        body = request.get_json(silent=True) or {}
+        path, clientIds = body.get('path'), body.get('clients')
+        if not path or not isinstance(clientIds, list) or not all(isinstance(clientId, str) for clientId in clientIds):
+            return self._failWithReason('invalid parameters for bulkupload', error_code=400)
+        try:
+            self.staging.path(body.get('hash'))
+        except StagedFileNotFoundError:
+            return self._failWithReason('file not staged', error_code=404)
+        offline = []
+        byWorker = {}
+        for clientId in dict.fromkeys(clientIds):
+            worker = self.workers.ownerOf(clientId)
+            if worker is None:
+                offline.append(clientId)
+            else:
+                byWorker.setdefault(worker, []).append(clientId)
+        headers = {'Content-Type': 'application/json'}
+        if request.headers.get('X-Api-Secret') is not None:
+            headers['X-Api-Secret'] = request.headers['X-Api-Secret']
+        results = queue.Queue()
+        connections = {worker: UnixHTTPConnection(self.workers.socketPath(worker)) for worker in byWorker}
+
+        def forward(worker: int, workerClientIds: list):
+            reported = set()
+            connection = connections[worker]
+            try:
+                connection.request('POST', '/bulkupload', json.dumps({**body, 'clients': workerClientIds}), headers)
+                response = connection.getresponse()
+                if response.status != 200:
+                    raise ValueError(f'status {response.status}')
+                for line in response:
+                    result = json.loads(line)
+                    if 'client_id' in result:
+                        reported.add(result['client_id'])
+                        results.put(result)
+            except (OSError, ValueError) as e:
+                self.logger.warning(f'Bulk upload through worker {worker} failed: {e}')
+            finally:
+                connection.close()
+                for clientId in workerClientIds:
+                    if clientId not in reported:
+                        results.put({'client_id': clientId, 'status': 'failed'})
+                results.put(None)
+
+        def mergedResults():
+            for clientId in offline:
+                yield {'client_id': clientId, 'status': 'offline'}
+            threads = [threading.Thread(target=forward, args=item, name='FlitifyBulkUploadRoute', daemon=True)
+                       for item in byWorker.items()]
+            for thread in threads:
+                thread.start()
+            try:
+                remaining = len(threads)
+                while remaining:
+                    result = results.get()
+                    if result is None:
+                        remaining -= 1
+                    else:
+                        yield result
+            finally:
+                # A client that stopped reading cancels the uploads not yet started, like in ApiServer
+                for connection in connections.values():
+                    connection.abort()
+
+        def lines():
+            counts = {}
+            with closing(mergedResults()) as merged:
+                for result in merged:
+                    counts[result['status']] = counts.get(result['status'], 0) + 1
+                    yield json.dumps(result) + '\n'
+            yield json.dumps({'request_status': 'ok', 'summary': counts}) + '\n'
+        return Response(lines(), mimetype='application/x-ndjson')
@@ -0,0 +1,78 @@
+"""
+Session cipher throughput benchmark: encrypting and decrypting one frame with
+each cipher suite, as sendEncryptedLarge and recvEncryptedLarge do.
+
+    eax (old)  CryptoHelperAES, decrypt() returning a new buffer (the previous receive path)
+    eax        CryptoHelperAES, decrypted in place
+    gcm        CryptoHelperAEAD with AES-256-GCM, counter nonces, decrypted in place
+    chacha20   CryptoHelperAEAD with ChaCha20-Poly1305, counter nonces, decrypted in place
+
+Usage (from the app/ directory):
+    python -m benchmarks.bench_ciphers [--sizes 64,1K,16K,1M,16M] [--seconds 0.5]
+
+Figures are MB/s of plaintext through encryption plus decryption on one core.
+"""
+import argparse
+import time
+
+from crypto.cryptohelper import CryptoHelperAES, CryptoHelperAEAD
+from benchmarks.bench_recvlarge import parseSize, formatSize, UNITS
+
+KEY = bytes(range(32))
+
+
+def legacyRoundTrip(payload: bytes):
+    cipher = CryptoHelperAES(KEY)
+
+    def roundTrip():
+        frame = bytearray(b''.join(cipher.encryptParts(payload)))
+        return cipher.decrypt(memoryview(frame))
+    return roundTrip
+
+
+def inPlaceRoundTrip(sender, receiver, payload: bytes):
+    def roundTrip():
+        frame = bytearray(b''.join(sender.encryptParts(payload)))
+        return receiver.decryptInPlace(frame)
+    return roundTrip
+
+
+def suites(payload: bytes) -> dict:
+    eax = CryptoHelperAES(KEY)
+    return {
+        'eax (old)': legacyRoundTrip(payload),
+        'eax': inPlaceRoundTrip(eax, eax, payload),
+        'gcm': inPlaceRoundTrip(CryptoHelperAEAD(KEY, 'aes-256-gcm', False), CryptoHelperAEAD(KEY, 'aes-256-gcm', True), payload),
+        'chacha20': inPlaceRoundTrip(CryptoHelperAEAD(KEY, 'chacha20-poly1305', False), CryptoHelperAEAD(KEY, 'chacha20-poly1305', True), payload),
+    }
+
+
+def measure(roundTrip, size: int, seconds: float) -> float:
+    """ Returns the throughput (MB/s) of round trips run for about the given time. """
+    count = 0
+    start = time.perf_counter()
+    while True:
+        roundTrip()
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return count * size / elapsed / UNITS['M']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='64,1K,16K,1M,16M', help='comma separated frame sizes')
+    parser.add_argument('--seconds', type=float, default=0.5, help='measuring time per suite and size')
+    args = parser.parse_args()
+
+    names = list(suites(b'').keys())
+    print(f"{'frame size':>10} | " + ' | '.join(f'{name:>10}' for name in names))
+    print('-' * (13 + 13 * len(names)))
+    for size in map(parseSize, args.sizes.split(',')):
+        payload = b'\xab' * size
+        rates = [measure(roundTrip, size, args.seconds) for roundTrip in suites(payload).values()]
+        print(f'{formatSize(size):>10} | ' + ' | '.join(f'{rate:>10.1f}' for rate in rates))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Message encoding benchmark: the JSON messages sent before binary envelopes were
+negotiated against binary envelopes, for the messages a session is made of.
+
+    ping       a keepalive action without data
+    status     a status response as reported by the OS agents
+    file       a file_send response carrying a file (base64 in JSON, a raw attachment in an envelope)
+
+Usage (from the app/ directory):
+    python -m benchmarks.bench_envelope [--file-size 10M] [--seconds 0.5]
+
+Encode and decode figures are microseconds per message on one core, decode
+including the base64 decoding of file contents; wire is the plaintext size.
+"""
+import argparse
+import base64
+import json
+import os
+import time
+
+from network.protocolconnection import encodeMessage
+from network.envelope import decodeMessage, bytesField
+from benchmarks.bench_recvlarge import parseSize, formatSize
+
+STATUS = {
+    'uptime_seconds': 864213,
+    'current_user': 'operator',
+    'cpu_usage': 12.5,
+    'memory_total': 15.53,
+    'memory_used': 6.21,
+    'disks': {f'/dev/sda{n}': {'used': 120.4, 'total': 465.76} for n in range(1, 4)},
+    'running_apps': {name: {'name': name, 'open_windows': 1} for name in
+                     ['systemd', 'bash', 'sshd', 'python3', 'firefox', 'code', 'dbus-daemon', 'pipewire']},
+}
+
+
+def messages(fileSize: int) -> dict:
+    """ Returns, for each message, its type and data in the JSON and in the binary form. """
+    fileData = os.urandom(fileSize)
+    return {
+        'ping': ('ping', {}, {}),
+        'status': ('status', STATUS, STATUS),
+        'file': ('file_send', {'status': 'ok', 'filedata': base64.b64encode(fileData).decode()}, {'status': 'ok', 'filedata': fileData}),
+    }
+
+
+def measure(function, seconds: float) -> float:
+    """ Returns the microseconds per call of a function run for about the given time. """
+    count = 0
+    start = time.perf_counter()
+    while True:
+        function()
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return elapsed / count * 1e6
+
+
+def run(messageType: str, data: dict, binary: bool, seconds: float) -> tuple[float, float, int]:
+    encoded = encodeMessage(messageType, data, 1, binary)
+
+    def decode():
+        message = decodeMessage(encoded)
+        if 'filedata' in message['data']:
+            bytesField(message['data']['filedata'])
+    return measure(lambda: encodeMessage(messageType, data, 1, binary), seconds), measure(decode, seconds), len(encoded)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--file-size', default='10M', help='size of the file message')
+    parser.add_argument('--seconds', type=float, default=0.5, help='measuring time per message and encoding')
+    args = parser.parse_args()
+
+    print(f"{'message':>8} | {'encoding':>8} | {'encode us':>10} | {'decode us':>10} | {'wire':>10}")
+    print('-' * 58)
+    for name, (messageType, jsonData, binaryData) in messages(parseSize(args.file_size)).items():
+        for encoding, data, binary in (('json', jsonData, False), ('binary', binaryData, True)):
+            encode, decode, size = run(messageType, data, binary, args.seconds)
+            print(f'{name:>8} | {encoding:>8} | {encode:>10.1f} | {decode:>10.1f} | {formatSize(size):>10}')
+
+
+if __name__ == '__main__':
+    main()
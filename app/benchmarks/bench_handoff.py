@@ -0,0 +1,108 @@
+"""
+Cost of a deploy for each number of connected agents in turn: reconnecting all of
+them, which is what restarting the server costs, against handing them over to a new
+process (see server.handoff).
+
+A server runs in a separate process with a HandoffListener; the agents connect to
+it from --threads threads, which is timed as the reconnect. This process then takes
+the server over and continues every agent's session in its own FlitifyServer; the
+handoff is timed from the request until the last connection is served again, with
+the CPU time this process spent on it.
+
+Usage (from the app/ directory):
+    python -m benchmarks.bench_handoff [--agents 100,500,1000] [--threads 16] [--key-exchange compact]
+
+The reconnect grows with the fleet by a handshake per agent; the handoff only by
+passing a socket and a few hundred bytes of session state per agent, and the agents
+neither notice it nor spend anything on it.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import socket
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from Crypto.PublicKey import RSA
+
+from benchmarks.bench_handshake import AnySecretDB
+from benchmarks.bench_workers import freePort, waitForPort
+from network.protocolconnection import ClientProtocolConnection
+from server.flitifyserver import FlitifyServer
+from server.handoff import HandoffListener, takeOver
+from server.keepalivescheduler import KeepAliveScheduler
+
+
+def runServer(path, port, privateKey):
+    logging.getLogger('flitify').setLevel(logging.CRITICAL)
+    server = FlitifyServer('127.0.0.1', port, privateKey, AnySecretDB())
+    # The benchmark's agents do not answer pings, which would keep their connections busy
+    server.keepAlive = KeepAliveScheduler(interval=3600)
+    threading.Thread(target=server.start, daemon=True).start()
+    HandoffListener(path, server).start()
+    threading.Event().wait()
+
+
+def connectAgent(port, publicKey, keyExchange, clientId):
+    sock = socket.create_connection(('127.0.0.1', port))
+    return ClientProtocolConnection(sock, ('127.0.0.1', port), publicKey, clientId, 'bench', keyExchange=keyExchange)
+
+
+def measure(count, privateKey, publicKey, keyExchange, threads) -> tuple[float, float, float]:
+    path = os.path.join(tempfile.mkdtemp(prefix='flitify-handoff-'), 'handoff.sock')
+    port = freePort()
+    process = multiprocessing.get_context('spawn').Process(target=runServer, args=(path, port, privateKey))
+    process.start()
+    agents = []
+    try:
+        waitForPort(port)
+        while not os.path.exists(path):
+            time.sleep(0.05)
+        started = time.perf_counter()
+        with ThreadPoolExecutor(threads) as pool:
+            agents = list(pool.map(lambda n: connectAgent(port, publicKey, keyExchange, f'agent{n}'), range(count)))
+        reconnect = time.perf_counter() - started
+
+        started, cpuStarted = time.perf_counter(), time.process_time()
+        takeover = takeOver(path)
+        server = FlitifyServer('127.0.0.1', 0, privateKey, AnySecretDB(), handshakeWorkers=0, listenSocket=takeover.listener)
+        adopted = sum(server.adoptConnection(sock, state) for sock, state in takeover.sessions)
+        while len(server.registry) < adopted:
+            time.sleep(0.001)
+        handoff, cpu = time.perf_counter() - started, time.process_time() - cpuStarted
+        if adopted != count:
+            raise SystemExit(f'only {adopted} of {count} agents were handed over')
+        server.sock.close()
+        return reconnect, handoff, cpu
+    finally:
+        for agent in agents:
+            agent.closeConnection()
+        process.kill()
+        process.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--agents', default='100,500,1000', help='comma separated numbers of agents')
+    parser.add_argument('--threads', type=int, default=16, help='threads connecting the agents')
+    parser.add_argument('--key-bits', type=int, default=2048)
+    parser.add_argument('--key-exchange', default='compact', choices=['compact', 'x25519', 'rsa'])
+    args = parser.parse_args()
+
+    logging.getLogger('flitify').setLevel(logging.CRITICAL)
+    key = RSA.generate(args.key_bits)
+    privateKey, publicKey = key.export_key(), key.publickey().export_key()
+
+    print(f'{args.key_bits}-bit key, {args.key_exchange} key exchange, {os.cpu_count()} CPUs')
+    print(f"{'agents':>7} | {'reconnect s':>11} | {'handoff s':>9} | {'handoff CPU s':>13}")
+    print('-' * 50)
+    for count in map(int, args.agents.split(',')):
+        reconnect, handoff, cpu = measure(count, privateKey, publicKey, args.key_exchange, args.threads)
+        print(f'{count:>7} | {reconnect:>11.2f} | {handoff:>9.3f} | {cpu:>13.3f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,154 @@
+"""
+Handshake rate benchmark for the threaded server's key exchange.
+
+Runs an accept loop with one thread per connection (like FlitifyServer) that
+performs the full ServerProtocolConnection handshake, while --procs helper
+processes reconnect as fast as they can for --duration seconds. Each mode is
+measured in turn:
+
+    legacy  the PEM key is imported per connection and decrypted in its thread
+    shared  the key is imported once, decryption still runs in the connection thread
+    pool    the key is imported once and decrypted in a CryptoHelperRSAPool
+    x25519  agents request the X25519 key exchange, no per-connection RSA work
+
+Usage (from the app/ directory):
+    python -m benchmarks.bench_handshake [--modes legacy,shared,pool,x25519] [--duration 10] [--procs 4] [--key-bits 4096] [--workers N]
+
+With clients on the same machine the end-to-end rate is partly bounded by the
+client side, so the server's CPU cost per key exchange is printed as well.
+
+The pool only pays off with more than one core: the GIL caps the legacy and
+shared modes at one core's worth of RSA decryptions however many threads run them.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import socket
+import threading
+import time
+
+from Crypto.PublicKey import RSA
+
+from crypto.cryptohelper import CryptoHelperRSA, CryptoHelperRSAPool, CryptoHelperX25519Client
+from network.protocolconnection import ServerProtocolConnection, ClientProtocolConnection
+
+
+class AnySecretDB:
+    def getSharedSecret(self, clientId):
+        return 'bench'
+
+
+def serve(listener, rsa, stop):
+    def handle(sock, addr):
+        connection = ServerProtocolConnection(sock, addr, rsa, AnySecretDB())
+        connection.closeConnection()
+
+    while not stop.is_set():
+        try:
+            sock, addr = listener.accept()
+        except OSError:
+            return
+        threading.Thread(target=handle, args=(sock, addr), daemon=True).start()
+
+
+def clientProcess(port, publicKey, keyExchange, threads, deadline, completed):
+    logging.getLogger('flitify').setLevel(logging.CRITICAL)
+
+    def loop():
+        while time.time() < deadline:
+            sock = socket.create_connection(('127.0.0.1', port))
+            try:
+                ClientProtocolConnection(sock, ('127.0.0.1', port), publicKey, 'bench', 'bench', keyExchange=keyExchange).closeConnection()
+                with completed.get_lock():
+                    completed.value += 1
+            except Exception:
+                sock.close()
+
+    workers = [threading.Thread(target=loop) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+
+def measure(rsa, publicKey, keyExchange, duration, procs, threads) -> float:
+    listener = socket.create_server(('127.0.0.1', 0), backlog=1024)
+    port = listener.getsockname()[1]
+    stop = threading.Event()
+    threading.Thread(target=serve, args=(listener, rsa, stop), daemon=True).start()
+
+    completed = multiprocessing.Value('i', 0)
+    deadline = time.time() + duration
+    clients = [multiprocessing.Process(target=clientProcess, args=(port, publicKey, keyExchange, threads, deadline, completed))
+               for _ in range(procs)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    stop.set()
+    listener.close()
+    return completed.value / duration
+
+
+def measureServerCost(privateKey, publicKey, rounds=50) -> tuple[float, float]:
+    """
+    Returns:
+        tuple[float, float]: server CPU milliseconds per RSA and per X25519 key exchange
+    """
+    server, client = CryptoHelperRSA(privateKey), CryptoHelperRSA(publicKey)
+    encrypted = client.encrypt(bytes(32))
+    start = time.process_time()
+    for _ in range(rounds):
+        server.decrypt(encrypted)
+    rsaCost = (time.process_time() - start) / rounds * 1000
+    x25519 = server.getX25519Server()
+    hello = CryptoHelperX25519Client(client).publicKey
+    start = time.process_time()
+    for _ in range(rounds):
+        x25519.respond(hello)
+    return rsaCost, (time.process_time() - start) / rounds * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', default='legacy,shared,pool,x25519')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--procs', type=int, default=4, help='client processes')
+    parser.add_argument('--threads', type=int, default=8, help='connecting threads per client process')
+    parser.add_argument('--key-bits', type=int, default=4096)
+    parser.add_argument('--workers', type=int, default=None, help='pool size (defaults to the CPU count)')
+    args = parser.parse_args()
+
+    logging.getLogger('flitify').setLevel(logging.CRITICAL)
+    key = RSA.generate(args.key_bits)
+    privateKey, publicKey = key.export_key(), key.publickey().export_key()
+
+    print(f'{args.key_bits}-bit key, {os.cpu_count()} CPUs, {args.procs}x{args.threads} connecting threads')
+    rsaCost, x25519Cost = measureServerCost(privateKey, publicKey)
+    print(f'server CPU per key exchange: RSA {rsaCost:.2f} ms, X25519 {x25519Cost:.2f} ms')
+    print(f"{'mode':>8} | {'handshakes/s':>12}")
+    print('-' * 23)
+    for mode in args.modes.split(','):
+        pool = None
+        keyExchange = 'rsa'
+        if mode == 'legacy':
+            rsa = privateKey
+        elif mode == 'shared':
+            rsa = CryptoHelperRSA(privateKey)
+        elif mode == 'pool':
+            rsa = pool = CryptoHelperRSAPool(privateKey, args.workers)
+        elif mode == 'x25519':
+            rsa = CryptoHelperRSA(privateKey)
+            rsa.getX25519Server()
+            keyExchange = 'x25519'
+        else:
+            raise SystemExit(f'unknown mode: {mode}')
+        rate = measure(rsa, publicKey, keyExchange, args.duration, args.procs, args.threads)
+        print(f'{mode:>8} | {rate:>12.1f}')
+        if pool is not None:
+            pool.shutdown()
+
+
+if __name__ == '__main__':
+    main()
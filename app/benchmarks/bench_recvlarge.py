@@ -0,0 +1,95 @@
+"""
+Receive-path throughput benchmark: legacy concatenating recvLarge vs the
+preallocated recv_into implementation in BaseConnection.
+
+Usage (from the app/ directory):
+    python -m benchmarks.bench_recvlarge [--sizes 1K,1M,64M,512M] [--legacy-max 64M] [--rounds 3]
+
+The legacy path is quadratic in the frame size; at 512 MB it runs for many
+minutes, so it is skipped above --legacy-max unless asked for explicitly.
+"""
+import argparse
+import socket
+import threading
+import time
+
+from network.baseconnection import BaseConnection
+
+UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parseSize(text: str) -> int:
+    text = text.strip().upper()
+    if text[-1] in UNITS:
+        return int(text[:-1]) * UNITS[text[-1]]
+    return int(text)
+
+
+def formatSize(size: int) -> str:
+    for unit in ('G', 'M', 'K'):
+        if size >= UNITS[unit] and size % UNITS[unit] == 0:
+            return f'{size // UNITS[unit]} {unit}B'
+    return f'{size} B'
+
+
+def legacyRecvLarge(connection: BaseConnection) -> bytes:
+    """ The original recvLarge implementation, kept here as the baseline. """
+    size_bytes = connection.recvRaw(4)
+    size = int.from_bytes(size_bytes, 'big')
+    data = b''
+    while len(data) < size:
+        data += connection.recvRaw(size - len(data))
+    return data
+
+
+def sendFrames(connection: BaseConnection, payload: bytes, count: int):
+    for _ in range(count):
+        connection.sendLarge(payload)
+
+
+def measure(recvFunc, payload: bytes, rounds: int) -> float:
+    """ Returns the best throughput (MB/s) over the given number of rounds. """
+    # Small frames are sent in batches so that thread start-up does not dominate
+    count = max(1, (16 * UNITS['M']) // max(len(payload), 1)) if len(payload) < UNITS['M'] else 1
+    best = 0.0
+    for _ in range(rounds):
+        a, b = socket.socketpair()
+        sender = BaseConnection(a, ('bench', 1))
+        receiver = BaseConnection(b, ('bench', 2), maxFrameSize=len(payload))
+        thread = threading.Thread(target=sendFrames, args=(sender, payload, count))
+        start = time.perf_counter()
+        thread.start()
+        for _ in range(count):
+            received = recvFunc(receiver)
+            assert len(received) == len(payload)
+        elapsed = time.perf_counter() - start
+        thread.join()
+        a.close()
+        b.close()
+        best = max(best, count * len(payload) / elapsed / 1024 ** 2)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1K,1M,64M,512M', help='comma separated frame sizes')
+    parser.add_argument('--legacy-max', default='64M', help='skip the (quadratic) legacy path above this size')
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+    legacyMax = parseSize(args.legacy_max)
+
+    print(f"{'frame size':>10} | {'legacy MB/s':>12} | {'recv_into MB/s':>14} | {'speedup':>8}")
+    print('-' * 54)
+    for size in map(parseSize, args.sizes.split(',')):
+        payload = b'\xab' * size
+        rounds = args.rounds if size < 64 * UNITS['M'] else 1
+        new = measure(BaseConnection.recvLarge, payload, rounds)
+        if size <= legacyMax:
+            old = measure(legacyRecvLarge, payload, rounds)
+            print(f'{formatSize(size):>10} | {old:>12.1f} | {new:>14.1f} | {new / old:>7.1f}x')
+        else:
+            print(f'{formatSize(size):>10} | {"skipped":>12} | {new:>14.1f} | {"-":>8}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Handshake rate of a server running in worker processes (see WorkerPool), for each
+worker count in turn. Every worker runs a FlitifyServer sharing the port through
+SO_REUSEPORT and publishing its clients to a shared WorkerDirectory, as in
+server_main; --procs helper processes reconnect as fast as they can for --duration
+seconds.
+
+Usage (from the app/ directory):
+    python -m benchmarks.bench_workers [--workers 1,2,4] [--duration 10] [--procs 4] [--key-exchange compact]
+
+One worker is the single-process server. The rate grows with the workers up to the
+number of cores left over by the client processes; on a single core it stays flat.
+Encrypted transfers are spread the same way, as each agent's connection is served
+entirely by the worker that accepted it.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import socket
+import time
+
+from Crypto.PublicKey import RSA
+
+from benchmarks.bench_handshake import AnySecretDB, clientProcess
+from server.flitifyserver import FlitifyServer
+from server.sharedregistry import WorkerDirectory, SharedClientRegistry
+from server.workerpool import WorkerPool
+
+
+def runWorker(worker, directoryPath, socketPath, port, privateKey):
+    logging.getLogger('flitify').setLevel(logging.CRITICAL)
+    registry = SharedClientRegistry(WorkerDirectory(directoryPath), worker)
+    server = FlitifyServer('127.0.0.1', port, privateKey, AnySecretDB(), handshakeWorkers=0, registry=registry, reusePort=True)
+    server.start()
+
+
+def freePort() -> int:
+    with socket.create_server(('127.0.0.1', 0)) as probe:
+        return probe.getsockname()[1]
+
+
+def waitForPort(port: int, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return
+        except ConnectionRefusedError:
+            time.sleep(0.05)
+    raise SystemExit(f'workers did not start listening on port {port}')
+
+
+def measure(count, privateKey, publicKey, keyExchange, duration, procs, threads) -> float:
+    port = freePort()
+    pool = WorkerPool(count, lambda *args: runWorker(*args, port, privateKey), privateKey)
+    pool.start()
+    try:
+        waitForPort(port)
+        # Give every worker the time to bind before the kernel starts spreading connections
+        time.sleep(0.5)
+        completed = multiprocessing.Value('i', 0)
+        deadline = time.time() + duration
+        clients = [multiprocessing.Process(target=clientProcess, args=(port, publicKey, keyExchange, threads, deadline, completed))
+                   for _ in range(procs)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        return completed.value / duration
+    finally:
+        pool.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', default='1,2,4', help='comma separated worker counts')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--procs', type=int, default=4, help='client processes')
+    parser.add_argument('--threads', type=int, default=8, help='connecting threads per client process')
+    parser.add_argument('--key-bits', type=int, default=2048)
+    parser.add_argument('--key-exchange', default='compact', choices=['compact', 'x25519', 'rsa'])
+    args = parser.parse_args()
+
+    logging.getLogger('flitify').setLevel(logging.CRITICAL)
+    key = RSA.generate(args.key_bits)
+    privateKey, publicKey = key.export_key(), key.publickey().export_key()
+
+    print(f'{args.key_bits}-bit key, {args.key_exchange} key exchange, {os.cpu_count()} CPUs, {args.procs}x{args.threads} connecting threads')
+    print(f"{'workers':>8} | {'handshakes/s':>12}")
+    print('-' * 23)
+    for count in map(int, args.workers.split(',')):
+        rate = measure(count, privateKey, publicKey, args.key_exchange, args.duration, args.procs, args.threads)
+        print(f'{count:>8} | {rate:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
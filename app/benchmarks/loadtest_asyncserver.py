@@ -0,0 +1,175 @@
+"""
+Idle-agent load test for the asyncio server engine.
+
+Starts an AsyncFlitifyServer in this process, connects --agents simulated agents
+from --procs helper processes (each a single asyncio loop that performs the real
+handshake and answers keepalive pings), then holds them connected and reports the
+server's resident memory, thread count and ping latency.
+
+Usage (from the app/ directory):
+    python -m benchmarks.loadtest_asyncserver [--agents 20000] [--procs 4] [--hold 30] [--key-bits 2048]
+
+Every connection needs a file descriptor on both sides: raise `ulimit -n` above
+the agent count first. The load test defaults to a 2048-bit key so the connect
+phase is not dominated by RSA; pass --key-bits 4096 to match production.
+
+On one CPU with a hard descriptor limit of 20000, which leaves room for 19800
+agents, --agents 19800 --keepalive 60 --connect-timeout 3600 connected every
+agent in 167 s and kept all of them through a 60 s hold, the server with 10
+threads and 201 MiB resident (8.9 KiB per agent), API pings taking 1.9 ms at
+the median and 626 ms at most. With the default 2 s keepalive that CPU, shared
+with the simulated agents, cannot even keep up with the pings.
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import random
+import resource
+import statistics
+import threading
+import time
+
+import psutil
+from Crypto.PublicKey import RSA
+
+from crypto.cryptohelper import CryptoHelperRSA, CryptoHelperAES
+from network.baseconnection import FRAME_HEADER_SIZE, encodeFrameHeader
+from network.protocolconnection import encodeMessage, parseResponse
+from network.secureconnection import GREETING, HANDSHAKE_PING, HANDSHAKE_PONG
+from server.asyncflitifyserver import AsyncFlitifyServer
+
+AGENT_SECRET = 'loadtest'
+
+
+class AnySecretDB:
+    def getSharedSecret(self, clientId):
+        return AGENT_SECRET
+
+
+def raiseFileLimit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+async def runAgent(host, port, rsa, clientId, localAddr, handshakeSlots, connected):
+    async with handshakeSlots:
+        reader, writer = await asyncio.open_connection(host, port, local_addr=localAddr)
+
+        async def recv():
+            header = await reader.readexactly(FRAME_HEADER_SIZE)
+            return await reader.readexactly(int.from_bytes(header, 'big'))
+
+        def send(*parts):
+            writer.writelines((encodeFrameHeader(sum(len(part) for part in parts)), *parts))
+
+        if (await recv()).decode() != GREETING:
+            raise RuntimeError('unexpected greeting')
+        aes = CryptoHelperAES()
+        send(rsa.encrypt(aes.key))
+        if aes.decrypt(await recv()) != HANDSHAKE_PING:
+            raise RuntimeError('unexpected handshake message')
+        send(*aes.encryptParts(HANDSHAKE_PONG))
+        challenge = aes.decrypt(await recv()).decode().split(':')[1]
+        send(*aes.encryptParts(f'{clientId}:{AGENT_SECRET}:{challenge}'.encode()))
+        if aes.decrypt(await recv()) != b'AUTH_CORRECT':
+            raise RuntimeError('authentication failed')
+    with connected.get_lock():
+        connected.value += 1
+    while True:
+        action = parseResponse(aes.decrypt(await recv()))
+        if action['type'] == 'ping':
+            send(*aes.encryptParts(encodeMessage('pong', {}, action['seq'])))
+            await writer.drain()
+
+
+def agentProcess(host, port, publicKey, clientIds, connected, failed):
+    raiseFileLimit()
+
+    async def main():
+        rsa = CryptoHelperRSA(publicKey)
+        handshakeSlots = asyncio.Semaphore(64)
+        tasks = []
+        for i, clientId in enumerate(clientIds):
+            # Spread source addresses over 127.0.0.0/8 so ephemeral ports never run out
+            localAddr = (f'127.0.{(i // 250) % 250}.{2 + i % 250}', 0) if host.startswith('127.') else None
+            tasks.append(asyncio.create_task(runAgent(host, port, rsa, clientId, localAddr, handshakeSlots, connected)))
+        for result in await asyncio.gather(*tasks, return_exceptions=True):
+            if isinstance(result, Exception):
+                with failed.get_lock():
+                    failed.value += 1
+
+    asyncio.run(main())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--agents', type=int, default=20000)
+    parser.add_argument('--procs', type=int, default=4, help='agent simulator processes')
+    parser.add_argument('--hold', type=float, default=30, help='seconds to keep the agents connected')
+    parser.add_argument('--connect-timeout', type=float, default=600)
+    parser.add_argument('--key-bits', type=int, default=2048)
+    parser.add_argument('--keepalive', type=float, default=None, help='keepalive interval (defaults to constants.INTERVAL)')
+    args = parser.parse_args()
+
+    logging.getLogger('flitify').setLevel(logging.WARNING)
+    fileLimit = raiseFileLimit()
+    if fileLimit < args.agents + 64:
+        print(f'[!] RLIMIT_NOFILE is {fileLimit}, the server cannot hold {args.agents} agents; raise ulimit -n')
+
+    key = RSA.generate(args.key_bits)
+    serverKwargs = {} if args.keepalive is None else {'keepAliveInterval': args.keepalive}
+    server = AsyncFlitifyServer('127.0.0.1', 0, key.export_key(), AnySecretDB(), **serverKwargs)
+    threading.Thread(target=server.start, daemon=True).start()
+    while not server.running:
+        time.sleep(0.01)
+    process = psutil.Process()
+    baseRss = process.memory_info().rss
+
+    connected = multiprocessing.Value('i', 0)
+    failed = multiprocessing.Value('i', 0)
+    clientIds = [f'agent-{i}' for i in range(args.agents)]
+    procs = []
+    for n in range(args.procs):
+        proc = multiprocessing.Process(target=agentProcess, daemon=True,
+                                       args=('127.0.0.1', server.port, key.publickey().export_key(), clientIds[n::args.procs], connected, failed))
+        proc.start()
+        procs.append(proc)
+
+    start = time.monotonic()
+    while len(server.getClientList()) < args.agents and time.monotonic() - start < args.connect_timeout:
+        time.sleep(0.5)
+        print(f'\r[*] connected: {len(server.getClientList())}/{args.agents} (agent failures: {failed.value})', end='', flush=True)
+    connectTime = time.monotonic() - start
+    print()
+
+    minimum = len(server.getClientList())
+    holdStart = time.monotonic()
+    while time.monotonic() - holdStart < args.hold:
+        time.sleep(0.5)
+        minimum = min(minimum, len(server.getClientList()))
+
+    latencies = []
+    for clientId in random.sample(server.getClientList(), min(100, len(server.getClientList()))):
+        client = server.getClientById(clientId)
+        if client is None:
+            continue
+        t = time.perf_counter()
+        if client.ping():
+            latencies.append((time.perf_counter() - t) * 1000)
+    rss = process.memory_info().rss
+
+    print(f'agents requested        : {args.agents}')
+    print(f'agents connected        : {len(server.getClientList())} (minimum during {args.hold:.0f}s hold: {minimum})')
+    print(f'time to connect all     : {connectTime:.1f} s')
+    print(f'server threads          : {threading.active_count()}')
+    print(f'server RSS              : {rss / 1024 ** 2:.0f} MiB ({(rss - baseRss) / max(minimum, 1) / 1024:.1f} KiB per agent)')
+    if latencies:
+        print(f'API ping latency        : median {statistics.median(latencies):.1f} ms, max {max(latencies):.1f} ms')
+    for proc in procs:
+        proc.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+"""
+Reconnect storm simulation: how long a restarted server takes to get its agents back
+online when all of them lost it at the same moment.
+
+A discrete-event simulation, so it runs 10k agents in seconds on one machine. The
+server has --cores cores and a full handshake costs --handshake-ms of CPU; the
+handshakes running at once share the cores equally. An agent abandons a handshake
+that has not completed --timeout seconds after it connected (a timed out TCP
+connect, a middlebox dropping an idle connection), and the CPU spent on it is lost.
+The agents and the server use the real ReconnectBackoff and HandshakeAdmission.
+
+    fixed      agents retry CLIENT_RECONNECT_TIME after every failure, the server
+               runs every handshake at once (before admission control)
+    jitter     agents back off exponentially with full jitter, the server is unchanged
+    admission  agents back off with full jitter and follow BUSY, the server runs at
+               most --max-handshakes handshakes and turns the excess away
+
+Usage (from the app/ directory):
+    python -m benchmarks.sim_reconnect_storm [--agents 10000] [--cores 4] [--handshake-ms 5] [--timeout 10]
+
+Times are seconds after the restart; 'never' means the share of agents was not
+online within --horizon. Wasted CPU is spent on handshakes that were abandoned.
+"""
+import argparse
+import collections
+import heapq
+import itertools
+import math
+import random
+
+import constants
+from client.reconnect import ReconnectBackoff
+from server.admission import HandshakeAdmission
+
+MODES = ['fixed', 'jitter', 'admission']
+
+
+class FixedDelay:
+    """ The agents' reconnect delay before jittered backoff. """
+    def nextDelay(self, retryAfter=None):
+        return constants.CLIENT_RECONNECT_TIME
+
+    def reset(self):
+        pass
+
+
+class Simulation:
+    """
+    Args:
+        mode (str): one of MODES
+        args (argparse.Namespace): the command line arguments
+    """
+    def __init__(self, mode: str, args):
+        self.args = args
+        self.cost = args.handshake_ms / 1000
+        self.rng = random.Random(args.seed)
+        self.now = 0.0
+        self.events = []
+        self.sequence = itertools.count()
+        # Processor sharing: all running handshakes receive CPU at the same rate, so the CPU a
+        # handshake has received is this clock's advance since the handshake started
+        self.virtual = 0.0
+        self.running = {}
+        self.completions = []
+        self.queue = collections.deque()
+        # The agents' current connection attempts, None between attempts and once online
+        self.attemptOf = [None] * args.agents
+        self.admission = None
+        if mode == 'admission':
+            self.admission = HandshakeAdmission(args.max_handshakes, args.queue, args.deadline, clock=lambda: self.now)
+        if mode == 'fixed':
+            self.backoffs = [FixedDelay() for _ in range(args.agents)]
+        else:
+            self.backoffs = [ReconnectBackoff(rng=random.Random(self.rng.random())) for _ in range(args.agents)]
+        self.online = []
+        self.attempts = 0
+        self.refused = 0
+        self.abandoned = 0
+        self.wasted = 0.0
+        for agent in range(args.agents):
+            lost = self.rng.uniform(0, args.spread)
+            # The agents before this change waited out the fixed delay even for the first attempt
+            self.schedule(lost + self.backoffs[agent].nextDelay(), self.connect, agent)
+
+    def schedule(self, at: float, action, *arguments):
+        heapq.heappush(self.events, (at, next(self.sequence), action, arguments))
+
+    def rate(self) -> float:
+        """ CPU seconds per second each running handshake receives. """
+        return min(1.0, self.args.cores / len(self.running)) if self.running else 0.0
+
+    def advance(self, until: float):
+        self.virtual += self.rate() * (until - self.now)
+        self.now = until
+
+    def run(self) -> 'Simulation':
+        while len(self.online) < self.args.agents:
+            # Completions of abandoned handshakes stay in the heap until they come up
+            while self.completions and self.running.get(self.completions[0][2], (None,))[0] != self.completions[0][1]:
+                heapq.heappop(self.completions)
+            nextCompletion = math.inf
+            if self.completions:
+                nextCompletion = self.now + (self.completions[0][0] - self.virtual) / self.rate()
+            nextEvent = self.events[0][0] if self.events else math.inf
+            if min(nextCompletion, nextEvent) > self.args.horizon:
+                break
+            if nextCompletion <= nextEvent:
+                self.advance(nextCompletion)
+                _, _, agent = heapq.heappop(self.completions)
+                startedAt = self.running.pop(agent)[1]
+                self.attemptOf[agent] = None
+                self.online.append(self.now)
+                self.backoffs[agent].reset()
+                self.finish(self.now - startedAt)
+            else:
+                at, _, action, arguments = heapq.heappop(self.events)
+                self.advance(at)
+                action(*arguments)
+        return self
+
+    def connect(self, agent: int):
+        self.attempts += 1
+        attempt = self.attempts
+        self.attemptOf[agent] = attempt
+        self.schedule(self.now + self.args.timeout, self.abandon, agent, attempt)
+        if self.admission is None:
+            self.start(agent, attempt)
+        elif self.admission.admit():
+            self.queue.append((agent, attempt, self.now))
+            self.startQueued()
+        else:
+            # Turning an agent away costs one round trip and no cryptography
+            self.refused += 1
+            self.attemptOf[agent] = None
+            self.retry(agent, self.admission.retryAfter())
+
+    def start(self, agent: int, attempt: int):
+        self.running[agent] = (attempt, self.now, self.virtual)
+        heapq.heappush(self.completions, (self.virtual + self.cost, attempt, agent))
+
+    def startQueued(self):
+        while self.queue and len(self.running) < self.admission.maxHandshakes:
+            agent, attempt, acceptedAt = self.queue.popleft()
+            if self.attemptOf[agent] != attempt:
+                # The agent gave up while its connection was queued, the handshake fails at once
+                self.admission.finish()
+            elif self.now - acceptedAt >= self.admission.deadline:
+                self.admission.finish()
+                self.attemptOf[agent] = None
+                self.retry(agent)
+            else:
+                self.start(agent, attempt)
+
+    def finish(self, duration: float = None):
+        if self.admission is not None:
+            self.admission.finish(duration)
+            self.startQueued()
+
+    def abandon(self, agent: int, attempt: int):
+        if self.attemptOf[agent] != attempt:
+            return
+        self.attemptOf[agent] = None
+        self.abandoned += 1
+        entry = self.running.get(agent)
+        if entry is not None and entry[0] == attempt:
+            del self.running[agent]
+            self.wasted += self.virtual - entry[2]
+            self.finish()
+        self.retry(agent)
+
+    def retry(self, agent: int, retryAfter: float = None):
+        self.schedule(self.now + self.backoffs[agent].nextDelay(retryAfter), self.connect, agent)
+
+    def onlineAfter(self, share: float) -> float:
+        """
+        Returns:
+            float: seconds until the share of agents was online, inf if it never was
+        """
+        needed = math.ceil(share * self.args.agents)
+        return self.online[needed - 1] if len(self.online) >= needed else math.inf
+
+
+def formatTime(seconds: float) -> str:
+    return 'never' if seconds == math.inf else f'{seconds:.1f}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--modes', default=','.join(MODES), help='comma separated modes to simulate')
+    parser.add_argument('--agents', type=int, default=10000, help='agents connected when the server restarts')
+    parser.add_argument('--spread', type=float, default=1.0, help='seconds over which the agents notice the restart')
+    parser.add_argument('--cores', type=float, default=4, help='server cores running handshakes')
+    parser.add_argument('--handshake-ms', type=float, default=5.0, help='server CPU per full handshake')
+    parser.add_argument('--timeout', type=float, default=10.0, help='seconds after which an agent abandons a handshake')
+    parser.add_argument('--max-handshakes', type=int, default=constants.MAX_HANDSHAKES)
+    parser.add_argument('--queue', type=int, default=constants.HANDSHAKE_QUEUE)
+    parser.add_argument('--deadline', type=float, default=constants.HANDSHAKE_DEADLINE)
+    parser.add_argument('--horizon', type=float, default=600.0, help='seconds simulated at most')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"{'mode':>9} | {'50% s':>6} | {'95% s':>6} | {'100% s':>6} | {'attempts':>8} | {'refused':>7} | {'abandoned':>9} | {'wasted CPU s':>12}")
+    print('-' * 86)
+    for mode in args.modes.split(','):
+        sim = Simulation(mode, args).run()
+        print(f'{mode:>9} | {formatTime(sim.onlineAfter(0.5)):>6} | {formatTime(sim.onlineAfter(0.95)):>6} | '
+              f'{formatTime(sim.onlineAfter(1)):>6} | {sim.attempts:>8} | {sim.refused:>7} | {sim.abandoned:>9} | {sim.wasted:>12.1f}')
+
+
+if __name__ == '__main__':
+    main()
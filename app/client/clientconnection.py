@@ -2,30 +2,47 @@ import platform
 import logging
 import os
 import base64
+import hashlib
 import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+import constants
 from network.protocolconnection import ClientProtocolConnection
+from network.streams import StreamError
+from network.delta import chooseBlockSize, fileSignature
+from network.envelope import bytesField
+from client.filetransfer import FileUploadSink, DeltaUploadSink, fileETag, fileDigest, resolveRange
 from client.OSAgents.linux import LinuxAgent
 from client.OSAgents.windows import WindowsAgent
 
 DEFAULT_TIMEOUT=5
+DEFAULT_ACTION_WORKERS=4
+DEFAULT_MAX_PENDING_ACTIONS=16
 
 class ConnectionKickedError(Exception):
     pass
 
 class ClientConnection():
-    def __init__(self, connection:ClientProtocolConnection):
+    def __init__(self, connection:ClientProtocolConnection, actionWorkers=DEFAULT_ACTION_WORKERS, maxPendingActions=DEFAULT_MAX_PENDING_ACTIONS):
         """
         Initializes a client connection and starts the action loop.
         
         Args:
             connection (ClientProtocolConnection): The active protocol connection.
+            actionWorkers (int): Number of worker threads executing heavy actions.
+            maxPendingActions (int): Maximum number of heavy actions queued or running at once;
+                once reached, the action loop stops reading until a worker finishes.
 
         Raises:
             NotImplementedError: If the client's os is unsupported / not yet implemented.
         """
         self.connection = connection
         self.logger = logging.getLogger("flitifyclient")
+        self.executor = ThreadPoolExecutor(max_workers=actionWorkers, thread_name_prefix='FlitifyAction')
+        self.pendingActions = threading.BoundedSemaphore(max(maxPendingActions, actionWorkers))
+        # Streamed uploads by upload ID (the seq of their upload_stream action)
+        self.uploads = {}
         match platform.system():
             case "Linux":
                 self.osagent = LinuxAgent()
@@ -38,124 +55,405 @@ class ClientConnection():
     def _actionLoop(self):
         """
         Main loop for receiving and handling actions sent from the server.
+        Cheap actions are answered inline; heavy ones run on the worker pool and
+        answer with the seq of their action, possibly out of order.
         Runs until connection is closed or a fatal error occurs.
         """
-        while True:
-            if not self.connection.running:
-                self.logger.error(f'{self.connection.peerAddr}: connection closed during actionLoop')
-                break
-            command, commandData = self.connection.recvAction()
-            self.logger.debug(f'{self.connection.peerAddr}: received command {command}')
-            match command:
-                case 'kick':
-                    if 'reason' not in commandData:
-                        raise ValueError('kicked without reason')
-                    self.logger.error(f"{self.connection.peerAddr}: kicked by server: {commandData['reason']}")
-                    raise ConnectionKickedError(commandData['reason'])
-                    self.connection.closeConnection()
-                    return
-                case 'ping':
-                    self.connection.sendResponse('pong', {})
-                case 'get_status':
-                    status_dict = self.osagent.getStatus()
-                    self.connection.sendResponse('status', status_dict)
-                case 'list_dir':
-                    path = commandData.get('path', '/')
-                    self.getDirectoryListing(path)
-                case 'shell_command':
-                    command = commandData.get('command')
-                    if not command:
-                        self.connection.sendResponse('shell_response', {'status': 'failed'})
-                        raise ValueError("shell_command: command not found in server request")
-                    timeout = commandData.get('timeout', DEFAULT_TIMEOUT)
-                    self.executeShellCommand(command, timeout=timeout)
-                case 'get_file':
-                    if not 'path' in commandData:
-                        self.connection.sendResponse('file_send', {'status': 'failed'})
-                        raise ValueError("file_send: 'path' not found in server request")
-                    self.sendFile(commandData['path'])
-                case 'upload_file':
-                    path = commandData.get('path')
-                    filedata = commandData.get('filedata')
-                    if not path or not filedata:
-                        raise ValueError("upload_file: 'path' or 'filedata' missing")
-                    self.saveFile(path, filedata)
-                case _:
-                    self.connection.sendResponse('invalid_action', {})
-
-    def getDirectoryListing(self, path:str):
+        try:
+            while True:
+                if not self.connection.running:
+                    self.logger.error(f'{self.connection.peerAddr}: connection closed during actionLoop')
+                    break
+                action = self.connection.recvAction()
+                if action is None:
+                    continue
+                command, commandData = action
+                seq = self.connection.currentSeq
+                self.logger.debug(f'{self.connection.peerAddr}: received command {command} (seq {seq})')
+                match command:
+                    case 'kick':
+                        if 'reason' not in commandData:
+                            raise ValueError('kicked without reason')
+                        self.logger.error(f"{self.connection.peerAddr}: kicked by server: {commandData['reason']}")
+                        raise ConnectionKickedError(commandData['reason'])
+                    case 'ping':
+                        self.connection.sendResponse('pong', {}, seq)
+                    case 'get_status':
+                        self._submit(self.sendStatus, seq)
+                    case 'list_dir':
+                        path = commandData.get('path', '/')
+                        self._submit(self.getDirectoryListing, path, seq)
+                    case 'shell_command':
+                        command = commandData.get('command')
+                        if not command:
+                            self.connection.sendResponse('shell_response', {'status': 'failed'}, seq)
+                            raise ValueError("shell_command: command not found in server request")
+                        timeout = commandData.get('timeout', DEFAULT_TIMEOUT)
+                        self._submit(self.executeShellCommand, command, timeout, seq)
+                    case 'get_file':
+                        if not 'path' in commandData:
+                            self.connection.sendResponse('file_send', {'status': 'failed'}, seq)
+                            raise ValueError("file_send: 'path' not found in server request")
+                        if commandData.get('stream'):
+                            self._submit(self.streamFile, commandData['path'], seq, commandData.get('offset', 0),
+                                         commandData.get('length'), commandData.get('if_range'), commandData.get('if_none_match'))
+                        else:
+                            self._submit(self.sendFile, commandData['path'], seq)
+                    case 'upload_file':
+                        path = commandData.get('path')
+                        filedata = commandData.get('filedata')
+                        if not path or not filedata:
+                            raise ValueError("upload_file: 'path' or 'filedata' missing")
+                        self._submit(self.saveFile, path, filedata, seq)
+                    case 'upload_stream':
+                        path = commandData.get('path')
+                        size = commandData.get('size')
+                        if not path or not isinstance(size, int):
+                            self.connection.sendResponse('file_upload', {'status': 'failed'}, seq)
+                            continue
+                        self._submit(self.prepareUpload, path, size, seq, bool(commandData.get('resume')), commandData.get('sha256'))
+                    case 'hash_file':
+                        paths = commandData.get('paths', [commandData['path']] if 'path' in commandData else None)
+                        algorithm = commandData.get('algorithm', 'sha256')
+                        if not isinstance(paths, list) or not paths or algorithm not in constants.HASH_ALGORITHMS:
+                            self.connection.sendResponse('file_hash', {'status': 'failed'}, seq)
+                            continue
+                        self._submit(self.hashFiles, paths, algorithm, seq)
+                    case 'file_signature':
+                        if not commandData.get('path'):
+                            self.connection.sendResponse('file_signature', {'status': 'failed'}, seq)
+                            continue
+                        self._submit(self.sendSignature, commandData['path'], seq)
+                    case 'delta_upload':
+                        path = commandData.get('path')
+                        size = commandData.get('size')
+                        blockSize = commandData.get('block_size')
+                        if not path or not isinstance(size, int) or not isinstance(blockSize, int) or blockSize < 1:
+                            self.connection.sendResponse('file_upload', {'status': 'failed'}, seq)
+                            continue
+                        self._submit(self.prepareDeltaUpload, path, size, blockSize, seq)
+                    case 'upload_finish':
+                        # Answered inline: the final segment was handled before this action arrived
+                        self.finishUpload(commandData.get('upload_id'), seq)
+                    case _:
+                        self.connection.sendResponse('invalid_action', {}, seq)
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _submit(self, func, *args):
+        """
+        Runs an action handler on the worker pool, blocking while maxPendingActions are in flight.
+
+        Args:
+            func (callable): Action handler.
+            *args: Arguments for the handler.
+        """
+        self.pendingActions.acquire()
+        try:
+            self.executor.submit(self._runAction, func, *args)
+        except RuntimeError:
+            self.pendingActions.release()
+            raise
+
+    def _runAction(self, func, *args):
+        try:
+            func(*args)
+        except BrokenPipeError:
+            self.logger.debug(f'{self.connection.peerAddr}: connection closed before {func.__name__} finished')
+        except Exception as e:
+            self.logger.error(f'{self.connection.peerAddr}: uncaught exception in {func.__name__}: {e}')
+        finally:
+            self.pendingActions.release()
+
+    def sendStatus(self, seq=None):
+        """
+        Sends the system status reported by the OS agent to the server.
+
+        Args:
+            seq (int, optional): Sequence number of the answered action.
+        """
+        status_dict = self.osagent.getStatus()
+        self.connection.sendResponse('status', status_dict, seq)
+
+    def getDirectoryListing(self, path:str, seq=None):
         """
         Sends a directory listing for the specified path to the server.
 
         Args:
             path (str): Filesystem path to list.
+            seq (int, optional): Sequence number of the answered action.
 
         Sends:
             'list_dir' response containing either a lit of entries or an error status
         """
         try:
             entries = self.osagent.getDirectoryListing(path)
-            self.connection.sendResponse('list_dir', {'status': 'ok', 'entries': entries})
+            self.connection.sendResponse('list_dir', {'status': 'ok', 'entries': entries}, seq)
         except FileNotFoundError:
-            self.connection.sendResponse('list_dir', {'status': 'not_found'})
+            self.connection.sendResponse('list_dir', {'status': 'not_found'}, seq)
             return
         except Exception as e:
-            self.connection.sendResponse('list_dir', {'status': 'failed'})
+            self.connection.sendResponse('list_dir', {'status': 'failed'}, seq)
             self.logger.warning(f'{self.connection.peerAddr}: list_dir failed: {e}')
 
-    def sendFile(self, path:str):
+    def sendFile(self, path:str, seq=None):
         try:
             if not os.path.isfile(path):
-                self.connection.sendResponse('file_send', {'status': 'not_found'})
+                self.connection.sendResponse('file_send', {'status': 'not_found'}, seq)
                 return
+            if os.path.getsize(path) > constants.MAX_INLINE_FILE_SIZE:
+                # The server would drop the connection over the frame; only streamed downloads carry larger files
+                raise ValueError(f'larger than {constants.MAX_INLINE_FILE_SIZE} bytes, the server does not support streamed downloads')
             fileData = open(path, 'rb').read()
-            fileData = base64.b64encode(fileData).decode()
-            self.connection.sendResponse('file_send', {'status': 'ok', 'filedata': fileData})
+            if not self.connection.binaryEnvelope:
+                fileData = base64.b64encode(fileData).decode()
+            self.connection.sendResponse('file_send', {'status': 'ok', 'filedata': fileData}, seq)
         except Exception as e:
-            self.connection.sendResponse('file_send', {'status': 'failed'})
+            self.connection.sendResponse('file_send', {'status': 'failed'}, seq)
             self.logger.warning(f'{self.connection.peerAddr}: file_send failed: {e}')
 
-    def saveFile(self, path: str, base64data: str):
+    def streamFile(self, path: str, seq=None, offset=0, length=None, ifRange=None, ifNoneMatch=None):
+        """
+        Sends a file, or a range of it, to the server as a stream: the response
+        announces the range, then the contents follow in segments read straight
+        from disk, so memory use does not depend on the file size.
+
+        Args:
+            path (str): Filesystem path of the file.
+            seq (int, optional): Sequence number of the answered action.
+            offset (int): First byte to send; negative values count from the end of the file.
+            length (int, optional): Number of bytes to send; defaults to the rest of the file.
+            ifRange (str | float, optional): ETag or modification time the range was
+                computed against; if the file changed since, the whole file is sent instead.
+            ifNoneMatch (str, optional): ETag of a copy the server holds; if the file still
+                has it, nothing is sent but the answer, which costs a stat() only.
+
+        Sends:
+            'file_send' response with status 'ok', the number of bytes sent as 'size', their
+            'offset', and the 'file_size', 'etag' and 'mtime' of the file; 'not_modified' with
+            the 'file_size', 'etag' and 'mtime' if the file has the ETag in ifNoneMatch;
+            'invalid_range' with the 'file_size' if the range lies outside the file; or
+            'not_found' / 'failed'.
+            With 'ok', a stream of exactly size bytes follows, aborted if reading fails.
+        """
+        try:
+            file = open(path, 'rb')
+        except (FileNotFoundError, IsADirectoryError):
+            self.connection.sendResponse('file_send', {'status': 'not_found'}, seq)
+            return
+        except Exception as e:
+            self.connection.sendResponse('file_send', {'status': 'failed'}, seq)
+            self.logger.warning(f'{self.connection.peerAddr}: file_send failed: {e}')
+            return
+        with file:
+            stat = os.fstat(file.fileno())
+            etag = fileETag(stat)
+            if ifNoneMatch is not None and ifNoneMatch == etag:
+                self.connection.sendResponse('file_send', {'status': 'not_modified', 'file_size': stat.st_size, 'etag': etag,
+                                                           'mtime': stat.st_mtime}, seq)
+                return
+            if ifRange is not None and ifRange != etag and ifRange != int(stat.st_mtime):
+                offset, length = 0, None
+            try:
+                offset, size = resolveRange(stat.st_size, offset, length)
+            except ValueError:
+                self.connection.sendResponse('file_send', {'status': 'invalid_range', 'file_size': stat.st_size}, seq)
+                return
+            file.seek(offset)
+            self.connection.sendResponse('file_send', {'status': 'ok', 'size': size, 'offset': offset, 'file_size': stat.st_size,
+                                                       'etag': etag, 'mtime': stat.st_mtime}, seq)
+            with self.connection.openStream(seq) as stream:
+                stream.writeFrom(file, size)
+
+    def saveFile(self, path: str, base64data, seq=None):
         """
         Saves a file received from the server to the specified path.
 
         Args:
             path (str): Destination path for the file.
-            base64data (str): File contents encoded in base64.
+            base64data (str | bytes): File contents encoded in base64, or raw in a binary envelope.
+            seq (int, optional): Sequence number of the answered action.
 
         Sends:
             'file_upload' response with status 'ok', 'file_exists', or 'failed'.
         """
         try:
-            file_bytes = base64.b64decode(base64data)
+            file_bytes = bytesField(base64data)
             if os.path.exists(path):
-                self.connection.sendResponse('file_upload', {'status': 'file_exists'})
+                self.connection.sendResponse('file_upload', {'status': 'file_exists'}, seq)
                 return
             with open(path, 'wb') as f:
                 f.write(file_bytes)
-            self.connection.sendResponse('file_upload', {'status': 'ok'})
+            self.connection.sendResponse('file_upload', {'status': 'ok'}, seq)
         except Exception as e:
-            self.connection.sendResponse('file_upload', {'status': 'failed'})
+            self.connection.sendResponse('file_upload', {'status': 'failed'}, seq)
             self.logger.warning(f'{self.connection.peerAddr}: file_upload failed: {e}')
 
-    def executeShellCommand(self, command: str, timeout=DEFAULT_TIMEOUT):
+    def prepareUpload(self, path: str, size: int, seq=None, resume=False, sha256=None):
+        """
+        Prepares a streamed upload: creates the temporary file and starts receiving
+        the stream the server sends once the upload is reported ready.
+
+        Args:
+            path (str): Destination path for the file.
+            size (int): Size of the file in bytes.
+            seq (int, optional): Sequence number of the answered action, used as the upload ID.
+            resume (bool): Continue a previously interrupted resumable upload of the file, and
+                keep the received part if this one is interrupted as well.
+            sha256 (str, optional): Hex digest of the file; the upload fails if the received
+                file does not match it.
+
+        Sends:
+            'file_upload' response with status 'ready', the 'upload_id' and the 'offset' the
+            stream has to start at; 'present' if the file exists with the given digest already;
+            'file_exists', 'busy' if the file is being uploaded already, or 'failed'.
+        """
+        if any(upload.path == path and upload.status is None for upload in list(self.uploads.values())):
+            self.connection.sendResponse('file_upload', {'status': 'busy'}, seq)
+            return
+        try:
+            sink = FileUploadSink(path, size, resume, sha256=sha256)
+        except FileExistsError:
+            present = sha256 is not None and fileDigest(path) == sha256
+            self.connection.sendResponse('file_upload', {'status': 'present' if present else 'file_exists'}, seq)
+            return
+        except Exception as e:
+            self.connection.sendResponse('file_upload', {'status': 'failed'}, seq)
+            self.logger.warning(f'{self.connection.peerAddr}: upload_stream failed: {e}')
+            return
+        self.uploads[seq] = sink
+        self.connection.incomingStreams.attach(seq, sink)
+        self.connection.sendResponse('file_upload', {'status': 'ready', 'upload_id': seq, 'offset': sink.received}, seq)
+
+    def hashFiles(self, paths: list, algorithm='sha256', seq=None):
+        """
+        Hashes files and sends only their digests, so checking a file against a known
+        version does not need a download. Files are read in chunks, whatever their size.
+
+        Args:
+            paths (list): Filesystem paths of the files.
+            algorithm (str): One of HASH_ALGORITHMS.
+            seq (int, optional): Sequence number of the answered action.
+
+        Sends:
+            'file_hash' response with status 'ok', the 'algorithm' and 'hashes' mapping each path
+            to its 'status' ('ok', 'not_found' or 'failed') and, with 'ok', its hex 'digest' and 'size'.
+        """
+        hashes = {}
+        for path in paths:
+            try:
+                with open(path, 'rb') as file:
+                    digest = hashlib.file_digest(file, algorithm).hexdigest()
+                    hashes[path] = {'status': 'ok', 'digest': digest, 'size': file.tell()}
+            except (FileNotFoundError, IsADirectoryError):
+                hashes[path] = {'status': 'not_found'}
+            except Exception as e:
+                hashes[path] = {'status': 'failed'}
+                self.logger.warning(f'{self.connection.peerAddr}: hash_file failed for {path}: {e}')
+        self.connection.sendResponse('file_hash', {'status': 'ok', 'algorithm': algorithm, 'hashes': hashes}, seq)
+
+    def sendSignature(self, path: str, seq=None):
+        """
+        Sends the block checksums of a file as a stream, for the server to compute a
+        delta upload against. Memory use does not depend on the file size.
+
+        Args:
+            path (str): Filesystem path of the file.
+            seq (int, optional): Sequence number of the answered action.
+
+        Sends:
+            'file_signature' response with status 'ok', the file 'size' and the 'block_size',
+            followed by a stream of the signature entries; or 'not_found' / 'failed'.
+        """
+        try:
+            file = open(path, 'rb')
+        except (FileNotFoundError, IsADirectoryError):
+            self.connection.sendResponse('file_signature', {'status': 'not_found'}, seq)
+            return
+        except Exception as e:
+            self.connection.sendResponse('file_signature', {'status': 'failed'}, seq)
+            self.logger.warning(f'{self.connection.peerAddr}: file_signature failed: {e}')
+            return
+        with file:
+            size = os.fstat(file.fileno()).st_size
+            blockSize = chooseBlockSize(size)
+            self.connection.sendResponse('file_signature', {'status': 'ok', 'size': size, 'block_size': blockSize}, seq)
+            with self.connection.openStream(seq) as stream:
+                for entry in fileSignature(file, blockSize):
+                    stream.write(entry)
+
+    def prepareDeltaUpload(self, path: str, size: int, blockSize: int, seq=None):
+        """
+        Prepares a delta upload replacing an existing file; the delta computed against its
+        signature is received as a stream and the rebuilt file replaces the old one once complete.
+
+        Args:
+            path (str): Path of the existing file.
+            size (int): Size of the new version in bytes.
+            blockSize (int): Block size of the signature the delta is computed from.
+            seq (int, optional): Sequence number of the answered action, used as the upload ID.
+
+        Sends:
+            'file_upload' response with status 'ready' and the 'upload_id', 'not_found',
+            'busy' if the file is being uploaded already, or 'failed'.
+        """
+        if any(upload.path == path and upload.status is None for upload in list(self.uploads.values())):
+            self.connection.sendResponse('file_upload', {'status': 'busy'}, seq)
+            return
+        try:
+            sink = DeltaUploadSink(path, size, blockSize)
+        except FileNotFoundError:
+            self.connection.sendResponse('file_upload', {'status': 'not_found'}, seq)
+            return
+        except Exception as e:
+            self.connection.sendResponse('file_upload', {'status': 'failed'}, seq)
+            self.logger.warning(f'{self.connection.peerAddr}: delta_upload failed: {e}')
+            return
+        self.uploads[seq] = sink
+        self.connection.incomingStreams.attach(seq, sink)
+        self.connection.sendResponse('file_upload', {'status': 'ready', 'upload_id': seq}, seq)
+
+    def finishUpload(self, uploadId: int, seq=None):
+        """
+        Reports the outcome of a streamed upload; one that has not received its
+        final segment by now is discarded.
+
+        Args:
+            uploadId (int): ID of the upload, from the 'ready' response.
+            seq (int, optional): Sequence number of the answered action.
+
+        Sends:
+            'file_upload' response with status 'ok', 'file_exists', 'incomplete' or 'failed'.
+        """
+        sink = self.uploads.pop(uploadId, None)
+        if sink is None:
+            status = 'failed'
+        elif sink.status is None:
+            sink.fail(StreamError('upload finished before its final segment'), 'incomplete')
+            status = 'incomplete'
+        else:
+            status = sink.status
+        self.connection.sendResponse('file_upload', {'status': status}, seq)
+
+    def executeShellCommand(self, command: str, timeout=DEFAULT_TIMEOUT, seq=None):
         """
         Executes a shell command and sends the result back to the server.
 
         Args:
             command (str): The shell command to execute.
             timeout (int): Maximum time in seconds before the command is forcibly terminated.
+            seq (int, optional): Sequence number of the answered action.
 
         Sends:
             'shell_result' response with command output, error stream, and exit code.
         """
         try:
             result = subprocess.run(command, shell=True, capture_output=True, text=True, timeout=timeout)
-            self.connection.sendResponse('shell_result', {'status': 'ok', 'stdout': result.stdout, 'stderr': result.stderr, 'exitcode': result.returncode})
+            self.connection.sendResponse('shell_result', {'status': 'ok', 'stdout': result.stdout, 'stderr': result.stderr, 'exitcode': result.returncode}, seq)
         except subprocess.TimeoutExpired:
-            self.connection.sendResponse('shell_result', {'status': 'timeout', 'stderr': 'Command timed out', 'exitcode': -1})
+            self.connection.sendResponse('shell_result', {'status': 'timeout', 'stderr': 'Command timed out', 'exitcode': -1}, seq)
             return
         except Exception as e:
-            self.connection.sendResponse('shell_result', {'status': 'failed'})
+            self.connection.sendResponse('shell_result', {'status': 'failed'}, seq)
             self.logger.warning(f'{self.connection.peerAddr}: shell_command failed: {e}')
 
@@ -0,0 +1,258 @@
+import os
+import hashlib
+import logging
+import shutil
+import tempfile
+
+from network.streams import SEGMENT_MORE, SEGMENT_FINAL, SEGMENT_ABORT
+from network.delta import DeltaDecoder, DeltaError
+
+def fileETag(stat: os.stat_result) -> str:
+    """
+    Returns:
+        str: validator of a file's contents, changing whenever its size or modification time does
+    """
+    return f'{stat.st_size:x}-{stat.st_mtime_ns:x}'
+
+def resolveRange(fileSize: int, offset=0, length: int = None) -> tuple[int, int]:
+    """
+    Clamps a requested byte range to a file.
+
+    Args:
+        fileSize (int): size of the file
+        offset (int): first byte; negative values count from the end of the file
+        length (int, optional): number of bytes; defaults to the rest of the file
+
+    Returns:
+        tuple[int, int]: offset and length of the range within the file
+
+    Raises:
+        ValueError: if the range is malformed or starts beyond the end of the file
+    """
+    if not isinstance(offset, int) or (length is not None and (not isinstance(length, int) or length < 0)):
+        raise ValueError('invalid range')
+    if offset < 0:
+        offset = max(fileSize + offset, 0)
+    if offset > fileSize or (offset == fileSize and fileSize > 0):
+        raise ValueError(f'range starts at {offset}, beyond the end of the file ({fileSize} bytes)')
+    available = fileSize - offset
+    return offset, available if length is None else min(length, available)
+
+def fileDigest(path: str) -> str | None:
+    """
+    Returns:
+        str or None: hex SHA-256 of a file's contents, None if it cannot be read
+    """
+    try:
+        with open(path, 'rb') as file:
+            return hashlib.file_digest(file, 'sha256').hexdigest()
+    except OSError:
+        return None
+
+def partialPath(path: str) -> str:
+    """
+    Returns:
+        str: where a resumable upload to path keeps its received part
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    return os.path.join(directory, f'.{name}.partial')
+
+def commitFile(tempPath: str, path: str, overwrite=False):
+    """
+    Moves a completely written temporary file into place in one atomic step.
+
+    Args:
+        tempPath (str): the temporary file, on the same filesystem as path
+        path (str): destination path
+        overwrite (bool): replace an existing destination instead of failing
+
+    Raises:
+        FileExistsError: if path exists and overwrite is False
+    """
+    if overwrite:
+        os.replace(tempPath, path)
+    elif os.name == 'nt':
+        # rename does not replace existing files on Windows
+        os.rename(tempPath, path)
+    else:
+        # link fails if path exists, unlike rename
+        os.link(tempPath, path)
+        os.unlink(tempPath)
+
+class FileUploadSink:
+    """
+    Receives an uploaded file stream into a temporary file next to its destination
+    and renames it into place once the final segment has arrived, so the destination
+    never holds a partial file.
+
+    Segments are written as they are delivered by the connection's read loop; the
+    stream is never buffered in memory. Takes the place of a StreamReader in
+    IncomingStreams.
+
+    A resumable upload writes to a fixed temporary file (see partialPath) that is kept,
+    truncated to the received data, if the upload is interrupted. The next resumable
+    upload of the same path and size continues after the received data, which
+    the sender has to skip.
+
+    Args:
+        path (str): destination path; must not exist unless overwrite is set
+        size (int, optional): announced file size, used to preallocate the temporary file
+        resume (bool): make the upload resumable, continuing a previous attempt if there is one
+        overwrite (bool): replace an existing file at path
+        sha256 (str, optional): hex digest the complete file has to match
+
+    Attributes:
+        received (int): bytes of the file received so far, including those of previous attempts
+
+    Raises:
+        FileExistsError: if path exists already
+        OSError: if the temporary file cannot be created
+    """
+    def __init__(self, path: str, size: int = None, resume=False, overwrite=False, sha256: str = None):
+        if os.path.exists(path) and not overwrite:
+            raise FileExistsError(path)
+        self.path = path
+        self.size = size
+        self.resumable = resume
+        self.overwrite = overwrite
+        self.sha256 = sha256
+        self.digest = hashlib.sha256() if sha256 is not None else None
+        self.received = 0
+        self.status = None
+        self.onClose = None
+        self.logger = logging.getLogger('flitify')
+        if resume:
+            self.tempPath = partialPath(path)
+            fd = os.open(self.tempPath, os.O_RDWR | os.O_CREAT, 0o600)
+            self.received = os.fstat(fd).st_size
+            # A part as large as the whole file is left by a crash after preallocating,
+            # not by an interrupted upload, which truncates it to the received data
+            if size is None or self.received >= size:
+                self.received = 0
+                os.ftruncate(fd, 0)
+            if self.digest is not None and self.received:
+                with open(self.tempPath, 'rb') as partial:
+                    while chunk := partial.read(1024 * 1024):
+                        self.digest.update(chunk)
+            os.lseek(fd, self.received, os.SEEK_SET)
+        else:
+            directory, name = os.path.split(os.path.abspath(path))
+            fd, self.tempPath = tempfile.mkstemp(dir=directory, prefix=f'.{name}.', suffix='.part')
+        self.file = os.fdopen(fd, 'wb')
+        if size and size > self.received and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, self.received, size - self.received)
+            except OSError:
+                pass
+
+    def feed(self, flags: int, payload: bytes, block=True) -> bool:
+        """
+        Writes a segment; the final one completes the upload. Refer to StreamReader.feed.
+        """
+        if self.status is not None:
+            return False
+        try:
+            if flags == SEGMENT_ABORT:
+                raise OSError(f'upload aborted by server: {bytes(payload).decode(errors="replace")}')
+            self._write(payload)
+            if flags == SEGMENT_FINAL:
+                self._finish()
+        except FileExistsError as e:
+            self.fail(e, 'file_exists', keep=False)
+        except (OSError, DeltaError) as e:
+            self.fail(e)
+        return True
+
+    def _write(self, payload: bytes):
+        self.file.write(payload)
+        self.received += len(payload)
+        if self.digest is not None:
+            self.digest.update(payload)
+
+    def fail(self, error: Exception, status='failed', keep=True):
+        """
+        Ends the upload unsuccessfully. The received part of a resumable upload is
+        kept for the next attempt, unless keep is False; otherwise it is discarded.
+
+        Args:
+            error (Exception): the reason, logged
+            status (str): the status reported for the upload
+            keep (bool): whether a resumable upload may be continued later
+        """
+        if self.status is not None:
+            return
+        self.logger.warning(f'upload of {self.path} failed after {self.received} bytes: {error}')
+        self.status = status
+        keep = keep and self.resumable
+        try:
+            if keep:
+                self.file.truncate(self.received)
+            self.file.close()
+        except OSError:
+            keep = False
+        if not keep:
+            try:
+                os.unlink(self.tempPath)
+            except OSError:
+                pass
+        self._notifyClosed()
+
+    def _finish(self):
+        if self.size is not None and self.received != self.size:
+            self.fail(OSError(f'received {self.received} of {self.size} bytes'), keep=False)
+            return
+        if self.digest is not None and self.digest.hexdigest() != self.sha256:
+            self.fail(OSError('received file does not match its SHA-256'), keep=False)
+            return
+        # Drops preallocated space beyond the data
+        self.file.truncate()
+        self.file.close()
+        commitFile(self.tempPath, self.path, self.overwrite)
+        self.status = 'ok'
+        self._notifyClosed()
+
+    def _notifyClosed(self):
+        onClose, self.onClose = self.onClose, None
+        if onClose is not None:
+            onClose()
+
+class DeltaUploadSink(FileUploadSink):
+    """
+    Receives a delta against an existing file (see network.delta) and rebuilds the
+    new version in a temporary file, which replaces the old one only once it is
+    complete and matches the digest of the new version.
+
+    Args:
+        path (str): the existing file
+        size (int): size of the new version
+        blockSize (int): block size of the signature the delta was computed from
+
+    Raises:
+        FileNotFoundError: if path does not exist
+        OSError: if the temporary file cannot be created
+    """
+    def __init__(self, path: str, size: int, blockSize: int):
+        self.basis = open(path, 'rb')
+        try:
+            super().__init__(path, size, overwrite=True)
+        except BaseException:
+            self.basis.close()
+            raise
+        self.decoder = DeltaDecoder(self.basis, self.file, blockSize)
+
+    def _write(self, payload: bytes):
+        self.decoder.feed(payload)
+        self.received = self.decoder.written
+
+    def _finish(self):
+        try:
+            self.decoder.finish()
+            # The new version keeps the permissions of the old one
+            shutil.copymode(self.path, self.tempPath)
+        finally:
+            self.basis.close()
+        super()._finish()
+
+    def fail(self, error: Exception, status='failed', keep=True):
+        self.basis.close()
+        super().fail(error, status, keep)
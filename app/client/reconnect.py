@@ -0,0 +1,81 @@
+import random
+
+import constants
+from crypto.cryptohelper import LEGACY_CIPHER_SUITE
+from network.secureconnection import KEY_EXCHANGES
+
+# A busy server's retry delay is stretched by up to this fraction, so agents given the same delay do not return together
+RETRY_AFTER_JITTER = 0.1
+
+class ReconnectBackoff:
+    """
+    Delays between an agent's reconnect attempts: exponential backoff with full jitter.
+    The n-th consecutive failed attempt is followed by a uniformly random delay of up
+    to base * 2 ** n seconds, capped at cap, which spreads agents that lost the server
+    at the same moment over time instead of having them return in lockstep.
+
+    Args:
+        base (float): upper bound of the first delay
+        cap (float): upper bound of every delay
+        rng (random.Random, optional): source of the jitter
+    """
+    def __init__(self, base=constants.CLIENT_RECONNECT_TIME, cap=constants.CLIENT_RECONNECT_MAX_TIME, rng=None):
+        self.base = base
+        self.cap = cap
+        self.rng = rng or random.Random()
+        self.attempt = 0
+
+    def nextDelay(self, retryAfter: float = None) -> float:
+        """
+        Args:
+            retryAfter (float, optional): delay a busy server asked for, followed
+                instead of the backoff as the server staggers the agents it turns away
+
+        Returns:
+            float: seconds to wait before the next attempt
+        """
+        if retryAfter is not None:
+            return retryAfter * (1 + self.rng.random() * RETRY_AFTER_JITTER)
+        limit = min(self.cap, self.base * 2 ** self.attempt)
+        if limit < self.cap:
+            self.attempt += 1
+        return self.rng.uniform(0, limit)
+
+    def reset(self):
+        """ Called once connected, so the next disconnection starts from the shortest delays again. """
+        self.attempt = 0
+
+class HandshakeFallback:
+    """
+    Handshake settings for an agent's connection attempts. Servers older than the agent close
+    the connection in reply to a hello or cipher offer they do not understand (see
+    KeyExchangeRejectedError), so the attempt following such a rejection steps down: first
+    it leaves the cipher offer out, then it uses the next older key exchange. Any other
+    outcome returns to the configured settings: a reset connection or a restarting server
+    never keeps the agent on an older handshake beyond the attempt that follows it.
+    """
+    def __init__(self):
+        self.rejections = 0
+
+    def settings(self, keyExchange: str, cipherSuites: list[str] | None) -> tuple[str, list[str] | None]:
+        """
+        Args:
+            keyExchange (str): the configured key exchange, one of KEY_EXCHANGES
+            cipherSuites (list[str] or None): the configured cipher suites, None for the default ones
+
+        Returns:
+            tuple[str, list[str] or None]: the key exchange and cipher suites for the next attempt
+        """
+        steps = [(keyExchange, cipherSuites)]
+        if keyExchange != 'rsa' and cipherSuites != [LEGACY_CIPHER_SUITE]:
+            steps.append((keyExchange, [LEGACY_CIPHER_SUITE]))
+        steps.extend((older, [LEGACY_CIPHER_SUITE]) for older in KEY_EXCHANGES[KEY_EXCHANGES.index(keyExchange) + 1:])
+        return steps[min(self.rejections, len(steps) - 1)]
+
+    def rejected(self):
+        """ Called when the server rejected the attempt's handshake. """
+        self.rejections += 1
+
+    def reset(self):
+        """ Called when an attempt ended any other way. """
+        self.rejections = 0
@@ -6,8 +6,12 @@ import time
 import config
 import constants
 from config import ConfigError
-from client.clientconnection import ClientConnection, ConnectionKickedError
+from client.clientconnection import ClientConnection, ConnectionKickedError, DEFAULT_ACTION_WORKERS, DEFAULT_MAX_PENDING_ACTIONS
 from network.protocolconnection import ClientProtocolConnection, AuthenticationError
+from network.secureconnection import KeyExchangeRejectedError, ServerBusyError, SessionTicketCache
+from network.compression import FrameCompressor
+from crypto.cryptohelper import DecryptionError
+from client.reconnect import ReconnectBackoff, HandshakeFallback
 
 logging.basicConfig(
     level=logging.DEBUG,
@@ -17,7 +21,7 @@ logging.basicConfig(
 
 
 
-def clientStartup():
+def clientStartup(ticketCache=None, backoff=None, fallback=None):
     # load config and key
     clientConfig = config.loadClientConfig()
     server_address = clientConfig['server_address']
@@ -25,23 +29,57 @@ def clientStartup():
     public_rsa_key = open(clientConfig['server_public_key_path'], 'rb').read()
     client_id = clientConfig['client_id']
     client_secret = clientConfig['client_secret']
+    max_frame_size = clientConfig.get('max_frame_size')
+    action_workers = clientConfig.get('action_workers', DEFAULT_ACTION_WORKERS)
+    max_pending_actions = clientConfig.get('max_pending_actions', DEFAULT_MAX_PENDING_ACTIONS)
+    key_exchange = clientConfig.get('key_exchange', 'compact')
+    cipher_suites = clientConfig.get('cipher_suites')
+    if fallback is not None:
+        key_exchange, cipher_suites = fallback.settings(key_exchange, cipher_suites)
+    compression = FrameCompressor(clientConfig.get('compression', constants.OFFERED_COMPRESSION),
+                                  clientConfig.get('compression_level', constants.COMPRESSION_LEVEL),
+                                  clientConfig.get('compression_threshold', constants.COMPRESSION_THRESHOLD))
     # setup connection
     clientSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     clientSocket.connect((server_address, server_port))
-    connection = ClientConnection(ClientProtocolConnection(clientSocket, (server_address, server_port), public_rsa_key, client_id, client_secret))
+    protocolConnection = ClientProtocolConnection(clientSocket, (server_address, server_port), public_rsa_key, client_id, client_secret, max_frame_size, key_exchange, ticketCache, cipher_suites, compression=compression)
+    if backoff is not None:
+        backoff.reset()
+    connection = ClientConnection(protocolConnection, action_workers, max_pending_actions)
 
 def mainLoop():
     invalid_attempts = 0
+    # Steps down to an older handshake for the attempt after a server rejected one
+    fallback = HandshakeFallback()
+    # Session tickets survive reconnects, so a reconnect skips the full key exchange
+    ticket_cache = SessionTicketCache()
+    # Agents lose a restarting server all at once; jittered delays keep them from returning in lockstep
+    backoff = ReconnectBackoff()
     while True:
         if invalid_attempts > 5:
             break
             return
         try:
-            clientStartup()
+            clientStartup(ticket_cache, backoff, fallback)
+        except KeyExchangeRejectedError as e:
+            # Servers before protocol 2.5 reject the cipher offer, older ones the X25519 and compact hellos
+            fallback.rejected()
+            logging.warning(f"{e}, retrying with an older handshake")
+            time.sleep(backoff.nextDelay())
+            continue
+        except ServerBusyError as e:
+            delay = backoff.nextDelay(e.retryAfter)
+            logging.warning(f"Server busy, reconnecting in {delay:.1f} s")
+            time.sleep(delay)
+            continue
         except BrokenPipeError as e:
             logging.error(f"Connection closed: broken pipe: {e}")
         except ConnectionRefusedError:
             logging.error("Connection refused")
+        except OSError as e:
+            logging.error(f"Connection error: {e}")
+        except (ValueError, DecryptionError) as e:
+            logging.error(f"Handshake failed: {e}")
         except KeyboardInterrupt:
             logging.info("Shutting down client, keyboard interrupt")
             break
@@ -56,7 +94,8 @@ def mainLoop():
         except ConnectionKickedError as e:
             pass
 
-        time.sleep(constants.CLIENT_RECONNECT_TIME)
+        fallback.reset()
+        time.sleep(backoff.nextDelay())
 
 
 if __name__ == "__main__":
@@ -1,5 +1,13 @@
 import json
 import logging
+import os
+import socket
+
+from crypto.cryptohelper import CIPHER_SUITES
+from network.compression import COMPRESSION_ALGORITHMS
+from network.secureconnection import KEY_EXCHANGES
+
+SERVER_ENGINES = ['threaded', 'asyncio']
 
 class ConfigError(Exception):
     pass
@@ -17,11 +25,23 @@ def loadServerConfig(config_path):
         for key in REQUIRED_FLITIFY_SERVER_KEYS:
             if key not in flitify_config:
                 raise ValueError(f"flitify_server config incorrect: missing key {key}")
+        _checkPositiveInts(flitify_config, ['max_frame_size', 'compression_threshold', 'max_handshakes', 'handshake_queue', 'handshake_deadline', 'workers',
+                                            'handoff_drain_timeout'], 'flitify_server')
+        _checkCompression(flitify_config, 'flitify_server')
+        workers = flitify_config.get('handshake_workers', 0)
+        if not isinstance(workers, int) or workers < 0:
+            raise ValueError("flitify_server config incorrect: handshake_workers must be a non-negative integer")
+        if flitify_config.get('engine', 'threaded') not in SERVER_ENGINES:
+            raise ValueError(f"flitify_server config incorrect: engine must be one of {SERVER_ENGINES}")
+        if flitify_config.get('workers', 1) > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+            raise ValueError("flitify_server config incorrect: workers need SO_REUSEPORT, which this platform lacks")
+        _checkHandoff(flitify_config)
         api_config = server_config['api_server']
         REQUIRED_API_SERVER_KEYS = ['host', 'port', 'secret']
         for key in REQUIRED_API_SERVER_KEYS:
             if key not in api_config:
                 raise ValueError(f"api_server config incorrect: missing key {key}")
+        _checkPositiveInts(api_config, ['bulk_upload_workers', 'file_cache_entries', 'file_cache_bytes'], 'api_server')
         return server_config
     except Exception as e:
         logging.critical(f"Failed to load server config: {e}")
@@ -35,7 +55,37 @@ def loadClientConfig(config_path='config_client.json'):
         for key in REQUIRED_KEYS:
             if key not in client_config:
                 raise ValueError(f"Client config incorrect: missing key {key}")
+        _checkPositiveInts(client_config, ['max_frame_size', 'action_workers', 'max_pending_actions', 'compression_threshold'], 'Client')
+        _checkCompression(client_config, 'Client')
+        if client_config.get('key_exchange', 'compact') not in KEY_EXCHANGES:
+            raise ValueError(f"Client config incorrect: key_exchange must be one of {KEY_EXCHANGES}")
+        cipher_suites = client_config.get('cipher_suites', CIPHER_SUITES)
+        if not isinstance(cipher_suites, list) or not cipher_suites or any(suite not in CIPHER_SUITES for suite in cipher_suites):
+            raise ValueError(f"Client config incorrect: cipher_suites must be a non-empty list of {CIPHER_SUITES}")
         return client_config
     except Exception as e:
         logging.critical(f"Failed to load client config: {e}")
         raise ConfigError(e)
+
+def _checkPositiveInts(section, keys, sectionName):
+    for key in keys:
+        if key in section and (not isinstance(section[key], int) or section[key] <= 0):
+            raise ValueError(f"{sectionName} config incorrect: {key} must be a positive integer")
+
+def _checkHandoff(section):
+    if 'handoff_socket' not in section:
+        return
+    if not isinstance(section['handoff_socket'], str) or not section['handoff_socket']:
+        raise ValueError("flitify_server config incorrect: handoff_socket must be a path")
+    if section.get('engine', 'threaded') != 'threaded' or section.get('workers', 1) > 1:
+        raise ValueError("flitify_server config incorrect: handoff_socket needs the threaded engine in a single process")
+    if not all(hasattr(socket, name) for name in ('SO_PEERCRED', 'SOCK_SEQPACKET', 'send_fds')) or not hasattr(os, 'pidfd_open'):
+        raise ValueError("flitify_server config incorrect: handoff_socket needs Linux, which this platform is not")
+
+def _checkCompression(section, sectionName):
+    algorithms = section.get('compression', [])
+    if not isinstance(algorithms, list) or any(algorithm not in COMPRESSION_ALGORITHMS for algorithm in algorithms):
+        raise ValueError(f"{sectionName} config incorrect: compression must be a list of {COMPRESSION_ALGORITHMS}")
+    level = section.get('compression_level', 1)
+    if not isinstance(level, int) or not 1 <= level <= 9:
+        raise ValueError(f"{sectionName} config incorrect: compression_level must be an integer from 1 to 9")
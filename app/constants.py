@@ -1,5 +1,72 @@
-PROTOCOL_VERSION = '2.1'
+PROTOCOL_VERSION = '2.5'
+# Version announced in the server greeting; agents speaking only RSA key exchange expect it verbatim
+LEGACY_PROTOCOL_VERSION = '2.1'
+# First version with the X25519 key exchange and session resumption
+X25519_PROTOCOL_VERSION = '2.2'
+# First version with the compact handshake
+COMPACT_PROTOCOL_VERSION = '2.3'
+# First version negotiating the session cipher; from PROTOCOL_VERSION on the negotiation is bound into the session key
+NEGOTIATION_PROTOCOL_VERSION = '2.4'
 MESSAGE_SIZE = 512
 SOCKET_TIMEOUT = 3
 INTERVAL = 2
+# Seconds a send to an agent may go without progress before the server gives the connection up
+SEND_TIMEOUT = 30
 CLIENT_RECONNECT_TIME = 5
+# Largest file sent whole in a single frame, to and from peers without streamed transfers; the
+# default frame cap fits it base64 encoded, with its JSON message and the cipher's overhead
+MAX_INLINE_FILE_SIZE = 256 * 1024 * 1024
+MAX_FRAME_SIZE = 4 * -(-MAX_INLINE_FILE_SIZE // 3) + 64 * 1024
+SESSION_TICKET_LIFETIME = 12 * 60 * 60
+# Payload bytes per stream segment; a stream buffers at most STREAM_QUEUE_DEPTH segments on the receiving side
+STREAM_SEGMENT_SIZE = 256 * 1024
+STREAM_QUEUE_DEPTH = 16
+STREAM_TIMEOUT = 30
+# Threads of the asyncio engine waiting for stalled stream readers to take a segment, each for up to STREAM_TIMEOUT
+STREAM_DELIVERY_WORKERS = 16
+# Signature block size bounds for delta uploads, and unmatched bytes the encoder checks at every offset
+DELTA_MIN_BLOCK_SIZE = 2 * 1024
+DELTA_MAX_BLOCK_SIZE = 128 * 1024
+DELTA_ROLLING_LIMIT = 1024 * 1024
+# Uploads a bulk upload runs at once
+BULK_UPLOAD_WORKERS = 16
+# Budget of the API server's cache of downloaded files
+FILE_CACHE_ENTRIES = 256
+FILE_CACHE_BYTES = 64 * 1024 * 1024
+# Digests agents compute for hash_file
+HASH_ALGORITHMS = ['sha256', 'blake2b']
+# Per-frame compression: agents offer OFFERED_COMPRESSION unless configured otherwise, as lzma
+# compresses stream data better but at a fraction of zlib's speed. zlib level 1 keeps up with a
+# gigabit link on one core; higher levels suit metered links. Frames below the threshold stay
+# uncompressed and larger ones only get compressed if their leading sample bytes compress well
+OFFERED_COMPRESSION = ['zlib']
+COMPRESSION_LEVEL = 1
+LZMA_PRESET = 1
+# Memory an lzma decompressor may use, whatever dictionary size a frame declares; enough for any preset (9 takes 65 MiB)
+LZMA_MEMORY_LIMIT = 80 * 1024 * 1024
+COMPRESSION_THRESHOLD = 1024
+COMPRESSION_SAMPLE_SIZE = 4096
+# Handshakes a server runs at once and accepted connections waiting for one; agents beyond that,
+# or that would wait more than HANDSHAKE_DEADLINE seconds, are turned away with BUSY
+MAX_HANDSHAKES = 64
+HANDSHAKE_QUEUE = 1024
+HANDSHAKE_DEADLINE = 10
+# Bounds of the retry delay announced with BUSY, and the time and threads spent turning connections away
+MIN_RETRY_AFTER = 0.1
+MAX_RETRY_AFTER = 300
+REFUSAL_TIMEOUT = 1
+REFUSAL_WORKERS = 8
+# Agents reconnect after a random delay of up to CLIENT_RECONNECT_TIME, doubled with every failed
+# attempt up to CLIENT_RECONNECT_MAX_TIME, or after the delay a busy server asked for
+CLIENT_RECONNECT_MAX_TIME = 120
+# Worker processes of a server (1 runs everything in one process), and bytes the API server relays
+# at a time between an HTTP client and the worker serving the requested agent
+WORKERS = 1
+WORKER_RELAY_SIZE = 256 * 1024
+# Seconds a server handing its agents over to a new process (see server.handoff) waits for their
+# connections to become idle; busy ones are polled every HANDOFF_POLL_INTERVAL seconds meanwhile.
+# Sessions travel in batches of HANDOFF_BATCH sockets per message, below the kernel's limit of 253
+HANDOFF_DRAIN_TIMEOUT = 30
+HANDOFF_POLL_INTERVAL = 0.1
+HANDOFF_BATCH = 100
+HANDOFF_MESSAGE_SIZE = 1024 * 1024
@@ -1,6 +1,34 @@
+import os
+import time
+import struct
+import logging
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
 from Crypto import Random
-from Crypto.Cipher import PKCS1_OAEP, AES
-from Crypto.PublicKey import RSA
+from Crypto.Util.number import long_to_bytes
+from Crypto.Cipher import PKCS1_OAEP, AES, ChaCha20_Poly1305
+from Crypto.Hash import SHA256
+from Crypto.Protocol.DH import key_agreement, import_x25519_public_key
+from Crypto.Protocol.KDF import HKDF
+from Crypto.PublicKey import RSA, ECC
+from Crypto.Signature import pss
+
+import constants
+
+X25519_KEY_SIZE = 32
+X25519_SIGNATURE_CONTEXT = b'FLITIFY_X25519_STATIC_KEY:'
+X25519_SESSION_CONTEXT = b'FLITIFY_X25519_SESSION_KEY'
+TICKET_KEY_CONTEXT = b'FLITIFY_SESSION_TICKET_KEY'
+RESUMED_SESSION_CONTEXT = b'FLITIFY_RESUMED_SESSION_KEY'
+NEGOTIATED_SESSION_CONTEXT = b'FLITIFY_NEGOTIATED_SESSION_KEY'
+TICKET_HEADER = struct.Struct('>d32s32s')
+SESSION_CIPHER_CONTEXT = b'FLITIFY_SESSION_CIPHER:'
+# Session ciphers by preference; EAX with random nonces is what peers without negotiation use
+CIPHER_SUITES = ['aes-256-gcm', 'chacha20-poly1305', 'aes-256-eax']
+LEGACY_CIPHER_SUITE = 'aes-256-eax'
+AEAD_TAG_SIZE = 16
 
 class DecryptionError(Exception):
     """ Exception raised when decryption fails (for example due to data authentication failiure) """
@@ -17,6 +45,8 @@ class CryptoHelperRSA:
     def __init__(self, key: bytes):
         self.key = RSA.importKey(key)
         self.cipher = PKCS1_OAEP.new(self.key)
+        self._x25519Server = None
+        self._tickets = None
 
     def encrypt(self, data: bytes) -> bytes:
         """
@@ -42,6 +72,358 @@ class CryptoHelperRSA:
         """
         return self.cipher.decrypt(data)
 
+    def sign(self, data: bytes) -> bytes:
+        """
+        Signs data with the RSA private key (RSASSA-PSS, SHA-256).
+
+        Args:
+            data (bytes): data to sign
+
+        Returns:
+            bytes: the signature
+        """
+        return pss.new(self.key).sign(SHA256.new(data))
+
+    def verify(self, data: bytes, signature: bytes):
+        """
+        Verifies a signature made by sign() with the matching private key.
+
+        Args:
+            data (bytes): signed data
+            signature (bytes): signature to check
+
+        Raises:
+            ValueError: if the signature is not valid
+        """
+        pss.new(self.key).verify(SHA256.new(data), bytes(signature))
+
+    def getX25519Server(self) -> 'CryptoHelperX25519Server':
+        """
+        Returns the X25519 key exchange helper authenticated by this private key,
+        creating it on first use.
+
+        Returns:
+            CryptoHelperX25519Server: helper shared by all connections using this key
+        """
+        if self._x25519Server is None:
+            self._x25519Server = CryptoHelperX25519Server(self)
+        return self._x25519Server
+
+    def getTicketHelper(self) -> 'CryptoHelperTickets':
+        """
+        Returns the session ticket helper keyed by this private key, creating it on first use.
+
+        Returns:
+            CryptoHelperTickets: helper shared by all connections using this key
+        """
+        if self._tickets is None:
+            self._tickets = CryptoHelperTickets(self)
+        return self._tickets
+
+_workerCipher = None
+
+def _initDecryptWorker(key: bytes):
+    global _workerCipher
+    _workerCipher = PKCS1_OAEP.new(RSA.importKey(key))
+
+def _decryptInWorker(data: bytes) -> bytes:
+    return _workerCipher.decrypt(data)
+
+class CryptoHelperRSAPool(CryptoHelperRSA):
+    """
+    RSA helper that runs private key decryption in a pool of worker processes.
+
+    RSA decryption holds the GIL, so in a single process the handshake rate is
+    capped at one core no matter how many connection threads run it. The key is
+    imported once here and once per worker; all workers are started right away so
+    no process is forked later from a busy multi-threaded server.
+
+    Args:
+        key (bytes): Exported RSA private key
+        workers (int, optional): Number of worker processes (defaults to the CPU count)
+    """
+
+    def __init__(self, key: bytes, workers: int = None):
+        super().__init__(key)
+        self.exportedKey = key
+        self.workers = workers or os.cpu_count() or 1
+        self.logger = logging.getLogger('flitify')
+        self.lock = threading.Lock()
+        self.executor = self._startExecutor()
+
+    def _startExecutor(self) -> ProcessPoolExecutor:
+        executor = ProcessPoolExecutor(self.workers, initializer=_initDecryptWorker, initargs=(self.exportedKey,))
+        for future in [executor.submit(os.getpid) for _ in range(self.workers)]:
+            future.result()
+        return executor
+
+    def decryptFuture(self, data: bytes) -> Future:
+        """
+        Submits data for decryption without waiting for the result.
+
+        Args:
+            data (bytes): ciphertext to decrypt
+
+        Returns:
+            Future: resolved with the plaintext, or with ValueError if decryption fails
+        """
+        executor = self.executor
+        try:
+            return executor.submit(_decryptInWorker, bytes(data))
+        except BrokenProcessPool:
+            with self.lock:
+                if executor is self.executor:
+                    self.logger.error('RSA worker pool is broken, restarting it')
+                    self.executor = self._startExecutor()
+            return self.executor.submit(_decryptInWorker, bytes(data))
+
+    def decrypt(self, data: bytes) -> bytes:
+        """
+        Decrypts data in a worker process, blocking the calling thread only.
+        Falls back to decrypting in this process if a worker died.
+
+        Args:
+            data (bytes): ciphertext to decrypt
+
+        Returns:
+            bytes: decrypted plaintext
+        """
+        try:
+            return self.decryptFuture(data).result()
+        except BrokenProcessPool:
+            self.logger.error('RSA worker died during decryption, decrypting in process')
+            return super().decrypt(data)
+
+    def shutdown(self, wait=False):
+        """
+        Stops the worker processes.
+
+        Args:
+            wait (bool): Waits until they exited.
+        """
+        self.executor.shutdown(wait=wait, cancel_futures=True)
+
+def _exportX25519(key) -> bytes:
+    return key.public_key().export_key(format='raw')
+
+def _x25519(privateKey, publicKey) -> bytes:
+    return key_agreement(eph_priv=privateKey, eph_pub=publicKey, kdf=lambda secret: secret)
+
+def _deriveX25519SessionKey(secret: bytes, clientPublic: bytes, staticPublic: bytes, ephemeralPublic: bytes) -> bytes:
+    # Binding all three public keys into the salt ties the session key to this exchange
+    return HKDF(secret, 32, clientPublic + staticPublic + ephemeralPublic, SHA256, context=X25519_SESSION_CONTEXT)
+
+class CryptoHelperX25519Server:
+    """
+    Server side of the X25519 key exchange.
+
+    The server holds a static X25519 key whose public half is signed once with the
+    RSA private key, so agents that only know the RSA public key can authenticate it.
+    Each exchange then costs two X25519 operations instead of an RSA decryption; a
+    fresh ephemeral server key per session keeps forward secrecy.
+
+    Args:
+        rsa (CryptoHelperRSA): helper holding the server's RSA private key
+    """
+
+    def __init__(self, rsa: CryptoHelperRSA):
+        self.staticKey = ECC.generate(curve='Curve25519')
+        self.staticPublic = _exportX25519(self.staticKey)
+        self.signature = rsa.sign(X25519_SIGNATURE_CONTEXT + self.staticPublic)
+
+    def respond(self, clientPublic: bytes) -> tuple[bytes, bytes]:
+        """
+        Completes the exchange for a client's ephemeral public key.
+
+        Args:
+            clientPublic (bytes): the client's ephemeral X25519 public key
+
+        Returns:
+            tuple[bytes, bytes]: the reply for the client (static public key, ephemeral
+            public key and the static key's signature) and the derived AES session key
+
+        Raises:
+            ValueError: if the client's public key is invalid
+        """
+        clientPublic = bytes(clientPublic)
+        peer = import_x25519_public_key(clientPublic)
+        ephemeralKey = ECC.generate(curve='Curve25519')
+        ephemeralPublic = _exportX25519(ephemeralKey)
+        secret = _x25519(self.staticKey, peer) + _x25519(ephemeralKey, peer)
+        aesKey = _deriveX25519SessionKey(secret, clientPublic, self.staticPublic, ephemeralPublic)
+        return self.staticPublic + ephemeralPublic + self.signature, aesKey
+
+class CryptoHelperX25519Client:
+    """
+    Client side of the X25519 key exchange, see CryptoHelperX25519Server.
+
+    Args:
+        rsa (CryptoHelperRSA): helper holding the server's RSA public key
+    """
+
+    def __init__(self, rsa: CryptoHelperRSA):
+        self.rsa = rsa
+        self.ephemeralKey = ECC.generate(curve='Curve25519')
+        self.publicKey = _exportX25519(self.ephemeralKey)
+
+    def finish(self, reply: bytes) -> bytes:
+        """
+        Authenticates the server's reply and derives the session key.
+
+        Args:
+            reply (bytes): the server's reply, see CryptoHelperX25519Server.respond
+
+        Returns:
+            bytes: the AES session key
+
+        Raises:
+            ValueError: if the reply is malformed or not signed by the server's RSA key
+        """
+        reply = bytes(reply)
+        staticPublic = reply[:X25519_KEY_SIZE]
+        ephemeralPublic = reply[X25519_KEY_SIZE:2 * X25519_KEY_SIZE]
+        signature = reply[2 * X25519_KEY_SIZE:]
+        try:
+            self.rsa.verify(X25519_SIGNATURE_CONTEXT + staticPublic, signature)
+        except (ValueError, TypeError):
+            raise ValueError('Server X25519 key is not signed by the server RSA key')
+        secret = (_x25519(self.ephemeralKey, import_x25519_public_key(staticPublic))
+                  + _x25519(self.ephemeralKey, import_x25519_public_key(ephemeralPublic)))
+        return _deriveX25519SessionKey(secret, self.publicKey, staticPublic, ephemeralPublic)
+
+def hashSecret(secret: str | bytes) -> bytes:
+    """
+    Returns:
+        bytes: SHA-256 digest of a client's shared secret, stored in session tickets
+    """
+    if isinstance(secret, str):
+        secret = secret.encode()
+    return SHA256.new(secret).digest()
+
+def _deriveResumedSessionKey(resumptionSecret: bytes, secret: bytes, clientPublic: bytes, serverPublic: bytes) -> bytes:
+    return HKDF(resumptionSecret + secret, 32, clientPublic + serverPublic, SHA256, context=RESUMED_SESSION_CONTEXT)
+
+def bindNegotiation(key: bytes, transcript: bytes) -> bytes:
+    """
+    Mixes the cipher negotiation, which precedes the key exchange in the clear, into a
+    session key. If the offer or the selection was altered on the way, both sides end
+    up with different keys and the handshake fails at the key confirmation.
+
+    Args:
+        key (bytes): session key from the key exchange or the redeemed ticket
+        transcript (bytes): the cipher offer followed by the server's selection, as sent
+
+    Returns:
+        bytes: the session key to create the session cipher with
+    """
+    return HKDF(key, 32, SHA256.new(transcript).digest(), SHA256, context=NEGOTIATED_SESSION_CONTEXT)
+
+class CryptoHelperTickets:
+    """
+    Issues and redeems session resumption tickets.
+
+    A ticket holds the client ID, a hash of the client's shared secret, a random
+    resumption secret and an expiry time, encrypted under a key derived from the
+    RSA private key. The server keeps no per-client state and tickets stay valid
+    across restarts. Redeeming a ticket is combined with an ephemeral X25519
+    exchange, so resumed sessions still get a fresh, forward secret key.
+
+    The expiry is fixed by the full handshake: tickets issued to resumed sessions
+    keep the expiry of the redeemed one, so a stolen ticket cannot be used to
+    extend a chain of resumptions beyond the lifetime.
+
+    Args:
+        rsa (CryptoHelperRSA): helper holding the server's RSA private key
+        lifetime (float): seconds a ticket remains valid
+    """
+
+    def __init__(self, rsa: CryptoHelperRSA, lifetime=constants.SESSION_TICKET_LIFETIME):
+        ticketKey = HKDF(long_to_bytes(rsa.key.d), 32, b'', SHA256, context=TICKET_KEY_CONTEXT)
+        self.aes = CryptoHelperAES(ticketKey)
+        self.lifetime = lifetime
+
+    def issue(self, clientId: str, secretHash: bytes, expiresAt: float = None) -> tuple[bytes, bytes]:
+        """
+        Creates a ticket for an authenticated client.
+
+        Args:
+            clientId (str): the authenticated client ID
+            secretHash (bytes): hashSecret() of the client's shared secret
+            expiresAt (float, optional): expiry of the ticket the session was resumed with, as returned
+                by redeem(); defaults to lifetime seconds from now for a full handshake
+
+        Returns:
+            tuple[bytes, bytes]: the opaque ticket and the resumption secret, both sent to the client
+        """
+        if expiresAt is None:
+            expiresAt = time.time() + self.lifetime
+        resumptionSecret = Random.get_random_bytes(32)
+        plaintext = TICKET_HEADER.pack(expiresAt, secretHash, resumptionSecret) + clientId.encode()
+        return self.aes.encrypt(plaintext), resumptionSecret
+
+    def redeem(self, hello: bytes) -> tuple[str, bytes, bytes, bytes]:
+        """
+        Validates a resumption hello (the client's ephemeral X25519 public key
+        followed by the ticket) and derives the session key.
+
+        Args:
+            hello (bytes): the resumption hello sent by the client
+
+        Returns:
+            tuple[str, bytes, bytes, bytes, float]: the client ID, the secret hash stored in the
+            ticket, the reply for the client (the server's ephemeral public key), the AES session key
+            and the ticket's expiry (time.time() based)
+
+        Raises:
+            ValueError: if the ticket is forged, malformed or expired
+        """
+        hello = bytes(hello)
+        clientPublic, ticket = hello[:X25519_KEY_SIZE], hello[X25519_KEY_SIZE:]
+        try:
+            plaintext = self.aes.decrypt(ticket)
+        except DecryptionError:
+            raise ValueError('Session ticket verification failed')
+        if len(plaintext) <= TICKET_HEADER.size:
+            raise ValueError('Malformed session ticket')
+        expiresAt, secretHash, resumptionSecret = TICKET_HEADER.unpack_from(plaintext)
+        if expiresAt < time.time():
+            raise ValueError('Session ticket expired')
+        peer = import_x25519_public_key(clientPublic)
+        ephemeralKey = ECC.generate(curve='Curve25519')
+        ephemeralPublic = _exportX25519(ephemeralKey)
+        aesKey = _deriveResumedSessionKey(resumptionSecret, _x25519(ephemeralKey, peer), clientPublic, ephemeralPublic)
+        return plaintext[TICKET_HEADER.size:].decode(), secretHash, ephemeralPublic, aesKey, expiresAt
+
+class CryptoHelperResumeClient:
+    """
+    Client side of a session resumption, see CryptoHelperTickets.
+
+    Args:
+        ticket (bytes): the opaque ticket issued by the server
+        resumptionSecret (bytes): the resumption secret issued with it
+    """
+
+    def __init__(self, ticket: bytes, resumptionSecret: bytes):
+        self.resumptionSecret = resumptionSecret
+        self.ephemeralKey = ECC.generate(curve='Curve25519')
+        self.publicKey = _exportX25519(self.ephemeralKey)
+        self.hello = self.publicKey + ticket
+
+    def finish(self, reply: bytes) -> bytes:
+        """
+        Args:
+            reply (bytes): the server's ephemeral X25519 public key
+
+        Returns:
+            bytes: the AES session key
+
+        Raises:
+            ValueError: if the reply is not a valid public key
+        """
+        reply = bytes(reply)
+        secret = _x25519(self.ephemeralKey, import_x25519_public_key(reply))
+        return _deriveResumedSessionKey(self.resumptionSecret, secret, self.publicKey, reply)
+
 class CryptoHelperAES:
     """
     AES encryption and decryption helper
@@ -66,17 +448,35 @@ class CryptoHelperAES:
         Returns:
             bytes: Nonce (16 bytes) + tag (16 bytes) + ciphertext
         """ 
+        return b''.join(self.encryptParts(data))
+
+    def encryptParts(self, data:bytes, output:bytearray=None) -> tuple[bytes, bytes, bytes]:
+        """
+        Encrypts data like encrypt, but returns the frame components separately
+        so they can be handed to a vectored send without concatenation.
+
+        Args:
+            data (bytes): Plaintext data to encrypt
+            output (bytearray | memoryview, optional): buffer of len(data) bytes to write the
+                ciphertext to; may be data itself to encrypt in place
+
+        Returns:
+            tuple[bytes, bytes, bytes]: nonce (16 bytes), tag (16 bytes), ciphertext (output, if given)
+        """
         cipher = AES.new(self.key, AES.MODE_EAX)
-        nonce = cipher.nonce
-        encrypted, tag = cipher.encrypt_and_digest(data)
-        return nonce + tag + encrypted
+        if output is None:
+            encrypted, tag = cipher.encrypt_and_digest(data)
+            return cipher.nonce, tag, encrypted
+        cipher.encrypt(data, output=output)
+        return cipher.nonce, cipher.digest(), output
 
     def decrypt(self, data:bytes) -> bytes:
         """
         Decrypts data encrypted with AES-EAX and verifies its integrity
         
         Args:
-            data (bytes): Concatenated nonce, tag, and ciphertext.
+            data (bytes | memoryview): Concatenated nonce, tag, and ciphertext.
+                Passing a memoryview avoids copying the ciphertext when slicing.
         
         Returns:
             bytes: Decrypted plaintext.
@@ -96,6 +496,29 @@ class CryptoHelperAES:
         except ValueError:
             raise DecryptionError("Message verification failed.")
 
+    def decryptInPlace(self, frame: bytearray) -> bytearray:
+        """
+        Decrypts a received frame like decrypt, writing the plaintext over the ciphertext.
+
+        Args:
+            frame (bytearray): Concatenated nonce, tag, and ciphertext; reused for the result.
+
+        Returns:
+            bytearray: the same buffer, holding only the plaintext.
+
+        Raises:
+            DecryptionError: If data authentication fails.
+        """
+        with memoryview(frame) as view:
+            cipher = AES.new(self.key, AES.MODE_EAX, nonce=view[:16])
+            cipher.decrypt(view[32:], output=view[32:])
+            try:
+                cipher.verify(view[16:32])
+            except ValueError:
+                raise DecryptionError("Message verification failed.")
+        del frame[:32]
+        return frame
+
     def generateKey(self):
         """
         Generates a new random AES key.
@@ -104,3 +527,183 @@ class CryptoHelperAES:
             bytes: Randomly generated 32 bytes (AES key)
         """
         return Random.get_random_bytes(32)
+
+    def exportState(self) -> dict:
+        """
+        Returns:
+            dict: the key, JSON serializable, for restoreSessionCipher in another process
+        """
+        return {'suite': LEGACY_CIPHER_SUITE, 'key': self.key.hex()}
+
+class CryptoHelperAEAD:
+    """
+    Session cipher for the negotiated AES-GCM and ChaCha20-Poly1305 suites.
+
+    Each direction has its own key, derived from the session key and the suite name, and
+    uses its message counter as the nonce. Nonces are therefore never sent and never
+    repeat, and a frame that is replayed, reordered or dropped fails authentication.
+    Frames consist of the tag (16 bytes) followed by the ciphertext and have to be
+    decrypted in the order they were encrypted, which the connections' send locks ensure.
+
+    pycryptodome binds a cipher object to a single nonce, so one is still created per
+    frame; the keys and nonce buffers are kept for the whole session.
+
+    Args:
+        key (bytes): session key from the key exchange
+        suite (str): 'aes-256-gcm' or 'chacha20-poly1305'
+        isServer (bool): True on the server side of the connection
+    """
+
+    def __init__(self, key: bytes, suite: str, isServer: bool):
+        if suite not in ('aes-256-gcm', 'chacha20-poly1305'):
+            raise ValueError(f'Unsupported cipher suite: {suite}')
+        self.suite = suite
+        keys = HKDF(key, 64, b'', SHA256, context=SESSION_CIPHER_CONTEXT + suite.encode())
+        clientKey, serverKey = keys[:32], keys[32:]
+        self.sendKey, self.recvKey = (serverKey, clientKey) if isServer else (clientKey, serverKey)
+        self.sendNonce = bytearray(12)
+        self.recvNonce = bytearray(12)
+        self.sendCounter = 0
+        self.recvCounter = 0
+
+    def _newCipher(self, key: bytes, nonce: bytearray, counter: int):
+        if counter >= 1 << 64:
+            raise DecryptionError('Message counter exhausted, the session has to be renewed')
+        struct.pack_into('>Q', nonce, 4, counter)
+        if self.suite == 'aes-256-gcm':
+            return AES.new(key, AES.MODE_GCM, nonce=bytes(nonce))
+        return ChaCha20_Poly1305.new(key=key, nonce=bytes(nonce))
+
+    def encrypt(self, data: bytes) -> bytes:
+        """
+        Encrypts data with the next send nonce.
+
+        Args:
+            data (bytes): Plaintext data to encrypt
+
+        Returns:
+            bytes: tag (16 bytes) + ciphertext
+        """
+        return b''.join(self.encryptParts(data))
+
+    def encryptParts(self, data: bytes, output: bytearray = None) -> tuple[bytes, bytearray]:
+        """
+        Encrypts data like encrypt, but returns the tag and the ciphertext separately
+        so they can be handed to a vectored send without concatenation.
+
+        Args:
+            data (bytes): Plaintext data to encrypt
+            output (bytearray | memoryview, optional): buffer of len(data) bytes to write the
+                ciphertext to; may be data itself to encrypt in place
+
+        Returns:
+            tuple[bytes, bytearray]: tag (16 bytes), ciphertext (output, if given)
+        """
+        cipher = self._newCipher(self.sendKey, self.sendNonce, self.sendCounter)
+        self.sendCounter += 1
+        if output is None:
+            output = bytearray(len(data))
+        cipher.encrypt(data, output=output)
+        return cipher.digest(), output
+
+    def decrypt(self, data: bytes, output: bytearray = None) -> bytearray:
+        """
+        Decrypts a frame encrypted by the peer with the next receive nonce and verifies its integrity.
+
+        Args:
+            data (bytes | memoryview): Concatenated tag and ciphertext.
+            output (bytearray | memoryview, optional): buffer of len(data) - 16 bytes for the plaintext
+
+        Returns:
+            bytearray: Decrypted plaintext (output, if given).
+
+        Raises:
+            DecryptionError: If data authentication fails.
+        """
+        if len(data) < AEAD_TAG_SIZE:
+            raise DecryptionError("Message too short.")
+        with memoryview(data) as view:
+            cipher = self._newCipher(self.recvKey, self.recvNonce, self.recvCounter)
+            if output is None:
+                output = bytearray(len(view) - AEAD_TAG_SIZE)
+            cipher.decrypt(view[AEAD_TAG_SIZE:], output=output)
+            try:
+                cipher.verify(view[:AEAD_TAG_SIZE])
+            except ValueError:
+                raise DecryptionError("Message verification failed.")
+        self.recvCounter += 1
+        return output
+
+    def decryptInPlace(self, frame: bytearray) -> bytearray:
+        """
+        Decrypts a received frame like decrypt, writing the plaintext over the ciphertext.
+
+        Args:
+            frame (bytearray): Concatenated tag and ciphertext; reused for the result.
+
+        Returns:
+            bytearray: the same buffer, holding only the plaintext.
+
+        Raises:
+            DecryptionError: If data authentication fails.
+        """
+        if len(frame) < AEAD_TAG_SIZE:
+            raise DecryptionError("Message too short.")
+        with memoryview(frame) as view:
+            self.decrypt(view, output=view[AEAD_TAG_SIZE:])
+        del frame[:AEAD_TAG_SIZE]
+        return frame
+
+    def exportState(self) -> dict:
+        """
+        Returns:
+            dict: the keys and message counters of both directions, JSON serializable, for
+            restoreSessionCipher in another process, which continues the session where this one stopped
+        """
+        return {'suite': self.suite, 'send_key': self.sendKey.hex(), 'recv_key': self.recvKey.hex(),
+                'send_counter': self.sendCounter, 'recv_counter': self.recvCounter}
+
+def createSessionCipher(key: bytes, suite: str, isServer: bool) -> CryptoHelperAES | CryptoHelperAEAD:
+    """
+    Creates the session cipher for a negotiated suite.
+
+    Args:
+        key (bytes): session key from the key exchange
+        suite (str): one of CIPHER_SUITES
+        isServer (bool): True on the server side of the connection
+
+    Returns:
+        CryptoHelperAES | CryptoHelperAEAD: helper with encryptParts, decrypt and decryptInPlace
+    """
+    if suite == LEGACY_CIPHER_SUITE:
+        return CryptoHelperAES(key)
+    return CryptoHelperAEAD(key, suite, isServer)
+
+def restoreSessionCipher(state: dict) -> CryptoHelperAES | CryptoHelperAEAD:
+    """
+    Recreates a session cipher from its exportState().
+
+    Args:
+        state (dict): exported state of the session cipher
+
+    Returns:
+        CryptoHelperAES | CryptoHelperAEAD: helper continuing the session
+
+    Raises:
+        ValueError: if the state is incomplete or names an unsupported suite
+    """
+    try:
+        if state['suite'] == LEGACY_CIPHER_SUITE:
+            return CryptoHelperAES(bytes.fromhex(state['key']))
+        if state['suite'] not in ('aes-256-gcm', 'chacha20-poly1305'):
+            raise ValueError(f"Unsupported cipher suite: {state['suite']}")
+        # The keys were derived by the process that ran the key exchange, the session key is not kept
+        cipher = CryptoHelperAEAD.__new__(CryptoHelperAEAD)
+        cipher.suite = state['suite']
+        cipher.sendKey, cipher.recvKey = bytes.fromhex(state['send_key']), bytes.fromhex(state['recv_key'])
+        cipher.sendCounter, cipher.recvCounter = int(state['send_counter']), int(state['recv_counter'])
+    except (KeyError, TypeError) as e:
+        raise ValueError(f'Invalid session cipher state: {e}')
+    cipher.sendNonce = bytearray(12)
+    cipher.recvNonce = bytearray(12)
+    return cipher
@@ -0,0 +1,444 @@
+import asyncio
+import logging
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import constants
+from crypto import cryptohelper
+from network.baseconnection import FRAME_HEADER_SIZE, FrameSizeError, encodeFrameHeader, decodeFrameHeader
+from network.secureconnection import GREETING, X25519_HELLO, COMPACT_HELLO, RESUME_HELLO, RESUME_REJECTED, CIPHER_SELECTED, ENVELOPE_FEATURE, HANDSHAKE_PING, HANDSHAKE_PONG, compactChallenge, selectCipherSuite, acceptFeatures, splitCipherOffer
+from network.compression import FrameCompressor
+from network.streams import IncomingStreams, StreamWriter, isSegment, splitSegment
+from network.protocolconnection import AuthenticationError, createAuthChallenge, verifyAuthResponse, acceptTicketClient, encodeSessionTicket, encodeMessage, parseResponse
+
+# Frames at least this large are compressed and decompressed in the default executor, off the event loop
+COMPRESSION_OFFLOAD_SIZE = 64 * 1024
+# Frames larger than this are read piecewise, so the keepalive scheduler sees them arriving
+RECV_CHUNK_SIZE = 256 * 1024
+# Waits for full stream readers; kept apart from the default executor, which the handshakes need
+STREAM_DELIVERY_POOL = ThreadPoolExecutor(constants.STREAM_DELIVERY_WORKERS, thread_name_prefix='FlitifyStreamDelivery')
+
+class AsyncServerProtocolConnection:
+    """
+    asyncio counterpart of ServerProtocolConnection, built on asyncio streams.
+
+    Speaks the same wire protocol (framing, greeting, RSA/AES key exchange and
+    shared secret authentication) as the threaded implementation. Coroutines must
+    run on the connection's event loop; invokeAction, sendPing, closeConnection and
+    closeConnectionWithReason are thread-safe facades so a ClientHandler can be
+    used from API server threads.
+
+    Args:
+        reader (asyncio.StreamReader): stream reader of the accepted connection
+        writer (asyncio.StreamWriter): stream writer of the accepted connection
+        rsa (CryptoHelperRSA): helper holding the server's private RSA key, usually a CryptoHelperRSAPool
+        dbHandler (DBHandler): database handler for retrieving client authentication secrets
+        maxFrameSize (int, optional): largest accepted frame payload (defaults to constants.MAX_FRAME_SIZE)
+        compression (FrameCompressor, optional): compression accepted from the client and its settings
+            (defaults to all algorithms)
+    """
+    def __init__(self, reader, writer, rsa, dbHandler, maxFrameSize=None, compression=None):
+        self.reader = reader
+        self.writer = writer
+        peerAddr = writer.get_extra_info('peername')
+        self.peerAddr = f'{peerAddr[0]}:{peerAddr[1]}'
+        self.rsa = rsa
+        self.db = dbHandler
+        self.maxFrameSize = maxFrameSize or constants.MAX_FRAME_SIZE
+        self.loop = asyncio.get_running_loop()
+        self.aes = None
+        self.clientId = None
+        self.authenticated = False
+        self.keyExchange = None
+        self.cipherSuite = cryptohelper.LEGACY_CIPHER_SUITE
+        self.binaryEnvelope = False
+        self.compression = compression or FrameCompressor()
+        self.compressor = None
+        self.authChallenge = None
+        self.running = True
+        self.lastActivity = time.monotonic()
+        self.lastReceived = self.lastActivity
+        # Seconds a send may go without progress before the peer is given up, like SO_SNDTIMEO of the threaded engine
+        self.sendTimeout = constants.SEND_TIMEOUT
+        self.pendingActions = {}
+        self.incomingStreams = IncomingStreams()
+        self.currentSeq = 0
+        self.logger = logging.getLogger('flitify')
+
+    async def recvLarge(self, timeout=None) -> bytes:
+        """
+        Receives a length-prefixed frame.
+
+        Args:
+            timeout (float, optional): seconds to wait for the whole frame, None waits indefinitely
+
+        Returns:
+            bytes: the received raw data
+
+        Raises:
+            BrokenPipeError: if the connection is closed by the peer
+            FrameSizeError: if the announced size exceeds maxFrameSize (the connection is closed)
+            TimeoutError: if the frame does not arrive in time
+        """
+        if not self.running:
+            raise BrokenPipeError("Attempted to recv on a closed connection")
+        try:
+            async with asyncio.timeout(timeout):
+                header = await self.reader.readexactly(FRAME_HEADER_SIZE)
+                size = decodeFrameHeader(header, self.maxFrameSize)
+                if size <= RECV_CHUNK_SIZE:
+                    data = await self.reader.readexactly(size)
+                else:
+                    data = bytearray(size)
+                    for start in range(0, size, RECV_CHUNK_SIZE):
+                        chunk = await self.reader.readexactly(min(RECV_CHUNK_SIZE, size - start))
+                        data[start:start + len(chunk)] = chunk
+                        self.lastReceived = time.monotonic()
+                self.lastActivity = self.lastReceived = time.monotonic()
+                return data
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.close()
+            raise BrokenPipeError("Connection closed")
+        except FrameSizeError:
+            self.close()
+            raise
+
+    async def sendLarge(self, *data: bytes):
+        """
+        Sends several buffers as a single length-prefixed frame.
+
+        Raises:
+            BrokenPipeError: if the connection is closed, or the peer accepted nothing
+                for sendTimeout seconds (the connection is closed)
+        """
+        if not self.running:
+            raise BrokenPipeError("Attempted to send on a closed connection")
+        self.writer.writelines((encodeFrameHeader(sum(len(part) for part in data)), *data))
+        try:
+            while True:
+                buffered = self.writer.transport.get_write_buffer_size()
+                try:
+                    async with asyncio.timeout(self.sendTimeout):
+                        await self.writer.drain()
+                    break
+                except TimeoutError:
+                    # Only a send making no progress at all times out, not a large frame on a slow link
+                    if self.writer.transport.get_write_buffer_size() >= buffered:
+                        self.logger.warning(f"{self.peerAddr}: Peer stopped reading, send timed out")
+                        # Closing would wait for the buffered data to be flushed first
+                        self.writer.transport.abort()
+                        self.close()
+                        raise BrokenPipeError("Send timed out")
+            self.lastActivity = time.monotonic()
+        except ConnectionError:
+            self.close()
+            raise BrokenPipeError("Connection closed")
+
+    async def sendEncryptedLarge(self, data: bytes, bulk=False):
+        """
+        Encrypts the payload with the session cipher and sends it as one frame,
+        compressed first if compression was negotiated.
+
+        Args:
+            data (bytes): the plaintext data to encrypt and send
+            bulk (bool): the payload is stream data (see FrameCompressor.compress)
+        """
+        if self.compressor is not None and len(data) >= self.compressor.threshold:
+            if len(data) >= COMPRESSION_OFFLOAD_SIZE:
+                compressed = await self.loop.run_in_executor(None, self.compressor.compress, data, bulk)
+            else:
+                compressed = self.compressor.compress(data, bulk)
+            data = compressed or data
+        await self.sendLarge(*self.aes.encryptParts(data))
+
+    async def recvEncryptedLarge(self, timeout=None) -> bytes:
+        """
+        Receives a frame and decrypts it with the session cipher.
+
+        Args:
+            timeout (float, optional): seconds to wait for the frame
+
+        Returns:
+            bytes: the decrypted plaintext data, decompressed if it was sent compressed
+
+        Raises:
+            FrameSizeError: if a compressed frame decompresses to more than maxFrameSize bytes
+            ValueError: if a compressed frame is corrupt
+        """
+        data = await self.recvLarge(timeout)
+        message = self.aes.decrypt(memoryview(data))
+        if self.compressor is None or not self.compressor.isCompressed(message):
+            return message
+        if len(message) >= COMPRESSION_OFFLOAD_SIZE:
+            return await self.loop.run_in_executor(None, self.compressor.decompress, message, self.maxFrameSize)
+        return self.compressor.decompress(message, self.maxFrameSize)
+
+    async def _redeemTicket(self, hello: bytes):
+        """
+        Redeems a session ticket, see ServerSecureConnection._redeemTicket.
+
+        Returns:
+            tuple[str, bytes, bytes, float] or None: the client ID, secret hash, AES session key
+            and expiry of the ticket, or None if the ticket was rejected
+        """
+        try:
+            clientId, secretHash, reply, aesKey, expiresAt = await self.loop.run_in_executor(None, self.rsa.getTicketHelper().redeem, hello)
+            if not await self.loop.run_in_executor(None, acceptTicketClient, clientId, secretHash, self.db):
+                raise ValueError(f'ticket of {clientId} is no longer accepted')
+        except ValueError as e:
+            self.logger.info(f"{self.peerAddr}: Session ticket rejected: {e}")
+            await self.sendLarge(RESUME_REJECTED)
+            return None
+        await self.sendLarge(reply)
+        return clientId, secretHash, aesKey, expiresAt
+
+    async def _exchangeKey(self, encMsg: bytes) -> bytes:
+        """
+        Completes a full key exchange, see ServerSecureConnection._exchangeKey.
+        """
+        for hello, keyExchange in ((COMPACT_HELLO, 'compact'), (X25519_HELLO, 'x25519')):
+            if encMsg.startswith(hello):
+                reply, aesKey = await self.loop.run_in_executor(None, self.rsa.getX25519Server().respond, encMsg[len(hello):])
+                await self.sendLarge(reply)
+                self.keyExchange = keyExchange
+                if keyExchange == 'compact':
+                    self.authChallenge = compactChallenge(reply)
+                return aesKey
+        self.keyExchange = 'rsa'
+        if isinstance(self.rsa, cryptohelper.CryptoHelperRSAPool):
+            return await asyncio.wrap_future(self.rsa.decryptFuture(encMsg))
+        return await self.loop.run_in_executor(None, self.rsa.decrypt, encMsg)
+
+    async def handshake(self) -> bool:
+        """
+        Performs the key exchange and the authentication handshake (in two round
+        trips for compact handshake clients), or redeems a session ticket in place of both.
+
+        RSA decryption runs in the helper's process pool (or the loop's default
+        executor for a plain helper); the X25519 exchange, ticket checks and the
+        secret lookup run in the default executor, so a burst of handshakes does
+        not stall established connections.
+
+        Returns:
+            bool: True if the client is authenticated, otherwise the connection is closed.
+        """
+        timeout = constants.SOCKET_TIMEOUT
+        try:
+            await self.sendLarge(GREETING.encode())
+            self.logger.debug(f'{self.peerAddr}: Greeting sent: {GREETING}')
+            encMsg = await self.recvLarge(timeout)
+            negotiation = None
+            offer = splitCipherOffer(encMsg)
+            if offer is not None:
+                offered, selectedPrefix = offer
+                self.cipherSuite = selectCipherSuite(offered)
+                features = acceptFeatures(offered, [ENVELOPE_FEATURE, *self.compression.features()])
+                self.binaryEnvelope = ENVELOPE_FEATURE in features
+                self.compressor = self.compression.negotiate(features)
+                selected = selectedPrefix + ','.join([self.cipherSuite, *features]).encode()
+                await self.sendLarge(selected)
+                if selectedPrefix == CIPHER_SELECTED:
+                    negotiation = bytes(encMsg) + selected
+                encMsg = await self.recvLarge(timeout)
+            resumed = expiresAt = None
+            if encMsg.startswith(RESUME_HELLO):
+                resumed = await self._redeemTicket(encMsg[len(RESUME_HELLO):])
+                if resumed is None:
+                    encMsg = await self.recvLarge(timeout)
+            if resumed is not None:
+                clientId, secretHash, aesKey, expiresAt = resumed
+                self.keyExchange = 'resume'
+            else:
+                aesKey = await self._exchangeKey(encMsg)
+            if negotiation is not None:
+                aesKey = cryptohelper.bindNegotiation(aesKey, negotiation)
+            self.aes = cryptohelper.createSessionCipher(aesKey, self.cipherSuite, isServer=True)
+            if self.keyExchange != 'compact':
+                await self.sendEncryptedLarge(HANDSHAKE_PING)
+                testMsg = await self.recvEncryptedLarge(timeout)
+                if testMsg != HANDSHAKE_PONG:
+                    raise ValueError(f'Incorrect handshake message: {testMsg}')
+            self.logger.debug(f"{self.peerAddr}: Handshake finished")
+
+            if resumed is None:
+                if self.keyExchange == 'compact':
+                    challenge = self.authChallenge
+                else:
+                    challenge = createAuthChallenge()
+                    await self.sendEncryptedLarge(f'AUTH_REQUIRED:{challenge}'.encode())
+                response = await self.recvEncryptedLarge(timeout)
+                try:
+                    clientId, secret = await self.loop.run_in_executor(None, verifyAuthResponse, challenge, response, self.db)
+                except AuthenticationError:
+                    await self.sendEncryptedLarge(b'AUTH_INVALID')
+                    raise
+                await self.sendEncryptedLarge(b'AUTH_CORRECT')
+                secretHash = cryptohelper.hashSecret(secret)
+            self.clientId = clientId
+            self.authenticated = True
+            if self.keyExchange != 'rsa':
+                await self.sendEncryptedLarge(encodeSessionTicket(self.rsa.getTicketHelper(), clientId, secretHash, expiresAt))
+            self.logger.info(f'{self.peerAddr}: Authentication successful as {self.clientId}{" (resumed)" if resumed else ""}')
+            return True
+        except ValueError as e:
+            self.logger.warning(f'{self.peerAddr}: Unexpected data during handshake, closing connection: {e}')
+        except AuthenticationError as e:
+            self.logger.warning(f'{self.peerAddr}: Authentication error: {e}')
+        except BrokenPipeError:
+            self.logger.warning(f'{self.peerAddr}: Connection broken during handshake')
+        except TimeoutError:
+            self.logger.warning(f'{self.peerAddr}: Connection timed out during handshake')
+        except Exception as e:
+            self.logger.error(f'{self.peerAddr}: Uncaught exception during handshake: {e}')
+        self.close()
+        return False
+
+    async def invokeActionAsync(self, actionType: str, actionData: dict, timeout=constants.SOCKET_TIMEOUT):
+        """
+        Sends an action request to the client and waits for the response with the same seq.
+
+        Args:
+            actionType (str): The type of action to invoke on the client.
+            actionData (dict): Payload data for the action.
+            timeout (float, optional): Seconds to wait for the response, None waits indefinitely.
+
+        Returns:
+            tuple[str, dict] or None: The response type and data, or None if the client rejected the action.
+
+        Raises:
+            BrokenPipeError: If the connection is closed before the response arrives.
+            TimeoutError: If the client does not respond within the timeout.
+        """
+        self.currentSeq += 1
+        seq = self.currentSeq
+        future = self.loop.create_future()
+        self.pendingActions[seq] = future
+        try:
+            await self.sendEncryptedLarge(encodeMessage(actionType, actionData, seq, self.binaryEnvelope))
+            async with asyncio.timeout(timeout):
+                return await future
+        except ValueError as e:
+            self.logger.warning(f"{self.peerAddr} ({self.clientId}): client sent invalid action response: {e}")
+        finally:
+            self.pendingActions.pop(seq, None)
+
+    async def invokeStreamActionAsync(self, actionType: str, actionData: dict, timeout=constants.SOCKET_TIMEOUT):
+        """
+        Sends an action whose response is followed by a stream, see ServerProtocolConnection.invokeStreamAction.
+        The returned StreamReader blocks and is meant to be consumed outside the event loop.
+        """
+        # invokeActionAsync takes the next seq before its first await, nothing can claim it in between
+        stream = self.incomingStreams.open(self.currentSeq + 1)
+        try:
+            response = await self.invokeActionAsync(actionType, actionData, timeout)
+        except BaseException:
+            stream.close()
+            raise
+        if response is None:
+            stream.close()
+            return None
+        return response[0], response[1], stream
+
+    async def readLoop(self):
+        """
+        Receives action responses and resolves the future waiting for each seq.
+        Runs until the connection is closed.
+        """
+        try:
+            while self.running:
+                response = await self.recvEncryptedLarge()
+                if isSegment(response):
+                    await self._deliverSegment(*splitSegment(response))
+                    continue
+                try:
+                    response = parseResponse(response)
+                except ValueError as e:
+                    self.logger.warning(f"{self.peerAddr} ({self.clientId}): client sent invalid action response: {e}")
+                    continue
+                future = self.pendingActions.pop(response['seq'], None)
+                if future is None or future.done():
+                    self.logger.debug(f"{self.peerAddr} ({self.clientId}): dropping response for unknown seq {response['seq']}")
+                elif response['type'] == 'invalid_action':
+                    future.set_exception(ValueError("client sent 'invalid_action'"))
+                else:
+                    future.set_result((response['type'], response['data']))
+        except (BrokenPipeError, OSError):
+            self.logger.debug(f"{self.peerAddr} ({self.clientId}): connection closed, readLoop finished")
+        except Exception as e:
+            self.logger.warning(f"{self.peerAddr} ({self.clientId}): readLoop stopped: {e}")
+        finally:
+            self.close()
+
+    async def _deliverSegment(self, flags: int, streamId: int, payload: bytes):
+        """
+        Hands a segment to its reader; waits for a full reader in STREAM_DELIVERY_POOL,
+        so other connections keep being served while this one is throttled, and stalled
+        readers never hold up the handshakes running in the default executor.
+        """
+        try:
+            delivered = self.incomingStreams.deliver(flags, streamId, payload, block=False)
+        except queue.Full:
+            delivered = await self.loop.run_in_executor(STREAM_DELIVERY_POOL, self.incomingStreams.deliver, flags, streamId, payload)
+        if not delivered:
+            self.logger.debug(f"{self.peerAddr} ({self.clientId}): dropping segment of a closed stream")
+
+    async def closeWithReason(self, reason: str):
+        """
+        Informs the client of the reason and closes the connection.
+        """
+        try:
+            await self.sendEncryptedLarge(encodeMessage('kick', {'reason': reason}, binary=self.binaryEnvelope))
+        except Exception as e:
+            self.logger.warning(f'{self.peerAddr} ({self.clientId or "unknown"}): failed to close connection gracefully: {e}')
+        self.close()
+        self.logger.debug(f"{self.peerAddr} ({self.clientId or 'unknown'}): connection closed with reason {reason}")
+
+    def close(self):
+        """
+        Closes the stream and fails every action still waiting for a response.
+        Must be called on the event loop.
+        """
+        if not self.running:
+            return
+        self.running = False
+        self.writer.close()
+        pending = list(self.pendingActions.values())
+        self.pendingActions.clear()
+        for future in pending:
+            if not future.done():
+                future.set_exception(BrokenPipeError("Connection closed while waiting for a response"))
+        self.incomingStreams.failAll()
+
+    # Thread-safe facade matching ServerProtocolConnection, used by ClientHandler
+
+    def invokeAction(self, actionType: str, actionData: dict, timeout=constants.SOCKET_TIMEOUT):
+        """ Refer to ServerProtocolConnection.invokeAction. Must not be called on the event loop. """
+        return asyncio.run_coroutine_threadsafe(self.invokeActionAsync(actionType, actionData, timeout), self.loop).result()
+
+    def invokeStreamAction(self, actionType: str, actionData: dict, timeout=constants.SOCKET_TIMEOUT):
+        """ Refer to ServerProtocolConnection.invokeStreamAction. Must not be called on the event loop. """
+        return asyncio.run_coroutine_threadsafe(self.invokeStreamActionAsync(actionType, actionData, timeout), self.loop).result()
+
+    def openStream(self, streamId: int) -> StreamWriter:
+        """ Refer to ServerProtocolConnection.openStream. The writer must not be used on the event loop. """
+        return StreamWriter(self._sendSegment, streamId)
+
+    def _sendSegment(self, buffer):
+        # The transport may keep a reference to unsent data, so the writer's buffer is not encrypted in place
+        asyncio.run_coroutine_threadsafe(self.sendEncryptedLarge(buffer, bulk=True), self.loop).result()
+
+    def hasPendingActions(self) -> bool:
+        return bool(self.pendingActions)
+
+    def sendPing(self):
+        """ Refer to ServerProtocolConnection.sendPing. Returns a concurrent Future without blocking. """
+        if not self.running:
+            return None
+        return asyncio.run_coroutine_threadsafe(self.invokeActionAsync('ping', {}, timeout=None), self.loop)
+
+    def closeConnection(self):
+        self.loop.call_soon_threadsafe(self.close)
+
+    def closeConnectionWithReason(self, reason: str):
+        asyncio.run_coroutine_threadsafe(self.closeWithReason(reason), self.loop).result()
@@ -1,29 +1,133 @@
 import struct
 import logging
+import select
+import socket
+import sys
+import time
 
 import constants
 
+FRAME_HEADER_SIZE = 4
+# Upper bound for the number of buffers handed to a single sendmsg call (POSIX IOV_MAX minimum)
+MAX_IOV = 1024
+
+class FrameSizeError(ValueError):
+    """ Raised when a frame header announces a payload larger than the allowed maximum """
+    pass
+
+def encodeFrameHeader(size: int) -> bytes:
+    """
+    Encodes the length prefix of a frame.
+
+    Args:
+        size (int): payload size in bytes
+
+    Returns:
+        bytes: FRAME_HEADER_SIZE bytes, big endian
+    """
+    return size.to_bytes(FRAME_HEADER_SIZE, 'big')
+
+def decodeFrameHeader(header: bytes, maxFrameSize: int) -> int:
+    """
+    Decodes and validates the length prefix of a frame.
+
+    Args:
+        header (bytes): FRAME_HEADER_SIZE bytes received from the peer
+        maxFrameSize (int): largest accepted payload size
+
+    Returns:
+        int: payload size in bytes
+
+    Raises:
+        FrameSizeError: if the announced size exceeds maxFrameSize
+    """
+    size = int.from_bytes(header, 'big')
+    if size > maxFrameSize:
+        raise FrameSizeError(f"Frame of {size} bytes exceeds the limit of {maxFrameSize} bytes")
+    return size
+
 class BaseConnection:
     """
     Basic connection wrapper for socket communication.
 
+    lastActivity holds the time.monotonic() timestamp of the last successful send
+    or receive, so liveness checks can skip connections that carry traffic;
+    lastReceived that of the last receive only, which alone proves the peer alive.
+
     Args:
         socket (socket): socket object
         peerAddr ((<str>, int)): address of the peer
+        maxFrameSize (int, optional): largest payload accepted by recvLarge (defaults to constants.MAX_FRAME_SIZE)
     """
-    def __init__(self, socket, peerAddr):
+    def __init__(self, socket, peerAddr, maxFrameSize=None):
         self.socket = socket
         self.peerAddr = peerAddr
         self.peerAddr = f'{self.peerAddr[0]}:{self.peerAddr[1]}'
+        self.maxFrameSize = maxFrameSize or constants.MAX_FRAME_SIZE
+        self._headerView = memoryview(bytearray(FRAME_HEADER_SIZE))
+        self._closeCallbacks = []
         self.running = True
+        self.lastActivity = time.monotonic()
+        self.lastReceived = self.lastActivity
         self.logger = logging.getLogger('flitify')
 
     def closeConnection(self):
         """
         Closes the socket and marks the connection as not running.
+        The socket is shut down first so threads blocked on it are woken up.
+        Close callbacks run once, on the first call.
         """
         self.running = False
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
         self.socket.close()
+        callbacks, self._closeCallbacks = self._closeCallbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                self.logger.error(f"{self.peerAddr}: close callback failed: {e}")
+
+    def addCloseCallback(self, callback):
+        """
+        Registers a function to be called when the connection is closed.
+        If the connection is already closed, the callback runs immediately.
+
+        Args:
+            callback (callable): function taking no arguments
+        """
+        self._closeCallbacks.append(callback)
+        if not self.running:
+            self.closeConnection()
+
+    def setSendTimeout(self, timeout: float):
+        """
+        Bounds how long a send on the blocking socket may go without progress, so a
+        peer that stopped reading cannot block the sending thread forever. Such a send
+        closes the connection. Unlike socket.settimeout, receives are not affected.
+
+        Args:
+            timeout (float): seconds without any byte accepted by the socket
+        """
+        seconds, fraction = divmod(timeout, 1)
+        if sys.platform == 'win32':
+            value = struct.pack('I', int(timeout * 1000))
+        else:
+            value = struct.pack('ll', int(seconds), int(fraction * 1000000))
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_SNDTIMEO, value)
+
+    def canSend(self) -> bool:
+        """
+        Returns:
+            bool: True if the socket's send buffer has room, so a small frame leaves without blocking
+        """
+        if hasattr(select, 'poll'):
+            poller = select.poll()
+            poller.register(self.socket, select.POLLOUT)
+            return bool(poller.poll(0))
+        return bool(select.select([], [self.socket], [], 0)[1])
 
     def sendRaw(self, data: bytes):
         """
@@ -39,10 +143,58 @@ class BaseConnection:
             raise BrokenPipeError("Attempted to send on a closed connection")
         try:
             self.socket.sendall(data)
+            self.lastActivity = time.monotonic()
         except BrokenPipeError:
             self.logger.debug(f"{self.peerAddr}: Connection closed during sendRaw")
             self.closeConnection()
             raise
+        except BlockingIOError:
+            self._sendTimedOut()
+
+    def sendRawParts(self, parts):
+        """
+        Sends several buffers as one contiguous stream without joining them in Python.
+
+        Uses a single vectored socket.sendmsg call where available and keeps
+        resending the unsent tail on partial writes. Falls back to one sendall
+        per buffer on platforms without sendmsg (Windows).
+
+        Args:
+            parts (iterable of bytes-like): buffers to be sent, in order
+
+        Raises:
+            BrokenPipeError: if the connection is closed during sending
+        """
+        if not self.running:
+            raise BrokenPipeError("Attempted to send on a closed connection")
+        try:
+            if not hasattr(self.socket, 'sendmsg'):
+                for part in parts:
+                    self.socket.sendall(part)
+                self.lastActivity = time.monotonic()
+                return
+            views = [memoryview(part) for part in parts if len(part)]
+            while views:
+                sent = self.socket.sendmsg(views[:MAX_IOV])
+                while sent:
+                    if sent >= len(views[0]):
+                        sent -= len(views.pop(0))
+                    else:
+                        views[0] = views[0][sent:]
+                        sent = 0
+            self.lastActivity = time.monotonic()
+        except BrokenPipeError:
+            self.logger.debug(f"{self.peerAddr}: Connection closed during sendRawParts")
+            self.closeConnection()
+            raise
+        except BlockingIOError:
+            self._sendTimedOut()
+
+    def _sendTimedOut(self):
+        """ Closes the connection after a send ran into the send timeout (see setSendTimeout). """
+        self.logger.warning(f"{self.peerAddr}: Peer stopped reading, send timed out")
+        self.closeConnection()
+        raise BrokenPipeError("Send timed out")
 
     def recvRaw(self, size: int) -> bytes:
         """
@@ -64,30 +216,75 @@ class BaseConnection:
             self.closeConnection()
             self.logger.debug(f"{self.peerAddr}: Connection closed during recvRaw")
             raise BrokenPipeError("Connection closed")
+        self.lastActivity = self.lastReceived = time.monotonic()
         return data
 
-    def recvLarge(self) -> bytes:
+    def recvInto(self, buffer: memoryview) -> int:
+        """
+        Receives raw data from the socket directly into a writable buffer.
+
+        Args:
+            buffer (memoryview): Writable buffer; at most len(buffer) bytes are received
+
+        Returns:
+            int: Number of bytes written into the buffer
+
+        Raises:
+            BrokenPipeError: If the connection is closed by the peer
+        """
+        if not self.running:
+            raise BrokenPipeError("Attempted to recv on a closed connection")
+        received = self.socket.recv_into(buffer)
+        if not received:
+            self.closeConnection()
+            self.logger.debug(f"{self.peerAddr}: Connection closed during recvInto")
+            raise BrokenPipeError("Connection closed")
+        self.lastActivity = self.lastReceived = time.monotonic()
+        return received
+
+    def recvExactly(self, buffer: memoryview):
+        """
+        Fills the whole buffer with data received from the socket.
+
+        Args:
+            buffer (memoryview): Writable buffer to fill
+        """
+        size = len(buffer)
+        received = self.recvInto(buffer) if size else 0
+        while received < size:
+            received += self.recvInto(buffer[received:])
+
+    def recvLarge(self) -> bytearray:
         """
         Receives a large block of data that was sent using sendLarge.
 
+        The payload buffer is allocated once, after the length header is known,
+        and filled in place.
+
         Returns:
-            bytes: the received raw data
+            bytearray: the received raw data
+
+        Raises:
+            FrameSizeError: if the announced size exceeds maxFrameSize (the connection is closed)
         """
-        size_bytes = self.recvRaw(4)
-        size = int.from_bytes(size_bytes, 'big')
-        data = b''
-        while len(data) < size:
-            data += self.recvRaw(size - len(data))
+        self.recvExactly(self._headerView)
+        try:
+            size = decodeFrameHeader(self._headerView, self.maxFrameSize)
+        except FrameSizeError:
+            self.closeConnection()
+            raise
+        data = bytearray(size)
+        self.recvExactly(memoryview(data))
         return data
 
-    def sendLarge(self, data:bytes):
+    def sendLarge(self, *data:bytes):
         """
-        Sends a large block of data.
+        Sends a large block of data as a single length-prefixed frame.
 
         Args:
-            data (bytes): data to be send
+            *data (bytes): data to be send; several buffers are sent back to back
+                as one frame, together with the header, in a single vectored write
         """
-        size = len(data).to_bytes(4, 'big')
-        self.sendRaw(size)
-        self.sendRaw(data)
+        size = encodeFrameHeader(sum(len(part) for part in data))
+        self.sendRawParts((size, *data))
 
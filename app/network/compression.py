@@ -0,0 +1,144 @@
+"""
+Per-frame compression, negotiated like binary envelopes by listing features after
+the suites of the cipher offer (see secureconnection).
+
+A compressed frame's plaintext is a marker byte followed by the compressed original
+plaintext; it is compressed before encryption and decompressed right after
+decryption, so everything above the secure connection sees the original frames.
+Markers differ from the first byte of every other kind of message (JSON, binary
+envelopes, stream segments and handshake messages).
+
+    zlib    messages and stream data, at a selectable level
+    lzma    stream data (bulk transfers) when negotiated: smaller but much slower
+"""
+import lzma
+import zlib
+
+import constants
+from network.baseconnection import FrameSizeError
+
+ZLIB_MARKER = 0x81
+LZMA_MARKER = 0x82
+MARKERS = {'zlib': ZLIB_MARKER, 'lzma': LZMA_MARKER}
+COMPRESSION_ALGORITHMS = list(MARKERS)
+# A frame is only compressed when its sample shrinks to less than this ratio
+SAMPLE_RATIO = 0.9
+
+def compressionFeature(algorithm: str) -> str:
+    """
+    Returns:
+        str: the cipher offer feature requesting an algorithm
+    """
+    return '+' + algorithm
+
+class FrameCompressor:
+    """
+    Compression settings of one side of a connection, and the compressor of its
+    outgoing frames once negotiated.
+
+    Frames below threshold are sent as they are. Larger ones are first checked by
+    compressing a sample of their leading bytes at the fastest zlib level, so
+    already compressed or encrypted data costs little; they are also sent as they
+    are if compression does not make them smaller.
+
+    Args:
+        algorithms (list[str]): algorithms offered (agents) or accepted (servers), out of COMPRESSION_ALGORITHMS
+        level (int): zlib compression level, 1 (fastest) to 9 (smallest)
+        threshold (int): smallest frame that is compressed
+        lzmaPreset (int): lzma preset for stream data, 0 (fastest) to 9 (smallest)
+
+    Raises:
+        ValueError: for an unknown algorithm or a level out of range
+    """
+    def __init__(self, algorithms=COMPRESSION_ALGORITHMS, level=constants.COMPRESSION_LEVEL,
+                 threshold=constants.COMPRESSION_THRESHOLD, lzmaPreset=constants.LZMA_PRESET):
+        for algorithm in algorithms:
+            if algorithm not in MARKERS:
+                raise ValueError(f'Unknown compression algorithm: {algorithm}')
+        if not 1 <= level <= 9 or not 0 <= lzmaPreset <= 9:
+            raise ValueError(f'Compression level out of range: {level}, lzma preset {lzmaPreset}')
+        self.algorithms = list(algorithms)
+        self.level = level
+        self.threshold = threshold
+        self.lzmaPreset = lzmaPreset
+
+    def features(self) -> list[str]:
+        """
+        Returns:
+            list[str]: the cipher offer features for the configured algorithms
+        """
+        return [compressionFeature(algorithm) for algorithm in self.algorithms]
+
+    def negotiate(self, features: list[str]) -> 'FrameCompressor | None':
+        """
+        Restricts the settings to the algorithms both sides support.
+
+        Args:
+            features (list[str]): features offered by the agent or accepted by the server
+
+        Returns:
+            FrameCompressor or None: compressor for the connection, None if no algorithm is shared
+        """
+        algorithms = [algorithm for algorithm in self.algorithms if compressionFeature(algorithm) in features]
+        if not algorithms:
+            return None
+        return FrameCompressor(algorithms, self.level, self.threshold, self.lzmaPreset)
+
+    def compress(self, data, bulk=False) -> bytes | None:
+        """
+        Args:
+            data (bytes | bytearray | memoryview): plaintext of a frame
+            bulk (bool): the frame is a stream segment, compressed with lzma if negotiated
+
+        Returns:
+            bytes or None: the compressed frame, or None if it should be sent as it is
+        """
+        if len(data) < self.threshold:
+            return None
+        if len(data) > constants.COMPRESSION_SAMPLE_SIZE:
+            sample = memoryview(data)[:constants.COMPRESSION_SAMPLE_SIZE]
+            if len(zlib.compress(sample, 1)) > len(sample) * SAMPLE_RATIO:
+                return None
+        if (bulk and 'lzma' in self.algorithms) or 'zlib' not in self.algorithms:
+            compressed = bytes([LZMA_MARKER]) + lzma.compress(data, preset=self.lzmaPreset, check=lzma.CHECK_NONE)
+        else:
+            compressed = bytes([ZLIB_MARKER]) + zlib.compress(data, self.level)
+        return compressed if len(compressed) < len(data) else None
+
+    def isCompressed(self, message) -> bool:
+        """
+        Returns:
+            bool: True if a decrypted frame is compressed with one of the negotiated algorithms
+        """
+        return len(message) > 0 and message[0] in (MARKERS[algorithm] for algorithm in self.algorithms)
+
+    def decompress(self, message, maxSize: int) -> bytearray:
+        """
+        Args:
+            message (bytes | bytearray): a decrypted frame for which isCompressed() is True
+            maxSize (int): largest accepted decompressed size, normally the frame size limit
+
+        Returns:
+            bytearray: the original plaintext
+
+        Raises:
+            FrameSizeError: if the frame decompresses to more than maxSize bytes
+            ValueError: if the compressed data is corrupt or truncated, or would take more
+                than LZMA_MEMORY_LIMIT bytes of memory to decompress
+        """
+        if message[0] == ZLIB_MARKER:
+            decompressor = zlib.decompressobj()
+            error = zlib.error
+        else:
+            # The dictionary size comes from the peer; a huge one would be allocated before decoding a byte
+            decompressor = lzma.LZMADecompressor(lzma.FORMAT_XZ, memlimit=constants.LZMA_MEMORY_LIMIT)
+            error = lzma.LZMAError
+        try:
+            data = decompressor.decompress(memoryview(message)[1:], maxSize + 1)
+        except error as e:
+            raise ValueError(f'Invalid compressed frame: {e}')
+        if len(data) > maxSize:
+            raise FrameSizeError(f"Compressed frame exceeds the limit of {maxSize} bytes")
+        if not decompressor.eof or decompressor.unused_data:
+            raise ValueError('Compressed frame ended early or has trailing data')
+        return bytearray(data)
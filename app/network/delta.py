@@ -0,0 +1,329 @@
+"""
+rsync-style delta transfer: the receiver describes the file it has by a signature of
+per-block checksums, the sender answers with a delta made of references to those
+blocks and literal data for everything else, and the receiver rebuilds the new file
+from its old one and the delta.
+
+Signature: one SIGNATURE_ENTRY per block of the old file, holding the weak (Adler-32)
+and strong (BLAKE2b) checksum of the block; the last block may be shorter.
+
+Delta: a sequence of operations
+    OP_COPY     copy count blocks of the old file, starting at block first
+    OP_LITERAL  the next length bytes are data of the new file
+    OP_DIGEST   the SHA-256 of the new file, always the last operation
+"""
+import hashlib
+import math
+import struct
+import zlib
+
+import constants
+
+SIGNATURE_ENTRY = struct.Struct('>I16s')
+OP_COPY = 0x43
+OP_LITERAL = 0x4c
+OP_DIGEST = 0x44
+COPY_HEADER = struct.Struct('>BQI')
+LITERAL_HEADER = struct.Struct('>BI')
+DIGEST_SIZE = 32
+HEADER_SIZES = {OP_COPY: COPY_HEADER.size, OP_LITERAL: LITERAL_HEADER.size, OP_DIGEST: 1 + DIGEST_SIZE}
+ADLER_MODULUS = 65521
+READ_SIZE = 1024 * 1024
+
+class DeltaError(Exception):
+    """
+    Raised for a malformed delta, one referring to blocks the old file does not have,
+    or a rebuilt file not matching the digest of the new one.
+    """
+    pass
+
+def chooseBlockSize(fileSize: int) -> int:
+    """
+    Picks the block size for a file's signature: about the square root of the file size,
+    which balances the size of the signature against the literal data sent for each change.
+
+    Returns:
+        int: a power of two between DELTA_MIN_BLOCK_SIZE and DELTA_MAX_BLOCK_SIZE
+    """
+    blockSize = 1 << max(math.isqrt(fileSize) - 1, 1).bit_length()
+    return min(max(blockSize, constants.DELTA_MIN_BLOCK_SIZE), constants.DELTA_MAX_BLOCK_SIZE)
+
+def strongChecksum(block: bytes) -> bytes:
+    return hashlib.blake2b(block, digest_size=16).digest()
+
+def fileSignature(file, blockSize: int):
+    """
+    Computes the signature of a file block by block.
+
+    Args:
+        file: binary file object, read until EOF
+        blockSize (int): block size in bytes
+
+    Yields:
+        bytes: one packed SIGNATURE_ENTRY per block
+    """
+    buffer = bytearray(blockSize)
+    view = memoryview(buffer)
+    while True:
+        count = file.readinto(buffer)
+        if not count:
+            return
+        block = view[:count]
+        yield SIGNATURE_ENTRY.pack(zlib.adler32(block), strongChecksum(block))
+
+class Signature:
+    """
+    Block checksums of the receiver's file, indexed for lookups by the encoder.
+
+    Args:
+        data (bytes): the concatenated signature entries
+        blockSize (int): block size the signature was computed with
+        fileSize (int): size of the file
+
+    Raises:
+        DeltaError: if the number of entries does not match the file size
+    """
+    def __init__(self, data: bytes, blockSize: int, fileSize: int):
+        if len(data) % SIGNATURE_ENTRY.size or len(data) // SIGNATURE_ENTRY.size != -(-fileSize // blockSize):
+            raise DeltaError(f'signature of {len(data)} bytes does not match a file of {fileSize} bytes')
+        self.blockSize = blockSize
+        self.fileSize = fileSize
+        # Length of a shorter last block, which can only match at the end of the new file
+        self.lastBlockSize = fileSize % blockSize
+        self.blocks = {}
+        for index, (weak, strong) in enumerate(SIGNATURE_ENTRY.iter_unpack(data)):
+            self.blocks.setdefault(weak, {}).setdefault(strong, index)
+
+    def find(self, weak: int, block: bytes) -> int | None:
+        """
+        Returns:
+            int or None: index of a block of the file with the given contents
+        """
+        candidates = self.blocks.get(weak)
+        if candidates is None:
+            return None
+        return candidates.get(strongChecksum(block))
+
+class DeltaEncoder:
+    """
+    Computes the delta turning the file a signature describes into a new one, reading
+    the new file once, sequentially, with memory use bounded by a few read buffers.
+
+    The weak checksum is rolled over every offset of the new file, so blocks moved by
+    insertions or deletions are found. Rolling runs in Python at a few MB/s; once
+    rollingLimit bytes in a row matched nothing, the encoder only checks whole blocks
+    until the next match, keeping wholly new data cheap to encode.
+
+    Args:
+        signature (Signature): signature of the receiver's file
+        rollingLimit (int): unmatched bytes checked at every offset before skipping ahead
+
+    Attributes:
+        literalBytes (int): bytes of the new file sent as literal data
+        copiedBytes (int): bytes of the new file referenced in the old one
+    """
+    def __init__(self, signature: Signature, rollingLimit=constants.DELTA_ROLLING_LIMIT):
+        self.signature = signature
+        self.rollingLimit = rollingLimit
+        self.literalBytes = 0
+        self.copiedBytes = 0
+        self.pendingCopy = None
+
+    def encode(self, source, size: int = None):
+        """
+        Args:
+            source: binary file object holding the new file
+            size (int, optional): bytes to read from source; defaults to everything until EOF
+
+        Yields:
+            bytes: the delta, in pieces of at most READ_SIZE bytes of literal data
+        """
+        signature = self.signature
+        blockSize = signature.blockSize
+        lastBlockSize = signature.lastBlockSize
+        blocks = signature.blocks
+        modulus = ADLER_MODULUS
+        digest = hashlib.sha256()
+        buffer = bytearray()
+        pos = literalStart = 0
+        left = size
+        eof = False
+        a = b = None
+        unmatched = 0
+        while True:
+            if len(buffer) - pos <= blockSize and not eof:
+                yield from self._literal(buffer, literalStart, pos)
+                del buffer[:pos]
+                pos = literalStart = 0
+                data = source.read(READ_SIZE if left is None else min(READ_SIZE, left))
+                if data:
+                    digest.update(data)
+                    buffer += data
+                    if left is not None:
+                        left -= len(data)
+                if not data or left == 0:
+                    eof = True
+                continue
+            remaining = len(buffer) - pos
+            if remaining < blockSize:
+                # End of the new file: only a shorter last block of the old file can match here
+                tailStart = len(buffer) - lastBlockSize
+                if lastBlockSize and tailStart >= pos:
+                    tail = bytes(buffer[tailStart:])
+                    index = signature.find(zlib.adler32(tail), tail)
+                    if index is not None:
+                        yield from self._literal(buffer, literalStart, tailStart)
+                        yield from self._copy(index, lastBlockSize)
+                        literalStart = pos = len(buffer)
+                yield from self._literal(buffer, literalStart, len(buffer))
+                break
+            if a is None:
+                weak = zlib.adler32(buffer[pos:pos + blockSize])
+                a, b = weak & 0xffff, weak >> 16
+            if (b << 16 | a) in blocks:
+                index = signature.find(b << 16 | a, bytes(buffer[pos:pos + blockSize]))
+                if index is not None:
+                    yield from self._literal(buffer, literalStart, pos)
+                    yield from self._copy(index, blockSize)
+                    pos += blockSize
+                    literalStart = pos
+                    a = None
+                    unmatched = 0
+                    continue
+            if unmatched >= self.rollingLimit:
+                # Long unmatched run: check the next whole block only
+                pos += blockSize
+                unmatched += blockSize
+                a = None
+            else:
+                # Roll the checksum forward until a candidate turns up or the buffer runs low
+                end = min(len(buffer) - blockSize, pos + self.rollingLimit - unmatched)
+                start = pos
+                while pos < end:
+                    outgoing = buffer[pos]
+                    a = (a - outgoing + buffer[pos + blockSize]) % modulus
+                    b = (b - blockSize * outgoing + a - 1) % modulus
+                    pos += 1
+                    if (b << 16 | a) in blocks:
+                        break
+                if pos == start:
+                    # At the very end of the new file, nothing left to roll in
+                    pos += 1
+                    a = None
+                unmatched += pos - start
+            if pos - literalStart >= READ_SIZE:
+                yield from self._literal(buffer, literalStart, pos)
+                literalStart = pos
+        yield from self._flushCopy()
+        yield bytes([OP_DIGEST]) + digest.digest()
+
+    def _literal(self, buffer: bytearray, start: int, end: int):
+        if end <= start:
+            return
+        yield from self._flushCopy()
+        self.literalBytes += end - start
+        yield LITERAL_HEADER.pack(OP_LITERAL, end - start)
+        yield bytes(buffer[start:end])
+
+    def _copy(self, index: int, length: int):
+        self.copiedBytes += length
+        if self.pendingCopy is not None:
+            first, count = self.pendingCopy
+            if index == first + count:
+                self.pendingCopy = (first, count + 1)
+                return
+            yield from self._flushCopy()
+        self.pendingCopy = (index, 1)
+
+    def _flushCopy(self):
+        if self.pendingCopy is not None:
+            yield COPY_HEADER.pack(OP_COPY, *self.pendingCopy)
+            self.pendingCopy = None
+
+class DeltaDecoder:
+    """
+    Rebuilds a new file from the old one and a delta, fed in pieces of any size as
+    they are received.
+
+    Args:
+        basis: the old file, opened for binary reading
+        output: binary file object the new file is written to
+        blockSize (int): block size of the signature the delta was computed from
+
+    Attributes:
+        written (int): bytes of the new file written so far
+    """
+    def __init__(self, basis, output, blockSize: int):
+        self.basis = basis
+        self.basisSize = basis.seek(0, 2)
+        self.output = output
+        self.blockSize = blockSize
+        self.written = 0
+        self.digest = hashlib.sha256()
+        self.header = bytearray()
+        self.literalLeft = 0
+        self.expectedDigest = None
+
+    def feed(self, data: bytes):
+        """
+        Raises:
+            DeltaError: if the delta is malformed or refers to blocks the old file does not have
+            OSError: if reading the old file or writing the new one fails
+        """
+        data = memoryview(data).cast('B')
+        while len(data):
+            if self.literalLeft:
+                count = min(self.literalLeft, len(data))
+                self._write(data[:count])
+                self.literalLeft -= count
+                data = data[count:]
+                continue
+            if self.expectedDigest is not None:
+                raise DeltaError('data after the end of the delta')
+            if not self.header and data[0] not in HEADER_SIZES:
+                raise DeltaError(f'unknown delta operation {data[0]:#x}')
+            count = min(HEADER_SIZES[self.header[0] if self.header else data[0]] - len(self.header), len(data))
+            self.header += data[:count]
+            data = data[count:]
+            if len(self.header) == HEADER_SIZES[self.header[0]]:
+                self._apply(self.header)
+                self.header = bytearray()
+
+    def finish(self):
+        """
+        Checks the rebuilt file once the whole delta has been fed.
+
+        Raises:
+            DeltaError: if the delta is incomplete or the file does not match its digest
+        """
+        if self.expectedDigest is None or self.header or self.literalLeft:
+            raise DeltaError('delta ended early')
+        if self.digest.digest() != self.expectedDigest:
+            raise DeltaError('rebuilt file does not match the digest of the new file')
+
+    def _apply(self, header: bytearray):
+        if header[0] == OP_LITERAL:
+            self.literalLeft = LITERAL_HEADER.unpack(header)[1]
+        elif header[0] == OP_DIGEST:
+            self.expectedDigest = bytes(header[1:])
+        else:
+            _, first, count = COPY_HEADER.unpack(header)
+            self._copy(first, count)
+
+    def _copy(self, first: int, count: int):
+        start = first * self.blockSize
+        length = min(count * self.blockSize, self.basisSize - start)
+        if count < 1 or length <= (count - 1) * self.blockSize:
+            raise DeltaError(f'blocks {first}-{first + count - 1} are beyond the end of the old file')
+        self.basis.seek(start)
+        while length:
+            block = self.basis.read(min(length, READ_SIZE))
+            if not block:
+                raise DeltaError('old file changed while rebuilding')
+            self._write(block)
+            length -= len(block)
+
+    def _write(self, data):
+        self.output.write(data)
+        self.digest.update(data)
+        self.written += len(data)
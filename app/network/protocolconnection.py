@@ -1,11 +1,18 @@
 from network.secureconnection import ServerSecureConnection, ClientSecureConnection, SecureConnection
+from network.streams import IncomingStreams, StreamWriter, isSegment, splitSegment
+from network.envelope import encodeEnvelope, decodeMessage
+from crypto.cryptohelper import CryptoHelperTickets, hashSecret
 import constants
 
 import logging
 import json
+import time
 import threading
 import socket
+import select
 import secrets
+import base64
+from concurrent.futures import Future
 
 class AuthenticationError(Exception):
     """
@@ -13,13 +20,125 @@ class AuthenticationError(Exception):
     """
     pass
 
+def createAuthChallenge() -> str:
+    """
+    Returns:
+        str: a random challenge the client has to echo back with its credentials
+    """
+    return secrets.token_hex(16)
+
+def verifyAuthResponse(challenge: str, response: bytes, dbHandler) -> tuple[str, str]:
+    """
+    Verifies the client's 'clientId:secret:challenge' answer to an AUTH_REQUIRED prompt.
+
+    Args:
+        challenge (str): The challenge sent to the client.
+        response (bytes): The decrypted response received from the client.
+        dbHandler (DBHandler): Database handler for retrieving client authentication secrets.
+
+    Returns:
+        tuple[str, str]: The authenticated client ID and its shared secret.
+
+    Raises:
+        ValueError: If the response is malformed.
+        AuthenticationError: If the challenge or the secret does not match.
+    """
+    response = bytes(response).decode().split(':')
+    if len(response) != 3:
+        raise ValueError('Invalid data format')
+    clientId, secret, clientChallenge = response
+    if challenge != clientChallenge:
+        raise AuthenticationError('Challenge verification failed!')
+    if secret != dbHandler.getSharedSecret(clientId):
+        raise AuthenticationError('Incorrect secret or hostname')
+    return clientId, secret
+
+def acceptTicketClient(clientId: str, secretHash: bytes, dbHandler) -> bool:
+    """
+    Checks that a client redeeming a session ticket still exists with the secret
+    it authenticated with when the ticket was issued.
+
+    Args:
+        clientId (str): The client ID stored in the ticket.
+        secretHash (bytes): The secret hash stored in the ticket.
+        dbHandler (DBHandler): Database handler for retrieving client authentication secrets.
+
+    Returns:
+        bool: True if the ticket may be redeemed.
+    """
+    secret = dbHandler.getSharedSecret(clientId)
+    return secret is not None and secrets.compare_digest(hashSecret(secret), secretHash)
+
+def encodeSessionTicket(tickets: CryptoHelperTickets, clientId: str, secretHash: bytes, expiresAt: float = None) -> bytes:
+    """
+    Issues a session ticket and encodes the message delivering it to the client.
+    Sent without seq, outside the action flow.
+
+    Args:
+        tickets (CryptoHelperTickets): The server's ticket helper.
+        clientId (str): The authenticated client ID.
+        secretHash (bytes): hashSecret() of the client's shared secret.
+        expiresAt (float, optional): Expiry of the ticket a resumed session was redeemed with,
+            which the new ticket keeps (see CryptoHelperTickets.issue).
+
+    Returns:
+        bytes: The encoded 'session_ticket' message.
+    """
+    ticket, resumptionSecret = tickets.issue(clientId, secretHash, expiresAt)
+    return encodeMessage('session_ticket', {
+        'ticket': base64.b64encode(ticket).decode(),
+        'secret': base64.b64encode(resumptionSecret).decode(),
+        'lifetime': tickets.lifetime if expiresAt is None else max(expiresAt - time.time(), 0)
+    })
+
+def encodeMessage(messageType: str, data: dict, seq=None, binary=False) -> bytes:
+    """
+    Encodes an action, a response or a kick message.
+
+    Args:
+        messageType (str): Message type.
+        data (dict): Message payload; bytes values are only allowed in binary messages.
+        seq (int, optional): Sequence number; omitted for messages outside the action flow (kick).
+        binary (bool): Encode a binary envelope instead of JSON, for connections that negotiated it.
+
+    Returns:
+        bytes: The encoded message.
+    """
+    if binary:
+        return encodeEnvelope(messageType, data, seq)
+    payload = {
+            "type": messageType,
+            "data": data
+    }
+    if seq is not None:
+        payload["seq"] = seq
+    return json.dumps(payload).encode()
+
+def parseResponse(raw: bytes) -> dict:
+    """
+    Decodes and validates an action response, either JSON or a binary envelope.
+
+    Args:
+        raw (bytes): The decrypted message.
+
+    Returns:
+        dict: The response with 'type', 'data' and 'seq' fields.
+
+    Raises:
+        ValueError: If the message is malformed or a field is missing.
+    """
+    response = decodeMessage(raw)
+    if not isinstance(response, dict) or 'type' not in response or 'data' not in response or 'seq' not in response:
+        raise ValueError("'type' or 'data' or 'seq' field not found in response")
+    return response
+
 
 class ServerProtocolConnection(ServerSecureConnection):
     """
     Handles a secure protocol connection on the server side, including authentication
     and command exchange with a connected client.
     """
-    def __init__(self, socket, peerAddr, rsaKey, dbHandler):
+    def __init__(self, socket, peerAddr, rsaKey, dbHandler, maxFrameSize=None, compression=None, handoff=None, sessionState=None):
         """
         Initializes the server-side protocol connection and begins the authentication handshake.
 
@@ -28,15 +147,32 @@ class ServerProtocolConnection(ServerSecureConnection):
             peerAddr (str): The address of the connected peer.
             rsaKey: RSA private key used for secure communication.
             dbHandler (DBHandler): Database handler for retrieving client authentication secrets.
+            maxFrameSize (int, optional): Largest accepted frame payload in bytes.
+            compression (FrameCompressor, optional): Compression settings (see ServerSecureConnection).
+            handoff (HandoffSignal, optional): Set when the server hands its connections over to
+                a new process, see readLoop.
+            sessionState (dict, optional): Session of an authenticated connection taken over from
+                another server process (see exportSession); the handshake is skipped.
         """
         from storage.dbhandler import DBHandler
-        super().__init__(socket, peerAddr, rsaKey)
+        self.sendLock = threading.Lock()
+        self.pendingLock = threading.Lock()
+        self.pendingActions = {}
+        self.incomingStreams = IncomingStreams()
+        self.outgoingStreams = set()
+        self.currentSeq = 0
         self.db = dbHandler
+        self.handoff = handoff
+        self.parked = threading.Event()
+        super().__init__(socket, peerAddr, rsaKey, maxFrameSize, compression, sessionState)
         self.clientId = None
-        self.sendLock = threading.Lock()
         self.authenticated = False
-        self._beginHandshake()
-        self.currentSeq = 0
+        if sessionState is None:
+            self._beginHandshake()
+        else:
+            self.clientId = sessionState['client_id']
+            self.currentSeq = sessionState['seq']
+            self.authenticated = self.running
 
 
     def closeConnectionWithReason(self, reason):
@@ -47,90 +183,327 @@ class ServerProtocolConnection(ServerSecureConnection):
             reason (str): Reason message to send to the client before closing.
         """
         try:
-            payload = {
-                    "type": 'kick',
-                    "data": {'reason': reason}
-            }
-            jsonPayload = json.dumps(payload).encode()
-            self.sendEncryptedLarge(jsonPayload)
+            payload = encodeMessage('kick', {'reason': reason}, binary=self.binaryEnvelope)
+            with self.sendLock:
+                self.sendEncryptedLarge(payload)
         except Exception as e:
             self.logger.warning(f'{self.peerAddr} ({self.clientId or "unknown"}): failed to close connection gracefully: {e}')
         self.closeConnection()
         self.logger.debug(f"{self.peerAddr} ({self.clientId or 'unknown'}): connection closed with reason {reason}")
 
-    def invokeAction(self, actionType: str, actionData: dict):
+    def closeConnection(self):
+        """
+        Closes the connection and fails every action still waiting for a response.
+        """
+        super().closeConnection()
+        with self.pendingLock:
+            pending = list(self.pendingActions.values())
+            self.pendingActions.clear()
+        for future in pending:
+            if not future.done():
+                future.set_exception(BrokenPipeError("Connection closed while waiting for a response"))
+        self.incomingStreams.failAll()
+
+    def _acceptTicket(self, clientId: str, secretHash: bytes) -> bool:
+        """ Refer to ServerSecureConnection._acceptTicket. """
+        return acceptTicketClient(clientId, secretHash, self.db)
+
+    def hasPendingActions(self) -> bool:
+        """
+        Returns:
+            bool: True if at least one action is waiting for its response.
+        """
+        return bool(self.pendingActions)
+
+    def isIdle(self) -> bool:
+        """
+        Returns:
+            bool: True if no action is waiting for its response and no stream is open in either direction.
+        """
+        return not self.pendingActions and not self.incomingStreams.streams and not self.outgoingStreams
+
+    def exportSession(self) -> dict:
+        """
+        Refer to ServerSecureConnection.exportSession. Only parked connections (see readLoop)
+        can be exported. The client ID and the last seq, which the client expects to keep
+        increasing, are part of the session.
+        """
+        if not self.parked.is_set():
+            raise ValueError('Only parked connections can be exported')
+        return {**super().exportSession(), 'client_id': self.clientId, 'seq': self.currentSeq}
+
+    def sendAction(self, actionType: str, actionData: dict, blocking=True):
+        """
+        Sends an action request to the client without waiting for the response.
+
+        Args:
+            actionType (str): The type of action to invoke on the client.
+            actionData (dict): Payload data for the action.
+            blocking (bool): If False, gives up instead of waiting for another thread's send to finish.
+
+        Returns:
+            tuple[int, Future] or None: The allocated seq and the future resolved by readLoop
+            with the response, or None if blocking is False and the connection is busy sending.
+
+        Raises:
+            BrokenPipeError: If the connection is closed.
+        """
+        sent = self._sendAction(actionType, actionData, blocking)
+        return None if sent is None else sent[:2]
+
+    def _sendAction(self, actionType: str, actionData: dict, blocking=True, openStream=False):
+        """
+        Refer to sendAction. With openStream, a StreamReader for the action's seq is
+        registered before the request leaves and returned as the third element.
+        """
+        if not self.sendLock.acquire(blocking):
+            return None
+        try:
+            if self.parked.is_set():
+                raise BrokenPipeError("Connection handed over to another server process")
+            future = Future()
+            self.currentSeq += 1
+            seq = self.currentSeq
+            payload = encodeMessage(actionType, actionData, seq, self.binaryEnvelope)
+            stream = self.incomingStreams.open(seq) if openStream else None
+            with self.pendingLock:
+                self.pendingActions[seq] = future
+            try:
+                self.sendEncryptedLarge(payload)
+            except Exception:
+                with self.pendingLock:
+                    self.pendingActions.pop(seq, None)
+                if stream is not None:
+                    stream.close()
+                raise
+        finally:
+            self.sendLock.release()
+        return seq, future, stream
+
+    def sendPing(self) -> Future | None:
+        """
+        Sends a keepalive ping without blocking, used by the KeepAliveScheduler.
+
+        The ping is only encrypted once the socket has room for it, as the cipher's message
+        counter must not skip a frame that is never sent. A ping that finds the send buffer
+        full is missed: the returned Future never resolves, so the connection times out
+        unless the client is heard from meanwhile.
+
+        Returns:
+            Future or None: Future resolved with the response, or None if another thread is sending.
+        """
+        if not self.sendLock.acquire(blocking=False):
+            return None
+        try:
+            if not self.running or self.parked.is_set():
+                return None
+            if not self.canSend():
+                self.logger.debug(f"{self.peerAddr} ({self.clientId}): send buffer full, ping missed")
+                return Future()
+            self.currentSeq += 1
+            seq = self.currentSeq
+            future = Future()
+            with self.pendingLock:
+                self.pendingActions[seq] = future
+            self.sendEncryptedLarge(encodeMessage('ping', {}, seq, self.binaryEnvelope))
+        except BrokenPipeError:
+            return None
+        finally:
+            self.sendLock.release()
+        return future
+
+    def invokeAction(self, actionType: str, actionData: dict, timeout=constants.SOCKET_TIMEOUT):
         """
         Sends an action request to the client and waits for a response.
 
+        The send lock is held only while the request is written, so several threads
+        may have actions outstanding on the same connection. Responses are delivered
+        by readLoop, matched by their 'seq' field, and may arrive in any order.
+
         Args:
             actionType (str): The type of action to invoke on the client.
             actionData (dict): Payload data for the action.
+            timeout (float, optional): Seconds to wait for the response, None waits indefinitely.
 
         Returns:
             tuple[str, dict] or None: A tuple containing the response type and data, or None if an error occurs
 
         Raises:
-            ValueError: If the client reponse is malformed or invalid.
+            BrokenPipeError: If the connection is closed before the response arrives.
+            TimeoutError: If the client does not respond within the timeout.
+        """
+        seq, future = self.sendAction(actionType, actionData)
+        try:
+            return future.result(timeout)
+        except ValueError as e:
+            self.logger.warning(f"{self.peerAddr} ({self.clientId}): client sent invalid action response: {e}")
+        finally:
+            with self.pendingLock:
+                self.pendingActions.pop(seq, None)
+
+    def invokeStreamAction(self, actionType: str, actionData: dict, timeout=constants.SOCKET_TIMEOUT):
+        """
+        Sends an action whose response is followed by a stream of segments carrying the action's seq.
+
+        Args:
+            actionType (str): The type of action to invoke on the client.
+            actionData (dict): Payload data for the action.
+            timeout (float, optional): Seconds to wait for the response, None waits indefinitely.
+
+        Returns:
+            tuple[str, dict, StreamReader] or None: The response type and data, and the reader of
+            the stream, which the caller has to consume or close; None if the client rejected the action.
+
+        Raises:
+            BrokenPipeError: If the connection is closed before the response arrives.
+            TimeoutError: If the client does not respond within the timeout.
+        """
+        seq, future, stream = self._sendAction(actionType, actionData, openStream=True)
+        try:
+            responseType, responseData = future.result(timeout)
+        except ValueError as e:
+            stream.close()
+            self.logger.warning(f"{self.peerAddr} ({self.clientId}): client sent invalid action response: {e}")
+            return None
+        except BaseException:
+            stream.close()
+            raise
+        finally:
+            with self.pendingLock:
+                self.pendingActions.pop(seq, None)
+        return responseType, responseData, stream
+
+    def openStream(self, streamId: int) -> StreamWriter:
+        """
+        Starts sending a stream to the client, see ClientProtocolConnection.openStream.
         """
-        self.currentSeq += 1
         with self.sendLock:
-            payload = {
-                    "type": actionType,
-                    "data": actionData,
-                    "seq": self.currentSeq
-            }
-            jsonPayload = json.dumps(payload).encode()
-            self.sendEncryptedLarge(jsonPayload)
-            try:
+            if self.parked.is_set():
+                raise BrokenPipeError("Connection handed over to another server process")
+            self.outgoingStreams.add(streamId)
+        writer = StreamWriter(self._sendSegment, streamId)
+        writer.onClose = self.outgoingStreams.discard
+        return writer
+
+    def _sendSegment(self, buffer):
+        with self.sendLock:
+            if self.parked.is_set():
+                raise BrokenPipeError("Connection handed over to another server process")
+            self.sendEncryptedBuffer(buffer)
+
+    def readLoop(self):
+        """
+        Receives action responses and hands each one to the invokeAction call waiting for its seq.
+
+        Runs until the connection is closed. Response timeouts are enforced per action
+        by invokeAction, so the socket itself blocks without a timeout here.
+
+        With a handoff signal, the loop waits for the next frame and the signal at once.
+        Once the signal is set, the connection is parked at the first frame boundary at
+        which it is idle (see isIdle): the loop returns without closing the connection and
+        further sends are refused, so its session can be exported to another process
+        (see exportSession) without this one reading or writing another frame.
+        """
+        if not self.running:
+            return
+        self.socket.settimeout(None)
+        self.setSendTimeout(constants.SEND_TIMEOUT)
+        poller = socketPoller = None
+        parked = False
+        if self.handoff is not None:
+            poller, socketPoller = select.poll(), select.poll()
+            poller.register(self.socket, select.POLLIN)
+            poller.register(self.handoff, select.POLLIN)
+            socketPoller.register(self.socket, select.POLLIN)
+        try:
+            while self.running:
+                if poller is not None and not self._awaitFrame(poller, socketPoller):
+                    # The connection may be resumed by another loop right away
+                    parked = True
+                    return
                 response = self.recvEncryptedLarge()
-                response = json.loads(response)
-                if 'type' not in response or 'data' not in response or 'seq' not in response:
-                    raise ValueError("'type' or 'data' or 'seq' field not found in response")
-                if response['type'] == 'invalid_action':
-                    raise ValueError("client sent 'invalid_action'")
-                if response['seq'] != self.currentSeq:
-                    raise ValueError(f"client sent incorrect seq. expected: {self.currentSeq}, received: {response['seq']}")
-                return response['type'], response['data']
-            except json.JSONDecodeError:
-                self.logger.warning(f"{self.peerAddr} ({self.clientId}): client sent invalid json")
-            except ValueError as e:
-                self.logger.warning(f"{self.peerAddr} ({self.clientId}): client sent invalid action response: {e}")
+                if isSegment(response):
+                    if not self.incomingStreams.deliver(*splitSegment(response)):
+                        self.logger.debug(f"{self.peerAddr} ({self.clientId}): dropping segment of a closed stream")
+                    continue
+                try:
+                    response = parseResponse(response)
+                except ValueError as e:
+                    self.logger.warning(f"{self.peerAddr} ({self.clientId}): client sent invalid action response: {e}")
+                    continue
+                with self.pendingLock:
+                    future = self.pendingActions.pop(response['seq'], None)
+                if future is None:
+                    self.logger.debug(f"{self.peerAddr} ({self.clientId}): dropping response for unknown seq {response['seq']}")
+                elif response['type'] == 'invalid_action':
+                    future.set_exception(ValueError("client sent 'invalid_action'"))
+                else:
+                    future.set_result((response['type'], response['data']))
+        except (BrokenPipeError, OSError):
+            self.logger.debug(f"{self.peerAddr} ({self.clientId}): connection closed, readLoop finished")
+        except Exception as e:
+            self.logger.warning(f"{self.peerAddr} ({self.clientId}): readLoop stopped: {e}")
+        finally:
+            if not parked:
+                self.closeConnection()
 
+    def _awaitFrame(self, poller, socketPoller) -> bool:
+        """
+        Waits for the next frame for readLoop, parking the connection instead once the
+        handoff signal is set and the connection is idle.
 
+        Returns:
+            bool: True if a frame arrived, False if the connection was parked
+        """
+        while True:
+            if self.handoff.is_set():
+                # Under the send lock, so no action can slip out between the check and parking
+                with self.sendLock:
+                    if self.isIdle():
+                        self.parked.set()
+                        self.logger.debug(f"{self.peerAddr} ({self.clientId}): connection parked for handoff")
+                        return False
+                # The signal stays readable, so only the socket is polled until the connection is idle
+                if socketPoller.poll(constants.HANDOFF_POLL_INTERVAL * 1000):
+                    return True
+            elif any(fd != self.handoff.fileno() for fd, _ in poller.poll()):
+                return True
 
     def _beginHandshake(self):
         """
         Performs authentication with the client using a shared secret.
+        A client that resumed its session with a ticket is already authenticated;
+        a compact handshake client sends its credentials without being prompted.
+        Clients speaking protocol 2.2 or newer receive a fresh session ticket afterwards.
 
         If authentication fails or a timeout/error occurs, the connection is closed.
         """
         if not self.running:
             return
         try:
-            challenge = secrets.token_hex(16)
-            challengeStr = f'AUTH_REQUIRED:{challenge}'
-            self.sendEncryptedLarge(challengeStr.encode())
-            response = self.recvEncryptedLarge().decode()
-            response = response.split(':')
-            if len(response) != 3:
-                raise ValueError('Invalid data format')
-            clientId = response[0]
-            secret = response[1]
-            clientChallenge = response[2]
-            if challenge != clientChallenge:
-                self.sendEncryptedLarge(b'AUTH_INVALID')
-                raise AuthenticationError('Challenge verification failed!')
-            if secret is None:
-                self.sendEncryptedLarge(b'AUTH_INVALID')
-                raise AuthenticationError('secret not found for id: {clientId}')
-            if secret != self.db.getSharedSecret(clientId):
-                self.sendEncryptedLarge(b'AUTH_INVALID')
-                raise AuthenticationError('Incorrect secret or hostname')
+            if self.resumedClientId is not None:
+                clientId, secretHash = self.resumedClientId, self.resumedSecretHash
             else:
+                if self.keyExchange == 'compact':
+                    # The challenge was derived from the key exchange reply, no AUTH_REQUIRED round trip
+                    challenge = self.authChallenge
+                else:
+                    challenge = createAuthChallenge()
+                    challengeStr = f'AUTH_REQUIRED:{challenge}'
+                    self.sendEncryptedLarge(challengeStr.encode())
+                response = self.recvEncryptedLarge()
+                try:
+                    clientId, secret = verifyAuthResponse(challenge, response, self.db)
+                except AuthenticationError:
+                    self.sendEncryptedLarge(b'AUTH_INVALID')
+                    raise
                 self.sendEncryptedLarge(b'AUTH_CORRECT')
-                self.clientId = clientId
-                self.authenticated = True
-                self.logger.info(f'{self.peerAddr}: Authentication successful as {self.clientId}')
+                secretHash = hashSecret(secret)
+            self.clientId = clientId
+            self.authenticated = True
+            if self.keyExchange != 'rsa':
+                self.sendEncryptedLarge(encodeSessionTicket(self.rsa.getTicketHelper(), clientId, secretHash, self.resumedExpiresAt))
+            self.logger.info(f'{self.peerAddr}: Authentication successful as {self.clientId}{" (resumed)" if self.resumedClientId else ""}')
         except ValueError as e:
             self.logger.warning(f'{self.peerAddr}: Error while authenticating: {e}')
             self.closeConnection()
@@ -150,7 +523,8 @@ class ClientProtocolConnection(ClientSecureConnection):
     Handles a secure protocol connection on the client side, including authentication
     and handling of incoming actions from the server.
     """
-    def __init__(self, socket, peerAddr, rsaKey, clientId, clientSecret):
+    def __init__(self, socket, peerAddr, rsaKey, clientId, clientSecret, maxFrameSize=None, keyExchange='compact', ticketCache=None, cipherSuites=None,
+                 binaryEnvelope=True, compression=None):
         """
         Initializes the client-side protocol connection and performs authentication.
 
@@ -160,27 +534,46 @@ class ClientProtocolConnection(ClientSecureConnection):
             rsaKey: RSA public key used for secure communication.
             clientId (str): Identifier of the client.
             clientSecret (str): Shared secret for authentication with the server.
+            maxFrameSize (int, optional): Largest accepted frame payload in bytes.
+            keyExchange (str): Key exchange to request, one of KEY_EXCHANGES (see ClientSecureConnection).
+            ticketCache (SessionTicketCache, optional): Session ticket storage kept across reconnects.
+            cipherSuites (list[str], optional): Session ciphers to offer by preference (see ClientSecureConnection).
+            binaryEnvelope (bool): Request binary envelopes instead of JSON messages (see ClientSecureConnection).
+            compression (FrameCompressor, optional): Compression to request and its settings (see ClientSecureConnection).
         """
-        super().__init__(socket, peerAddr, rsaKey)
+        super().__init__(socket, peerAddr, rsaKey, maxFrameSize, keyExchange, ticketCache, cipherSuites, binaryEnvelope, compression)
         self.clientId = clientId
         self.clientSecret = clientSecret
-        self._beginHandshake()
+        self.sendLock = threading.Lock()
         self.currentSeq = 0
+        self.incomingStreams = IncomingStreams()
+        self.addCloseCallback(self.incomingStreams.failAll)
+        self._beginHandshake()
 
     def recvAction(self):
         """
         Receives an action message from the server.
 
+        Sequence numbers must increase, but gaps are accepted: the server may have
+        several actions in flight and gives up on ones that time out. Session tickets
+        and stream segments arriving in between are handled here and not returned.
+
         Returns:
             tuple[str, dict] or None: A tuple containing the action type and data, or None if parsing fails.
         """
         try:
-            action = self.recvEncryptedLarge()
-            action = json.loads(action)
-            if 'type' not in action or 'data' not in action or 'seq' not in action:
-                raise ValueError("'type' or 'data' or 'seq' field not found in action")
-            if action['seq'] != self.currentSeq + 1:
-                raise ValueError(f"out of order (expected {self.currentSeq + 1}, got {action['seq']}")
+            action = self._recvMessage()
+            while isinstance(action, dict) and action.get('type') == 'session_ticket':
+                self._storeSessionTicket(action.get('data'))
+                action = self._recvMessage()
+            if 'type' not in action or 'data' not in action:
+                raise ValueError("'type' or 'data' field not found in action")
+            if action['type'] == 'kick':
+                return action['type'], action['data']
+            if not isinstance(action.get('seq'), int):
+                raise ValueError("'seq' field not found in action")
+            if action['seq'] <= self.currentSeq:
+                raise ValueError(f"out of order (expected more than {self.currentSeq}, got {action['seq']})")
             self.currentSeq = action['seq']
             return action['type'], action['data']
         except json.JSONDecodeError:
@@ -189,33 +582,79 @@ class ClientProtocolConnection(ClientSecureConnection):
             self.logger.warning(f"{self.peerAddr}: Client sent invalid action: {e}")
 
  
-    def sendResponse(self, responseType: str, responseData: dict):
+    def sendResponse(self, responseType: str, responseData: dict, seq=None):
         """
         Sends a response back to the server after handling an action.
+        Safe to call from several threads at once.
 
         Args:
             responseType (str): Type of response (e.g., 'status', 'file_send').
             responseData (dict): The response payload to send.
+            seq (int, optional): Sequence number of the answered action (defaults to the last received one).
         """
-        payload = {
-                "type": responseType,
-                "data": responseData,
-                "seq": self.currentSeq
-        }
-        jsonPayload = json.dumps(payload).encode()
-        self.sendEncryptedLarge(jsonPayload)
+        payload = encodeMessage(responseType, responseData, self.currentSeq if seq is None else seq, self.binaryEnvelope)
+        with self.sendLock:
+            self.sendEncryptedLarge(payload)
+
+    def openStream(self, seq=None) -> StreamWriter:
+        """
+        Starts sending a stream, usually right after the response announcing it.
+        Segments are sent under the send lock one at a time, so responses of other
+        actions can go out in between.
+
+        Args:
+            seq (int, optional): Sequence number of the answered action (defaults to the last received one).
+
+        Returns:
+            StreamWriter: the writer; close it to send the final segment.
+        """
+        return StreamWriter(self._sendSegment, self.currentSeq if seq is None else seq)
+
+    def _sendSegment(self, buffer):
+        with self.sendLock:
+            self.sendEncryptedBuffer(buffer)
+
+    def _recvMessage(self):
+        """
+        Receives the next message, handing stream segments received before it to their readers.
+        """
+        message = self.recvEncryptedLarge()
+        while isSegment(message):
+            if not self.incomingStreams.deliver(*splitSegment(message)):
+                self.logger.debug(f"{self.peerAddr}: dropping segment of a closed stream")
+            message = self.recvEncryptedLarge()
+        return decodeMessage(message)
+
+    def _storeSessionTicket(self, data: dict):
+        """
+        Keeps a session ticket sent by the server for the next reconnect.
+        """
+        if self.ticketCache is None:
+            return
+        try:
+            self.ticketCache.store(base64.b64decode(data['ticket']), base64.b64decode(data['secret']), float(data['lifetime']))
+            self.logger.debug(f"{self.peerAddr}: Session ticket received")
+        except (KeyError, TypeError, ValueError) as e:
+            self.logger.warning(f"{self.peerAddr}: Server sent invalid session ticket: {e}")
 
     def _beginHandshake(self):
         """
         Performs the authentication handshake with the server.
+        Skipped when the session was resumed with a ticket.
         """
+        if self.resumed:
+            self.logger.info(f'{self.peerAddr}: Session resumed, client authentication skipped')
+            return
         try:
-            command = self.recvEncryptedLarge().decode().split(':')
-            if(len(command) != 2):
-                raise ValueError('Invalid auth data format from the server')
-            if command[0] != 'AUTH_REQUIRED':
-                raise ValueError('Invalid auth prompt from server')
-            challenge = command[1]
+            if self.keyExchange == 'compact':
+                challenge = self.authChallenge
+            else:
+                command = self.recvEncryptedLarge().decode().split(':')
+                if(len(command) != 2):
+                    raise ValueError('Invalid auth data format from the server')
+                if command[0] != 'AUTH_REQUIRED':
+                    raise ValueError('Invalid auth prompt from server')
+                challenge = command[1]
             authString = self.clientId + ':' + self.clientSecret + ':' + challenge
             self.sendEncryptedLarge(authString.encode())
             response = self.recvEncryptedLarge().decode()
@@ -1,30 +1,202 @@
 import logging
+import time
 
 from network.baseconnection import BaseConnection
+from network.compression import FrameCompressor
 from crypto import cryptohelper
 
 import socket
 
 import constants
 
+GREETING = 'FLITIFY_V' + constants.LEGACY_PROTOCOL_VERSION
+# Sent by newer clients in place of the RSA encrypted AES key to request an X25519 exchange
+X25519_HELLO = ('FLITIFY_V' + constants.X25519_PROTOCOL_VERSION + ':X25519:').encode()
+# X25519 exchange followed directly by the credentials, without HNDSHK_PING/PONG and AUTH_REQUIRED
+COMPACT_HELLO = ('FLITIFY_V' + constants.COMPACT_PROTOCOL_VERSION + ':COMPACT:').encode()
+# Sent in place of the key exchange message to redeem a session ticket
+RESUME_HELLO = ('FLITIFY_V' + constants.X25519_PROTOCOL_VERSION + ':RESUME:').encode()
+RESUME_REJECTED = b'RESUME_REJECTED'
+# Sent right before the hello to negotiate the session cipher, followed by the accepted suites by preference;
+# both sides mix the offer and the selection into the session key (see cryptohelper.bindNegotiation)
+CIPHER_OFFER = ('FLITIFY_V' + constants.PROTOCOL_VERSION + ':CIPHERS:').encode()
+# The server's answer to CIPHER_OFFER, followed by the selected suite
+CIPHER_SELECTED = ('FLITIFY_V' + constants.PROTOCOL_VERSION + ':CIPHER:').encode()
+# The same negotiation from agents predating the binding, answered in kind and not bound into the key
+UNBOUND_CIPHER_OFFER = ('FLITIFY_V' + constants.NEGOTIATION_PROTOCOL_VERSION + ':CIPHERS:').encode()
+UNBOUND_CIPHER_SELECTED = ('FLITIFY_V' + constants.NEGOTIATION_PROTOCOL_VERSION + ':CIPHER:').encode()
+# Listed after the suites of CIPHER_OFFER to request binary envelopes (see network.envelope), like the
+# compression features (see network.compression); servers skip features they do not know like unknown
+# suites and echo the ones they accept after the selected suite
+ENVELOPE_FEATURE = '+binary'
+# Listed in CIPHER_OFFER by agents that understand BUSY; the server never echoes it
+BUSY_FEATURE = '+busy'
+# Sent in place of CIPHER_SELECTED by a saturated server, followed by the milliseconds to wait before retrying
+BUSY = ('FLITIFY_V' + constants.NEGOTIATION_PROTOCOL_VERSION + ':BUSY:').encode()
+HANDSHAKE_PING = b'HNDSHK_PING'
+HANDSHAKE_PONG = b'HNDSHK_PONG'
+# Ordered from newest to oldest; agents step down the list when a server rejects a hello
+KEY_EXCHANGES = ['compact', 'x25519', 'rsa']
+
 class ProtocolVersionError(Exception):
     pass
 
+class ServerBusyError(Exception):
+    """
+    Raised on the client when the server turned the connection away because it is
+    saturated with handshakes.
+
+    Args:
+        retryAfter (float): seconds the server asked to wait before reconnecting
+    """
+    def __init__(self, retryAfter: float):
+        super().__init__(f'server busy, retry after {retryAfter:.3f} s')
+        self.retryAfter = retryAfter
+
+class KeyExchangeRejectedError(Exception):
+    """
+    Raised on the client when the server closes the connection in reply to the
+    X25519 or compact hello, which is how servers not supporting it react. Only a
+    connection closed or reset while the client waits for the reply counts: failing
+    to send the hello, or a timeout, is a transport error and raised as such.
+    """
+    pass
+
+def compactChallenge(reply: bytes) -> str:
+    """
+    Derives the authentication challenge of a compact handshake from the server's
+    key exchange reply. The reply carries a fresh ephemeral key, so the challenge
+    is as unpredictable as an AUTH_REQUIRED one and costs no extra message.
+
+    Args:
+        reply (bytes): the server's X25519 reply
+
+    Returns:
+        str: the challenge the client echoes back with its credentials
+    """
+    return cryptohelper.SHA256.new(bytes(reply)).hexdigest()[:32]
+
+def selectCipherSuite(offer: bytes) -> str:
+    """
+    Picks the session cipher for a CIPHER_OFFER, honouring the client's preference.
+
+    Args:
+        offer (bytes): comma separated suite names following CIPHER_OFFER
+
+    Returns:
+        str: the first offered suite in CIPHER_SUITES, or the legacy suite if there is none
+    """
+    for suite in bytes(offer).decode().split(','):
+        if suite in cryptohelper.CIPHER_SUITES:
+            return suite
+    return cryptohelper.LEGACY_CIPHER_SUITE
+
+def acceptFeatures(offer: bytes, supported: list[str]) -> list[str]:
+    """
+    Picks the optional features of a CIPHER_OFFER the server supports.
+
+    Args:
+        offer (bytes): comma separated suite names and features following CIPHER_OFFER
+        supported (list[str]): features the server supports
+
+    Returns:
+        list[str]: the supported features, to be listed after the selected suite
+    """
+    return [item for item in bytes(offer).decode().split(',') if item in supported]
+
+def splitCipherOffer(message: bytes) -> tuple[memoryview, bytes] | None:
+    """
+    Recognizes a CIPHER_OFFER, or an UNBOUND_CIPHER_OFFER of an older agent.
+
+    Args:
+        message (bytes): a message received from the client
+
+    Returns:
+        tuple[memoryview, bytes] or None: the offered suites and features, and the prefix of
+        the selection answering them; None if the message is no cipher offer
+    """
+    for offer, selected in ((CIPHER_OFFER, CIPHER_SELECTED), (UNBOUND_CIPHER_OFFER, UNBOUND_CIPHER_SELECTED)):
+        if message.startswith(offer):
+            return memoryview(message)[len(offer):], selected
+    return None
+
+def busyReply(firstMessage: bytes, retryAfter: float) -> bytes | None:
+    """
+    Builds the BUSY message for a connection the server turns away, if the client
+    understands it: its first message must be a CIPHER_OFFER listing BUSY_FEATURE.
+    Older agents, among them those sending the RSA encrypted key first, would fail
+    on any answer but the one they expect.
+
+    Args:
+        firstMessage (bytes): the first message received from the client
+        retryAfter (float): seconds the client should wait before reconnecting
+
+    Returns:
+        bytes or None: the message, or None if the connection should just be closed
+    """
+    offer = splitCipherOffer(firstMessage)
+    if offer is None:
+        return None
+    if BUSY_FEATURE not in bytes(offer[0]).decode(errors='replace').split(','):
+        return None
+    return BUSY + str(round(retryAfter * 1000)).encode()
+
+class SessionTicketCache:
+    """
+    Keeps the latest session ticket issued to an agent across reconnects.
+    """
+    def __init__(self):
+        self.ticket = None
+        self.secret = None
+        self.expiresAt = 0.0
+
+    def store(self, ticket: bytes, secret: bytes, lifetime: float):
+        """
+        Args:
+            ticket (bytes): opaque ticket issued by the server
+            secret (bytes): resumption secret issued with it
+            lifetime (float): seconds the server accepts the ticket for
+        """
+        self.ticket = ticket
+        self.secret = secret
+        # Expire a little early so a ticket never dies in flight
+        self.expiresAt = time.monotonic() + lifetime * 0.9
+
+    def get(self) -> tuple[bytes, bytes] | None:
+        """
+        Returns:
+            tuple[bytes, bytes] or None: the ticket and its resumption secret, or None if there is no valid ticket
+        """
+        if self.ticket is None or time.monotonic() >= self.expiresAt:
+            return None
+        return self.ticket, self.secret
+
+    def clear(self):
+        self.ticket = None
+        self.secret = None
+
 class SecureConnection(BaseConnection):
     """
-    Base class representing a secure connection using AES encryption with RSA key exchange.
+    Base class representing a secure connection using AES encryption with RSA or X25519 key exchange.
 
     Args:
         socket (socket): socket object for the connection
         peerAddr ((str, int)): address of the peer (host, port)
-        rsaKey (bytes): exported server's RSA key
+        rsaKey (bytes | CryptoHelperRSA): exported RSA key, or a helper holding the already imported key
+        maxFrameSize (int, optional): largest accepted frame payload, see BaseConnection
     """
 
-    def __init__(self, socket, peerAddr, rsaKey):
-        super().__init__(socket, peerAddr)
-        self.rsa = cryptohelper.CryptoHelperRSA(rsaKey)
+    def __init__(self, socket, peerAddr, rsaKey, maxFrameSize=None):
+        super().__init__(socket, peerAddr, maxFrameSize)
+        if isinstance(rsaKey, cryptohelper.CryptoHelperRSA):
+            self.rsa = rsaKey
+        else:
+            self.rsa = cryptohelper.CryptoHelperRSA(rsaKey)
         self.rsaKey = rsaKey
         self.aes = None
+        self.authChallenge = None
+        # Set by the key exchange if both sides agreed on compression
+        self.compressor = None
         self._performKeyExchange()
 
     def _performKeyExchange(self):
@@ -38,8 +210,7 @@ class SecureConnection(BaseConnection):
         Args:
             data (bytes): the plaintext data to encrypt and send
         """
-        data = self.aes.encrypt(data)
-        self.sendRaw(data)
+        self.sendRawParts(self.aes.encryptParts(data))
 
     def recvEncrypted(self, size: int) -> bytes:
         """
@@ -57,23 +228,48 @@ class SecureConnection(BaseConnection):
 
     def sendEncryptedLarge(self, data:bytes): 
         """
-        Sends a large payload of arbitrary length using AES encryption
+        Sends a large payload of arbitrary length using AES encryption.
+        Header, nonce, tag and ciphertext leave in one vectored write.
+
         Args:
             data (bytes): the plaintext data to encrypt and send
         """
-        data = self.aes.encrypt(data)
-        self.sendLarge(data)
+        if self.compressor is not None:
+            data = self.compressor.compress(data) or data
+        self.sendLarge(*self.aes.encryptParts(data))
 
-    def recvEncryptedLarge(self) -> bytes:
+    def sendEncryptedBuffer(self, buffer: bytearray):
+        """
+        Sends a payload like sendEncryptedLarge, but encrypts it in place instead
+        of allocating the ciphertext. The buffer's contents are overwritten.
+        Meant for stream data, which is compressed as bulk data if compression was negotiated.
+
+        Args:
+            buffer (bytearray | memoryview): writable plaintext to encrypt and send
+        """
+        compressed = self.compressor.compress(buffer, bulk=True) if self.compressor is not None else None
+        if compressed is not None:
+            self.sendLarge(*self.aes.encryptParts(compressed))
+        else:
+            self.sendLarge(*self.aes.encryptParts(buffer, output=buffer))
+
+    def recvEncryptedLarge(self) -> bytearray:
         """
         Receives a large encrypted payload using AES decryption.
+        The received frame is decrypted in place, without intermediate copies,
+        and decompressed if it was sent compressed.
         
         Returns:
-            bytes: the decrypted plaintext data
+            bytearray: the decrypted plaintext data
+
+        Raises:
+            FrameSizeError: if a compressed frame decompresses to more than maxFrameSize bytes
+            ValueError: if a compressed frame is corrupt
         """
-        data = self.recvLarge()
-        data = self.aes.decrypt(data)
-        return data
+        message = self.aes.decryptInPlace(self.recvLarge())
+        if self.compressor is not None and self.compressor.isCompressed(message):
+            return self.compressor.decompress(message, self.maxFrameSize)
+        return message
 
 class ServerSecureConnection(SecureConnection):
     """
@@ -82,25 +278,153 @@ class ServerSecureConnection(SecureConnection):
     Args:
         socket (socket): socket object for the connection
         peerAddr ((str, int)): address of the peer (host, port)
-        rsaKey (bytes): the server's private RSA key for decrypting the AES key
+        rsaKey (bytes | CryptoHelperRSA): the server's private RSA key for decrypting the AES key
+            (RSA clients) or signing the static X25519 key (X25519 clients);
+            pass a shared CryptoHelperRSAPool to parse it once and decrypt off the connection thread
+        maxFrameSize (int, optional): largest accepted frame payload, see BaseConnection
+        compression (FrameCompressor, optional): compression algorithms accepted from agents that offer
+            them and the settings for frames sent to them; defaults to all algorithms
+        sessionState (dict, optional): session taken over from another server process (see exportSession);
+            the key exchange is skipped and the session continues where that process left it
     """
 
-    def __init__(self, socket, peerAddr, rsaKey):
-        super().__init__(socket, peerAddr, rsaKey)
+    def __init__(self, socket, peerAddr, rsaKey, maxFrameSize=None, compression=None, sessionState=None):
+        self.keyExchange = None
+        self.cipherSuite = cryptohelper.LEGACY_CIPHER_SUITE
+        self.binaryEnvelope = False
+        self.compression = compression or FrameCompressor()
+        self.resumedClientId = None
+        self.resumedSecretHash = None
+        self.resumedExpiresAt = None
+        # The cipher offer and selection, if bound into the session key
+        self.negotiation = None
+        self.sessionState = sessionState
+        super().__init__(socket, peerAddr, rsaKey, maxFrameSize)
+
+    def exportSession(self) -> dict:
+        """
+        Captures what was negotiated for the connection, so another server process can
+        take it over with the connection's socket. The caller has to make sure no frame
+        is sent or received meanwhile, as the cipher's message counters are part of it.
+
+        Returns:
+            dict: JSON serializable session state, see sessionState
+        """
+        return {'key_exchange': self.keyExchange, 'cipher': self.aes.exportState(), 'binary': self.binaryEnvelope,
+                'compression': self.compressor.algorithms if self.compressor is not None else []}
+
+    def _restoreSession(self, state: dict):
+        """
+        Continues a session exported by another server process, in place of the key exchange.
+
+        Raises:
+            ValueError: if the state is invalid
+        """
+        self.aes = cryptohelper.restoreSessionCipher(state['cipher'])
+        self.cipherSuite = state['cipher']['suite']
+        self.keyExchange = state['key_exchange']
+        self.binaryEnvelope = bool(state['binary'])
+        # The algorithms were agreed on with the agent and stay, whatever this process accepts from new ones
+        if state['compression']:
+            self.compressor = FrameCompressor(state['compression'], self.compression.level, self.compression.threshold, self.compression.lzmaPreset)
+
+    def _acceptTicket(self, clientId: str, secretHash: bytes) -> bool:
+        """
+        Decides whether a valid session ticket may still be redeemed, for example
+        because the client's secret has not changed since it was issued.
+        """
+        return True
+
+    def _redeemTicket(self, hello: bytes) -> bytes | None:
+        """
+        Redeems the session ticket in a resumption hello.
+
+        Returns:
+            bytes or None: the AES session key, or None if the ticket was rejected
+            (the client then continues with a full key exchange)
+        """
+        try:
+            clientId, secretHash, reply, aesKey, expiresAt = self.rsa.getTicketHelper().redeem(hello)
+            if not self._acceptTicket(clientId, secretHash):
+                raise ValueError(f'ticket of {clientId} is no longer accepted')
+        except ValueError as e:
+            self.logger.info(f"{self.peerAddr}: Session ticket rejected: {e}")
+            self.sendLarge(RESUME_REJECTED)
+            return None
+        self.sendLarge(reply)
+        self.resumedClientId = clientId
+        self.resumedSecretHash = secretHash
+        self.resumedExpiresAt = expiresAt
+        self.keyExchange = 'resume'
+        self.logger.debug(f"{self.peerAddr}: Session of {clientId} resumed")
+        return aesKey
+
+    def _exchangeKey(self, encMsg: bytes) -> bytes:
+        """
+        Completes a full key exchange: X25519 for clients sending X25519_HELLO or
+        COMPACT_HELLO, otherwise the message is the RSA encrypted AES key.
+
+        Returns:
+            bytes: the AES session key
+        """
+        if encMsg.startswith(COMPACT_HELLO):
+            reply, aesKey = self.rsa.getX25519Server().respond(memoryview(encMsg)[len(COMPACT_HELLO):])
+            self.sendLarge(reply)
+            self.keyExchange = 'compact'
+            self.authChallenge = compactChallenge(reply)
+            self.logger.debug(f"{self.peerAddr}: Compact key exchange completed")
+            return aesKey
+        if encMsg.startswith(X25519_HELLO):
+            reply, aesKey = self.rsa.getX25519Server().respond(memoryview(encMsg)[len(X25519_HELLO):])
+            self.sendLarge(reply)
+            self.keyExchange = 'x25519'
+            self.logger.debug(f"{self.peerAddr}: X25519 key exchange completed")
+            return aesKey
+        aesKey = self.rsa.decrypt(encMsg)
+        self.keyExchange = 'rsa'
+        self.logger.debug(f"{self.peerAddr}: AES key recieved")
+        return aesKey
 
     def _performKeyExchange(self):
         """ Refer to base class documentation. """
+        if self.sessionState is not None:
+            self._restoreSession(self.sessionState)
+            self.logger.debug(f"{self.peerAddr}: Session taken over, cipher: {self.cipherSuite}")
+            return
         try:
-            protocolMsg = 'FLITIFY_V' + constants.PROTOCOL_VERSION
+            protocolMsg = GREETING
             self.sendLarge(protocolMsg.encode())
             self.logger.debug(f'{self.peerAddr}: Greeting sent: {protocolMsg}')
             encMsg = self.recvLarge()
-            aesKey = self.rsa.decrypt(encMsg)
-            self.aes = cryptohelper.CryptoHelperAES(aesKey)
-            self.logger.debug(f"{self.peerAddr}: AES key recieved")
-            self.sendEncryptedLarge(b'HNDSHK_PING')
+            offer = splitCipherOffer(encMsg)
+            if offer is not None:
+                offered, selectedPrefix = offer
+                self.cipherSuite = selectCipherSuite(offered)
+                features = acceptFeatures(offered, [ENVELOPE_FEATURE, *self.compression.features()])
+                self.binaryEnvelope = ENVELOPE_FEATURE in features
+                self.compressor = self.compression.negotiate(features)
+                selected = selectedPrefix + ','.join([self.cipherSuite, *features]).encode()
+                self.sendLarge(selected)
+                if selectedPrefix == CIPHER_SELECTED:
+                    self.negotiation = bytes(encMsg) + selected
+                encMsg = self.recvLarge()
+            aesKey = None
+            if encMsg.startswith(RESUME_HELLO):
+                aesKey = self._redeemTicket(memoryview(encMsg)[len(RESUME_HELLO):])
+                if aesKey is None:
+                    encMsg = self.recvLarge()
+            if aesKey is None:
+                aesKey = self._exchangeKey(encMsg)
+            if self.negotiation is not None:
+                aesKey = cryptohelper.bindNegotiation(aesKey, self.negotiation)
+            self.aes = cryptohelper.createSessionCipher(aesKey, self.cipherSuite, isServer=True)
+            self.logger.debug(f"{self.peerAddr}: Session cipher: {self.cipherSuite}")
+            if self.keyExchange == 'compact':
+                # The encrypted credentials that follow confirm the key
+                return
+            self.sendEncryptedLarge(HANDSHAKE_PING)
             testMsg = self.recvEncryptedLarge()
-            if testMsg != b'HNDSHK_PONG':
+            if testMsg != HANDSHAKE_PONG:
                 raise ValueError(f'Incorrect handshake message: {testMsg}')
             self.logger.debug(f"{self.peerAddr}: Handshake finished")
         except ValueError as e:
@@ -120,33 +444,86 @@ class ClientSecureConnection(SecureConnection):
     Args:
         socket (socket): socket object for the connection
         peerAddr ((str, int)): address of the peer (host, port)
-        rsaKey (bytes): the server's public RSA key for encrypting the AES key
+        rsaKey (bytes): the server's public RSA key for encrypting the AES key or authenticating the X25519 exchange
+        maxFrameSize (int, optional): largest accepted frame payload, see BaseConnection
+        keyExchange (str): one of KEY_EXCHANGES: 'compact' (X25519 with credentials sent along, needs
+            a COMPACT_PROTOCOL_VERSION server), 'x25519' (needs an X25519_PROTOCOL_VERSION server) or 'rsa'
+        ticketCache (SessionTicketCache, optional): session ticket storage; a valid ticket is
+            redeemed instead of a full key exchange and new tickets are stored in it
+        cipherSuites (list[str], optional): session ciphers to offer by preference (defaults to
+            CIPHER_SUITES); not offered with the RSA key exchange or when only the legacy suite is
+            listed, as servers before PROTOCOL_VERSION do not understand the offer
+        binaryEnvelope (bool): request binary envelopes along with the cipher offer; messages stay
+            JSON if the server does not accept them or no offer is sent
+        compression (FrameCompressor, optional): compression algorithms to request along with the cipher
+            offer and the settings for frames sent to the server; defaults to OFFERED_COMPRESSION
     """
-    def __init__(self, socket, peerAddr, rsaKey):
-        super().__init__(socket, peerAddr, rsaKey)
+    def __init__(self, socket, peerAddr, rsaKey, maxFrameSize=None, keyExchange='compact', ticketCache=None, cipherSuites=None,
+                 binaryEnvelope=True, compression=None):
+        if keyExchange not in KEY_EXCHANGES:
+            raise ValueError(f'Unknown key exchange: {keyExchange}')
+        cipherSuites = cipherSuites or cryptohelper.CIPHER_SUITES
+        for suite in cipherSuites:
+            if suite not in cryptohelper.CIPHER_SUITES:
+                raise ValueError(f'Unknown cipher suite: {suite}')
+        self.keyExchange = keyExchange
+        self.ticketCache = ticketCache
+        self.cipherSuites = list(cipherSuites)
+        self.cipherSuite = cryptohelper.LEGACY_CIPHER_SUITE
+        self.compression = compression or FrameCompressor(constants.OFFERED_COMPRESSION)
+        self.features = ([ENVELOPE_FEATURE] if binaryEnvelope else []) + self.compression.features() + [BUSY_FEATURE]
+        self.binaryEnvelope = False
+        self._cipherOfferPending = False
+        # The cipher offer and selection, bound into the session key
+        self._negotiation = None
+        self.resumed = False
+        super().__init__(socket, peerAddr, rsaKey, maxFrameSize)
 
     def _performKeyExchange(self):
         """ Refer to base class documentation. """
         try:
             protocolMsg = self.recvLarge().decode()
             self.logger.debug(f'{self.peerAddr}: Greeting recieved from server: {protocolMsg}')
-            myProtocolMsg = 'FLITIFY_V' + constants.PROTOCOL_VERSION
-            if protocolMsg != myProtocolMsg:
+            if protocolMsg != GREETING:
                 raise ProtocolVersionError(f"My version is: {constants.PROTOCOL_VERSION}, server sent: {protocolMsg}")
-            self.aes = cryptohelper.CryptoHelperAES()
-            aesKey = self.aes.key
-            encMsg = self.rsa.encrypt(aesKey)
-            self.logger.debug(f"Sending AES key")
-            self.sendLarge(encMsg)
+            if self.keyExchange != 'rsa' and self.cipherSuites != [cryptohelper.LEGACY_CIPHER_SUITE]:
+                # Pipelined with the hello, the selection arrives ahead of the server's reply
+                self._negotiation = CIPHER_OFFER + ','.join(self.cipherSuites + self.features).encode()
+                self.sendLarge(self._negotiation)
+                self._cipherOfferPending = True
+            aesKey = self._resume()
+            if aesKey is None and self.keyExchange != 'rsa':
+                aesKey = self._exchangeX25519(COMPACT_HELLO if self.keyExchange == 'compact' else X25519_HELLO)
+            if aesKey is not None:
+                if self._negotiation is not None:
+                    aesKey = cryptohelper.bindNegotiation(aesKey, self._negotiation)
+                self.aes = cryptohelper.createSessionCipher(aesKey, self.cipherSuite, isServer=False)
+                if self.keyExchange == 'compact' and not self.resumed:
+                    self.logger.info(f"{self.peerAddr}: Client key exchange finished")
+                    return
+            else:
+                self.aes = cryptohelper.CryptoHelperAES()
+                encMsg = self.rsa.encrypt(self.aes.key)
+                self.logger.debug(f"Sending AES key")
+                self.sendLarge(encMsg)
+            # Never BUSY: the RSA key exchange sends no cipher offer, so a saturated server just closes the connection
             testMsg = self.recvEncryptedLarge()
-            if testMsg != b'HNDSHK_PING':
-                raise ValueError('Incorrect handshake message: {testMsg}')
-            self.sendEncryptedLarge(b'HNDSHK_PONG')
+            if testMsg != HANDSHAKE_PING:
+                raise ValueError(f'Incorrect handshake message: {testMsg}')
+            self.sendEncryptedLarge(HANDSHAKE_PONG)
             self.logger.info(f"{self.peerAddr}: Client handshake finished")
         except ValueError as e:
             self.logger.error(f"{self.peerAddr}: Unexpected data format from server during handshake, closing connection: {e}")
             self.closeConnection()
             raise
+        except cryptohelper.DecryptionError as e:
+            # The keys differ, as they do when the cipher negotiation was tampered with
+            self.logger.error(f"{self.peerAddr}: Key confirmation failed, closing connection: {e}")
+            self.closeConnection()
+            raise
+        except ServerBusyError as e:
+            self.logger.warning(f"{self.peerAddr}: Connection turned away: {e}")
+            raise
         except BrokenPipeError:
             self.logger.warning(f"{self.peerAddr}: Connection broken by server during handshake")
             raise
@@ -157,3 +534,86 @@ class ClientSecureConnection(SecureConnection):
         except socket.timeout:
             self.logger.error(f"{self.peerAddr}: Client socket timed out during key exchange")
             raise
+
+    def _resume(self) -> bytes | None:
+        """
+        Redeems the cached session ticket, if there is one.
+
+        Returns:
+            bytes or None: the AES session key, or None if there is no ticket or the server
+            rejected it, in which case the full key exchange follows on the same connection
+        """
+        cached = self.ticketCache.get() if self.ticketCache is not None else None
+        if cached is None:
+            return None
+        exchange = cryptohelper.CryptoHelperResumeClient(*cached)
+        self.logger.debug(f"Sending session ticket")
+        self.sendLarge(RESUME_HELLO, exchange.hello)
+        try:
+            reply = self._recvReply()
+        except (BrokenPipeError, ConnectionResetError):
+            self.ticketCache.clear()
+            raise
+        if reply == RESUME_REJECTED:
+            self.logger.info(f"{self.peerAddr}: Session ticket rejected by server, performing full key exchange")
+            self.ticketCache.clear()
+            return None
+        self.resumed = True
+        return exchange.finish(reply)
+
+    def _exchangeX25519(self, hello: bytes) -> bytes:
+        """
+        Runs the X25519 exchange in place of sending an RSA encrypted key.
+
+        Args:
+            hello (bytes): X25519_HELLO, or COMPACT_HELLO to also derive authChallenge from the reply
+
+        Returns:
+            bytes: the AES session key
+
+        Raises:
+            KeyExchangeRejectedError: if the server closes the connection instead of replying
+            ValueError: if the server's reply is malformed or not signed by its RSA key
+        """
+        exchange = cryptohelper.CryptoHelperX25519Client(self.rsa)
+        self.logger.debug(f"Sending {self.keyExchange} hello")
+        self.sendLarge(hello, exchange.publicKey)
+        try:
+            reply = self._recvReply()
+        except (BrokenPipeError, ConnectionResetError):
+            self.closeConnection()
+            raise KeyExchangeRejectedError(f'server closed the connection after the {self.keyExchange} hello, it may not support it')
+        aesKey = exchange.finish(reply)
+        if hello == COMPACT_HELLO:
+            self.authChallenge = compactChallenge(reply)
+        return aesKey
+
+    def _recvReply(self) -> bytearray:
+        """
+        Receives the server's reply to a hello, preceded by its CIPHER_SELECTED answer
+        if a cipher offer is still unanswered.
+
+        Raises:
+            ValueError: if the server selected a suite or feature that was not offered
+            ServerBusyError: if the server turned the connection away
+        """
+        if self._cipherOfferPending:
+            self._cipherOfferPending = False
+            selected = self.recvLarge()
+            if selected.startswith(BUSY):
+                self.closeConnection()
+                raise ServerBusyError(int(bytes(selected[len(BUSY):])) / 1000)
+            if not selected.startswith(CIPHER_SELECTED):
+                raise ValueError(f'Expected the cipher selection, got: {bytes(selected[:32])}')
+            suite, *features = bytes(selected[len(CIPHER_SELECTED):]).decode().split(',')
+            if suite not in self.cipherSuites:
+                raise ValueError(f'Server selected a cipher suite that was not offered: {suite}')
+            for feature in features:
+                if feature not in self.features:
+                    raise ValueError(f'Server accepted a feature that was not offered: {feature}')
+            self.cipherSuite = suite
+            self._negotiation += bytes(selected)
+            self.binaryEnvelope = ENVELOPE_FEATURE in features
+            self.compressor = self.compression.negotiate(features)
+            self.logger.debug(f"{self.peerAddr}: Session cipher: {suite}")
+        return self.recvLarge()
@@ -0,0 +1,342 @@
+import logging
+import queue
+import struct
+import threading
+
+import constants
+
+# Segment frames start with flags and the stream ID, JSON messages with '{'
+SEGMENT_HEADER = struct.Struct('>BI')
+SEGMENT_MORE = 0x01
+SEGMENT_FINAL = 0x02
+SEGMENT_ABORT = 0x03
+SEGMENT_FLAGS = (SEGMENT_MORE, SEGMENT_FINAL, SEGMENT_ABORT)
+
+class StreamError(Exception):
+    """
+    Raised while reading a stream that was aborted by the sender, timed out or
+    ended without its final segment (for example because the connection closed).
+    """
+    pass
+
+def isSegment(message: bytes) -> bool:
+    """
+    Args:
+        message (bytes): a decrypted message
+
+    Returns:
+        bool: True if the message is a stream segment rather than a JSON message
+    """
+    return len(message) >= SEGMENT_HEADER.size and message[0] in SEGMENT_FLAGS
+
+def splitSegment(message: bytearray) -> tuple[int, int, bytearray]:
+    """
+    Splits a decrypted segment into its header fields and payload.
+    A bytearray is trimmed in place, without copying the payload.
+
+    Args:
+        message (bytearray | bytes): a message for which isSegment() is True
+
+    Returns:
+        tuple[int, int, bytearray]: flags, stream ID and payload
+    """
+    flags, streamId = SEGMENT_HEADER.unpack_from(message)
+    if isinstance(message, bytearray):
+        del message[:SEGMENT_HEADER.size]
+        return flags, streamId, message
+    return flags, streamId, message[SEGMENT_HEADER.size:]
+
+class StreamReader:
+    """
+    Receiving end of a stream, iterating over the payloads of its segments.
+
+    Segments are handed over by the connection's read loop. At most depth of them
+    are buffered: a slow consumer stalls the read loop and, through TCP flow control,
+    the sender. A consumer not picking up a segment within the timeout, or
+    stopping early without close(), has the stream dropped.
+
+    Args:
+        streamId (int): ID the segments of this stream carry
+        timeout (float): seconds to wait for the next segment, and for the consumer to take one
+        depth (int): number of segments buffered
+    """
+    def __init__(self, streamId: int, timeout=constants.STREAM_TIMEOUT, depth=constants.STREAM_QUEUE_DEPTH):
+        self.streamId = streamId
+        self.timeout = timeout
+        self.queue = queue.Queue()
+        self.slots = threading.Semaphore(depth)
+        self.finished = False
+        self.closed = False
+        self.error = None
+        self.onClose = None
+
+    def feed(self, flags: int, payload: bytes, block=True) -> bool:
+        """
+        Queues a received segment. Called by the connection's read loop.
+
+        Args:
+            flags (int): SEGMENT_MORE, SEGMENT_FINAL or SEGMENT_ABORT
+            payload (bytes): segment payload
+            block (bool): if False, raises queue.Full instead of waiting for the consumer
+
+        Returns:
+            bool: False if the stream was closed or dropped and the segment discarded
+
+        Raises:
+            queue.Full: if block is False and depth segments are buffered already
+        """
+        if self.closed:
+            return False
+        if not self.slots.acquire(block, self.timeout if block else None):
+            if not block:
+                raise queue.Full()
+            logging.getLogger('flitify').warning(f'stream {self.streamId}: consumer stalled, dropping the stream')
+            self.fail(StreamError(f'stream {self.streamId}: segment not consumed within {self.timeout} s'))
+            return False
+        self.queue.put((flags, payload))
+        return True
+
+    def fail(self, error: Exception):
+        """
+        Ends the stream with an error, raised by the iterator once buffered segments are consumed.
+        """
+        if self.finished or self.error is not None:
+            return
+        self.error = error
+        self.queue.put((None, None))
+        self._notifyClosed()
+
+    def __iter__(self):
+        while not self.finished:
+            try:
+                flags, payload = self.queue.get(timeout=self.timeout)
+            except queue.Empty:
+                self.close()
+                raise StreamError(f'stream {self.streamId}: no segment received within {self.timeout} s')
+            if flags is None:
+                self.close()
+                raise self.error
+            self.slots.release()
+            if flags == SEGMENT_ABORT:
+                self.close()
+                raise StreamError(f'stream {self.streamId} aborted by sender: {bytes(payload).decode(errors="replace")}')
+            if flags == SEGMENT_FINAL:
+                self.finished = True
+                self.close()
+            if payload:
+                yield payload
+
+    def read(self) -> bytes:
+        """
+        Reads the whole stream. Only meant for payloads known to be small.
+
+        Returns:
+            bytes: concatenated payloads of all segments
+
+        Raises:
+            StreamError: if the stream does not end with its final segment
+        """
+        return b''.join(self)
+
+    def close(self):
+        """
+        Stops receiving the stream; segments still arriving for it are discarded.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self._notifyClosed()
+
+    def _notifyClosed(self):
+        onClose, self.onClose = self.onClose, None
+        if onClose is not None:
+            onClose(self.streamId)
+
+class IncomingStreams:
+    """
+    Streams a connection is receiving, by stream ID. Thread-safe.
+    """
+    def __init__(self):
+        self.streams = {}
+        self.lock = threading.Lock()
+
+    def open(self, streamId: int, timeout=constants.STREAM_TIMEOUT) -> StreamReader:
+        """
+        Registers a stream before the peer is asked to send it.
+
+        Returns:
+            StreamReader: the reader receiving the stream's segments
+        """
+        reader = StreamReader(streamId, timeout)
+        reader.onClose = self._remove
+        with self.lock:
+            self.streams[streamId] = reader
+        return reader
+
+    def attach(self, streamId: int, sink):
+        """
+        Registers another kind of receiver for a stream, for example one writing to a file.
+
+        Args:
+            streamId (int): ID of the expected stream
+            sink: object with feed() and fail() like StreamReader; its onClose attribute
+                is set to a function the sink calls without arguments once it is done
+        """
+        sink.onClose = lambda: self._remove(streamId)
+        with self.lock:
+            self.streams[streamId] = sink
+
+    def get(self, streamId: int) -> StreamReader | None:
+        with self.lock:
+            return self.streams.get(streamId)
+
+    def deliver(self, flags: int, streamId: int, payload: bytes, block=True) -> bool:
+        """
+        Hands a received segment to its reader.
+
+        Returns:
+            bool: False if no open stream has the ID and the segment was discarded
+
+        Raises:
+            queue.Full: if block is False and the reader is full
+        """
+        reader = self.get(streamId)
+        if reader is None:
+            return False
+        return reader.feed(flags, payload, block)
+
+    def failAll(self, error: Exception = None):
+        """
+        Fails every open stream, used when the connection closes.
+        """
+        with self.lock:
+            readers = list(self.streams.items())
+            self.streams.clear()
+        for streamId, reader in readers:
+            reader.fail(error or StreamError(f'stream {streamId}: connection closed before the end of the stream'))
+
+    def _remove(self, streamId: int):
+        with self.lock:
+            self.streams.pop(streamId, None)
+
+class StreamWriter:
+    """
+    Sending end of a stream. Data is cut into segments of segmentSize bytes, each
+    sent as its own encrypted frame, so other messages on the connection interleave
+    with the stream and memory use is bounded by one segment buffer.
+
+    Segments are encrypted in place in the writer's buffer. Used as a context manager,
+    the stream is closed on success and aborted if an exception is raised.
+
+    Args:
+        send (callable): sends a buffer holding the segment header and payload as one
+            encrypted frame; may overwrite the buffer
+        streamId (int): ID the segments carry, usually the seq of the action the stream answers
+        segmentSize (int): payload bytes per segment
+
+    onClose, if set, is called with the stream ID once the final or abort segment was sent.
+    """
+    def __init__(self, send, streamId: int, segmentSize=constants.STREAM_SEGMENT_SIZE):
+        self.send = send
+        self.streamId = streamId
+        self.segmentSize = segmentSize
+        self.buffer = bytearray(SEGMENT_HEADER.size + segmentSize)
+        self.view = memoryview(self.buffer)
+        self.used = 0
+        self.closed = False
+        self.bytesSent = 0
+        self.onClose = None
+
+    def write(self, data: bytes):
+        """
+        Appends data to the stream, sending every segment that fills up.
+
+        Raises:
+            BrokenPipeError: if the connection is closed
+        """
+        data = memoryview(data).cast('B')
+        while len(data):
+            count = min(len(data), self.segmentSize - self.used)
+            start = SEGMENT_HEADER.size + self.used
+            self.view[start:start + count] = data[:count]
+            self.used += count
+            data = data[count:]
+            if self.used == self.segmentSize:
+                self._flush(SEGMENT_MORE)
+
+    def writeFrom(self, file, size: int = None) -> int:
+        """
+        Streams a binary file object, reading directly into the segment buffer.
+
+        Args:
+            file: object with readinto(), for example a file opened with 'rb'
+            size (int, optional): number of bytes to send; defaults to everything until EOF
+
+        Returns:
+            int: number of bytes read from the file
+
+        Raises:
+            BrokenPipeError: if the connection is closed
+        """
+        total = 0
+        while size is None or total < size:
+            free = self.segmentSize - self.used
+            if size is not None:
+                free = min(free, size - total)
+            start = SEGMENT_HEADER.size + self.used
+            count = file.readinto(self.view[start:start + free])
+            if not count:
+                break
+            self.used += count
+            total += count
+            if self.used == self.segmentSize:
+                self._flush(SEGMENT_MORE)
+        return total
+
+    def close(self):
+        """
+        Sends the buffered data as the final segment.
+        """
+        if not self.closed:
+            self._flush(SEGMENT_FINAL)
+            self.closed = True
+            self._notifyClosed()
+
+    def abort(self, reason: str):
+        """
+        Ends the stream with an error instead of a final segment; buffered data is discarded.
+        The reader raises StreamError with the reason.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        encoded = reason.encode()[:self.segmentSize]
+        self.view[SEGMENT_HEADER.size:SEGMENT_HEADER.size + len(encoded)] = encoded
+        self.used = len(encoded)
+        self._flush(SEGMENT_ABORT)
+        self._notifyClosed()
+
+    def _notifyClosed(self):
+        onClose, self.onClose = self.onClose, None
+        if onClose is not None:
+            onClose(self.streamId)
+
+    def _flush(self, flags: int):
+        SEGMENT_HEADER.pack_into(self.buffer, 0, flags, self.streamId)
+        self.send(self.view[:SEGMENT_HEADER.size + self.used])
+        if flags != SEGMENT_ABORT:
+            self.bytesSent += self.used
+        self.used = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, exc, traceback):
+        if exc is None:
+            self.close()
+        elif not isinstance(exc, BrokenPipeError):
+            try:
+                self.abort(f'{excType.__name__}: {exc}')
+            except BrokenPipeError:
+                pass
+        return False
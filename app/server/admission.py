@@ -0,0 +1,177 @@
+import asyncio
+import socket
+import threading
+import time
+
+import constants
+from network.baseconnection import FRAME_HEADER_SIZE, encodeFrameHeader, decodeFrameHeader
+from network.secureconnection import GREETING, busyReply
+
+# Largest first message read from an agent being turned away; a CIPHER_OFFER or RSA encrypted key is far smaller
+REFUSAL_FRAME_SIZE = 4096
+# Assumed duration of a handshake until the first ones have been measured
+INITIAL_HANDSHAKE_TIME = 0.05
+# Weight of the latest handshake in the moving average of handshake durations
+HANDSHAKE_TIME_WEIGHT = 0.05
+
+class HandshakeAdmission:
+    """
+    Admission control for agent handshakes, so a reconnect storm after a restart is
+    served at the rate the server can sustain instead of timing out all at once.
+
+    At most maxHandshakes handshakes run at once and up to maxQueued accepted
+    connections wait for one, as long as the wait is expected to end within the
+    deadline. Further connections are turned away with BUSY (see refuseConnection).
+    Each refusal books the next free handshake slot the server expects after the
+    ones already booked, and the agent is told to come back then, so the agents
+    turned away by a storm return spread over the time the server needs for them.
+
+    Thread-safe.
+
+    Args:
+        maxHandshakes (int): handshakes running at once
+        maxQueued (int): accepted connections waiting for a handshake slot at most
+        deadline (float): seconds from the accept by which a handshake must have started;
+            connections that waited longer are closed without starting it
+        clock (callable): monotonic time in seconds, replaced in simulations
+    """
+    def __init__(self, maxHandshakes=constants.MAX_HANDSHAKES, maxQueued=constants.HANDSHAKE_QUEUE,
+                 deadline=constants.HANDSHAKE_DEADLINE, clock=time.monotonic):
+        self.maxHandshakes = maxHandshakes
+        self.maxQueued = maxQueued
+        self.deadline = deadline
+        self.pending = 0
+        self.refusing = 0
+        self.handshakeTime = INITIAL_HANDSHAKE_TIME
+        self.bookedUntil = 0.0
+        self.clock = clock
+        self.lock = threading.Lock()
+
+    def _interval(self) -> float:
+        """ Seconds between two handshakes finishing when all slots are busy. """
+        return self.handshakeTime / self.maxHandshakes
+
+    def admit(self) -> bool:
+        """
+        Admits a connection that was just accepted; call finish() once its handshake
+        is over or given up.
+
+        Returns:
+            bool: False if the connection should be turned away
+        """
+        with self.lock:
+            queued = self.pending - self.maxHandshakes + 1
+            if queued > self.maxQueued or queued * self._interval() >= self.deadline:
+                return False
+            self.pending += 1
+            return True
+
+    def finish(self, duration: float = None):
+        """
+        Args:
+            duration (float, optional): seconds the handshake took once it had a slot;
+                None for a connection dropped before its handshake started
+        """
+        with self.lock:
+            self.pending -= 1
+            if duration is not None:
+                self.handshakeTime += (duration - self.handshakeTime) * HANDSHAKE_TIME_WEIGHT
+
+    def retryAfter(self) -> float:
+        """
+        Books a handshake slot for an agent that is turned away.
+
+        Returns:
+            float: seconds until the slot, between MIN_RETRY_AFTER and MAX_RETRY_AFTER
+        """
+        with self.lock:
+            now = self.clock()
+            interval = self._interval()
+            # Admitted connections go first
+            self.bookedUntil = max(self.bookedUntil, now + self.pending * interval) + interval
+            return min(max(self.bookedUntil - now, constants.MIN_RETRY_AFTER), constants.MAX_RETRY_AFTER)
+
+    def startRefusal(self) -> bool:
+        """
+        Bounds the connections being turned away at once, each of which takes one round trip.
+
+        Returns:
+            bool: False if the connection should be closed right away; otherwise call endRefusal() afterwards
+        """
+        with self.lock:
+            if self.refusing >= self.maxQueued:
+                return False
+            self.refusing += 1
+            return True
+
+    def endRefusal(self):
+        with self.lock:
+            self.refusing -= 1
+
+def _recvExactly(sock: socket.socket, size: int) -> bytes:
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionResetError('connection closed')
+        data += chunk
+    return data
+
+def refuseConnection(sock: socket.socket, retryAfter: float):
+    """
+    Turns a connection away without any cryptographic work: sends the greeting, reads
+    the agent's first message and answers BUSY if the agent understands it (see
+    busyReply). Older agents, such as those sending the RSA encrypted key, only see the
+    connection closed, which they retry like any failed attempt. Whatever else the agent
+    sent meanwhile is read until it closes the connection, so the close does not reset
+    the connection and discard BUSY before the agent read it, nor reach an older agent
+    as a reset it does not expect. All of it takes at most REFUSAL_TIMEOUT seconds.
+
+    Args:
+        sock (socket.socket): the accepted connection
+        retryAfter (float): seconds the agent should wait, see HandshakeAdmission.retryAfter
+    """
+    deadline = time.monotonic() + constants.REFUSAL_TIMEOUT
+    try:
+        sock.settimeout(constants.REFUSAL_TIMEOUT)
+        greeting = GREETING.encode()
+        sock.sendall(encodeFrameHeader(len(greeting)) + greeting)
+        message = _recvExactly(sock, decodeFrameHeader(_recvExactly(sock, FRAME_HEADER_SIZE), REFUSAL_FRAME_SIZE))
+        reply = busyReply(message, retryAfter)
+        if reply is not None:
+            sock.sendall(encodeFrameHeader(len(reply)) + reply)
+        sock.shutdown(socket.SHUT_WR)
+        while (remaining := deadline - time.monotonic()) > 0:
+            sock.settimeout(remaining)
+            if not sock.recv(REFUSAL_FRAME_SIZE):
+                break
+    except (OSError, ValueError):
+        pass
+    finally:
+        sock.close()
+
+async def refuseConnectionAsync(reader, writer, retryAfter: float):
+    """
+    asyncio counterpart of refuseConnection.
+
+    Args:
+        reader (asyncio.StreamReader): stream reader of the accepted connection
+        writer (asyncio.StreamWriter): stream writer of the accepted connection
+        retryAfter (float): seconds the agent should wait
+    """
+    try:
+        async with asyncio.timeout(constants.REFUSAL_TIMEOUT):
+            greeting = GREETING.encode()
+            writer.write(encodeFrameHeader(len(greeting)) + greeting)
+            header = await reader.readexactly(FRAME_HEADER_SIZE)
+            message = await reader.readexactly(decodeFrameHeader(header, REFUSAL_FRAME_SIZE))
+            reply = busyReply(message, retryAfter)
+            if reply is not None:
+                writer.write(encodeFrameHeader(len(reply)) + reply)
+            writer.write_eof()
+            while await reader.read(REFUSAL_FRAME_SIZE):
+                pass
+    except (OSError, ValueError, TimeoutError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import time
+
+from network.asyncprotocolconnection import AsyncServerProtocolConnection
+from server.admission import HandshakeAdmission, refuseConnectionAsync
+from server.clientregistry import ClientRegistry
+from server.flitifyserver import createRSAHelper
+from server.keepalivescheduler import KeepAliveScheduler
+from server.handlers.clienthandler import ClientHandler
+
+import constants
+
+LISTEN_BACKLOG = 4096
+
+class AsyncFlitifyServer:
+    def __init__(self, host, port, rsaKey, dbHandler, maxFrameSize=None, keepAliveInterval=constants.INTERVAL, handshakeWorkers=None, compression=None, admission=None,
+                 registry=None, reusePort=False):
+        """
+        Initializes an asyncio based server engine.
+
+        All agent connections are served by a single event loop instead of one
+        thread per agent, so a process can hold tens of thousands of idle agents.
+        Exposes the same client lookup surface as FlitifyServer to the ApiServer.
+
+        Args:
+            host (str): The host IP or hostname to bind the server socket to.
+            port (int): Port number to listen on.
+            rsaKey: RSA private key used to establish secure communication.
+            dbHandler: Database handler for client authentication data.
+            maxFrameSize (int, optional): Largest frame payload accepted from clients (defaults to constants.MAX_FRAME_SIZE).
+            keepAliveInterval (float): Seconds a client may stay idle before it is pinged.
+            handshakeWorkers (int, optional): Processes decrypting handshake RSA messages (defaults to the CPU count, 0 uses the loop's default executor).
+            compression (FrameCompressor, optional): Compression accepted from clients and its settings (defaults to all algorithms).
+            admission (HandshakeAdmission, optional): Bounds of the handshakes run at once and queued (defaults to the constants).
+            registry (ClientRegistry, optional): Registry of the connected clients (defaults to a new one).
+            reusePort (bool): Sets SO_REUSEPORT, so worker processes can listen on the same port.
+        """
+        self.host = host
+        self.port = port
+        self.dbHandler = dbHandler
+        self.rsaKey = rsaKey
+        self.rsa = createRSAHelper(rsaKey, handshakeWorkers)
+        self.maxFrameSize = maxFrameSize
+        self.compression = compression
+        self.admission = admission or HandshakeAdmission()
+        self.handshakeSlots = None
+        self.keepAlive = KeepAliveScheduler(keepAliveInterval)
+        self.running = False
+        self.loop = None
+        self.registry = registry if registry is not None else ClientRegistry()
+        self.reusePort = reusePort
+        self.logger = logging.getLogger('flitify')
+
+    def getClientList(self) -> list:
+        """
+        Retrieves a list of currently active client IDs.
+
+        Returns:
+            list: A list of active client identifiers.
+        """
+        return self.registry.getClientIds()
+
+    def getClientById(self, clientId:str) -> ClientHandler | None:
+        """
+        Retrieves a client handler by its unique identifier.
+
+        Args:
+            clientId (str): The identifier of the client.
+
+        Returns:
+            ClientHandler or None: The associated client handler, or None if not found.
+        """
+        return self.registry.get(clientId)
+
+    def start(self):
+        """
+        Starts the server and runs its event loop in the calling thread.
+        """
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.handshakeSlots = asyncio.Semaphore(self.admission.maxHandshakes)
+        server = await asyncio.start_server(self._handleClient, self.host, self.port, backlog=LISTEN_BACKLOG,
+                                            reuse_port=self.reusePort or None)
+        self.port = server.sockets[0].getsockname()[1]
+        self.keepAlive.start()
+        self.running = True
+        self.logger.info(f'AsyncFlitifyServer listening on {self.host}:{self.port}')
+        async with server:
+            await server.serve_forever()
+
+    async def _handleClient(self, reader, writer):
+        """
+        Serves one agent connection: handshake, registration and response reading.
+        Connections beyond the admission bounds are turned away before the handshake.
+        """
+        if not self.admission.admit():
+            await refuseConnectionAsync(reader, writer, self.admission.retryAfter())
+            return
+        connection = AsyncServerProtocolConnection(reader, writer, self.rsa, self.dbHandler, self.maxFrameSize, self.compression)
+        self.logger.info(f'{connection.peerAddr}: Connection accepted')
+        try:
+            async with asyncio.timeout(self.admission.deadline):
+                await self.handshakeSlots.acquire()
+        except TimeoutError:
+            self.admission.finish()
+            self.logger.info(f'{connection.peerAddr}: Waited {self.admission.deadline} s for a handshake slot, closing connection')
+            connection.close()
+            return
+        started = time.monotonic()
+        try:
+            authenticated = await connection.handshake()
+        finally:
+            self.handshakeSlots.release()
+            self.admission.finish(time.monotonic() - started)
+        if not authenticated:
+            return
+        clientId = connection.clientId
+        client = ClientHandler(connection)
+        if not self.registry.register(clientId, client):
+            self.logger.warning(f'{connection.peerAddr} ({clientId}): duplicate detected, closing connection')
+            await connection.closeWithReason('You are a duplicate!')
+            return
+        self.keepAlive.add(connection)
+        try:
+            await connection.readLoop()
+        finally:
+            self.registry.unregister(clientId, client)
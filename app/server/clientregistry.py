@@ -0,0 +1,73 @@
+import threading
+import logging
+
+class ClientRegistry:
+    """
+    Thread-safe registry of authenticated clients, keyed by client ID.
+
+    Connections register themselves as soon as authentication succeeds and
+    unregister when they close, so the registry never has to be polled.
+    """
+    def __init__(self):
+        self._clients = {}
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger('flitify')
+
+    def register(self, clientId: str, client) -> bool:
+        """
+        Registers a client unless another one with the same ID is already registered.
+
+        Args:
+            clientId (str): The authenticated client ID.
+            client (ClientHandler): Handler of the client's connection.
+
+        Returns:
+            bool: True if registered, False if the ID is already taken (duplicate).
+        """
+        with self._lock:
+            if clientId in self._clients:
+                return False
+            self._clients[clientId] = client
+        self.logger.debug(f'Registry: {clientId} registered')
+        return True
+
+    def unregister(self, clientId: str, client):
+        """
+        Removes a client, but only if the registered entry is the given handler,
+        so a rejected duplicate can never remove the original connection.
+
+        Args:
+            clientId (str): The client ID.
+            client (ClientHandler): Handler that was registered.
+        """
+        with self._lock:
+            if self._clients.get(clientId) is not client:
+                return
+            del self._clients[clientId]
+        self.logger.debug(f'Registry: {clientId} unregistered')
+
+    def get(self, clientId: str):
+        """
+        Returns:
+            ClientHandler or None: The registered handler, or None if not found.
+        """
+        return self._clients.get(clientId)
+
+    def getClientIds(self) -> list:
+        """
+        Returns:
+            list: IDs of all registered clients.
+        """
+        with self._lock:
+            return list(self._clients.keys())
+
+    def getClients(self) -> list:
+        """
+        Returns:
+            list: Handlers of all registered clients.
+        """
+        with self._lock:
+            return list(self._clients.values())
+
+    def __len__(self):
+        return len(self._clients)
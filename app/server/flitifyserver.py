@@ -2,34 +2,78 @@ import threading
 import socket
 import logging
 import time
+from concurrent.futures import ThreadPoolExecutor
 
+from crypto.cryptohelper import CryptoHelperRSA, CryptoHelperRSAPool
+from server.clientregistry import ClientRegistry
+from server.keepalivescheduler import KeepAliveScheduler
 from server.handlers.clienthandler import ClientHandler
-from network.protocolconnection import ServerProtocolConnection
+from network.protocolconnection import ServerProtocolConnection, AuthenticationError
+from server.admission import HandshakeAdmission, refuseConnection
+from server.handoff import HandoffSignal
 
 import constants
 
+def createRSAHelper(rsaKey: bytes, handshakeWorkers=None) -> CryptoHelperRSA:
+    """
+    Imports the server's private key once for all connections and prepares
+    the signed static key for X25519 key exchanges and the session ticket key.
+
+    Args:
+        rsaKey (bytes): Exported RSA private key.
+        handshakeWorkers (int, optional): Size of the decryption process pool; None uses the CPU count, 0 disables the pool.
+
+    Returns:
+        CryptoHelperRSA: A CryptoHelperRSAPool, or a plain helper if the pool is disabled.
+    """
+    if handshakeWorkers == 0:
+        rsa = CryptoHelperRSA(rsaKey)
+    else:
+        rsa = CryptoHelperRSAPool(rsaKey, handshakeWorkers)
+    # Sign the static X25519 key and derive the ticket key now rather than during the first handshake
+    rsa.getX25519Server()
+    rsa.getTicketHelper()
+    return rsa
+
 class ClientThread(threading.Thread):
     """
     Represents a dedicated thread handling a single client connection.
-    Responsible for initializing the secure protocol connection and the client handler.
+    Responsible for initializing the secure protocol connection and the client handler,
+    and for registering the client as soon as it is authenticated.
+
+    The handshake runs first, in the server's handshake pool (see handshake()); the
+    thread is only started for authenticated clients.
     """
-    def __init__(self, socket, peerAddr, rsaKey, dbHandler):
+    def __init__(self, socket, peerAddr, rsaKey, dbHandler, registry, keepAlive, maxFrameSize=None, compression=None, handoff=None,
+                 sessionState=None):
         """
         Initializes the client thread.
 
         Args:
             socket (socket.socket): The socket object for communication.
             peerAddr (tuple): IP address and port of the connecting client.
-            rsaKey: Server RSA private key used for secure communication.
+            rsaKey (CryptoHelperRSA): Helper holding the server's imported RSA private key.
             dbHandler: Database handler for retrieving authentication secrets.
+            registry (ClientRegistry): Registry the authenticated client is added to.
+            keepAlive (KeepAliveScheduler): Scheduler checking the liveness of the connection.
+            maxFrameSize (int, optional): Largest frame payload accepted from the client.
+            compression (FrameCompressor, optional): Compression accepted from the client and its settings.
+            handoff (HandoffSignal, optional): Signal of the server handing its connections over to a new process.
+            sessionState (dict, optional): Session taken over from another server process, in place of the handshake.
         """
         self.socket = socket
         self.peerAddr = peerAddr
         self.rsaKey = rsaKey
         self.client = None
         self.dbHandler = dbHandler
+        self.registry = registry
+        self.keepAlive = keepAlive
+        self.maxFrameSize = maxFrameSize
+        self.compression = compression
+        self.handoff = handoff
+        self.sessionState = sessionState
         self.logger = logging.getLogger('flitify')
-        super().__init__()
+        super().__init__(daemon=True)
 
     def getClient(self):
         """
@@ -40,37 +84,79 @@ class ClientThread(threading.Thread):
         """
         return self.client
 
+    def handshake(self) -> bool:
+        """
+        Performs the key exchange and authentication in the calling thread.
+
+        Returns:
+            bool: True if the client is authenticated and the thread may be started.
+        """
+        try:
+            self.connection = ServerProtocolConnection(self.socket, self.peerAddr, self.rsaKey, self.dbHandler, self.maxFrameSize, self.compression,
+                                                       self.handoff, self.sessionState)
+        except AuthenticationError:
+            return False
+        return self.connection.running
+
     def run(self):
         """
-        Starts the thread.
+        Starts the thread once the handshake succeeded. The thread serves as the
+        connection's response reader until the client disconnects.
         """
         self.logger.debug(f'{self.peerAddr[0]}:{self.peerAddr[1]}: Starting thread')
-        self.connection = ServerProtocolConnection(self.socket, self.peerAddr, self.rsaKey, self.dbHandler)
-        self.client = ClientHandler(self.connection)
+        clientId = self.connection.clientId
+        client = ClientHandler(self.connection)
+        if not self.registry.register(clientId, client):
+            self.logger.warning(f'{self.connection.peerAddr} ({clientId}): duplicate detected, closing connection')
+            self.connection.closeConnectionWithReason('You are a duplicate!')
+            return
+        self.connection.addCloseCallback(lambda: self.registry.unregister(clientId, client))
+        self.client = client
+        self.keepAlive.add(self.connection)
+        self.connection.readLoop()
 
 class FlitifyServer:
-    def __init__(self, host, port, rsaKey, dbHandler):
+    def __init__(self, host, port, rsaKey, dbHandler, maxFrameSize=None, handshakeWorkers=None, compression=None, admission=None,
+                 registry=None, reusePort=False, listenSocket=None):
         """
-        Initializes the server with specified configuration and starts the watchdog thread.
+        Initializes the server with specified configuration.
 
         Args:
             host (str): The host IP or hostname to bind the server socket to.
             port (int): Port number to listen on.
             rsaKey: RSA private key used to establish secure communication.
             dbHandler: Database handler for client authentication data.
+            maxFrameSize (int, optional): Largest frame payload accepted from clients (defaults to constants.MAX_FRAME_SIZE).
+            handshakeWorkers (int, optional): Processes decrypting handshake RSA messages (defaults to the CPU count, 0 decrypts in the connection thread).
+            compression (FrameCompressor, optional): Compression accepted from clients and its settings (defaults to all algorithms).
+            admission (HandshakeAdmission, optional): Bounds of the handshakes run at once and queued (defaults to the constants).
+            registry (ClientRegistry, optional): Registry of the connected clients (defaults to a new one).
+            reusePort (bool): Sets SO_REUSEPORT, so worker processes can listen on the same port.
+            listenSocket (socket.socket, optional): Listening socket taken over from the previous server process
+                (see server.handoff), accepted on in place of binding host and port.
         """
         self.host = host
         self.port = port
         self.dbHandler = dbHandler
         self.rsaKey = rsaKey
+        self.rsa = createRSAHelper(rsaKey, handshakeWorkers)
+        self.maxFrameSize = maxFrameSize
+        self.compression = compression
+        self.admission = admission or HandshakeAdmission()
+        self.handshakePool = ThreadPoolExecutor(self.admission.maxHandshakes, thread_name_prefix='FlitifyHandshake')
+        self.refusalPool = ThreadPoolExecutor(constants.REFUSAL_WORKERS, thread_name_prefix='FlitifyRefusal')
         self.running = False
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.waitingClients = []
-        self.activeClients = {}
-        self.clientsLock = threading.Lock()
-        self.watchdogThread = threading.Thread(target=self._clientsWatchdog, daemon=True, name='FlitifyServer-Watchdog')
-        self.watchdogThread.start()
+        self.takenOver = listenSocket is not None
+        if self.takenOver:
+            self.sock = listenSocket
+        else:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reusePort:
+                self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.registry = registry if registry is not None else ClientRegistry()
+        self.keepAlive = KeepAliveScheduler()
+        self.handoff = HandoffSignal()
         self.logger = logging.getLogger('flitify')
     
     def getClientList(self) -> list:
@@ -80,10 +166,7 @@ class FlitifyServer:
         Returns:
             list: A list of active client identifiers.
         """
-        clientList = [] 
-        for client in self.activeClients.keys():
-            clientList.append(client)
-        return clientList
+        return self.registry.getClientIds()
         
     def getClientById(self, clientId:str) -> ClientHandler | None:
         """
@@ -95,65 +178,94 @@ class FlitifyServer:
         Returns:
             ClientHandler or None: The associated client handler, or None if not found.
         """
-        if clientId not in self.activeClients:
-            return None
-        return self.activeClients[clientId]
+        return self.registry.get(clientId)
 
     def start(self):
         """
         Starts the server.
         """
-        self.sock.bind((self.host, self.port))
-        self.sock.listen()
+        if not self.takenOver:
+            self.sock.bind((self.host, self.port))
+            self.sock.listen()
+        self.port = self.sock.getsockname()[1]
+        self.keepAlive.start()
         self.running = True
         self.logger.info(f'FlitifyServer listening on {self.host}:{self.port}')
 
         while self.running:
             client_sock, client_addr = self.sock.accept()
-            self.logger.info(f'{client_addr[0]}:{client_addr[1]}: Connection accepted')
-            client_sock.settimeout(constants.SOCKET_TIMEOUT)
-            try:
-                with self.clientsLock:
-                    self.waitingClients.append(ClientThread(client_sock, client_addr, self.rsaKey, self.dbHandler))
-                    self.waitingClients[-1].start()
-            except Exception as e:
-                self.logger.error(f'{client_addr[0]}:{client_addr[1]}: Uncaught exception while running ClientThread: {e}')
-
-    def _clientsWatchdog(self, interval=constants.INTERVAL):
-        while True:
+            if self.admission.admit():
+                self.logger.info(f'{client_addr[0]}:{client_addr[1]}: Connection accepted')
+                self.handshakePool.submit(self._handshake, client_sock, client_addr, time.monotonic())
+            elif self.admission.startRefusal():
+                self.logger.debug(f'{client_addr[0]}:{client_addr[1]}: Handshakes saturated, turning connection away')
+                self.refusalPool.submit(self._refuse, client_sock)
+            else:
+                client_sock.close()
+
+    def _handshake(self, client_sock, client_addr, acceptedAt: float):
+        """
+        Runs a client's handshake in the handshake pool and starts its thread if it succeeds.
+        Connections that waited for a slot past the admission deadline are closed instead;
+        the deadline only bounds that wait, the handshake gets the usual socket timeout.
+        """
+        started = time.monotonic()
+        waited = started - acceptedAt
+        if waited >= self.admission.deadline:
+            self.logger.info(f'{client_addr[0]}:{client_addr[1]}: Waited {waited:.1f} s for a handshake slot, closing connection')
+            client_sock.close()
+            self.admission.finish()
+            return
+        client_sock.settimeout(constants.SOCKET_TIMEOUT)
+        thread = ClientThread(client_sock, client_addr, self.rsa, self.dbHandler, self.registry, self.keepAlive, self.maxFrameSize, self.compression,
+                              self.handoff)
+        try:
+            authenticated = thread.handshake()
+        except Exception as e:
+            self.logger.error(f'{client_addr[0]}:{client_addr[1]}: Uncaught exception during handshake: {e}')
+            client_sock.close()
+            authenticated = False
+        finally:
+            self.admission.finish(time.monotonic() - started)
+        if not authenticated:
+            return
+        try:
+            thread.start()
+        except Exception as e:
+            self.logger.error(f'{client_addr[0]}:{client_addr[1]}: Uncaught exception while running ClientThread: {e}')
+            client_sock.close()
+
+    def adoptConnection(self, client_sock, sessionState: dict) -> bool:
+        """
+        Serves a client connection taken over from the previous server process (see
+        server.handoff), continuing its session without a handshake.
+
+        Args:
+            client_sock (socket.socket): The client's socket.
+            sessionState (dict): The session exported by the previous process.
+
+        Returns:
+            bool: True if the session was restored and the client's thread started.
+        """
+        try:
+            client_addr = client_sock.getpeername()
+            thread = ClientThread(client_sock, client_addr, self.rsa, self.dbHandler, self.registry, self.keepAlive, self.maxFrameSize,
+                                  self.compression, self.handoff, sessionState)
+            if not thread.handshake():
+                return False
+            thread.start()
+        except (OSError, KeyError, ValueError) as e:
+            self.logger.error(f'Cannot take over connection of {sessionState.get("client_id")}: {e}')
             try:
-                time.sleep(interval)
-                for client in list(self.waitingClients):
-                    if not client.getClient():
-                        with self.clientsLock:
-                            self.waitingClients.remove(client)
-                        continue
-                    connection = client.getClient().getConnection()
-                    if connection.clientId:
-                        if connection.clientId in self.activeClients:
-                            self.logger.warning(f'{connection.peerAddr} ({connection.clientId}): duplicate detected, closing connection')
-                            connection.closeConnectionWithReason('You are a duplicate!')
-                        else:
-                            self.logger.debug(f'Watchdog: adding {client.getClient().getConnection().peerAddr} ({connection.clientId}) to activeClients')
-                            with self.clientsLock:
-                                self.activeClients[connection.clientId] = client
-                        if client in self.waitingClients:
-                            self.logger.debug(f'Watchdog: removing {client.getClient().getConnection().peerAddr} from waitingClients')
-                            with self.clientsLock:
-                                self.waitingClients.remove(client)
-                            continue
-
-                    if not connection.running and client in self.waitingClients:
-                        self.logger.debug(f'Watchdog: removing {client.getClient().getConnection().peerAddr} from waitingClients')
-                        with self.clientsLock:
-                            self.waitingClients.remove(client)
-
-                for client_id in list(self.activeClients.keys()):
-                    client = self.activeClients[client_id]
-                    if not client.getClient().getConnection().running:
-                        self.logger.debug(f'Watchdog: client {client.getClient().getConnection().peerAddr} ({client_id}) offline, removing from active clients')
-                        with self.clientsLock:
-                            del self.activeClients[client_id]
-            except Exception as e:
-                self.logger.critical(f'Watchdog: uncaught exception: {e}')
-                raise
+                client_sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            client_sock.close()
+            return False
+        return True
+
+    def _refuse(self, client_sock):
+        try:
+            refuseConnection(client_sock, self.admission.retryAfter())
+        finally:
+            self.admission.endRefusal()
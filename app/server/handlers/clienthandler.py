@@ -1,16 +1,64 @@
-import threading
-import time
+import io
 import logging
 import base64
-import socket
 
 import constants
+
 from network.protocolconnection import ServerProtocolConnection
-from server.handlers.clientutils import disable_timeout
+from network.streams import StreamError
+from network.delta import Signature, DeltaEncoder, DeltaError
+from network.envelope import bytesField
 
 class FileTransferError(Exception):
     pass
 
+class RangeNotSatisfiableError(FileTransferError):
+    """
+    Raised when a requested range starts beyond the end of the file.
+
+    Args:
+        fileSize (int): size of the file on the client
+    """
+    def __init__(self, fileSize: int):
+        super().__init__(f'range not satisfiable, the file has {fileSize} bytes')
+        self.fileSize = fileSize
+
+class FileDownload:
+    """
+    A file, or a range of it, being received from a client. Iterating over it yields
+    the contents in chunks; it has to be exhausted or closed.
+
+    Args:
+        chunks (Iterator[bytes]): the contents
+        length (int): number of bytes the chunks add up to
+        offset (int): position of the first byte in the file
+        fileSize (int, optional): size of the whole file; defaults to offset + length
+        etag (str, optional): validator of the file's contents, None for clients not reporting it
+        mtime (float, optional): modification time of the file
+        notModified (bool): the file still has the ETag the download was conditional on;
+            nothing is sent and length is 0
+    """
+    def __init__(self, chunks, length: int, offset=0, fileSize: int = None, etag: str = None, mtime: float = None,
+                 notModified=False):
+        self.chunks = chunks
+        self.length = length
+        self.offset = offset
+        self.fileSize = offset + length if fileSize is None else fileSize
+        self.etag = etag
+        self.mtime = mtime
+        self.notModified = notModified
+
+    @property
+    def partial(self) -> bool:
+        return not self.notModified and self.length < self.fileSize
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        if hasattr(self.chunks, 'close'):
+            self.chunks.close()
+
 class InvalidResponseError(ValueError):
     pass
 
@@ -18,13 +66,12 @@ class ClientHandler():
     def __init__(self, connection: ServerProtocolConnection):
         self.connection = connection
         self.clientId = connection.clientId
-        self._startKeepAliveLoop()
     
     def getConnection(self):
         return self.connection
 
     def isOnline(self):
-        if self.connection.sendLock.locked():
+        if self.connection.hasPendingActions():
             return True 
         return self.ping()
 
@@ -54,43 +101,343 @@ class ClientHandler():
             logging.warning('{self.connection.peerAddr} ({self.clientId}): get_status failed: {e}') 
             self.connection.closeConnectionWithReason('invalid_response')
 
-    @disable_timeout()
-    def getFile(self, path: str):
+    def getFile(self, path: str, offset=0, length: int = None):
+        """
+        Downloads a file, or a range of it, into memory. Use streamFile for files
+        of arbitrary size. Refer to streamFile for the arguments.
+
+        Returns:
+            bytes or None: the file contents, or None if the transfer failed
+        """
+        try:
+            download = self.streamFile(path, offset, length)
+            if download is None:
+                return None
+            return b''.join(download)
+        except FileTransferError as e:
+            logging.info(f'{self.connection.peerAddr} ({self.clientId}): get_file failed (FileTransferError): {e}')
+
+    def streamFile(self, path: str, offset=0, length: int = None, ifRange=None, ifNoneMatch: str = None):
+        """
+        Requests a file, or a range of it, from the client, which sends it as a stream
+        of segments. Clients without streaming support answer with the whole file in
+        base64 instead, which is handed out as a single chunk.
+
+        Clients predating ranged transfers send the whole file whatever the range;
+        the offset and length of the returned download tell what is actually sent.
+
+        Args:
+            path (str): path of the file on the client
+            offset (int): first byte; negative values count from the end of the file
+            length (int, optional): number of bytes; defaults to the rest of the file
+            ifRange (str | int, optional): the file's ETag or modification time (in whole
+                seconds) the range refers to; if the file changed, the whole file is sent
+            ifNoneMatch (str, optional): ETag of a copy held already; if the file still has it,
+                the returned download is empty and marked notModified. Clients predating
+                this send the file regardless.
+
+        Returns:
+            FileDownload or None: the download, None if the client sent an invalid response
+
+        Raises:
+            RangeNotSatisfiableError: if the range starts beyond the end of the file
+            FileTransferError: if the file does not exist or the client failed to read it;
+                raised by the iterator if the transfer breaks off
+        """
         actionType = 'get_file'
-        data = {'path': path}
+        data = {'path': path, 'stream': True}
+        if offset or length is not None:
+            data.update({'offset': offset, 'length': length})
+            if ifRange is not None:
+                data['if_range'] = ifRange
+        if ifNoneMatch is not None:
+            data['if_none_match'] = ifNoneMatch
+        logging.debug('Waiting for file...')
+        response = self.connection.invokeStreamAction(actionType, data, timeout=None)
+        if response is None:
+            logging.warning(f'{self.connection.peerAddr} ({self.clientId}): get_file rejected by client')
+            return None
+        resp_type, resp_contents, stream = response
         try:
-            logging.debug('Waiting for file...')
-            resp_type, resp_contents = self.connection.invokeAction(actionType, data)
             if resp_type != 'file_send':
                 raise InvalidResponseError(f'invalid response type from client for get_file: {resp_type}')
             if 'status' not in resp_contents:
                 raise InvalidResponseError("'status' not found in client response")
             if resp_contents['status'] == 'not_found':
                 raise FileTransferError("Invalid path")
+            elif resp_contents['status'] == 'not_modified':
+                stream.close()
+                return FileDownload(iter(()), 0, fileSize=resp_contents.get('file_size'), etag=resp_contents.get('etag'),
+                                    mtime=resp_contents.get('mtime'), notModified=True)
+            elif resp_contents['status'] == 'invalid_range':
+                raise RangeNotSatisfiableError(resp_contents.get('file_size'))
             elif resp_contents['status'] == 'failed':
                 raise FileTransferError('Client responded with failed status')
-            if 'filedata' not in resp_contents:
-                raise InvalidResponseError("'filedata' not found in client response")
-            filebytes = base64.b64decode(resp_contents['filedata'])
-            # TODO: Validate checksum
-            return filebytes
+            if 'filedata' in resp_contents:
+                stream.close()
+                filebytes = bytesField(resp_contents['filedata'])
+                return FileDownload(iter((filebytes,)), len(filebytes))
+            size = resp_contents.get('size')
+            if not isinstance(size, int):
+                raise InvalidResponseError("'size' not found in client response")
+            return FileDownload(self._readFileStream(path, size, stream), size, resp_contents.get('offset', 0),
+                                resp_contents.get('file_size'), resp_contents.get('etag'), resp_contents.get('mtime'))
         except InvalidResponseError as e:
+            stream.close()
             logging.warning(f'{self.connection.peerAddr} ({self.clientId}): get_file failed (InvalidResponseError): {e}') 
-            self.closeConnectionWithReason('invalid_response')
-        except FileTransferError as e:
-            logging.info(f'{self.connection.peerAddr} ({self.clientId}): get_file failed (FileTransferError): {e}')
+            self.connection.closeConnectionWithReason('invalid_response')
+        except FileTransferError:
+            stream.close()
+            raise
+
+    def _readFileStream(self, path: str, size: int, stream):
+        received = 0
+        try:
+            for chunk in stream:
+                received += len(chunk)
+                yield bytes(chunk)
+            if received != size:
+                raise FileTransferError(f'{path}: received {received} of {size} bytes')
+        except (StreamError, FileTransferError) as e:
+            logging.warning(f'{self.connection.peerAddr} ({self.clientId}): get_file interrupted: {e}')
+            raise FileTransferError(str(e))
+        finally:
+            stream.close()
+
+    def hashFiles(self, paths: list, algorithm='sha256') -> dict | None:
+        """
+        Has the client hash files, transferring only their digests.
+
+        Args:
+            paths (list): paths of the files on the client
+            algorithm (str): one of HASH_ALGORITHMS
+
+        Returns:
+            dict or None: each path mapped to its 'status' ('ok', 'not_found' or 'failed')
+            and, with 'ok', its hex 'digest' and 'size'; None if the request failed
+        """
+        try:
+            response = self.connection.invokeAction('hash_file', {'paths': paths, 'algorithm': algorithm}, timeout=None)
+            if response is None:
+                logging.warning(f'{self.connection.peerAddr} ({self.clientId}): hash_file rejected by client')
+                return None
+            resp_type, resp = response
+            if resp_type != 'file_hash':
+                raise InvalidResponseError(f'invalid response type from client for hash_file: {resp_type}')
+            if resp.get('status') != 'ok' or not isinstance(resp.get('hashes'), dict):
+                logging.warning(f'{self.connection.peerAddr} ({self.clientId}): hash_file failed: {resp.get("status")}')
+                return None
+            return resp['hashes']
+        except InvalidResponseError as e:
+            logging.warning(f'{self.connection.peerAddr} ({self.clientId}): hash_file failed (InvalidResponseError): {e}')
+            self.connection.closeConnectionWithReason('invalid_response')
+        except Exception as e:
+            logging.warning(f'{self.connection.peerAddr} ({self.clientId}): hash_file failed: {e}')
+
+    def hashFile(self, path: str, algorithm='sha256') -> str | None:
+        """
+        Returns:
+            str or None: hex digest of a file on the client, None if it cannot be hashed
+        """
+        result = (self.hashFiles([path], algorithm) or {}).get(path, {})
+        return result.get('digest') if result.get('status') == 'ok' else None
 
-    @disable_timeout()
     def uploadFile(self, path: str, file_bytes: bytes):
+        """
+        Uploads a file held in memory. Use uploadStream for files of arbitrary size.
+
+        Returns:
+            bool: True if the client saved the file
+        """
+        return self.uploadStream(path, io.BytesIO(file_bytes), len(file_bytes))
+
+    def uploadStream(self, path: str, source, size: int, resume=False, sha256: str = None) -> bool:
+        """
+        Uploads a file to the client as a stream of segments read from source, so
+        neither side holds more than a few segments of it in memory. The client
+        writes a temporary file and renames it into place once complete.
+
+        A resumable upload interrupted midway keeps the received part on the client;
+        uploading the same file again with resume=True only sends the rest.
+
+        Given the SHA-256 of the data, the client checks the file it receives against
+        it, and an existing file at path with the same contents counts as uploaded
+        without sending anything.
+
+        Clients without streaming support get the whole file in one base64 action.
+
+        Args:
+            path (str): destination path on the client; must not exist
+            source: binary file object positioned at the start of the data
+            size (int): number of bytes to send
+            resume (bool): make the upload resumable, continuing a previous attempt if there is one
+            sha256 (str, optional): hex digest of the data
+
+        Returns:
+            bool: True if the client saved the file, or already had it
+        """
         try:
-            data = {'path': path, 'filedata': base64.b64encode(file_bytes).decode()}
-            resp_type, resp = self.connection.invokeAction('upload_file', data)
+            data = {'path': path, 'size': size}
+            if resume:
+                data['resume'] = True
+            if sha256 is not None:
+                data['sha256'] = sha256
+            # The client hashes an existing file or a partial upload and preallocates the
+            # temporary file before answering, which takes as long as the file is large
+            response = self.connection.invokeAction('upload_stream', data, timeout=None)
+            if response is None:
+                # Rejected as 'invalid_action' by clients predating streamed uploads
+                if size > constants.MAX_INLINE_FILE_SIZE:
+                    logging.warning(f'{self.connection.peerAddr} ({self.clientId}): {path} is larger than {constants.MAX_INLINE_FILE_SIZE} bytes, '
+                                    'which clients without streamed uploads cannot receive')
+                    return False
+                return self._uploadInline(path, source.read(size))
+            resp_type, resp = response
+            if resp_type != 'file_upload':
+                raise InvalidResponseError(f'invalid response type: {resp_type}')
+            if resp.get('status') == 'present':
+                logging.info(f'{self.connection.peerAddr} ({self.clientId}): {path} is up to date, upload skipped')
+                return True
+            if resp.get('status') != 'ready':
+                logging.info(f'{self.connection.peerAddr} ({self.clientId}): upload_stream refused: {resp.get("status")}')
+                return False
+            offset = resp.get('offset', 0)
+            if offset:
+                logging.info(f'{self.connection.peerAddr} ({self.clientId}): resuming upload of {path} at {offset} of {size} bytes')
+                self._skip(source, offset)
+
+            def write(stream):
+                sent = stream.writeFrom(source, size - offset)
+                if sent != size - offset:
+                    raise FileTransferError(f'source ended after {offset + sent} of {size} bytes')
+            return self._sendUpload(resp.get('upload_id'), write)
+        except InvalidResponseError as e:
+            logging.warning(f'{self.connection.peerAddr} ({self.clientId}): upload_stream failed (invalid response)')
+            self.connection.closeConnectionWithReason('invalid_response')
+        except Exception as e:
+            logging.warning(f'{self.connection.peerAddr} ({self.clientId}): upload_stream failed: {e}')
+        return False
+
+    def uploadDelta(self, path: str, source, size: int) -> bool:
+        """
+        Replaces a file on the client with a new version, sending only what differs
+        from the version the client has: the client sends block checksums of its file,
+        and the new version goes out as references to matching blocks plus literal data
+        for the rest (see network.delta). The client rebuilds the file next to the old
+        one and replaces it once the result matches the new version's digest.
+
+        A file the client does not have yet is uploaded whole.
+
+        Args:
+            path (str): path of the file on the client
+            source: binary file object holding the new version, read once sequentially
+            size (int): size of the new version
+
+        Returns:
+            bool: True if the client saved the new version
+        """
+        try:
+            response = self.connection.invokeStreamAction('file_signature', {'path': path}, timeout=None)
+            if response is None:
+                logging.warning(f'{self.connection.peerAddr} ({self.clientId}): file_signature rejected, client does not support delta uploads')
+                return False
+            resp_type, resp, stream = response
+            if resp_type != 'file_signature' or resp.get('status') != 'ok':
+                stream.close()
+                if resp_type != 'file_signature':
+                    raise InvalidResponseError(f'invalid response type: {resp_type}')
+                if resp.get('status') == 'not_found':
+                    return self.uploadStream(path, source, size)
+                logging.info(f'{self.connection.peerAddr} ({self.clientId}): file_signature failed: {resp.get("status")}')
+                return False
+            blockSize, basisSize = resp.get('block_size'), resp.get('size')
+            if not isinstance(blockSize, int) or blockSize < 1 or not isinstance(basisSize, int):
+                stream.close()
+                raise InvalidResponseError("'block_size' or 'size' missing in file_signature response")
+            try:
+                signature = Signature(stream.read(), blockSize, basisSize)
+            except DeltaError as e:
+                raise InvalidResponseError(str(e))
+
+            resp_type, resp = self.connection.invokeAction('delta_upload', {'path': path, 'size': size, 'block_size': blockSize}, timeout=None)
+            if resp_type != 'file_upload':
+                raise InvalidResponseError(f'invalid response type: {resp_type}')
+            if resp.get('status') != 'ready':
+                logging.info(f'{self.connection.peerAddr} ({self.clientId}): delta_upload refused: {resp.get("status")}')
+                return False
+            encoder = DeltaEncoder(signature)
+
+            def write(stream):
+                for piece in encoder.encode(source, size):
+                    stream.write(piece)
+            success = self._sendUpload(resp.get('upload_id'), write)
+            logging.info(f'{self.connection.peerAddr} ({self.clientId}): delta upload of {path}: {encoder.literalBytes} bytes sent, '
+                         f'{encoder.copiedBytes} bytes reused')
+            return success
+        except InvalidResponseError as e:
+            logging.warning(f'{self.connection.peerAddr} ({self.clientId}): delta upload failed (invalid response): {e}')
+            self.connection.closeConnectionWithReason('invalid_response')
+        except Exception as e:
+            logging.warning(f'{self.connection.peerAddr} ({self.clientId}): delta upload failed: {e}')
+        return False
+
+    def _sendUpload(self, uploadId: int, write) -> bool:
+        """
+        Sends the stream of an upload the client reported ready and waits for the result.
+
+        Args:
+            uploadId (int): ID from the client's 'ready' response
+            write (callable): writes the upload to the StreamWriter passed to it; an
+                exception aborts the upload and is re-raised
+
+        Returns:
+            bool: True if the client saved the file
+
+        Raises:
+            InvalidResponseError: if the client answers upload_finish with an unexpected response
+        """
+        try:
+            with self.connection.openStream(uploadId) as stream:
+                write(stream)
+        except BrokenPipeError:
+            raise
+        except Exception:
+            # The stream was aborted; finishing releases the upload on the client
+            self.connection.invokeAction('upload_finish', {'upload_id': uploadId})
+            raise
+        resp_type, resp = self.connection.invokeAction('upload_finish', {'upload_id': uploadId}, timeout=None)
+        if resp_type != 'file_upload':
+            raise InvalidResponseError(f'invalid response type: {resp_type}')
+        return resp.get('status') == 'ok'
+
+    @staticmethod
+    def _skip(source, count: int):
+        """
+        Advances a file object by count bytes, reading and discarding them if it cannot seek.
+
+        Raises:
+            FileTransferError: if the source ends first
+        """
+        if source.seekable():
+            source.seek(count, io.SEEK_CUR)
+            return
+        while count:
+            skipped = len(source.read(min(count, 1024 * 1024)))
+            if not skipped:
+                raise FileTransferError('source ended before the resume offset')
+            count -= skipped
+
+    def _uploadInline(self, path: str, file_bytes: bytes) -> bool:
+        try:
+            fileData = file_bytes if self.connection.binaryEnvelope else base64.b64encode(file_bytes).decode()
+            data = {'path': path, 'filedata': fileData}
+            resp_type, resp = self.connection.invokeAction('upload_file', data, timeout=None)
             if resp_type != 'file_upload':
                 raise InvalidResponseError(f'invalid response type: {resp_type}')
             return resp.get('status') == 'ok'
         except InvalidResponseError as e:
             logging.warning(f'{self.connection.peerAddr} ({self.clientId}): upload_file failed (invalid response)')
-            self.closeConnectionWithReason('invalid_response')
+            self.connection.closeConnectionWithReason('invalid_response')
         except Exception as e:
             logging.warning(f'{self.connection.peerAddr} ({self.clientId}): upload_file failed: {e}')
 
@@ -110,7 +457,6 @@ class ClientHandler():
         except Exception as e:
             logging.warning(f'{self.connection.peerAddr} ({self.clientId}): listDirectory failed: {e}')
 
-    @disable_timeout()
     def executeShellCommand(self, command: str, timeout=None):
         actionType = 'shell_command'
         if not timeout is None:
@@ -118,7 +464,7 @@ class ClientHandler():
         else:
             data = {'command': command}
         try:
-            resp_type, resp_contents = self.connection.invokeAction(actionType, data)
+            resp_type, resp_contents = self.connection.invokeAction(actionType, data, timeout=None)
             if resp_type != 'shell_result':
                 raise InvalidResponseError(f'invalid response type from client for shell_command: {resp_type}')
             if resp_contents.get('status') == 'timeout':
@@ -131,27 +477,3 @@ class ClientHandler():
             self.closeConnectionWithReason('invalid_response')
         except Exception as e:
             logging.error(f'{self.connection.peerAddr} ({self.clientId}): shell_command failed: {e}')
-
-    def _keepAliveLoop(self, interval=constants.INTERVAL):
-        if not self.connection.running:
-            return
-        logging.debug(f'{self.connection.peerAddr} ({self.clientId}): keepAliveLoop started')
-        while True:
-            if not self.connection.running:
-                return
-            time.sleep(interval)
-            if self.connection.sendLock.locked():
-                continue
-            try:
-                self.ping()
-            except socket.timeout:
-                logging.error(f'{self.connection.peerAddr} ({self.clientId}): Connection timed out')
-                self.connection.closeConnection()
-            except Exception as e:
-                logging.error(f'{self.connection.peerAddr} ({self.clientId}): Uncaught exception in keepAliveLoop: {e}')
-                self.connection.closeConnection()
-
-    def _startKeepAliveLoop(self):
-        threading.Thread(target=self._keepAliveLoop, daemon=True).start()
-
-
@@ -0,0 +1,278 @@
+import json
+import logging
+import os
+import select
+import socket
+import struct
+import threading
+import time
+
+from crypto.cryptohelper import CryptoHelperRSAPool
+import constants
+
+UCRED = struct.Struct('3i')
+
+class HandoffError(Exception):
+    pass
+
+class HandoffSignal:
+    """
+    Tells the read loops of a server's connections to park them for a handoff (see
+    ServerProtocolConnection.readLoop). The loops poll it like a socket: it becomes
+    readable when set and stays readable until cleared.
+    """
+    def __init__(self):
+        self._read, self._write = os.pipe()
+        self._set = False
+        self._lock = threading.Lock()
+
+    def fileno(self) -> int:
+        return self._read
+
+    def is_set(self) -> bool:
+        return self._set
+
+    def set(self):
+        with self._lock:
+            if not self._set:
+                self._set = True
+                os.write(self._write, b'\0')
+
+    def clear(self):
+        with self._lock:
+            if self._set:
+                self._set = False
+                os.read(self._read, 1)
+
+class Takeover:
+    """
+    What a new server process received from the one it took over from (see takeOver).
+
+    Args:
+        listener (socket.socket): the listening socket of the agent server
+        apiSockets (list[socket.socket]): the listening sockets of the API server
+        sessions (list[tuple[socket.socket, dict]]): the agents' sockets with their session states
+    """
+    def __init__(self, listener, apiSockets: list, sessions: list):
+        self.listener = listener
+        self.apiSockets = apiSockets
+        self.sessions = sessions
+
+def _peerCredentials(sock) -> tuple[int, int]:
+    """
+    Returns:
+        tuple[int, int]: the pid and uid of the process at the other end of a Unix socket
+    """
+    pid, uid, _ = UCRED.unpack(sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, UCRED.size))
+    return pid, uid
+
+def _send(sock, message: dict, fds=()):
+    socket.send_fds(sock, [json.dumps(message).encode()], list(fds))
+
+def _recv(sock, *expected: str) -> tuple[dict, list]:
+    """
+    Receives a message of one of the expected types with the file descriptors passed along.
+
+    Raises:
+        HandoffError: if the peer closed the socket or sent something else; received
+            file descriptors are closed then
+    """
+    data, fds, flags, _ = socket.recv_fds(sock, constants.HANDOFF_MESSAGE_SIZE, constants.HANDOFF_BATCH + 1)
+    try:
+        if not data:
+            raise HandoffError('the other process closed the handoff socket')
+        if flags & (socket.MSG_TRUNC | socket.MSG_CTRUNC):
+            raise HandoffError('handoff message truncated')
+        message = json.loads(data)
+        if message.get('type') not in expected:
+            raise HandoffError(f"expected a {' or '.join(expected)} message, got {message.get('type')}")
+    except (HandoffError, ValueError) as e:
+        for fd in fds:
+            os.close(fd)
+        raise HandoffError(str(e))
+    return message, fds
+
+class HandoffListener:
+    """
+    Lets a new server process take over the sockets of this one, so a deploy neither
+    drops the agents' connections nor makes them redo their handshakes.
+
+    A new process connects to the Unix socket at path (see takeOver). This process then
+    parks its connections as they become idle (see ServerProtocolConnection.readLoop),
+    and sends the listening sockets of the agent and API servers, and the sockets of the
+    parked connections together with their sessions, over the Unix socket (SCM_RIGHTS).
+    Once the new process confirmed, onHandedOff is called, which by default exits without
+    closing anything; the new process only starts reading once this one is gone.
+
+    Connections still busy after drainTimeout, still in their handshake, or accepted
+    meanwhile are not handed over and close with this process; their agents reconnect.
+    If the new process goes away before confirming, the parked connections are resumed.
+
+    Only the peer's own user may connect. The threaded FlitifyServer in a single process
+    is supported; the asyncio engine and worker processes are not.
+
+    Args:
+        path (str): path of the Unix socket
+        server (FlitifyServer): the agent server
+        apiServer (ApiServer, optional): the API server, whose listening sockets are handed over too
+        drainTimeout (float): seconds to wait for busy connections to become idle
+        onHandedOff (callable, optional): called once the new process took over (defaults to stopping
+            the RSA worker processes and os._exit(0))
+    """
+    def __init__(self, path: str, server, apiServer=None, drainTimeout=constants.HANDOFF_DRAIN_TIMEOUT, onHandedOff=None):
+        self.path = path
+        self.server = server
+        self.apiServer = apiServer
+        self.drainTimeout = drainTimeout
+        self.onHandedOff = onHandedOff or self._exit
+        self.sock = None
+        self.logger = logging.getLogger('flitify')
+
+    def start(self):
+        """
+        Starts listening for a new process in a daemon thread. A socket left at path
+        by the process this one took over from is replaced.
+        """
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self.sock.listen()
+        threading.Thread(target=self._serve, name='FlitifyHandoff', daemon=True).start()
+
+    def _serve(self):
+        while True:
+            conn, _ = self.sock.accept()
+            with conn:
+                conn.settimeout(constants.SOCKET_TIMEOUT)
+                try:
+                    pid, uid = _peerCredentials(conn)
+                    if uid != os.getuid():
+                        self.logger.warning(f'Handoff: refusing process {pid} of user {uid}')
+                        continue
+                    _recv(conn, 'takeover')
+                except (OSError, HandoffError) as e:
+                    self.logger.warning(f'Handoff: invalid request: {e}')
+                    continue
+                self._handOff(conn, pid)
+
+    def _handOff(self, conn, pid: int):
+        self.logger.info(f'Handoff: handing connections over to process {pid}')
+        started = time.monotonic()
+        parked = self._park()
+        try:
+            apiSockets = self.apiServer.listeningSockets() if self.apiServer is not None else []
+            _send(conn, {'type': 'listeners', 'api': len(apiSockets)}, [self.server.sock.fileno(), *(sock.fileno() for sock in apiSockets)])
+            for start in range(0, len(parked), constants.HANDOFF_BATCH):
+                batch = parked[start:start + constants.HANDOFF_BATCH]
+                _send(conn, {'type': 'sessions', 'sessions': [connection.exportSession() for connection in batch]},
+                      [connection.socket.fileno() for connection in batch])
+            _send(conn, {'type': 'done'})
+            _recv(conn, 'ack')
+        except Exception as e:
+            self.logger.error(f'Handoff: process {pid} did not take over, resuming: {e}')
+            self._resume(parked)
+            return
+        self.logger.info(f'Handoff: {len(parked)} connections handed over in {time.monotonic() - started:.2f} s')
+        self.onHandedOff()
+
+    def _exit(self):
+        # The RSA worker processes would outlive os._exit
+        if isinstance(self.server.rsa, CryptoHelperRSAPool):
+            self.server.rsa.shutdown(wait=True)
+        os._exit(0)
+
+    def _park(self) -> list:
+        """
+        Parks every connection as soon as it is idle, for at most drainTimeout seconds.
+
+        Returns:
+            list: the parked connections
+        """
+        self.server.handoff.set()
+        deadline = time.monotonic() + self.drainTimeout
+        while True:
+            # Clients finishing their handshake meanwhile are parked too
+            connections = [client.connection for client in self.server.registry.getClients()]
+            if all(connection.parked.is_set() or not connection.running for connection in connections) or time.monotonic() >= deadline:
+                break
+            time.sleep(constants.HANDOFF_POLL_INTERVAL)
+        parked = [connection for connection in connections if connection.parked.is_set() and connection.running]
+        if len(parked) < len(connections):
+            self.logger.warning(f'Handoff: {len(connections) - len(parked)} connections are still busy and will be dropped')
+        return parked
+
+    def _resume(self, parked: list):
+        self.server.handoff.clear()
+        for connection in parked:
+            connection.parked.clear()
+            threading.Thread(target=connection.readLoop, name='FlitifyResumedClient', daemon=True).start()
+
+def takeOver(path: str, timeout=constants.HANDOFF_DRAIN_TIMEOUT + constants.SOCKET_TIMEOUT) -> Takeover:
+    """
+    Takes over the sockets of the server process listening for a handoff at path (see HandoffListener).
+    Returns once that process has exited, so from then on nothing but this process reads
+    from the sockets.
+
+    Args:
+        path (str): path of the Unix socket the running server listens on
+        timeout (float): seconds to wait for the running server to drain its connections and exit
+
+    Returns:
+        Takeover: the listening sockets and the agents' sockets with their sessions
+
+    Raises:
+        HandoffError: if no server of this user listens at path or the handoff fails
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    listeners, sessions = [], []
+    try:
+        sock.settimeout(timeout)
+        try:
+            sock.connect(path)
+        except OSError as e:
+            raise HandoffError(f'no server process to take over at {path}: {e}')
+        pid, uid = _peerCredentials(sock)
+        if uid != os.getuid():
+            raise HandoffError(f'the server process at {path} belongs to user {uid}')
+        _send(sock, {'type': 'takeover'})
+        message, listeners = _recv(sock, 'listeners')
+        if len(listeners) != 1 + message['api']:
+            raise HandoffError('listening sockets missing')
+        while True:
+            message, fds = _recv(sock, 'sessions', 'done')
+            if len(fds) != len(message.get('sessions', [])):
+                listeners.extend(fds)
+                raise HandoffError('sockets of the sessions missing')
+            sessions.extend(zip(fds, message.get('sessions', [])))
+            if message['type'] == 'done':
+                break
+        _send(sock, {'type': 'ack'})
+        _waitForExit(pid, timeout)
+    except BaseException:
+        for fd in listeners + [fd for fd, _ in sessions]:
+            os.close(fd)
+        raise
+    finally:
+        sock.close()
+    listener, *apiSockets = (socket.socket(fileno=fd) for fd in listeners)
+    return Takeover(listener, apiSockets, [(socket.socket(fileno=fd), state) for fd, state in sessions])
+
+def _waitForExit(pid: int, timeout: float):
+    """
+    Raises:
+        HandoffError: if the process is still running after timeout seconds
+    """
+    try:
+        pidfd = os.pidfd_open(pid)
+    except ProcessLookupError:
+        return
+    try:
+        # poll rather than select, the descriptor number is as high as the agents are many
+        poller = select.poll()
+        poller.register(pidfd, select.POLLIN)
+        if not poller.poll(timeout * 1000):
+            raise HandoffError(f'process {pid} did not exit after the handoff')
+    finally:
+        os.close(pidfd)
@@ -0,0 +1,158 @@
+import math
+import threading
+import logging
+import time
+
+import constants
+
+class TimerWheel:
+    """
+    Hashed timer wheel.
+
+    Timers are hashed into slots by their expiry tick, so scheduling is O(1) and
+    each tick only looks at the timers stored in one slot. Not thread-safe.
+
+    Args:
+        tick (float): resolution of the wheel in seconds
+        slots (int): number of slots; timers further than tick * slots ahead wrap around
+    """
+    def __init__(self, tick=0.1, slots=512):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.origin = time.monotonic()
+        self.currentTick = 0
+
+    def schedule(self, deadline: float, item):
+        """
+        Schedules an item to expire at the given time.
+
+        Args:
+            deadline (float): expiry time on the time.monotonic() clock
+            item: any object, returned by advance() once expired
+        """
+        expiryTick = max(math.ceil((deadline - self.origin) / self.tick), self.currentTick + 1)
+        self.slots[expiryTick % len(self.slots)].append((expiryTick, item))
+
+    def advance(self, now: float) -> list:
+        """
+        Moves the wheel forward to the given time.
+
+        Args:
+            now (float): current time on the time.monotonic() clock
+
+        Returns:
+            list: items whose deadline has passed
+        """
+        targetTick = int((now - self.origin) / self.tick)
+        expired = []
+        while self.currentTick < targetTick:
+            self.currentTick += 1
+            index = self.currentTick % len(self.slots)
+            pending = []
+            for expiryTick, item in self.slots[index]:
+                if expiryTick <= self.currentTick:
+                    expired.append(item)
+                else:
+                    pending.append((expiryTick, item))
+            self.slots[index] = pending
+        return expired
+
+class _KeepAliveEntry:
+    def __init__(self, connection):
+        self.connection = connection
+        self.pingFuture = None
+        self.pingSentAt = 0.0
+
+class KeepAliveScheduler:
+    """
+    Drives liveness checks of all connections of a server from a single thread.
+
+    A connection is pinged only after it has been idle (no frame sent or received)
+    for a full interval, whether or not actions are waiting for their responses, as
+    agents answer pings while busy. A ping after which nothing at all is received
+    for longer than the timeout closes the connection, which fails the actions waiting
+    on it; anything received meanwhile, such as a large frame ahead of the pong, counts
+    as the answer. Pings are sent without blocking, the scheduler never waits for a response.
+
+    Connections must provide running, lastActivity, lastReceived, sendPing() (returning
+    a Future, or None if the connection is busy sending) and closeConnection().
+
+    Args:
+        interval (float): idle time in seconds after which a connection is pinged
+        timeout (float): seconds a ping may remain unanswered
+        tick (float): resolution of the timer wheel in seconds
+    """
+    def __init__(self, interval=constants.INTERVAL, timeout=constants.SOCKET_TIMEOUT, tick=0.1):
+        self.interval = interval
+        self.timeout = timeout
+        self.wheel = TimerWheel(tick)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.logger = logging.getLogger('flitify')
+
+    def start(self):
+        """
+        Starts the scheduler thread.
+        """
+        self.thread = threading.Thread(target=self._run, daemon=True, name='FlitifyServer-KeepAlive')
+        self.thread.start()
+
+    def add(self, connection):
+        """
+        Starts watching an authenticated connection. Closed connections are dropped automatically.
+        """
+        self._schedule(_KeepAliveEntry(connection), time.monotonic() + self.interval)
+
+    def _schedule(self, entry, deadline):
+        with self.lock:
+            self.wheel.schedule(deadline, entry)
+
+    def _run(self):
+        while True:
+            time.sleep(self.wheel.tick)
+            with self.lock:
+                expired = self.wheel.advance(time.monotonic())
+            for entry in expired:
+                try:
+                    self._check(entry)
+                except Exception as e:
+                    self.logger.error(f'{entry.connection.peerAddr}: uncaught exception in keepalive check: {e}')
+                    entry.connection.closeConnection()
+
+    def _check(self, entry):
+        connection = entry.connection
+        if not connection.running:
+            return
+        now = time.monotonic()
+        if entry.pingFuture is not None and not entry.pingFuture.done():
+            if connection.lastReceived <= entry.pingSentAt:
+                if now - entry.pingSentAt >= self.timeout:
+                    self.logger.error(f'{connection.peerAddr} ({connection.clientId}): Connection timed out')
+                    connection.closeConnection()
+                else:
+                    self._schedule(entry, entry.pingSentAt + self.timeout)
+                return
+            # Anything received since proves the connection alive, the pong may be queued behind it
+            entry.pingFuture = None
+        if entry.pingFuture is not None:
+            future, entry.pingFuture = entry.pingFuture, None
+            try:
+                response = future.result()
+            except BrokenPipeError:
+                return
+            except Exception as e:
+                response = e
+            if not isinstance(response, tuple) or response[0] != 'pong':
+                self.logger.warning(f'{connection.peerAddr} ({connection.clientId}): Ping failed: invalid response {response}')
+                connection.closeConnection()
+                return
+        if now - connection.lastActivity < self.interval:
+            # Recent traffic already proves the connection is alive
+            self._schedule(entry, connection.lastActivity + self.interval)
+            return
+        entry.pingFuture = connection.sendPing()
+        if entry.pingFuture is None:
+            self._schedule(entry, now + self.interval)
+            return
+        entry.pingSentAt = now
+        self._schedule(entry, now + self.timeout)
@@ -0,0 +1,97 @@
+import sqlite3
+import threading
+
+from server.clientregistry import ClientRegistry
+
+class WorkerDirectory:
+    """
+    Table of which worker process owns which client ID, shared by the worker
+    processes of one server through a local SQLite database.
+
+    The table only lives as long as the server: it is not synced to disk and the
+    server starts with an empty one. Thread-safe.
+
+    Args:
+        path (str): path of the database file
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=OFF')
+        self.db.execute('CREATE TABLE IF NOT EXISTS clients (client_id TEXT PRIMARY KEY, worker INTEGER NOT NULL)')
+
+    def claim(self, clientId: str, worker: int) -> bool:
+        """
+        Returns:
+            bool: True if the client now belongs to the worker, False if another connection already owns it
+        """
+        with self.lock:
+            try:
+                self.db.execute('INSERT INTO clients (client_id, worker) VALUES (?, ?)', (clientId, worker))
+            except sqlite3.IntegrityError:
+                return False
+        return True
+
+    def release(self, clientId: str, worker: int):
+        """ Removes a client, but only if the worker owns it. """
+        with self.lock:
+            self.db.execute('DELETE FROM clients WHERE client_id = ? AND worker = ?', (clientId, worker))
+
+    def owner(self, clientId: str) -> int | None:
+        """
+        Returns:
+            int or None: the worker the client is connected to, None if it is offline
+        """
+        with self.lock:
+            row = self.db.execute('SELECT worker FROM clients WHERE client_id = ?', (clientId,)).fetchone()
+        return None if row is None else row[0]
+
+    def clientIds(self) -> list:
+        """
+        Returns:
+            list: IDs of the clients connected to any worker
+        """
+        with self.lock:
+            return [row[0] for row in self.db.execute('SELECT client_id FROM clients')]
+
+    def clearWorker(self, worker: int):
+        """ Removes all clients of a worker, after it stopped. """
+        with self.lock:
+            self.db.execute('DELETE FROM clients WHERE worker = ?', (worker,))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+class SharedClientRegistry(ClientRegistry):
+    """
+    Registry of the clients connected to one worker process, which also publishes
+    them to the WorkerDirectory. A client ID registered with any worker counts as
+    taken, so duplicate connections are rejected across workers like within one.
+
+    Args:
+        directory (WorkerDirectory): the table shared by the workers
+        worker (int): index of this worker
+    """
+    def __init__(self, directory: WorkerDirectory, worker: int):
+        super().__init__()
+        self.directory = directory
+        self.worker = worker
+
+    def register(self, clientId: str, client) -> bool:
+        with self._lock:
+            if clientId in self._clients or not self.directory.claim(clientId, self.worker):
+                return False
+            self._clients[clientId] = client
+        self.logger.debug(f'Registry: {clientId} registered with worker {self.worker}')
+        return True
+
+    def unregister(self, clientId: str, client):
+        with self._lock:
+            if self._clients.get(clientId) is not client:
+                return
+            del self._clients[clientId]
+            self.directory.release(clientId, self.worker)
+        self.logger.debug(f'Registry: {clientId} unregistered from worker {self.worker}')
@@ -0,0 +1,126 @@
+import hashlib
+import logging
+import os
+import re
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import constants
+
+DIGEST_PATTERN = re.compile(r'[0-9a-f]{64}')
+COPY_BUFFER_SIZE = 1024 * 1024
+
+class StagedFileNotFoundError(Exception):
+    pass
+
+class StagingArea:
+    """
+    Server-side store of files to push to clients, addressed by the SHA-256 of their
+    contents, so a file pushed to many clients is received and stored once.
+
+    Args:
+        directory (str): where staged files are kept; created if missing
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def store(self, source, size: int = None) -> tuple[str, int]:
+        """
+        Copies a file into the staging area, hashing it on the way.
+
+        Args:
+            source: binary file object to read
+            size (int, optional): bytes to read; defaults to everything until EOF
+
+        Returns:
+            tuple[str, int]: hex digest the file is staged under, and its size
+
+        Raises:
+            OSError: if the file cannot be written
+        """
+        digest = hashlib.sha256()
+        stored = 0
+        fd, tempPath = tempfile.mkstemp(dir=self.directory, prefix='.incoming.')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                while size is None or stored < size:
+                    data = source.read(COPY_BUFFER_SIZE if size is None else min(COPY_BUFFER_SIZE, size - stored))
+                    if not data:
+                        break
+                    digest.update(data)
+                    file.write(data)
+                    stored += len(data)
+            # Storing the same contents again replaces the file with an identical one
+            os.replace(tempPath, os.path.join(self.directory, digest.hexdigest()))
+        except BaseException:
+            os.unlink(tempPath)
+            raise
+        return digest.hexdigest(), stored
+
+    def path(self, digest: str) -> str:
+        """
+        Returns:
+            str: path of a staged file
+
+        Raises:
+            StagedFileNotFoundError: if no file is staged under digest
+        """
+        if not DIGEST_PATTERN.fullmatch(digest or ''):
+            raise StagedFileNotFoundError(f'invalid digest: {digest!r}')
+        path = os.path.join(self.directory, digest)
+        if not os.path.isfile(path):
+            raise StagedFileNotFoundError(digest)
+        return path
+
+    def remove(self, digest: str):
+        """
+        Raises:
+            StagedFileNotFoundError: if no file is staged under digest
+        """
+        os.unlink(self.path(digest))
+
+def pushToClients(server, stagedPath: str, digest: str, path: str, clientIds: list, delta=False,
+                  workers=constants.BULK_UPLOAD_WORKERS):
+    """
+    Uploads a staged file to many clients, at most workers at a time. Clients that
+    already have an identical file at path skip the transfer.
+
+    Args:
+        server (FlitifyServer | AsyncFlitifyServer): server the clients are connected to
+        stagedPath (str): path of the staged file
+        digest (str): its SHA-256
+        path (str): destination path on the clients
+        clientIds (list): clients to upload to
+        delta (bool): replace existing files with delta uploads (see ClientHandler.uploadDelta)
+        workers (int): number of uploads running at once
+
+    Yields:
+        dict: 'client_id' and 'status' ('ok', 'failed' or 'offline') of each client, in
+        the order the uploads finish; closing the generator cancels uploads not yet started
+    """
+    size = os.path.getsize(stagedPath)
+
+    def upload(clientId):
+        client = server.getClientById(clientId)
+        if client is None:
+            return 'offline'
+        with open(stagedPath, 'rb') as source:
+            if delta:
+                success = client.uploadDelta(path, source, size)
+            else:
+                success = client.uploadStream(path, source, size, sha256=digest)
+        return 'ok' if success else 'failed'
+
+    executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='FlitifyBulkUpload')
+    try:
+        futures = {executor.submit(upload, clientId): clientId for clientId in clientIds}
+        for future in as_completed(futures):
+            try:
+                status = future.result()
+            except Exception as e:
+                logging.warning(f'bulk upload of {digest} to {futures[future]} failed: {e}')
+                status = 'failed'
+            yield {'client_id': futures[future], 'status': status}
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,130 @@
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import shutil
+import signal
+import tempfile
+import threading
+
+from server.sharedregistry import WorkerDirectory
+
+class WorkerExitedError(Exception):
+    pass
+
+def _watchParent():
+    """ Exits a worker as soon as the process that started it is gone. """
+    multiprocessing.connection.wait([multiprocessing.parent_process().sentinel])
+    os._exit(1)
+
+def _runWorker(target, worker: int, directoryPath: str, socketPath: str):
+    # Interrupts reach the whole process group; the parent stops the workers itself
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    threading.Thread(target=_watchParent, name='FlitifyWorker-Parent', daemon=True).start()
+    target(worker, directoryPath, socketPath)
+
+class WorkerPool:
+    """
+    Pre-forked worker processes, so handshakes and encrypted transfers are spread over
+    all cores instead of the one core the GIL leaves a single process.
+
+    Each worker runs its own agent server, listening on the same port with
+    SO_REUSEPORT so the kernel spreads incoming agents over the workers, and its own
+    API server on a Unix socket in runDir. The workers publish the clients connected
+    to them in a WorkerDirectory, which the API server of this process uses to route
+    each client's requests to its worker (see RoutingApiServer).
+
+    Args:
+        count (int): number of worker processes
+        target (callable): run in each worker as target(worker, directoryPath, socketPath)
+            with the worker's index, the WorkerDirectory path and the Unix socket its API
+            server listens on; it should not return
+        rsaKey (bytes): RSA private key of the server, for the API server's /getkey
+        runDir (str, optional): directory of the WorkerDirectory and the workers' sockets
+            (defaults to a new temporary directory, removed by stop())
+    """
+    def __init__(self, count: int, target, rsaKey: bytes, runDir: str = None):
+        self.count = count
+        self.target = target
+        self.rsaKey = rsaKey
+        self.ownsRunDir = runDir is None
+        self.runDir = runDir or tempfile.mkdtemp(prefix='flitify-workers-')
+        self.directoryPath = os.path.join(self.runDir, 'clients.db')
+        # Created before the workers so they start from an empty table
+        WorkerDirectory(self.directoryPath).close()
+        self.directory = None
+        self.processes = []
+        self.running = False
+        self.logger = logging.getLogger('flitify')
+
+    def socketPath(self, worker: int) -> str:
+        """
+        Returns:
+            str: path of the Unix socket the worker's API server listens on
+        """
+        return os.path.join(self.runDir, f'worker-{worker}.sock')
+
+    def start(self):
+        """ Starts the worker processes. """
+        context = multiprocessing.get_context('fork')
+        for worker in range(self.count):
+            process = context.Process(target=_runWorker, args=(self.target, worker, self.directoryPath, self.socketPath(worker)),
+                                      name=f'FlitifyWorker-{worker}')
+            process.start()
+            self.processes.append(process)
+        # SQLite connections must not cross a fork, so this one is only opened afterwards
+        self.directory = WorkerDirectory(self.directoryPath)
+        self.running = True
+        self.logger.info(f'Started {self.count} worker processes')
+
+    def watch(self):
+        """
+        Blocks until a worker process exits.
+
+        Raises:
+            WorkerExitedError: if the worker exited while the pool is running
+        """
+        sentinels = {process.sentinel: worker for worker, process in enumerate(self.processes)}
+        ready = multiprocessing.connection.wait(list(sentinels))
+        if self.running:
+            worker = sentinels[ready[0]]
+            raise WorkerExitedError(f'worker {worker} exited with code {self.processes[worker].exitcode}')
+
+    def stop(self, timeout=5):
+        """ Terminates the worker processes and removes what start() created. """
+        self.running = False
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join(timeout)
+            if process.is_alive():
+                process.kill()
+        if self.directory is not None:
+            self.directory.close()
+        if self.ownsRunDir:
+            shutil.rmtree(self.runDir, ignore_errors=True)
+
+    def ownerOf(self, clientId: str) -> int | None:
+        """
+        Returns:
+            int or None: the worker the client is connected to, None if it is offline
+        """
+        return self.directory.owner(clientId)
+
+    def getClientList(self) -> list:
+        """
+        Returns:
+            list: IDs of the clients connected to any worker
+        """
+        return self.directory.clientIds()
+
+    def getClientById(self, clientId: str):
+        """
+        Clients are served by the worker they are connected to, not in this process;
+        their requests are forwarded (see ownerOf).
+
+        Returns:
+            None
+        """
+        return None
@@ -1,15 +1,25 @@
 import config
+import constants
 from config import ConfigError
 from server.flitifyserver import FlitifyServer
+from server.asyncflitifyserver import AsyncFlitifyServer
 from storage.dbhandler import DBHandler, DBFailure
 from apiserver.apiserver import ApiServer
-
+from apiserver.router import RoutingApiServer
+from network.compression import FrameCompressor, COMPRESSION_ALGORITHMS
+from server.admission import HandshakeAdmission
+from server.sharedregistry import WorkerDirectory, SharedClientRegistry
+from server.workerpool import WorkerPool
+from server.handoff import HandoffListener, takeOver
+
+import argparse
 import time
 import logging
 import threading
 import os
 import traceback
 import signal
+import functools
 
 shutdownEvent = threading.Event()
 
@@ -21,20 +31,35 @@ logging.basicConfig(
 
 logging.getLogger("pymongo").setLevel(logging.ERROR)
 
-def startFlitifyServer(servConfig, rsaKey):
+def startFlitifyServer(servConfig, rsaKey, registry=None, worker=None, takeover=None):
     """
     Initializes and starts the Flitify server in a separate daemon thread.
 
     Args:
-        servConfig (dict): Configuration dictionary for the Flitify server, including host, port, and database settings.
+        servConfig (dict): Configuration dictionary for the Flitify server, including host, port, database settings and the optional max_frame_size.
         rsaKey (bytes): RSA private key used for secure communication with clients.
+        registry (ClientRegistry, optional): Registry of the connected clients, shared with the other workers in a worker process.
+        worker (int, optional): Index of the worker process the server runs in, which listens with SO_REUSEPORT.
+        takeover (Takeover, optional): Listening socket and agent connections taken over from the previous
+            server process, which the threaded server continues to serve.
+
+    The optional 'engine' key selects the threaded FlitifyServer ('threaded', default)
+    or the asyncio based AsyncFlitifyServer ('asyncio'). The optional 'handshake_workers'
+    key sizes the RSA decryption process pool (defaults to the CPU count, or to 0, disabling
+    it, in worker processes, which already spread the decryptions over the cores).
+    'compression' lists the compression algorithms accepted from agents (defaults to all,
+    an empty list disables compression), 'compression_level' and 'compression_threshold'
+    set the zlib level and the smallest frame compressed. 'max_handshakes', 'handshake_queue'
+    and 'handshake_deadline' bound the handshakes run at once, the connections waiting for one
+    and the seconds they may wait; further agents are asked to retry later.
 
     Returns:
-        FlitifyServer: The initialized Flitify server instance.
+        FlitifyServer | AsyncFlitifyServer: The initialized Flitify server instance.
     """
     logger = logging.getLogger("flitify")
     handler = logging.StreamHandler()
-    formatter = logging.Formatter("FlitifyServer: [%(asctime)s] [%(levelname)s] %(message)s", datefmt='%Y-%m-%d %H:%M:%S')
+    name = "FlitifyServer" if worker is None else f"FlitifyServer[{worker}]"
+    formatter = logging.Formatter(name + ": [%(asctime)s] [%(levelname)s] %(message)s", datefmt='%Y-%m-%d %H:%M:%S')
     handler.setFormatter(formatter)
     logger.addHandler(handler)
     logger.propagate = False
@@ -45,19 +70,41 @@ def startFlitifyServer(servConfig, rsaKey):
     dbUser = servConfig['db_user']
     dbPassword = servConfig['db_password']
     dbName = servConfig['db_name']
+    maxFrameSize = servConfig.get('max_frame_size')
+    handshakeWorkers = servConfig.get('handshake_workers', None if worker is None else 0)
+    compression = FrameCompressor(servConfig.get('compression', COMPRESSION_ALGORITHMS),
+                                  servConfig.get('compression_level', constants.COMPRESSION_LEVEL),
+                                  servConfig.get('compression_threshold', constants.COMPRESSION_THRESHOLD))
+    admission = HandshakeAdmission(servConfig.get('max_handshakes', constants.MAX_HANDSHAKES),
+                                   servConfig.get('handshake_queue', constants.HANDSHAKE_QUEUE),
+                                   servConfig.get('handshake_deadline', constants.HANDSHAKE_DEADLINE))
     dbHandler = DBHandler(dbAddress, dbUser, dbPassword, dbName)
-    server = FlitifyServer(host, port, rsaKey, dbHandler)
+    if servConfig.get('engine', 'threaded') == 'asyncio':
+        server = AsyncFlitifyServer(host, port, rsaKey, dbHandler, maxFrameSize, handshakeWorkers=handshakeWorkers, compression=compression,
+                                    admission=admission, registry=registry, reusePort=worker is not None)
+    else:
+        server = FlitifyServer(host, port, rsaKey, dbHandler, maxFrameSize, handshakeWorkers, compression, admission,
+                               registry, reusePort=worker is not None, listenSocket=takeover.listener if takeover else None)
+        if takeover is not None:
+            adopted = sum(server.adoptConnection(sock, state) for sock, state in takeover.sessions)
+            logger.info(f'Took over {adopted} of {len(takeover.sessions)} agent connections')
     server_thread = threading.Thread(target=server.start, name='FlitifyServer', daemon=True)
     server_thread.start()
     return server
 
-def startAPIServer(flitifyServer, apiConfig):
+def startAPIServer(flitifyServer, apiConfig, unixSocket=None, sockets=None):
     """
     Initializes and starts the API server in a separate daemon thread.
 
     Args:
-        flitifyServer (FlitifyServer): Reference to the running Flitify server instance.
+        flitifyServer (FlitifyServer | WorkerPool): Reference to the running Flitify server instance, or
+            the worker processes running the servers, whose clients' requests are routed to them.
         apiConfig (dict): Configuration dictionary for the API server, including host, port, and API secret.
+        unixSocket (str, optional): Unix socket the API server of a worker process listens on instead.
+        sockets (list[socket.socket], optional): Listening sockets taken over from the previous server process.
+
+    Returns:
+        ApiServer: The initialized API server instance.
     """
     logger = logging.getLogger('waitress')
     handler = logging.StreamHandler()
@@ -73,9 +120,36 @@ def startAPIServer(flitifyServer, apiConfig):
     logger.propagate = False
 
 
-    server = ApiServer(flitifyServer, host=apiConfig['host'], port=apiConfig['port'], secret=apiConfig['secret'])
+    options = dict(host=apiConfig['host'], port=apiConfig['port'], secret=apiConfig['secret'],
+                   stagingDir=apiConfig.get('staging_dir'), bulkUploadWorkers=apiConfig.get('bulk_upload_workers', constants.BULK_UPLOAD_WORKERS),
+                   fileCacheEntries=apiConfig.get('file_cache_entries', constants.FILE_CACHE_ENTRIES),
+                   fileCacheBytes=apiConfig.get('file_cache_bytes', constants.FILE_CACHE_BYTES), unixSocket=unixSocket, sockets=sockets)
+    if isinstance(flitifyServer, WorkerPool):
+        server = RoutingApiServer(flitifyServer, **options)
+    else:
+        server = ApiServer(flitifyServer, **options)
     server_thread = threading.Thread(target=server.start, name='ApiServer', daemon=True)
     server_thread.start()
+    return server
+
+def runWorker(worker, directoryPath, socketPath, servConfig, apiConfig, rsaKey):
+    """
+    Entry point of a worker process (see WorkerPool): runs a Flitify server sharing the
+    port with the other workers, and an API server for its clients on a Unix socket.
+
+    Args:
+        worker (int): Index of the worker.
+        directoryPath (str): Path of the WorkerDirectory the connected clients are published to.
+        socketPath (str): Unix socket the worker's API server listens on.
+        servConfig (dict): Configuration dictionary for the Flitify server.
+        apiConfig (dict): Configuration dictionary for the API server.
+        rsaKey (bytes): RSA private key used for secure communication with clients.
+    """
+    threading.excepthook = kill_on_exception
+    registry = SharedClientRegistry(WorkerDirectory(directoryPath), worker)
+    flitifyServer = startFlitifyServer(servConfig, rsaKey, registry, worker)
+    startAPIServer(flitifyServer, apiConfig, socketPath)
+    threading.Event().wait()
 
 def graceful_shutdown(signum, frame):
     """
@@ -94,13 +168,13 @@ def kill_on_exception(args):
     """
     Custom exception hook for critical server threads.
 
-    If a monitored thread (FlitifyServer, ApiServer, or Watchdog) crashes,
+    If a monitored thread (FlitifyServer, its keepalive scheduler or ApiServer) crashes,
     logs the error and immediately terminates the process.
 
     Args:
         args (threading.ExceptHookArgs): Exception information passed by the thread.
     """
-    if args.thread.name not in ['FlitifyServer', 'ApiServer', 'FlitifyServer-Watchdog']:
+    if args.thread.name not in ['FlitifyServer', 'FlitifyServer-KeepAlive', 'ApiServer', 'FlitifyWorkers']:
         return
     logging.critical(f"Thread {args.thread.name} stopped, stopping server {args.exc_type.__name__}: {args.exc_value}")
     logging.critical("Traceback:\n" + "".join(traceback.format_exception(args.exc_type, args.exc_value, args.exc_traceback)))
@@ -110,8 +184,22 @@ def main():
     """
     Entry point for launching the Flitify Server.
 
+    With 'workers' above 1 in the flitify_server config, the Flitify servers run in that
+    many worker processes and this process only runs the API server, which routes the
+    requests for each client to its worker.
+
+    With 'handoff_socket' in the flitify_server config, the server listens on that Unix
+    socket for its successor: started with --upgrade, a new process takes over the
+    listening sockets and the agents' connections of the running one, which exits, so
+    a deploy neither drops agents nor costs handshakes (see server.handoff).
+    'handoff_drain_timeout' sets the seconds granted to busy connections to become idle.
+
     On failure, logs a critical error and exits the process.
     """
+    parser = argparse.ArgumentParser(description='Flitify server')
+    parser.add_argument('--upgrade', action='store_true',
+                        help="take over the agents of the server running with the same config, through its handoff_socket")
+    args = parser.parse_args()
     signal.signal(signal.SIGINT, graceful_shutdown)
     signal.signal(signal.SIGTERM, graceful_shutdown)
     try:
@@ -121,8 +209,26 @@ def main():
         apiConfig = lConfig['api_server']
         rsaKey = open(servConfig['private_key_path'], 'rb').read()
         threading.excepthook = kill_on_exception
-        flitifyServer = startFlitifyServer(servConfig, rsaKey)
-        startAPIServer(flitifyServer, apiConfig)
+        handoffSocket = servConfig.get('handoff_socket')
+        drainTimeout = servConfig.get('handoff_drain_timeout', constants.HANDOFF_DRAIN_TIMEOUT)
+        if args.upgrade and handoffSocket is None:
+            raise ConfigError('--upgrade needs handoff_socket in the flitify_server config')
+        workerCount = servConfig.get('workers', constants.WORKERS)
+        if workerCount > 1:
+            workers = WorkerPool(workerCount, functools.partial(runWorker, servConfig=servConfig, apiConfig=apiConfig, rsaKey=rsaKey), rsaKey)
+            workers.start()
+            threading.Thread(target=workers.watch, name='FlitifyWorkers', daemon=True).start()
+            startAPIServer(workers, apiConfig)
+            shutdownEvent.wait()
+            workers.stop()
+            return
+        takeover = None
+        if args.upgrade:
+            takeover = takeOver(handoffSocket, drainTimeout + constants.SOCKET_TIMEOUT)
+        flitifyServer = startFlitifyServer(servConfig, rsaKey, takeover=takeover)
+        apiServer = startAPIServer(flitifyServer, apiConfig, sockets=takeover.apiSockets if takeover else None)
+        if handoffSocket is not None:
+            HandoffListener(handoffSocket, flitifyServer, apiServer, drainTimeout).start()
         shutdownEvent.wait()
     except Exception as e:
         logging.critical(f"Cannot launch: {e}")
@@ -0,0 +1,38 @@
+import socket
+import time
+import pytest
+from Crypto.PublicKey import RSA
+
+from network.protocolconnection import ClientProtocolConnection
+
+
+class DummyDB:
+    def __init__(self, secrets=None):
+        # Without a mapping every client authenticates with 'secret'
+        self.secrets = secrets
+
+    def getSharedSecret(self, client_id):
+        if self.secrets is None:
+            return 'secret'
+        return self.secrets.get(client_id, None)
+
+
+@pytest.fixture(scope="module")
+def rsa_keypair():
+    key = RSA.generate(2048)
+    return key.export_key(), key.publickey().export_key()
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def connect(server, rsa_public_key, clientId, secret='secret', ticketCache=None):
+    sock = socket.socket()
+    sock.connect(('localhost', server.port))
+    return ClientProtocolConnection(sock, ('localhost', server.port), rsa_public_key, clientId, secret, ticketCache=ticketCache)
@@ -0,0 +1,192 @@
+import random
+import socket
+import threading
+import time
+import pytest
+
+import constants
+from client.reconnect import ReconnectBackoff, HandshakeFallback
+from network.baseconnection import BaseConnection
+from network.secureconnection import (ClientSecureConnection, ServerBusyError, KeyExchangeRejectedError, GREETING, CIPHER_OFFER, COMPACT_HELLO,
+                                      BUSY)
+from network.protocolconnection import ClientProtocolConnection
+from server.admission import HandshakeAdmission, refuseConnection
+from server.flitifyserver import FlitifyServer
+from conftest import DummyDB, wait_for
+
+
+@pytest.fixture
+def server_socket():
+    s = socket.socket()
+    s.bind(("localhost", 0))
+    s.listen(1)
+    yield s
+    s.close()
+
+
+def test_admission_bounds_handshakes_and_queue():
+    admission = HandshakeAdmission(maxHandshakes=2, maxQueued=1, deadline=10)
+    assert admission.admit() and admission.admit()
+    # The third connection waits for a slot, the fourth is turned away
+    assert admission.admit()
+    assert not admission.admit()
+    admission.finish(0.01)
+    assert admission.admit()
+
+
+def test_admission_refuses_waits_past_deadline():
+    admission = HandshakeAdmission(maxHandshakes=1, maxQueued=100, deadline=0.1)
+    admission.handshakeTime = 0.06
+    assert admission.admit()
+    assert admission.admit()
+    # A second queued connection would only get a slot after 0.12s
+    assert not admission.admit()
+
+
+def test_retry_after_staggers_refused_agents():
+    admission = HandshakeAdmission(maxHandshakes=4, maxQueued=0, deadline=10)
+    admission.handshakeTime = 0.4
+    delays = [admission.retryAfter() for _ in range(10)]
+    assert delays == sorted(delays)
+    assert delays[-1] - delays[0] == pytest.approx(0.9, abs=0.05)
+    admission = HandshakeAdmission(maxHandshakes=1, maxQueued=0, deadline=10000)
+    admission.handshakeTime = 1000
+    assert admission.retryAfter() == constants.MAX_RETRY_AFTER
+
+
+def test_refusal_count_is_bounded():
+    admission = HandshakeAdmission(maxHandshakes=1, maxQueued=2, deadline=10)
+    assert admission.startRefusal() and admission.startRefusal()
+    assert not admission.startRefusal()
+    admission.endRefusal()
+    assert admission.startRefusal()
+
+
+def test_client_raises_server_busy(rsa_keypair, server_socket):
+    def refuse():
+        client_sock, _ = server_socket.accept()
+        refuseConnection(client_sock, 2.5)
+    server_thread = threading.Thread(target=refuse)
+    server_thread.start()
+    s = socket.socket()
+    s.connect(server_socket.getsockname())
+    with pytest.raises(ServerBusyError) as excinfo:
+        ClientSecureConnection(s, server_socket.getsockname(), rsa_keypair[1])
+    server_thread.join()
+    assert excinfo.value.retryAfter == 2.5
+
+
+@pytest.mark.parametrize('first, busy', [(CIPHER_OFFER + b'aes-256-gcm,+binary,+busy', True),
+                                         (CIPHER_OFFER + b'aes-256-gcm,+binary', False),
+                                         (COMPACT_HELLO + bytes(32), False),
+                                         (bytes(256), False)])
+def test_refusal_answers_busy_only_to_agents_offering_it(server_socket, first, busy):
+    server_thread = threading.Thread(target=lambda: refuseConnection(server_socket.accept()[0], 1))
+    server_thread.start()
+    s = socket.socket()
+    s.connect(server_socket.getsockname())
+    conn = BaseConnection(s, server_socket.getsockname())
+    assert conn.recvLarge() == GREETING.encode()
+    conn.sendLarge(first)
+    if busy:
+        assert conn.recvLarge() == BUSY + b'1000'
+    # Closed without a reset, which older agents would not expect
+    with pytest.raises(BrokenPipeError):
+        conn.recvLarge()
+    conn.closeConnection()
+    server_thread.join()
+
+
+def test_saturated_server_turns_agents_away(rsa_keypair):
+    server = FlitifyServer('localhost', 0, rsa_keypair[0], DummyDB(), admission=HandshakeAdmission(1, 1, 5))
+    threading.Thread(target=server.start, daemon=True).start()
+    while not server.running:
+        time.sleep(0.01)
+    # Silent connections hold the only handshake slot and the only place in the queue
+    idle = [socket.create_connection(('localhost', server.port)) for _ in range(2)]
+    assert wait_for(lambda: server.admission.pending == 2)
+    sock = socket.create_connection(('localhost', server.port))
+    with pytest.raises(ServerBusyError) as excinfo:
+        ClientProtocolConnection(sock, ('localhost', server.port), rsa_keypair[1], 'client1', 'secret')
+    assert excinfo.value.retryAfter >= constants.MIN_RETRY_AFTER
+    for sock in idle:
+        sock.close()
+    assert wait_for(lambda: server.admission.pending == 0)
+    sock = socket.create_connection(('localhost', server.port))
+    connection = ClientProtocolConnection(sock, ('localhost', server.port), rsa_keypair[1], 'client1', 'secret')
+    connection.closeConnection()
+
+
+@pytest.mark.parametrize('keyExchange, closed', [('compact', KeyExchangeRejectedError), ('x25519', KeyExchangeRejectedError),
+                                                  ('rsa', BrokenPipeError)])
+def test_saturated_server_closes_legacy_agents(rsa_keypair, keyExchange, closed):
+    server = FlitifyServer('localhost', 0, rsa_keypair[0], DummyDB(), admission=HandshakeAdmission(1, 1, 5))
+    threading.Thread(target=server.start, daemon=True).start()
+    while not server.running:
+        time.sleep(0.01)
+    idle = [socket.create_connection(('localhost', server.port)) for _ in range(2)]
+    assert wait_for(lambda: server.admission.pending == 2)
+    # Agents not offering a cipher, like 2.1 agents with the RSA key exchange, cannot tell BUSY
+    # from the handshake ping and only see the connection closed
+    sock = socket.create_connection(('localhost', server.port))
+    with pytest.raises(closed):
+        ClientProtocolConnection(sock, ('localhost', server.port), rsa_keypair[1], 'client1', 'secret',
+                                 keyExchange=keyExchange, cipherSuites=['aes-256-eax'])
+    for sock in idle:
+        sock.close()
+
+
+def test_handshake_after_long_wait_gets_full_timeout(rsa_keypair):
+    server = FlitifyServer('localhost', 0, rsa_keypair[0], DummyDB(), admission=HandshakeAdmission(1, 1, 1))
+    threading.Thread(target=server.start, daemon=True).start()
+    while not server.running:
+        time.sleep(0.01)
+    idle = socket.create_connection(('localhost', server.port))
+    queued = socket.create_connection(('localhost', server.port))
+    assert wait_for(lambda: server.admission.pending == 2)
+    # The queued connection gets the slot close to the admission deadline
+    time.sleep(0.7)
+    idle.close()
+    # and its agent is slower to answer than the time left until the deadline
+    time.sleep(0.6)
+    connection = ClientProtocolConnection(queued, ('localhost', server.port), rsa_keypair[1], 'client1', 'secret')
+    connection.closeConnection()
+
+
+def test_backoff_full_jitter_within_bounds():
+    backoff = ReconnectBackoff(base=1, cap=8, rng=random.Random(1))
+    limits = [1, 2, 4, 8, 8, 8]
+    for limit in limits:
+        assert 0 <= backoff.nextDelay() <= limit
+    assert backoff.attempt == 3
+    backoff.reset()
+    assert backoff.nextDelay() <= 1
+
+
+def test_backoff_follows_retry_after():
+    backoff = ReconnectBackoff(base=1, cap=8, rng=random.Random(1))
+    for _ in range(20):
+        assert 3 <= backoff.nextDelay(3) <= 3.3
+    assert backoff.attempt == 0
+
+
+def test_fallback_lasts_one_attempt():
+    fallback = HandshakeFallback()
+    assert fallback.settings('compact', None) == ('compact', None)
+    fallback.rejected()
+    assert fallback.settings('compact', None) == ('compact', ['aes-256-eax'])
+    fallback.rejected()
+    assert fallback.settings('compact', None) == ('x25519', ['aes-256-eax'])
+    fallback.rejected()
+    fallback.rejected()
+    assert fallback.settings('compact', None) == ('rsa', ['aes-256-eax'])
+    fallback.reset()
+    assert fallback.settings('compact', None) == ('compact', None)
+    fallback.rejected()
+    assert fallback.settings('x25519', ['aes-256-eax']) == ('rsa', ['aes-256-eax'])
+
+
+def test_backoff_spreads_agents():
+    delays = [ReconnectBackoff(base=5, rng=random.Random(seed)).nextDelay() for seed in range(1000)]
+    # Full jitter: no second of the window gets much more than its share of the agents
+    assert max(sum(1 for d in delays if s <= d < s + 1) for s in range(5)) < 260
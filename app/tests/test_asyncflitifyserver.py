@@ -0,0 +1,177 @@
+import os
+import socket
+import threading
+import time
+import pytest
+
+from network.protocolconnection import ClientProtocolConnection, AuthenticationError
+from network.secureconnection import SessionTicketCache, ServerBusyError
+from client.clientconnection import ClientConnection, ConnectionKickedError
+from server.asyncflitifyserver import AsyncFlitifyServer
+from server.admission import HandshakeAdmission
+from conftest import DummyDB, wait_for, connect
+
+
+@pytest.fixture(scope="module")
+def server(rsa_keypair):
+    server = AsyncFlitifyServer('localhost', 0, rsa_keypair[0], DummyDB({'client1': 'secret', 'client2': 'secret', 'client3': 'secret', 'client4': 'secret', 'client5': 'secret', 'client6': 'secret'}))
+    threading.Thread(target=server.start, daemon=True).start()
+    while not server.running:
+        time.sleep(0.01)
+    return server
+
+
+def run_agent(connection, errors):
+    try:
+        ClientConnection(connection)
+    except Exception as e:
+        errors.append(e)
+
+
+def test_agent_registers_and_answers_actions(server, rsa_keypair):
+    errors = []
+    connection = connect(server, rsa_keypair[1], 'client1')
+    threading.Thread(target=run_agent, args=(connection, errors), daemon=True).start()
+    assert wait_for(lambda: 'client1' in server.getClientList())
+
+    client = server.getClientById('client1')
+    assert client.ping() is True
+    result = client.executeShellCommand('echo hello')
+    assert result['stdout'] == 'hello\n'
+
+    connection.closeConnection()
+    assert wait_for(lambda: 'client1' not in server.getClientList())
+    assert server.getClientById('client1') is None
+
+
+def test_duplicate_agent_is_kicked(server, rsa_keypair):
+    errors = []
+    first = connect(server, rsa_keypair[1], 'client2')
+    threading.Thread(target=run_agent, args=(first, errors), daemon=True).start()
+    assert wait_for(lambda: 'client2' in server.getClientList())
+
+    duplicate = connect(server, rsa_keypair[1], 'client2')
+    with pytest.raises(ConnectionKickedError):
+        ClientConnection(duplicate)
+    assert server.getClientById('client2').ping() is True
+    first.closeConnection()
+
+
+def test_wrong_secret_is_rejected(server, rsa_keypair):
+    with pytest.raises(AuthenticationError):
+        connect(server, rsa_keypair[1], 'client1', secret='wrong')
+
+
+def test_session_is_resumed_with_ticket(server, rsa_keypair):
+    errors = []
+    cache = SessionTicketCache()
+    first = connect(server, rsa_keypair[1], 'client3', ticketCache=cache)
+    threading.Thread(target=run_agent, args=(first, errors), daemon=True).start()
+    assert wait_for(lambda: cache.get() is not None)
+    first.closeConnection()
+    assert wait_for(lambda: 'client3' not in server.getClientList())
+
+    resumed = connect(server, rsa_keypair[1], 'client3', secret='not needed', ticketCache=cache)
+    assert resumed.resumed
+    threading.Thread(target=run_agent, args=(resumed, errors), daemon=True).start()
+    assert wait_for(lambda: 'client3' in server.getClientList())
+    assert server.getClientById('client3').ping() is True
+    resumed.closeConnection()
+
+
+def test_ticket_is_rejected_after_secret_change(server, rsa_keypair):
+    errors = []
+    cache = SessionTicketCache()
+    first = connect(server, rsa_keypair[1], 'client4', ticketCache=cache)
+    threading.Thread(target=run_agent, args=(first, errors), daemon=True).start()
+    assert wait_for(lambda: cache.get() is not None)
+    first.closeConnection()
+    assert wait_for(lambda: 'client4' not in server.getClientList())
+
+    server.dbHandler.secrets['client4'] = 'rotated'
+    with pytest.raises(AuthenticationError):
+        connect(server, rsa_keypair[1], 'client4', ticketCache=cache)
+    assert cache.get() is None
+
+
+def test_file_download_is_streamed(server, rsa_keypair, tmp_path):
+    errors = []
+    path = tmp_path / 'large.bin'
+    content = bytes(range(256)) * 4096
+    path.write_bytes(content)
+    connection = connect(server, rsa_keypair[1], 'client5')
+    threading.Thread(target=run_agent, args=(connection, errors), daemon=True).start()
+    assert wait_for(lambda: 'client5' in server.getClientList())
+
+    download = server.getClientById('client5').streamFile(str(path))
+    assert download.length == len(content)
+    assert b''.join(download) == content
+    connection.closeConnection()
+
+
+def test_stalled_download_waits_outside_default_executor(server, rsa_keypair, tmp_path):
+    errors = []
+    path = tmp_path / 'large.bin'
+    content = bytes(range(256)) * 4096 * 8
+    path.write_bytes(content)
+    connection = connect(server, rsa_keypair[1], 'client6')
+    threading.Thread(target=run_agent, args=(connection, errors), daemon=True).start()
+    assert wait_for(lambda: 'client6' in server.getClientList())
+
+    # More segments than a reader buffers, none of them consumed yet
+    download = server.getClientById('client6').streamFile(str(path))
+    assert wait_for(lambda: any(thread.name.startswith('FlitifyStreamDelivery') for thread in threading.enumerate()))
+    assert b''.join(download) == content
+    connection.closeConnection()
+
+
+def test_saturated_server_turns_agents_away(rsa_keypair):
+    server = AsyncFlitifyServer('localhost', 0, rsa_keypair[0], DummyDB({'client1': 'secret'}), admission=HandshakeAdmission(1, 1, 5))
+    threading.Thread(target=server.start, daemon=True).start()
+    assert wait_for(lambda: server.running)
+    # Silent connections hold the only handshake slot and the only place in the queue
+    idle = [socket.create_connection(('localhost', server.port)) for _ in range(2)]
+    assert wait_for(lambda: server.admission.pending == 2)
+    with pytest.raises(ServerBusyError):
+        connect(server, rsa_keypair[1], 'client1')
+    for sock in idle:
+        sock.close()
+    assert wait_for(lambda: server.admission.pending == 0)
+    connect(server, rsa_keypair[1], 'client1').closeConnection()
+
+
+def test_saturated_server_closes_legacy_agents(rsa_keypair):
+    server = AsyncFlitifyServer('localhost', 0, rsa_keypair[0], DummyDB({'client1': 'secret'}), admission=HandshakeAdmission(1, 1, 5))
+    threading.Thread(target=server.start, daemon=True).start()
+    assert wait_for(lambda: server.running)
+    idle = [socket.create_connection(('localhost', server.port)) for _ in range(2)]
+    assert wait_for(lambda: server.admission.pending == 2)
+    # A 2.1 agent expects the handshake ping in reply to its RSA encrypted key and would fail on BUSY
+    sock = socket.create_connection(('localhost', server.port))
+    with pytest.raises(BrokenPipeError):
+        ClientProtocolConnection(sock, ('localhost', server.port), rsa_keypair[1], 'client1', 'secret', keyExchange='rsa',
+                                 cipherSuites=['aes-256-eax'])
+    for sock in idle:
+        sock.close()
+
+
+def test_send_to_agent_that_stopped_reading_times_out(rsa_keypair):
+    server = AsyncFlitifyServer('localhost', 0, rsa_keypair[0], DummyDB())
+    threading.Thread(target=server.start, daemon=True).start()
+    assert wait_for(lambda: server.running)
+    # Authenticated, but nothing reads the agent's socket
+    agent = connect(server, rsa_keypair[1], 'client1')
+    assert wait_for(lambda: server.getClientById('client1') is not None)
+    connection = server.getClientById('client1').connection
+    connection.sendTimeout = 0.3
+    payload = os.urandom(4 * 1024 * 1024).hex()
+    started = time.monotonic()
+    with pytest.raises(BrokenPipeError):
+        for _ in range(100):
+            try:
+                connection.invokeAction('echo', {'data': payload}, timeout=0.01)
+            except TimeoutError:
+                pass
+    assert time.monotonic() - started < 10
+    assert wait_for(lambda: server.getClientById('client1') is None)
+    agent.closeConnection()
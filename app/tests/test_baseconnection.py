@@ -0,0 +1,126 @@
+import json
+import socket
+import threading
+import pytest
+
+import constants
+
+from network.baseconnection import BaseConnection, FrameSizeError
+
+
+@pytest.fixture
+def connection_pair():
+    a, b = socket.socketpair()
+    yield BaseConnection(a, ('local', 1)), BaseConnection(b, ('local', 2))
+    a.close()
+    b.close()
+
+
+def test_send_recv_large(connection_pair):
+    sender, receiver = connection_pair
+    payload = bytes(range(256)) * 4096  # 1 MiB, larger than the socket buffer
+    thread = threading.Thread(target=sender.sendLarge, args=(payload,))
+    thread.start()
+    received = receiver.recvLarge()
+    thread.join()
+    assert received == payload
+
+
+def test_recv_large_header_split_across_segments(connection_pair):
+    sender, receiver = connection_pair
+    # Header and body arrive in separate small chunks
+    sender.socket.sendall(b'\x00\x00')
+    thread = threading.Thread(target=lambda: sender.socket.sendall(b'\x00\x05hello'))
+    thread.start()
+    assert receiver.recvLarge() == b'hello'
+    thread.join()
+
+
+def test_recv_large_rejects_oversized_frame(connection_pair):
+    sender, receiver = connection_pair
+    receiver.maxFrameSize = 1024
+    sender.socket.sendall((1025).to_bytes(4, 'big'))
+    with pytest.raises(FrameSizeError):
+        receiver.recvLarge()
+    assert receiver.running is False
+
+
+def test_recv_large_peer_closed(connection_pair):
+    sender, receiver = connection_pair
+    sender.socket.sendall((10).to_bytes(4, 'big') + b'abc')
+    sender.socket.shutdown(socket.SHUT_WR)
+    with pytest.raises(BrokenPipeError):
+        receiver.recvLarge()
+
+
+class TrickleSocket:
+    """ Fake socket whose sendmsg accepts only a few bytes per call. """
+    def __init__(self, chunk):
+        self.chunk = chunk
+        self.sent = bytearray()
+        self.calls = 0
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        budget = self.chunk
+        for buf in buffers:
+            take = min(budget, len(buf))
+            self.sent += buf[:take]
+            budget -= take
+            if not budget:
+                break
+        return self.chunk - budget
+
+    def close(self):
+        pass
+
+
+class NoSendmsgSocket:
+    def __init__(self):
+        self.sent = bytearray()
+
+    def sendall(self, data):
+        self.sent += data
+
+    def close(self):
+        pass
+
+
+def test_send_large_handles_partial_writes():
+    sock = TrickleSocket(chunk=3)
+    conn = BaseConnection(sock, ('local', 1))
+    conn.sendLarge(b'nonce', b'', b'tag', b'ciphertext')
+    assert bytes(sock.sent) == (18).to_bytes(4, 'big') + b'noncetagciphertext'
+    assert sock.calls == 8
+
+
+def test_send_large_single_sendmsg_call():
+    sock = TrickleSocket(chunk=1 << 20)
+    conn = BaseConnection(sock, ('local', 1))
+    conn.sendLarge(b'a' * 100, b'b' * 100)
+    assert sock.calls == 1
+    assert len(sock.sent) == 204
+
+
+def test_send_large_without_sendmsg():
+    sock = NoSendmsgSocket()
+    conn = BaseConnection(sock, ('local', 1))
+    conn.lastActivity = 0
+    conn.sendLarge(b'abc', b'def')
+    assert bytes(sock.sent) == (6).to_bytes(4, 'big') + b'abcdef'
+    # Sending counts as activity, so the keepalive scheduler leaves the connection alone
+    assert conn.lastActivity > 0
+
+
+def test_default_cap_fits_largest_inline_file():
+    # Peers without streamed transfers send files whole, base64 encoded in a JSON message
+    message = len(json.dumps({'type': 'file_send', 'seq': 2 ** 31, 'data': {'status': 'ok', 'filedata': ''}}))
+    assert 4 * -(-constants.MAX_INLINE_FILE_SIZE // 3) + message + 64 <= constants.MAX_FRAME_SIZE
+
+
+def test_send_to_peer_that_stopped_reading_times_out(connection_pair):
+    sender, _ = connection_pair
+    sender.setSendTimeout(0.2)
+    with pytest.raises(BrokenPipeError):
+        sender.sendLarge(bytes(16 * 1024 * 1024))
+    assert not sender.running
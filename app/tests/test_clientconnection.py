@@ -0,0 +1,314 @@
+import hashlib
+import io
+import json
+import os
+import re
+import socket
+import threading
+import time
+import pytest
+from types import SimpleNamespace
+
+from network.protocolconnection import ServerProtocolConnection, ClientProtocolConnection
+from client.clientconnection import ClientConnection
+from server.handlers.clienthandler import ClientHandler, FileTransferError
+import client.clientconnection
+import constants
+from apiserver.apiserver import ApiServer
+from conftest import DummyDB
+
+
+@pytest.fixture
+def connected_agent(rsa_keypair):
+    rsa_private_key, rsa_public_key = rsa_keypair
+    listener = socket.socket()
+    listener.bind(('localhost', 0))
+    listener.listen(1)
+    port = listener.getsockname()[1]
+    ready = {}
+
+    def serve():
+        sock, addr = listener.accept()
+        ready['conn'] = ServerProtocolConnection(sock, addr, rsa_private_key, DummyDB())
+        ready['conn'].readLoop()
+
+    def agent():
+        sock = socket.socket()
+        sock.connect(('localhost', port))
+        try:
+            ClientConnection(ClientProtocolConnection(sock, ('localhost', port), rsa_public_key, 'client1', 'secret'), actionWorkers=2)
+        except BrokenPipeError:
+            pass
+
+    threading.Thread(target=serve, daemon=True).start()
+    threading.Thread(target=agent, daemon=True).start()
+    while 'conn' not in ready:
+        time.sleep(0.01)
+    yield ready['conn']
+    ready['conn'].closeConnection()
+    listener.close()
+
+
+def test_ping_answered_while_shell_command_runs(connected_agent):
+    results = {}
+
+    def slowCommand():
+        results['shell'] = connected_agent.invokeAction('shell_command', {'command': 'sleep 1 && echo done'}, timeout=5)
+        results['shell_finished'] = time.monotonic()
+
+    thread = threading.Thread(target=slowCommand)
+    thread.start()
+    time.sleep(0.2)
+    assert connected_agent.invokeAction('ping', {}, timeout=0.5) == ('pong', {})
+    pong_finished = time.monotonic()
+    thread.join()
+    assert results['shell'][0] == 'shell_result'
+    assert results['shell'][1]['stdout'] == 'done\n'
+    assert pong_finished < results['shell_finished']
+
+
+def test_unknown_action_is_rejected(connected_agent):
+    assert connected_agent.invokeAction('no_such_action', {}, timeout=1) is None
+
+
+def test_file_is_streamed_in_segments(connected_agent, tmp_path):
+    path = tmp_path / 'large.bin'
+    content = os.urandom(3 * 256 * 1024 + 123)
+    path.write_bytes(content)
+
+    download = ClientHandler(connected_agent).streamFile(str(path))
+    chunks = list(download)
+    assert download.length == download.fileSize == len(content)
+    assert len(chunks) == 4 and b''.join(chunks) == content
+
+
+def test_missing_file_is_reported(connected_agent, tmp_path):
+    with pytest.raises(FileTransferError):
+        ClientHandler(connected_agent).streamFile(str(tmp_path / 'missing'))
+    assert ClientHandler(connected_agent).getFile(str(tmp_path / 'missing')) is None
+
+
+def test_getfile_endpoint_streams_with_content_length(connected_agent, tmp_path):
+    path = tmp_path / 'download.bin'
+    content = os.urandom(600 * 1024)
+    path.write_bytes(content)
+    handler = ClientHandler(connected_agent)
+    fserver = SimpleNamespace(getClientById=lambda clientId: handler if clientId == 'client1' else None)
+
+    response = ApiServer(fserver).app.test_client().get('/client1/getfile', query_string={'file_path': str(path)})
+    assert response.status_code == 200
+    assert response.headers['Content-Length'] == str(len(content))
+    assert response.data == content
+
+
+def test_upload_is_streamed_to_temporary_file_and_renamed(connected_agent, tmp_path):
+    content = os.urandom(2 * 256 * 1024 + 5)
+    destination = tmp_path / 'uploaded.bin'
+    handler = ClientHandler(connected_agent)
+
+    assert handler.uploadStream(str(destination), io.BytesIO(content), len(content)) is True
+    assert destination.read_bytes() == content
+    assert os.listdir(tmp_path) == ['uploaded.bin']
+    # Existing files are not overwritten
+    assert handler.uploadFile(str(destination), b'other') is False
+    assert destination.read_bytes() == content
+
+
+def test_interrupted_upload_leaves_no_file(connected_agent, tmp_path):
+    destination = tmp_path / 'partial.bin'
+    # The source is shorter than announced, so the stream is aborted
+    assert ClientHandler(connected_agent).uploadStream(str(destination), io.BytesIO(b'x' * 1000), 5000) is False
+    assert wait_for_empty(tmp_path)
+
+
+def wait_for_empty(path, timeout=2):
+    deadline = time.monotonic() + timeout
+    while os.listdir(path):
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_uploadfile_endpoint_accepts_raw_body(connected_agent, tmp_path):
+    content = os.urandom(300 * 1024)
+    destination = tmp_path / 'raw.bin'
+    handler = ClientHandler(connected_agent)
+    fserver = SimpleNamespace(getClientById=lambda clientId: handler)
+    client = ApiServer(fserver).app.test_client()
+
+    response = client.post('/client1/uploadfile', query_string={'path': str(destination)}, data=content,
+                           content_type='application/octet-stream')
+    assert response.status_code == 200
+    assert destination.read_bytes() == content
+
+    response = client.post('/client1/uploadfile', data={'path': str(tmp_path / 'form.bin'), 'file': (io.BytesIO(b'form data'), 'form.bin')})
+    assert response.status_code == 200
+    assert (tmp_path / 'form.bin').read_bytes() == b'form data'
+
+
+def test_getfile_endpoint_serves_byte_ranges(connected_agent, tmp_path):
+    path = tmp_path / 'ranged.bin'
+    content = os.urandom(300 * 1024)
+    path.write_bytes(content)
+    handler = ClientHandler(connected_agent)
+    client = ApiServer(SimpleNamespace(getClientById=lambda clientId: handler)).app.test_client()
+    url, query = '/client1/getfile', {'file_path': str(path)}
+
+    full = client.get(url, query_string=query)
+    etag = full.headers['ETag']
+    assert full.status_code == 200 and full.headers['Accept-Ranges'] == 'bytes'
+
+    response = client.get(url, query_string=query, headers={'Range': 'bytes=1000-299999', 'If-Range': etag})
+    assert response.status_code == 206
+    assert response.headers['Content-Range'] == f'bytes 1000-299999/{len(content)}'
+    assert response.data == content[1000:300000]
+
+    response = client.get(url, query_string=query, headers={'Range': 'bytes=-100'})
+    assert response.status_code == 206 and response.data == content[-100:]
+
+    # A stale validator gets the whole, current file
+    response = client.get(url, query_string=query, headers={'Range': 'bytes=1000-', 'If-Range': '"stale"'})
+    assert response.status_code == 200 and response.data == content
+
+    response = client.get(url, query_string=query, headers={'Range': f'bytes={len(content)}-'})
+    assert response.status_code == 416
+    assert response.headers['Content-Range'] == f'bytes */{len(content)}'
+
+
+class FailingSource(io.BytesIO):
+    """ Raises after limit bytes, like a client connection dropping mid-upload. """
+    def __init__(self, data, limit):
+        super().__init__(data)
+        self.limit = limit
+
+    def readinto(self, buffer):
+        if self.tell() >= self.limit:
+            raise OSError('connection lost')
+        return super().readinto(memoryview(buffer)[:self.limit - self.tell()])
+
+
+def test_interrupted_upload_is_resumed(connected_agent, tmp_path):
+    content = os.urandom(3 * 256 * 1024)
+    destination = tmp_path / 'resumed.bin'
+    handler = ClientHandler(connected_agent)
+
+    source = FailingSource(content, 2 * 256 * 1024)
+    assert handler.uploadStream(str(destination), source, len(content), resume=True) is False
+    partial = tmp_path / '.resumed.bin.partial'
+    assert not destination.exists() and partial.stat().st_size == 2 * 256 * 1024
+
+    source = io.BytesIO(content)
+    assert handler.uploadStream(str(destination), source, len(content), resume=True) is True
+    assert destination.read_bytes() == content
+    assert not partial.exists()
+
+
+def test_delta_upload_sends_only_changes(connected_agent, tmp_path, caplog):
+    old = os.urandom(4 * 1024 * 1024)
+    new = old[:1000000] + b'patched' + old[1000000:3000000] + old[3000100:]
+    destination = tmp_path / 'app.bin'
+    destination.write_bytes(old)
+    destination.chmod(0o751)
+    handler = ClientHandler(connected_agent)
+
+    with caplog.at_level('INFO'):
+        assert handler.uploadDelta(str(destination), io.BytesIO(new), len(new)) is True
+    assert destination.read_bytes() == new
+    assert destination.stat().st_mode & 0o777 == 0o751
+    assert os.listdir(tmp_path) == ['app.bin']
+    sent = re.search(r'(\d+) bytes sent', caplog.text)
+    assert int(sent.group(1)) < 20000
+
+    # A file the client does not have is uploaded whole
+    assert handler.uploadDelta(str(tmp_path / 'other.bin'), io.BytesIO(b'whole'), 5) is True
+    assert (tmp_path / 'other.bin').read_bytes() == b'whole'
+
+
+def test_upload_waits_for_client_hashing_existing_file(connected_agent, tmp_path, monkeypatch):
+    content = os.urandom(300 * 1024)
+    destination = tmp_path / 'present.bin'
+    destination.write_bytes(content)
+    fileDigest = client.clientconnection.fileDigest
+
+    def slowDigest(path):
+        # Hashing a large file takes longer than an action's default timeout
+        time.sleep(constants.SOCKET_TIMEOUT + 0.5)
+        return fileDigest(path)
+
+    monkeypatch.setattr(client.clientconnection, 'fileDigest', slowDigest)
+    sha256 = hashlib.sha256(content).hexdigest()
+    assert ClientHandler(connected_agent).uploadStream(str(destination), io.BytesIO(content), len(content), sha256=sha256) is True
+
+
+def test_bulk_upload_stages_once_and_reports_each_client(connected_agent, tmp_path):
+    content = os.urandom(300 * 1024)
+    handler = ClientHandler(connected_agent)
+    fserver = SimpleNamespace(getClientById=lambda clientId: handler if clientId == 'client1' else None)
+    api = ApiServer(fserver, stagingDir=str(tmp_path / 'staging')).app.test_client()
+
+    staged = api.post('/staging', data=content, content_type='application/octet-stream').get_json()
+    assert staged['size'] == len(content)
+    assert os.listdir(tmp_path / 'staging') == [staged['hash']]
+
+    destination = tmp_path / 'artifact.bin'
+    response = api.post('/bulkupload', json={'hash': staged['hash'], 'path': str(destination), 'clients': ['client1', 'client2']})
+    lines = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert sorted((line['client_id'], line['status']) for line in lines[:-1]) == [('client1', 'ok'), ('client2', 'offline')]
+    assert lines[-1]['summary'] == {'ok': 1, 'offline': 1}
+    assert destination.read_bytes() == content
+
+    # The client has the file already, so nothing is sent again
+    response = api.post('/bulkupload', json={'hash': staged['hash'], 'path': str(destination), 'clients': ['client1']})
+    assert json.loads(response.data.decode().splitlines()[0])['status'] == 'ok'
+
+    assert api.post('/bulkupload', json={'hash': '0' * 64, 'path': 'x', 'clients': []}).status_code == 404
+
+
+def test_upload_with_wrong_digest_is_rejected(connected_agent, tmp_path):
+    destination = tmp_path / 'checked.bin'
+    assert ClientHandler(connected_agent).uploadStream(str(destination), io.BytesIO(b'data'), 4, sha256='0' * 64) is False
+    assert wait_for_empty(tmp_path)
+
+
+def test_getfile_endpoint_revalidates_cached_files(connected_agent, tmp_path, monkeypatch):
+    path = tmp_path / 'config.yml'
+    path.write_bytes(b'version: 1\n')
+    handler = ClientHandler(connected_agent)
+    client = ApiServer(SimpleNamespace(getClientById=lambda clientId: handler)).app.test_client()
+    query = {'file_path': str(path)}
+    transfers = []
+    readFileStream = ClientHandler._readFileStream
+    monkeypatch.setattr(ClientHandler, '_readFileStream', lambda self, *args: transfers.append(1) or readFileStream(self, *args))
+
+    first = client.get('/client1/getfile', query_string=query)
+    assert first.data == b'version: 1\n' and len(transfers) == 1
+
+    response = client.get('/client1/getfile', query_string=query, headers={'If-None-Match': first.headers['ETag']})
+    assert response.status_code == 304 and response.data == b''
+    response = client.get('/client1/getfile', query_string=query)
+    assert response.status_code == 200 and response.data == b'version: 1\n'
+    assert len(transfers) == 1
+
+    path.write_bytes(b'version: 22\n')
+    response = client.get('/client1/getfile', query_string=query, headers={'If-None-Match': first.headers['ETag']})
+    assert response.status_code == 200 and response.data == b'version: 22\n'
+    assert response.headers['ETag'] != first.headers['ETag']
+    assert len(transfers) == 2
+
+
+def test_hash_endpoint_returns_digests_only(connected_agent, tmp_path):
+    content = os.urandom(3 * 1024 * 1024)
+    (tmp_path / 'a.bin').write_bytes(content)
+    handler = ClientHandler(connected_agent)
+    client = ApiServer(SimpleNamespace(getClientById=lambda clientId: handler)).app.test_client()
+
+    response = client.get('/client1/hash', query_string={'path': [str(tmp_path / 'a.bin'), str(tmp_path / 'missing')]})
+    hashes = response.get_json()['hashes']
+    assert hashes[str(tmp_path / 'a.bin')] == {'status': 'ok', 'digest': hashlib.sha256(content).hexdigest(), 'size': len(content)}
+    assert hashes[str(tmp_path / 'missing')] == {'status': 'not_found'}
+
+    response = client.post('/client1/hash', json={'paths': [str(tmp_path / 'a.bin')], 'algorithm': 'blake2b'})
+    assert response.get_json()['hashes'][str(tmp_path / 'a.bin')]['digest'] == hashlib.blake2b(content).hexdigest()
+    assert client.get('/client1/hash', query_string={'path': 'x', 'algorithm': 'md5'}).status_code == 400
+    assert handler.hashFile(str(tmp_path / 'missing')) is None
@@ -0,0 +1,40 @@
+import threading
+
+from server.clientregistry import ClientRegistry
+
+
+def test_register_and_unregister():
+    registry = ClientRegistry()
+    handler = object()
+    assert registry.register('client1', handler) is True
+    assert registry.get('client1') is handler
+    assert registry.getClientIds() == ['client1']
+    registry.unregister('client1', handler)
+    assert registry.get('client1') is None
+    assert len(registry) == 0
+
+
+def test_duplicate_cannot_replace_or_remove_original():
+    registry = ClientRegistry()
+    original, duplicate = object(), object()
+    assert registry.register('client1', original) is True
+    assert registry.register('client1', duplicate) is False
+    registry.unregister('client1', duplicate)
+    assert registry.get('client1') is original
+
+
+def test_concurrent_registration_admits_exactly_one():
+    registry = ClientRegistry()
+    results = []
+    barrier = threading.Barrier(16)
+
+    def register():
+        barrier.wait()
+        results.append(registry.register('client1', object()))
+
+    threads = [threading.Thread(target=register) for _ in range(16)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results.count(True) == 1
@@ -0,0 +1,74 @@
+import lzma
+import os
+import zlib
+
+import pytest
+
+from network.baseconnection import FrameSizeError
+from network.compression import FrameCompressor, ZLIB_MARKER, LZMA_MARKER
+
+TEXT = b'{"name": "python3", "open_windows": 1}, ' * 1000
+
+
+@pytest.mark.parametrize('algorithms, bulk, marker', [
+    (['zlib', 'lzma'], False, ZLIB_MARKER),
+    (['zlib', 'lzma'], True, LZMA_MARKER),
+    (['zlib'], True, ZLIB_MARKER),
+    (['lzma'], False, LZMA_MARKER),
+])
+def test_round_trip(algorithms, bulk, marker):
+    compressor = FrameCompressor(algorithms)
+    compressed = compressor.compress(TEXT, bulk)
+    assert compressed[0] == marker and len(compressed) < len(TEXT) // 10
+    assert compressor.isCompressed(compressed)
+    assert compressor.decompress(compressed, len(TEXT)) == TEXT
+
+
+def test_small_and_incompressible_frames_are_left_alone():
+    compressor = FrameCompressor(threshold=1024)
+    assert compressor.compress(b'x' * 1023) is None
+    assert compressor.compress(os.urandom(64 * 1024)) is None
+    assert compressor.compress(os.urandom(2000)) is None
+
+
+def test_negotiate_keeps_shared_algorithms():
+    compressor = FrameCompressor(['zlib', 'lzma'], level=9, threshold=10)
+    negotiated = compressor.negotiate(['+binary', '+lzma'])
+    assert negotiated.algorithms == ['lzma'] and negotiated.level == 9 and negotiated.threshold == 10
+    assert compressor.negotiate(['+binary']) is None
+    assert not negotiated.isCompressed(bytes([ZLIB_MARKER]) + zlib.compress(TEXT))
+
+
+def test_decompression_is_bounded_by_the_frame_size():
+    compressor = FrameCompressor()
+    compressed = compressor.compress(b'\0' * (1024 * 1024))
+    with pytest.raises(FrameSizeError):
+        compressor.decompress(compressed, 1024 * 1024 - 1)
+
+
+@pytest.mark.parametrize('damage', [lambda data: data[:-10], lambda data: data + b'trailing', lambda data: data[:1] + b'garbage' + data[8:]])
+def test_corrupt_frames_are_rejected(damage):
+    compressor = FrameCompressor()
+    with pytest.raises(ValueError):
+        compressor.decompress(damage(compressor.compress(TEXT)), len(TEXT))
+
+
+def test_lzma_frame_declaring_a_huge_dictionary_is_rejected():
+    stream = bytearray(lzma.compress(TEXT, preset=1, check=lzma.CHECK_NONE))
+    # The block header follows the 12 byte stream header; its LZMA2 filter flags end in
+    # the dictionary size, and its last 4 bytes are a CRC32 of the rest
+    headerSize = (stream[12] + 1) * 4
+    props = stream.index(b'\x21\x01', 12, 12 + headerSize) + 2
+    stream[props] = 36  # 1 GiB
+    stream[12 + headerSize - 4:12 + headerSize] = zlib.crc32(stream[12:12 + headerSize - 4]).to_bytes(4, 'little')
+    assert lzma.decompress(stream) == TEXT
+
+    with pytest.raises(ValueError):
+        FrameCompressor(['lzma']).decompress(bytes([LZMA_MARKER]) + stream, len(TEXT))
+
+
+def test_unknown_algorithm_or_level():
+    with pytest.raises(ValueError):
+        FrameCompressor(['brotli'])
+    with pytest.raises(ValueError):
+        FrameCompressor(level=0)
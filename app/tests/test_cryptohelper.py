@@ -1,6 +1,7 @@
+import time
 import pytest
 from Crypto.PublicKey import RSA
-from crypto.cryptohelper import CryptoHelperRSA, CryptoHelperAES, DecryptionError
+from crypto.cryptohelper import CryptoHelperRSA, CryptoHelperRSAPool, CryptoHelperAES, CryptoHelperAEAD, CryptoHelperTickets, CryptoHelperResumeClient, DecryptionError, hashSecret
 
 def test_aes_encrypt_decrypt():
     aes = CryptoHelperAES()
@@ -38,3 +39,72 @@ def test_rsa_decrypt_with_wrong_key():
     encrypted = rsa_enc.encrypt(plaintext)
     with pytest.raises(ValueError):
         rsa_dec.decrypt(encrypted)
+
+def test_aes_encrypt_parts_decrypt():
+    aes = CryptoHelperAES()
+    nonce, tag, ciphertext = aes.encryptParts(b"Test message for AES")
+    assert len(nonce) == 16 and len(tag) == 16
+    assert aes.decrypt(memoryview(nonce + tag + ciphertext)) == b"Test message for AES"
+
+def test_rsa_pool_decrypts_in_worker_processes():
+    key = RSA.generate(2048)
+    rsa_enc = CryptoHelperRSA(key.publickey().export_key())
+    rsa_pool = CryptoHelperRSAPool(key.export_key(), workers=2)
+    try:
+        encrypted = [rsa_enc.encrypt(bytes([i]) * 32) for i in range(8)]
+        futures = [rsa_pool.decryptFuture(data) for data in encrypted]
+        assert [future.result() for future in futures] == [bytes([i]) * 32 for i in range(8)]
+        assert rsa_pool.decrypt(encrypted[0]) == bytes(32)
+        with pytest.raises(ValueError):
+            rsa_pool.decrypt(b'\x00' * 256)
+    finally:
+        rsa_pool.shutdown()
+
+def test_session_ticket_redeem_and_expiry():
+    server_rsa = CryptoHelperRSA(RSA.generate(2048).export_key())
+    tickets = server_rsa.getTicketHelper()
+    ticket, secret = tickets.issue('client1', hashSecret('secret'))
+    client = CryptoHelperResumeClient(ticket, secret)
+    client_id, secret_hash, reply, key, expires_at = tickets.redeem(client.hello)
+    assert client_id == 'client1' and secret_hash == hashSecret('secret')
+    assert client.finish(reply) == key
+
+    # Tickets issued on resumption keep the expiry of the full handshake
+    reissued, secret = tickets.issue(client_id, secret_hash, expires_at)
+    assert tickets.redeem(CryptoHelperResumeClient(reissued, secret).hello)[4] == expires_at
+    chained, secret = tickets.issue(client_id, secret_hash, time.time() - 1)
+    with pytest.raises(ValueError):
+        tickets.redeem(CryptoHelperResumeClient(chained, secret).hello)
+
+    forged = bytearray(ticket)
+    forged[-1] ^= 0xFF
+    with pytest.raises(ValueError):
+        tickets.redeem(CryptoHelperResumeClient(bytes(forged), secret).hello)
+    expired, secret = CryptoHelperTickets(server_rsa, lifetime=-1).issue('client1', hashSecret('secret'))
+    with pytest.raises(ValueError):
+        tickets.redeem(CryptoHelperResumeClient(expired, secret).hello)
+
+@pytest.mark.parametrize('suite', ['aes-256-gcm', 'chacha20-poly1305'])
+def test_aead_counter_nonces(suite):
+    client = CryptoHelperAEAD(b'k' * 32, suite, isServer=False)
+    server = CryptoHelperAEAD(b'k' * 32, suite, isServer=True)
+    first, second = client.encrypt(b"same message"), client.encrypt(b"same message")
+    assert first != second and len(first) == 16 + len(b"same message")
+    # Frames must arrive in order: the second one does not decrypt with the first nonce
+    with pytest.raises(DecryptionError):
+        server.decrypt(second)
+    assert server.decrypt(first) == b"same message"
+    assert server.decryptInPlace(bytearray(second)) == b"same message"
+    # Each direction has its own key
+    reply = server.encrypt(b"reply")
+    assert client.decrypt(reply) == b"reply"
+    with pytest.raises(DecryptionError):
+        CryptoHelperAEAD(b'k' * 32, suite, isServer=True).decrypt(client.encrypt(b"own frame"))
+
+def test_aead_rejects_tampered_frame():
+    client = CryptoHelperAEAD(b'k' * 32, 'aes-256-gcm', isServer=False)
+    server = CryptoHelperAEAD(b'k' * 32, 'aes-256-gcm', isServer=True)
+    frame = bytearray(client.encrypt(b"Test message"))
+    frame[-1] ^= 0xFF
+    with pytest.raises(DecryptionError):
+        server.decryptInPlace(frame)
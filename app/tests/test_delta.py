@@ -0,0 +1,68 @@
+import io
+import os
+import pytest
+
+from network.delta import (Signature, DeltaEncoder, DeltaDecoder, DeltaError, fileSignature, chooseBlockSize,
+                           COPY_HEADER, OP_COPY)
+
+
+def signature_of(data, blockSize):
+    return Signature(b''.join(fileSignature(io.BytesIO(data), blockSize)), blockSize, len(data))
+
+
+def rebuild(old, delta, blockSize, pieceSize=1000):
+    output = io.BytesIO()
+    decoder = DeltaDecoder(io.BytesIO(old), output, blockSize)
+    for start in range(0, len(delta), pieceSize):
+        decoder.feed(delta[start:start + pieceSize])
+    decoder.finish()
+    return output.getvalue()
+
+
+@pytest.mark.parametrize('edit', ['unchanged', 'insert', 'delete', 'replace', 'append', 'new', 'empty'])
+def test_delta_round_trip(edit):
+    blockSize = 2048
+    old = os.urandom(50 * blockSize + 100)
+    new = {
+        'unchanged': old,
+        'insert': old[:30000] + b'inserted' + old[30000:],
+        'delete': old[:30000] + old[30500:],
+        'replace': old[:30000] + os.urandom(10) + old[30010:],
+        'append': old + os.urandom(5000),
+        'new': os.urandom(20000),
+        'empty': b'',
+    }[edit]
+    encoder = DeltaEncoder(signature_of(old, blockSize))
+    delta = b''.join(encoder.encode(io.BytesIO(new)))
+    assert rebuild(old, delta, blockSize) == new
+    assert encoder.literalBytes + encoder.copiedBytes == len(new)
+    if edit in ('unchanged', 'insert', 'delete', 'replace'):
+        # Only the blocks touched by the edit are sent
+        assert encoder.literalBytes <= 2 * blockSize + 500
+
+
+def test_encoder_skips_ahead_in_new_data():
+    blockSize = 2048
+    old = os.urandom(20 * blockSize)
+    new = os.urandom(5 * blockSize) + old
+    encoder = DeltaEncoder(signature_of(old, blockSize), rollingLimit=blockSize)
+    delta = b''.join(encoder.encode(io.BytesIO(new)))
+    assert rebuild(old, delta, blockSize) == new
+    # Block aligned after the new data, so the old file is still found
+    assert encoder.copiedBytes == len(old)
+
+
+def test_decoder_rejects_corrupt_delta():
+    blockSize = 2048
+    old = os.urandom(4 * blockSize)
+    delta = b''.join(DeltaEncoder(signature_of(old, blockSize)).encode(io.BytesIO(old[:-1] + b'x')))
+    with pytest.raises(DeltaError):
+        rebuild(old, delta[:-1] + bytes([delta[-1] ^ 1]), blockSize)
+    with pytest.raises(DeltaError, match='beyond the end'):
+        rebuild(old, COPY_HEADER.pack(OP_COPY, 4, 1), blockSize)
+
+
+def test_block_size_grows_with_file_size():
+    assert chooseBlockSize(0) == chooseBlockSize(1024) == 2048
+    assert chooseBlockSize(100 * 1024 * 1024) == 16384
+    assert chooseBlockSize(1 << 40) == 128 * 1024
@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+from network.envelope import encodeEnvelope, decodeEnvelope, decodeMessage, isEnvelope, bytesField
+from network.streams import SEGMENT_FLAGS
+
+
+def test_round_trip_with_attachments():
+    data = {'status': 'ok', 'filedata': b'\x00\xff' * 1000, 'parts': [b'', bytearray(b'abc'), {'nested': memoryview(b'xyz')}]}
+    message = encodeEnvelope('file_send', data, 42)
+    assert isEnvelope(message)
+    decoded = decodeEnvelope(message)
+    assert decoded['type'] == 'file_send' and decoded['seq'] == 42
+    assert decoded['data']['status'] == 'ok'
+    assert bytes(decoded['data']['filedata']) == b'\x00\xff' * 1000
+    assert [bytes(part) for part in decoded['data']['parts'][:2]] == [b'', b'abc']
+    assert bytes(decoded['data']['parts'][2]['nested']) == b'xyz'
+
+
+def test_message_without_seq():
+    decoded = decodeMessage(encodeEnvelope('kick', {'reason': 'shutdown'}))
+    assert decoded == {'type': 'kick', 'data': {'reason': 'shutdown'}}
+
+
+def test_json_messages_are_still_decoded():
+    message = json.dumps({'type': 'status', 'data': {}, 'seq': 1}).encode()
+    assert not isEnvelope(message)
+    assert decodeMessage(message) == {'type': 'status', 'data': {}, 'seq': 1}
+
+
+def test_marker_differs_from_json_and_segments():
+    marker = encodeEnvelope('ping', {})[0]
+    assert marker != ord('{') and marker not in SEGMENT_FLAGS
+
+
+@pytest.mark.parametrize('cut', [5, 20, -1])
+def test_truncated_envelope_is_rejected(cut):
+    message = encodeEnvelope('file_send', {'filedata': b'data'}, 1)
+    with pytest.raises(ValueError):
+        decodeEnvelope(message[:cut])
+
+
+def test_reference_to_missing_attachment_is_rejected():
+    message = encodeEnvelope('file_send', {'filedata': b'data', 'forged': {'$bin': 0}}, 1)
+    message = message.replace(b'"forged":{"$bin":0}', b'"forged":{"$bin":7}')
+    with pytest.raises(ValueError):
+        decodeEnvelope(message)
+
+
+def test_bytes_field_accepts_raw_and_base64():
+    assert bytes(bytesField(memoryview(b'raw'))) == b'raw'
+    assert bytesField('cmF3') == b'raw'
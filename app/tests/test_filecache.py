@@ -0,0 +1,30 @@
+from apiserver.filecache import FileCache, CachedFile
+
+
+def entry(size, etag='e'):
+    return CachedFile(b'x' * size, etag, None)
+
+
+def test_least_recently_used_entries_are_evicted_by_count():
+    cache = FileCache(maxEntries=2, maxBytes=1000)
+    cache.put('c', 'a', entry(10))
+    cache.put('c', 'b', entry(10))
+    cache.get('c', 'a')
+    cache.put('c', 'c', entry(10))
+    assert cache.get('c', 'b') is None
+    assert cache.get('c', 'a') is not None and cache.get('c', 'c') is not None
+
+
+def test_entries_are_evicted_by_total_size():
+    cache = FileCache(maxEntries=10, maxBytes=100, maxEntrySize=60)
+    assert cache.put('c', 'a', entry(50))
+    assert cache.put('c', 'b', entry(40))
+    assert cache.put('c', 'c', entry(30))
+    assert cache.get('c', 'a') is None
+    assert cache.size == 70
+    assert not cache.put('c', 'd', entry(61))
+    # Replacing an entry accounts for the old one
+    cache.put('c', 'b', entry(10, 'f'))
+    assert cache.size == 40 and cache.get('c', 'b').etag == 'f'
+    cache.invalidate('c', 'b')
+    assert cache.size == 30
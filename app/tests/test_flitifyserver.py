@@ -0,0 +1,78 @@
+import threading
+import time
+import pytest
+
+from client.clientconnection import ClientConnection, ConnectionKickedError
+from network.secureconnection import SessionTicketCache
+from crypto.cryptohelper import CryptoHelperResumeClient
+from server.flitifyserver import FlitifyServer
+from conftest import DummyDB, wait_for, connect
+
+
+@pytest.fixture(scope="module")
+def server(rsa_keypair):
+    server = FlitifyServer('localhost', 0, rsa_keypair[0], DummyDB())
+    threading.Thread(target=server.start, daemon=True).start()
+    while not server.running:
+        time.sleep(0.01)
+    return server
+
+
+def serve_until_closed(connection):
+    try:
+        ClientConnection(connection)
+    except BrokenPipeError:
+        pass
+
+
+def test_client_visible_right_after_authentication(server, rsa_keypair):
+    connection = connect(server, rsa_keypair[1], 'client1')
+    # Registration happens in the handshake thread, well below the old watchdog interval
+    assert wait_for(lambda: 'client1' in server.getClientList(), timeout=0.5)
+    connection.closeConnection()
+    assert wait_for(lambda: server.getClientById('client1') is None, timeout=0.5)
+
+
+def test_duplicate_is_kicked_and_original_kept(server, rsa_keypair):
+    first = connect(server, rsa_keypair[1], 'client2')
+    threading.Thread(target=serve_until_closed, args=(first,), daemon=True).start()
+    assert wait_for(lambda: 'client2' in server.getClientList())
+    original = server.getClientById('client2')
+
+    duplicate = connect(server, rsa_keypair[1], 'client2')
+    with pytest.raises(ConnectionKickedError):
+        ClientConnection(duplicate)
+    assert server.getClientById('client2') is original
+    assert original.ping() is True
+    first.closeConnection()
+
+
+def test_reconnect_resumes_session_with_ticket(server, rsa_keypair):
+    cache = SessionTicketCache()
+    first = connect(server, rsa_keypair[1], 'client3', ticketCache=cache)
+    assert not first.resumed
+    threading.Thread(target=serve_until_closed, args=(first,), daemon=True).start()
+    assert wait_for(lambda: cache.get() is not None)
+    first.closeConnection()
+    assert wait_for(lambda: server.getClientById('client3') is None)
+    firstTicket = cache.ticket
+
+    resumed = connect(server, rsa_keypair[1], 'client3', ticketCache=cache)
+    assert resumed.resumed
+    threading.Thread(target=serve_until_closed, args=(resumed,), daemon=True).start()
+    assert wait_for(lambda: 'client3' in server.getClientList())
+    assert server.getClientById('client3').ping() is True
+    # The new ticket does not outlive the one from the full handshake
+    assert wait_for(lambda: cache.ticket != firstTicket)
+    tickets = server.rsa.getTicketHelper()
+    assert tickets.redeem(CryptoHelperResumeClient(*cache.get()).hello)[4] == tickets.redeem(CryptoHelperResumeClient(firstTicket, b'').hello)[4]
+    resumed.closeConnection()
+
+
+def test_invalid_ticket_falls_back_to_full_handshake(server, rsa_keypair):
+    cache = SessionTicketCache()
+    cache.store(b'\x00' * 64, b'\x00' * 32, 60)
+    connection = connect(server, rsa_keypair[1], 'client4', ticketCache=cache)
+    assert connection.running and not connection.resumed
+    assert wait_for(lambda: 'client4' in server.getClientList())
+    connection.closeConnection()
@@ -0,0 +1,132 @@
+import http.client
+import json
+import multiprocessing
+import os
+import socket
+import threading
+import time
+import pytest
+
+from apiserver.apiserver import ApiServer
+from client.clientconnection import ClientConnection
+from crypto.cryptohelper import createSessionCipher, restoreSessionCipher
+from network.protocolconnection import ClientProtocolConnection
+from server.flitifyserver import FlitifyServer
+from server.handoff import HandoffListener, takeOver, _send, _recv
+from conftest import DummyDB, wait_for
+
+
+def free_port() -> int:
+    with socket.create_server(('localhost', 0)) as probe:
+        return probe.getsockname()[1]
+
+
+@pytest.mark.parametrize('suite', ['aes-256-gcm', 'chacha20-poly1305', 'aes-256-eax'])
+def test_restored_session_cipher_continues_the_session(suite):
+    key = os.urandom(32)
+    server, client = createSessionCipher(key, suite, isServer=True), createSessionCipher(key, suite, isServer=False)
+    assert client.decrypt(server.encrypt(b'before')) == b'before'
+    assert server.decrypt(client.encrypt(b'before')) == b'before'
+    restored = restoreSessionCipher(json.loads(json.dumps(server.exportState())))
+    assert client.decrypt(restored.encrypt(b'after')) == b'after'
+    assert restored.decrypt(client.encrypt(b'after')) == b'after'
+
+
+def run_old_server(path, port, apiPort, rsaKey, stagingDir):
+    server = FlitifyServer('localhost', port, rsaKey, DummyDB(), handshakeWorkers=0)
+    threading.Thread(target=server.start, daemon=True).start()
+    api = ApiServer(server, host='localhost', port=apiPort, secret='apisecret', stagingDir=stagingDir)
+    threading.Thread(target=api.start, daemon=True).start()
+    while not api.listeningSockets():
+        time.sleep(0.01)
+    HandoffListener(path, server, api, drainTimeout=5).start()
+    threading.Event().wait()
+
+
+@pytest.fixture
+def old_server(rsa_keypair, tmp_path):
+    path, port, apiPort = str(tmp_path / 'handoff.sock'), free_port(), free_port()
+    process = multiprocessing.get_context('spawn').Process(target=run_old_server,
+                                                          args=(path, port, apiPort, rsa_keypair[0], str(tmp_path / 'staging')))
+    process.start()
+    assert wait_for(lambda: os.path.exists(path), timeout=10)
+    yield process, path, port, apiPort
+    process.kill()
+    process.join()
+
+
+def serve_until_closed(connection):
+    try:
+        ClientConnection(connection)
+    except BrokenPipeError:
+        pass
+
+
+def connect_agent(port, rsa_public_key, clientId, **kwargs):
+    sock = socket.create_connection(('localhost', port))
+    connection = ClientProtocolConnection(sock, ('localhost', port), rsa_public_key, clientId, 'secret', **kwargs)
+    thread = threading.Thread(target=serve_until_closed, args=(connection,), daemon=True)
+    thread.start()
+    return connection, thread
+
+
+def api_get(apiPort, path):
+    connection = http.client.HTTPConnection('localhost', apiPort, timeout=10)
+    try:
+        connection.request('GET', path, headers={'X-Api-Secret': 'apisecret'})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+
+def test_agents_keep_their_connections_across_a_handoff(old_server, rsa_keypair, tmp_path):
+    process, path, port, apiPort = old_server
+    agents = [connect_agent(port, rsa_keypair[1], 'modern'),
+              connect_agent(port, rsa_keypair[1], 'legacy', cipherSuites=['aes-256-eax'], binaryEnvelope=False)]
+    assert wait_for(lambda: sorted(api_get(apiPort, '/clients')[1]['client_list']) == ['legacy', 'modern'], timeout=10)
+    (tmp_path / 'marker.txt').write_text('x')
+    for clientId in ('modern', 'legacy'):
+        assert api_get(apiPort, f'/{clientId}/listdir?path={tmp_path}')[0] == 200
+
+    takeover = takeOver(path, timeout=10)
+    process.join(5)
+    assert process.exitcode == 0
+    assert sorted(state['client_id'] for _, state in takeover.sessions) == ['legacy', 'modern']
+
+    server = FlitifyServer('localhost', 0, rsa_keypair[0], DummyDB(), handshakeWorkers=0, listenSocket=takeover.listener)
+    assert all(server.adoptConnection(sock, state) for sock, state in takeover.sessions)
+    threading.Thread(target=server.start, daemon=True).start()
+    api = ApiServer(server, secret='apisecret', sockets=takeover.apiSockets, stagingDir=str(tmp_path / 'staging'))
+    threading.Thread(target=api.start, daemon=True).start()
+
+    # Same API port and the agents' original connections, which continue their sessions
+    for clientId in ('modern', 'legacy'):
+        status, body = api_get(apiPort, f'/{clientId}/listdir?path={tmp_path}')
+        assert status == 200 and 'marker.txt' in str(body['entries'])
+    assert all(connection.running and thread.is_alive() for connection, thread in agents)
+    # New agents connect on the same port
+    connect_agent(port, rsa_keypair[1], 'newcomer')
+    assert wait_for(lambda: server.getClientById('newcomer') is not None, timeout=10)
+    for connection, _ in agents:
+        connection.closeConnection()
+
+
+def test_aborted_takeover_resumes_the_connections(old_server, rsa_keypair, tmp_path):
+    process, path, port, apiPort = old_server
+    connection, thread = connect_agent(port, rsa_keypair[1], 'agent1')
+    assert wait_for(lambda: api_get(apiPort, '/clients')[1]['client_list'] == ['agent1'], timeout=10)
+
+    # A new process that goes away before confirming the takeover
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    sock.connect(path)
+    _send(sock, {'type': 'takeover'})
+    _, fds = _recv(sock, 'listeners')
+    _, sessionFds = _recv(sock, 'sessions')
+    for fd in fds + sessionFds:
+        os.close(fd)
+    sock.close()
+
+    assert wait_for(lambda: api_get(apiPort, f'/agent1/listdir?path={tmp_path}')[0] == 200, timeout=10)
+    assert process.is_alive() and connection.running and thread.is_alive()
+    connection.closeConnection()
@@ -0,0 +1,85 @@
+import time
+from concurrent.futures import Future
+
+from server.keepalivescheduler import TimerWheel, KeepAliveScheduler
+
+
+class FakeConnection:
+    def __init__(self, respond=True):
+        self.peerAddr = '127.0.0.1:1'
+        self.clientId = 'client1'
+        self.running = True
+        self.lastActivity = self.lastReceived = time.monotonic()
+        self.respond = respond
+        self.pings = 0
+
+    def sendPing(self):
+        self.pings += 1
+        future = Future()
+        if self.respond:
+            self.lastActivity = self.lastReceived = time.monotonic()
+            future.set_result(('pong', {}))
+        return future
+
+    def closeConnection(self):
+        self.running = False
+
+
+def test_timer_wheel_expires_items_in_order_and_wraps():
+    wheel = TimerWheel(tick=1, slots=4)
+    origin = wheel.origin
+    wheel.schedule(origin + 2, 'a')
+    wheel.schedule(origin + 9, 'b')
+    assert wheel.advance(origin + 1.5) == []
+    assert wheel.advance(origin + 2) == ['a']
+    # 'b' shares a slot with tick 5 but only expires at tick 9
+    assert wheel.advance(origin + 6) == []
+    assert wheel.advance(origin + 9) == ['b']
+
+
+def test_active_connection_is_not_pinged():
+    scheduler = KeepAliveScheduler(interval=0.3, timeout=0.3, tick=0.02)
+    scheduler.start()
+    connection = FakeConnection()
+    scheduler.add(connection)
+    deadline = time.monotonic() + 1
+    while time.monotonic() < deadline:
+        connection.lastActivity = time.monotonic()
+        time.sleep(0.05)
+    assert connection.pings == 0
+    assert connection.running
+
+
+def test_idle_connection_is_pinged():
+    scheduler = KeepAliveScheduler(interval=0.1, timeout=0.3, tick=0.02)
+    scheduler.start()
+    connection = FakeConnection()
+    scheduler.add(connection)
+    time.sleep(0.6)
+    assert connection.pings >= 2
+    assert connection.running
+
+
+def test_unanswered_ping_closes_connection():
+    scheduler = KeepAliveScheduler(interval=0.1, timeout=0.2, tick=0.02)
+    scheduler.start()
+    connection = FakeConnection(respond=False)
+    scheduler.add(connection)
+    time.sleep(0.6)
+    assert connection.pings == 1
+    assert not connection.running
+
+
+def test_connection_receiving_is_not_timed_out():
+    scheduler = KeepAliveScheduler(interval=0.1, timeout=0.2, tick=0.02)
+    scheduler.start()
+    connection = FakeConnection(respond=False)
+    scheduler.add(connection)
+    # A large frame arriving ahead of the pong
+    deadline = time.monotonic() + 0.6
+    while time.monotonic() < deadline:
+        connection.lastReceived = time.monotonic()
+        time.sleep(0.05)
+    assert connection.running
+    time.sleep(0.6)
+    assert not connection.running
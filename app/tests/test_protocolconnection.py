@@ -2,29 +2,16 @@ import socket
 import threading
 import time
 import pytest
-from Crypto.PublicKey import RSA
 from unittest.mock import MagicMock
 
 from network.protocolconnection import ServerProtocolConnection, ClientProtocolConnection, AuthenticationError
 from network.secureconnection import ClientSecureConnection
+from server.keepalivescheduler import KeepAliveScheduler
+from conftest import DummyDB
 
 MESSAGE_SIZE = 1024
 
 
-@pytest.fixture(scope="module")
-def rsa_keypair():
-    key = RSA.generate(2048)
-    return key.export_key(), key.export_key()
-
-
-class DummyDB:
-    def __init__(self, secrets):
-        self.secrets = secrets
-
-    def getSharedSecret(self, client_id):
-        return self.secrets.get(client_id, None)
-
-
 def server_thread(listener_sock, rsa_private_key, db_handler):
     client_sock, addr = listener_sock.accept()
     try:
@@ -109,7 +96,7 @@ def test_failed_authentication_invalid_format(rsa_keypair):
     client_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     client_sock.connect(('localhost', port))
 
-    clientCon = ClientSecureConnection(client_sock, ('localhost', port), rsa_public_key)
+    clientCon = ClientSecureConnection(client_sock, ('localhost', port), rsa_public_key, keyExchange='x25519')
     auth_req = clientCon.recvEncryptedLarge().decode()
     assert auth_req.split(':')[0] == 'AUTH_REQUIRED'
     invalid_data = 'client::'
@@ -123,3 +110,183 @@ def test_failed_authentication_invalid_format(rsa_keypair):
     server_sock.close()
     thread.join(timeout=1)
 
+
+def test_compact_handshake_authenticates_without_auth_request(rsa_keypair):
+    rsa_private_key, rsa_public_key = rsa_keypair
+    db = DummyDB({"client1": "correct_secret"})
+
+    server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_sock.bind(('localhost', 0))
+    server_sock.listen(1)
+    port = server_sock.getsockname()[1]
+
+    thread = threading.Thread(target=server_thread, args=(server_sock, rsa_private_key, db))
+    thread.daemon = True
+    thread.start()
+
+    client_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client_sock.connect(('localhost', port))
+
+    # The first encrypted frame is the client's answer, the challenge comes from the key exchange
+    clientCon = ClientSecureConnection(client_sock, ('localhost', port), rsa_public_key, keyExchange='compact')
+    assert clientCon.authChallenge is not None
+    clientCon.sendEncryptedLarge(f'client1:correct_secret:{clientCon.authChallenge}'.encode())
+    assert clientCon.recvEncryptedLarge() == b'AUTH_CORRECT'
+
+    client_sock.close()
+    server_sock.close()
+    thread.join(timeout=1)
+
+
+@pytest.mark.parametrize('key_exchange', ['compact', 'x25519', 'rsa'])
+def test_authentication_with_each_key_exchange(rsa_keypair, key_exchange):
+    rsa_private_key, rsa_public_key = rsa_keypair
+    db = DummyDB({"client1": "correct_secret"})
+
+    server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_sock.bind(('localhost', 0))
+    server_sock.listen(1)
+    port = server_sock.getsockname()[1]
+
+    thread = threading.Thread(target=server_thread, args=(server_sock, rsa_private_key, db))
+    thread.daemon = True
+    thread.start()
+
+    client_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client_sock.connect(('localhost', port))
+    client_conn = ClientProtocolConnection(client_sock, ('localhost', port), rsa_public_key, "client1", "correct_secret", keyExchange=key_exchange)
+    assert client_conn.running is True
+
+    client_sock.close()
+    server_sock.close()
+    thread.join(timeout=1)
+
+
+def test_multiplexed_actions_out_of_order(rsa_keypair):
+    rsa_private_key, rsa_public_key = rsa_keypair
+    db = DummyDB({"client1": "correct_secret"})
+
+    server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_sock.bind(('localhost', 0))
+    server_sock.listen(1)
+    port = server_sock.getsockname()[1]
+    server_conn = {}
+
+    def accept():
+        sock, addr = server_sock.accept()
+        server_conn['conn'] = ServerProtocolConnection(sock, addr, rsa_private_key, db)
+        server_conn['conn'].readLoop()
+
+    reader = threading.Thread(target=accept, daemon=True)
+    reader.start()
+
+    client_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client_sock.connect(('localhost', port))
+    client_conn = ClientProtocolConnection(client_sock, ('localhost', port), rsa_public_key, "client1", "correct_secret")
+    while 'conn' not in server_conn:
+        time.sleep(0.01)
+
+    results = {}
+    def invoke(name):
+        results[name] = server_conn['conn'].invokeAction(name, {})
+
+    slow = threading.Thread(target=invoke, args=('slow',))
+    slow.start()
+    slow_action = client_conn.recvAction()
+    slow_seq = client_conn.currentSeq
+    fast = threading.Thread(target=invoke, args=('fast',))
+    fast.start()
+    fast_action = client_conn.recvAction()
+    assert slow_action[0] == 'slow' and fast_action[0] == 'fast'
+
+    # Answer the second action first; the first one is still outstanding
+    client_conn.sendResponse('fast_done', {'n': 2})
+    fast.join(timeout=2)
+    assert results['fast'] == ('fast_done', {'n': 2})
+    assert slow.is_alive()
+    client_conn.sendResponse('slow_done', {'n': 1}, seq=slow_seq)
+    slow.join(timeout=2)
+    assert results['slow'] == ('slow_done', {'n': 1})
+
+    client_conn.closeConnection()
+    reader.join(timeout=2)
+    assert server_conn['conn'].running is False
+    server_sock.close()
+
+
+def test_silent_peer_fails_actions_waiting_without_timeout(rsa_keypair):
+    rsa_private_key, rsa_public_key = rsa_keypair
+    server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_sock.bind(('localhost', 0))
+    server_sock.listen(1)
+    port = server_sock.getsockname()[1]
+    server_conn = {}
+
+    def accept():
+        sock, addr = server_sock.accept()
+        server_conn['conn'] = ServerProtocolConnection(sock, addr, rsa_private_key, DummyDB({"client1": "correct_secret"}))
+        server_conn['conn'].readLoop()
+
+    threading.Thread(target=accept, daemon=True).start()
+    client_sock = socket.create_connection(('localhost', port))
+    client_conn = ClientProtocolConnection(client_sock, ('localhost', port), rsa_public_key, "client1", "correct_secret")
+    while 'conn' not in server_conn:
+        time.sleep(0.01)
+    scheduler = KeepAliveScheduler(interval=0.2, timeout=0.3, tick=0.02)
+    scheduler.start()
+    scheduler.add(server_conn['conn'])
+
+    # The agent dies while the action is pending: the ping goes unanswered and fails it
+    started = time.monotonic()
+    with pytest.raises(BrokenPipeError):
+        server_conn['conn'].invokeAction('shell_command', {'command': 'sleep 100'}, timeout=None)
+    assert time.monotonic() - started < 2
+    client_conn.closeConnection()
+    server_sock.close()
+
+
+@pytest.mark.parametrize('key_exchange, binary_envelope, negotiated', [
+    ('compact', True, True),
+    ('compact', False, False),
+    ('rsa', True, False),
+])
+def test_binary_envelope_negotiation(rsa_keypair, key_exchange, binary_envelope, negotiated):
+    rsa_private_key, rsa_public_key = rsa_keypair
+    db = DummyDB({"client1": "correct_secret"})
+
+    server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_sock.bind(('localhost', 0))
+    server_sock.listen(1)
+    port = server_sock.getsockname()[1]
+    server_conn = {}
+
+    def accept():
+        sock, addr = server_sock.accept()
+        server_conn['conn'] = ServerProtocolConnection(sock, addr, rsa_private_key, db)
+        server_conn['conn'].readLoop()
+
+    reader = threading.Thread(target=accept, daemon=True)
+    reader.start()
+
+    client_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client_sock.connect(('localhost', port))
+    client_conn = ClientProtocolConnection(client_sock, ('localhost', port), rsa_public_key, "client1", "correct_secret",
+                                           keyExchange=key_exchange, binaryEnvelope=binary_envelope)
+    while 'conn' not in server_conn:
+        time.sleep(0.01)
+    assert client_conn.binaryEnvelope is negotiated
+    assert server_conn['conn'].binaryEnvelope is negotiated
+
+    payload = bytes(range(256)) * 4 if negotiated else 'text'
+    results = {}
+    invoke = threading.Thread(target=lambda: results.update(response=server_conn['conn'].invokeAction('echo', {'data': [payload]})))
+    invoke.start()
+    action, data = client_conn.recvAction()
+    assert action == 'echo' and data['data'][0] == payload
+    client_conn.sendResponse('echoed', {'data': data['data'][0]})
+    invoke.join(timeout=2)
+    assert results['response'] == ('echoed', {'data': payload})
+
+    client_conn.closeConnection()
+    reader.join(timeout=2)
+    server_sock.close()
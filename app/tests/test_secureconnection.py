@@ -2,7 +2,10 @@ import socket
 import threading
 import pytest
 from Crypto.PublicKey import RSA
-from network.secureconnection import ServerSecureConnection, ClientSecureConnection, ProtocolVersionError
+from network.baseconnection import BaseConnection
+from network.secureconnection import ServerSecureConnection, ClientSecureConnection, ProtocolVersionError, KeyExchangeRejectedError, GREETING, COMPACT_HELLO, CIPHER_OFFER, UNBOUND_CIPHER_OFFER, UNBOUND_CIPHER_SELECTED
+from crypto.cryptohelper import CryptoHelperRSA, DecryptionError
+from network.compression import FrameCompressor
 
 @pytest.fixture(scope="module")
 def rsa_keys():
@@ -28,7 +31,7 @@ def run_server_with_socket(server_socket, rsa_key, server_ready_event):
     conn.closeConnection()
 
 def run_server_with_invalid_protocol(server_socket, rsa_key, server_ready_event):
-    from crypto.cryptohelper import CryptoHelperRSA
+    from crypto.cryptohelper import CryptoHelperRSA, DecryptionError
     port = server_socket.getsockname()[1]
     server_ready_event.set()
     client_sock, addr = server_socket.accept()
@@ -87,3 +90,198 @@ def test_full_secure_connection_protocol_mismatch(rsa_keys, server_socket):
 
     s.close()
     server_thread.join()
+
+def test_rsa_key_exchange_still_supported(rsa_keys, server_socket):
+    rsa_private, rsa_public = rsa_keys
+    server_ready_event = threading.Event()
+    server_thread = threading.Thread(target=run_server_with_socket, args=(server_socket, rsa_private, server_ready_event))
+    server_thread.start()
+    server_ready_event.wait()
+    port = server_socket.getsockname()[1]
+
+    s = socket.socket()
+    s.connect(("localhost", port))
+    conn = ClientSecureConnection(s, ("localhost", port), rsa_public, keyExchange='rsa')
+    assert conn.recvEncryptedLarge() == b"Hello from server!"
+    conn.sendEncryptedLarge(b"Hello from client!")
+    conn.closeConnection()
+    server_thread.join()
+
+def run_rsa_only_server(server_socket, rsa_key):
+    client_sock, addr = server_socket.accept()
+    conn = BaseConnection(client_sock, addr)
+    conn.sendLarge(GREETING.encode())
+    try:
+        CryptoHelperRSA(rsa_key).decrypt(conn.recvLarge())
+    except ValueError:
+        pass
+    conn.closeConnection()
+
+def test_x25519_hello_rejected_by_rsa_only_server(rsa_keys, server_socket):
+    rsa_private, rsa_public = rsa_keys
+    server_thread = threading.Thread(target=run_rsa_only_server, args=(server_socket, rsa_private))
+    server_thread.start()
+    port = server_socket.getsockname()[1]
+
+    s = socket.socket()
+    s.connect(("localhost", port))
+    with pytest.raises(KeyExchangeRejectedError):
+        ClientSecureConnection(s, ("localhost", port), rsa_public)
+    server_thread.join()
+
+def run_impostor_server(server_socket, impostor_key):
+    client_sock, addr = server_socket.accept()
+    conn = BaseConnection(client_sock, addr)
+    conn.sendLarge(GREETING.encode())
+    hello = conn.recvLarge()
+    reply, _ = CryptoHelperRSA(impostor_key).getX25519Server().respond(hello[len(COMPACT_HELLO):])
+    conn.sendLarge(reply)
+    try:
+        conn.recvLarge()
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+    conn.closeConnection()
+
+def test_x25519_rejects_server_key_not_signed_by_rsa_key(rsa_keys, server_socket):
+    rsa_private, rsa_public = rsa_keys
+    impostor_key = RSA.generate(2048).export_key()
+    server_thread = threading.Thread(target=run_impostor_server, args=(server_socket, impostor_key))
+    server_thread.start()
+    port = server_socket.getsockname()[1]
+
+    s = socket.socket()
+    s.connect(("localhost", port))
+    with pytest.raises(ValueError):
+        ClientSecureConnection(s, ("localhost", port), rsa_public, cipherSuites=['aes-256-eax'])
+    server_thread.join()
+
+def run_silent_server(server_socket, done):
+    client_sock, addr = server_socket.accept()
+    conn = BaseConnection(client_sock, addr)
+    conn.sendLarge(GREETING.encode())
+    done.wait(5)
+    conn.closeConnection()
+
+def test_server_not_replying_is_no_rejection(rsa_keys, server_socket):
+    rsa_private, rsa_public = rsa_keys
+    done = threading.Event()
+    server_thread = threading.Thread(target=run_silent_server, args=(server_socket, done))
+    server_thread.start()
+    port = server_socket.getsockname()[1]
+
+    s = socket.socket()
+    s.connect(("localhost", port))
+    s.settimeout(0.3)
+    with pytest.raises(socket.timeout):
+        ClientSecureConnection(s, ("localhost", port), rsa_public)
+    done.set()
+    server_thread.join()
+
+class DowngradingClient(ClientSecureConnection):
+    """ Has its cipher offer rewritten on the way, as an attacker on the path could. """
+    def sendLarge(self, *data):
+        if bytes(data[0]).startswith(CIPHER_OFFER):
+            data = (CIPHER_OFFER + b'aes-256-eax',)
+        super().sendLarge(*data)
+
+def run_server_reporting_handshake(server_socket, rsa_key, result):
+    client_sock, addr = server_socket.accept()
+    conn = ServerSecureConnection(client_sock, addr, rsa_key)
+    result['suite'] = conn.cipherSuite
+    result['running'] = conn.running
+    conn.closeConnection()
+
+def test_tampered_cipher_offer_fails_handshake(rsa_keys, server_socket):
+    rsa_private, rsa_public = rsa_keys
+    result = {}
+    server_thread = threading.Thread(target=run_server_reporting_handshake, args=(server_socket, rsa_private, result))
+    server_thread.start()
+    port = server_socket.getsockname()[1]
+
+    s = socket.socket()
+    s.connect(("localhost", port))
+    with pytest.raises(DecryptionError):
+        DowngradingClient(s, ("localhost", port), rsa_public, keyExchange='x25519')
+    server_thread.join()
+    assert result == {'suite': 'aes-256-eax', 'running': False}
+
+def test_unbound_cipher_offer_answered_in_kind(rsa_keys, server_socket):
+    rsa_private, rsa_public = rsa_keys
+    result = {}
+    server_thread = threading.Thread(target=run_server_reporting_handshake, args=(server_socket, rsa_private, result))
+    server_thread.start()
+    port = server_socket.getsockname()[1]
+
+    conn = BaseConnection(socket.create_connection(("localhost", port)), ("localhost", port))
+    assert conn.recvLarge() == GREETING.encode()
+    conn.sendLarge(UNBOUND_CIPHER_OFFER + b'chacha20-poly1305,+busy')
+    assert conn.recvLarge() == UNBOUND_CIPHER_SELECTED + b'chacha20-poly1305'
+    conn.closeConnection()
+    server_thread.join()
+
+def run_server_reporting_cipher(server_socket, rsa_key, result):
+    client_sock, addr = server_socket.accept()
+    conn = ServerSecureConnection(client_sock, addr, rsa_key)
+    result['suite'] = conn.cipherSuite
+    conn.sendEncryptedLarge(b"Hello from server!")
+    result['msg'] = conn.recvEncryptedLarge()
+    conn.closeConnection()
+
+@pytest.mark.parametrize('offered, expected', [
+    (None, 'aes-256-gcm'),
+    (['chacha20-poly1305', 'aes-256-gcm'], 'chacha20-poly1305'),
+    (['aes-256-eax'], 'aes-256-eax'),
+])
+def test_cipher_suite_negotiation(rsa_keys, server_socket, offered, expected):
+    rsa_private, rsa_public = rsa_keys
+    result = {}
+    server_thread = threading.Thread(target=run_server_reporting_cipher, args=(server_socket, rsa_private, result))
+    server_thread.start()
+    port = server_socket.getsockname()[1]
+
+    s = socket.socket()
+    s.connect(("localhost", port))
+    conn = ClientSecureConnection(s, ("localhost", port), rsa_public, keyExchange='x25519', cipherSuites=offered)
+    assert conn.cipherSuite == expected
+    assert conn.recvEncryptedLarge() == b"Hello from server!"
+    conn.sendEncryptedLarge(b"Hello from client!")
+    server_thread.join()
+    assert result == {'suite': expected, 'msg': b"Hello from client!"}
+
+def run_server_echoing_compressed(server_socket, rsa_key, compression, result):
+    client_sock, addr = server_socket.accept()
+    conn = ServerSecureConnection(client_sock, addr, rsa_key, compression=compression)
+    result['algorithms'] = conn.compressor.algorithms if conn.compressor else None
+    message = conn.recvEncryptedLarge()
+    conn.sendEncryptedBuffer(bytearray(message))
+    conn.sendEncryptedLarge(bytes(message))
+    conn.closeConnection()
+
+@pytest.mark.parametrize('offered, accepted, expected', [
+    (['zlib'], ['zlib', 'lzma'], ['zlib']),
+    (['zlib', 'lzma'], ['zlib', 'lzma'], ['zlib', 'lzma']),
+    (['lzma'], ['zlib'], None),
+    ([], ['zlib', 'lzma'], None),
+])
+def test_compression_negotiation(rsa_keys, server_socket, offered, accepted, expected):
+    rsa_private, rsa_public = rsa_keys
+    result = {}
+    server_thread = threading.Thread(target=run_server_echoing_compressed,
+                                     args=(server_socket, rsa_private, FrameCompressor(accepted), result))
+    server_thread.start()
+    port = server_socket.getsockname()[1]
+
+    s = socket.socket()
+    s.connect(("localhost", port))
+    conn = ClientSecureConnection(s, ("localhost", port), rsa_public, keyExchange='x25519', compression=FrameCompressor(offered))
+    assert (conn.compressor.algorithms if conn.compressor else None) == expected
+    message = b'2024-01-01 12:00:00 INFO request served\n' * 10000
+    sent = []
+    sendLarge = conn.sendLarge
+    conn.sendLarge = lambda *parts: sent.append(sum(len(part) for part in parts)) or sendLarge(*parts)
+    conn.sendEncryptedLarge(message)
+    assert (sent[0] < len(message) // 10) == (expected is not None)
+    assert conn.recvEncryptedLarge() == message
+    assert conn.recvEncryptedLarge() == message
+    server_thread.join()
+    assert result['algorithms'] == expected
@@ -0,0 +1,110 @@
+import hashlib
+import io
+import os
+import threading
+import pytest
+from types import SimpleNamespace
+
+from server.staging import StagingArea, StagedFileNotFoundError, pushToClients
+
+
+class FailingSource(io.BytesIO):
+    def read(self, size=-1):
+        if self.tell():
+            raise OSError('connection lost')
+        return super().read(size)
+
+
+def test_store_addresses_files_by_digest(tmp_path):
+    staging = StagingArea(str(tmp_path / 'staging'))
+    content = os.urandom(3 * 1024 * 1024 + 17)
+    digest, size = staging.store(io.BytesIO(content))
+    assert (digest, size) == (hashlib.sha256(content).hexdigest(), len(content))
+    with open(staging.path(digest), 'rb') as file:
+        assert file.read() == content
+
+    # The same contents are kept once
+    assert staging.store(io.BytesIO(content)) == (digest, size)
+    assert os.listdir(staging.directory) == [digest]
+
+    # Only size bytes are read from the source
+    assert staging.store(io.BytesIO(content), 100)[0] == hashlib.sha256(content[:100]).hexdigest()
+
+    staging.remove(digest)
+    with pytest.raises(StagedFileNotFoundError):
+        staging.path(digest)
+
+
+def test_invalid_digest_is_not_found(tmp_path):
+    staging = StagingArea(str(tmp_path))
+    for digest in (None, '', '../' + '0' * 61, '0' * 64):
+        with pytest.raises(StagedFileNotFoundError):
+            staging.path(digest)
+
+
+def test_interrupted_store_leaves_nothing(tmp_path):
+    staging = StagingArea(str(tmp_path))
+    with pytest.raises(OSError):
+        staging.store(FailingSource(os.urandom(3 * 1024 * 1024)))
+    assert os.listdir(tmp_path) == []
+
+
+class FakeClient:
+    def __init__(self, uploaded, result=True, started=None, release=None):
+        self.uploaded = uploaded
+        self.result = result
+        self.started = started
+        self.release = release
+
+    def uploadStream(self, path, source, size, sha256=None):
+        self.uploaded.append((path, source.read(), size, sha256))
+        if self.started is not None:
+            self.started.set()
+            self.release.wait(5)
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+    def uploadDelta(self, path, source, size):
+        self.uploaded.append(('delta', path, size))
+        return self.result
+
+
+@pytest.fixture
+def staged(tmp_path):
+    path = tmp_path / 'artifact.bin'
+    path.write_bytes(b'artifact')
+    return str(path), hashlib.sha256(b'artifact').hexdigest()
+
+
+def test_push_reports_each_client(staged):
+    stagedPath, digest = staged
+    uploaded = []
+    clients = {'ok': FakeClient(uploaded), 'refused': FakeClient(uploaded, False), 'broken': FakeClient(uploaded, OSError('reset'))}
+    server = SimpleNamespace(getClientById=clients.get)
+
+    results = list(pushToClients(server, stagedPath, digest, '/opt/app.bin', ['ok', 'refused', 'broken', 'gone']))
+    assert sorted((r['client_id'], r['status']) for r in results) == [
+        ('broken', 'failed'), ('gone', 'offline'), ('ok', 'ok'), ('refused', 'failed')]
+    assert uploaded == [('/opt/app.bin', b'artifact', 8, digest)] * 3
+
+    uploaded.clear()
+    assert list(pushToClients(server, stagedPath, digest, '/opt/app.bin', ['ok'], delta=True)) == [{'client_id': 'ok', 'status': 'ok'}]
+    assert uploaded == [('delta', '/opt/app.bin', 8)]
+
+
+def test_closing_push_cancels_pending_uploads(staged):
+    stagedPath, digest = staged
+    uploaded = []
+    started, release = threading.Event(), threading.Event()
+    clients = {'first': FakeClient(uploaded), 'second': FakeClient(uploaded, started=started, release=release)}
+    clients.update({f'later{n}': FakeClient(uploaded) for n in range(5)})
+    server = SimpleNamespace(getClientById=clients.get)
+
+    push = pushToClients(server, stagedPath, digest, '/opt/app.bin', list(clients), workers=1)
+    assert next(push) == {'client_id': 'first', 'status': 'ok'}
+    assert started.wait(5)
+    push.close()
+    release.set()
+    # The upload running when the push was closed finishes, the rest never start
+    assert len(uploaded) == 2
@@ -0,0 +1,134 @@
+import io
+import socket
+import threading
+import time
+import pytest
+from Crypto.PublicKey import RSA
+
+from network.protocolconnection import ServerProtocolConnection, ClientProtocolConnection
+from network.streams import StreamReader, StreamWriter, StreamError, IncomingStreams, isSegment, splitSegment
+
+
+class DummyDB:
+    def getSharedSecret(self, client_id):
+        return 'secret'
+
+
+@pytest.fixture(scope="module")
+def rsa_keypair():
+    key = RSA.generate(2048)
+    return key.export_key(), key.publickey().export_key()
+
+
+@pytest.fixture
+def connections(rsa_keypair):
+    listener = socket.create_server(('localhost', 0))
+    port = listener.getsockname()[1]
+    server = {}
+
+    def accept():
+        sock, addr = listener.accept()
+        server['conn'] = ServerProtocolConnection(sock, addr, rsa_keypair[0], DummyDB())
+        server['conn'].readLoop()
+
+    thread = threading.Thread(target=accept, daemon=True)
+    thread.start()
+    client_sock = socket.create_connection(('localhost', port))
+    client = ClientProtocolConnection(client_sock, ('localhost', port), rsa_keypair[1], 'client1', 'secret')
+    while 'conn' not in server:
+        time.sleep(0.01)
+    yield server['conn'], client
+    client.closeConnection()
+    thread.join(timeout=2)
+    listener.close()
+
+
+def loopback():
+    """ A writer feeding an IncomingStreams directly, as a connection would. """
+    streams = IncomingStreams()
+    reader = streams.open(7, timeout=1)
+
+    def send(buffer):
+        message = bytearray(buffer)
+        assert isSegment(message)
+        streams.deliver(*splitSegment(message))
+    return StreamWriter(send, 7, segmentSize=4), reader
+
+
+def test_writer_splits_into_segments_and_reader_reassembles():
+    writer, reader = loopback()
+    with writer:
+        writer.write(b'0123456789')
+        writer.writeFrom(io.BytesIO(b'abcdef'))
+    assert [bytes(chunk) for chunk in reader] == [b'0123', b'4567', b'89ab', b'cdef']
+    assert writer.bytesSent == 16
+
+
+def test_aborted_stream_raises():
+    writer, reader = loopback()
+    writer.write(b'01234')
+    writer.abort('disk error')
+    with pytest.raises(StreamError, match='aborted by sender'):
+        reader.read()
+
+
+def test_stream_without_final_segment_is_truncated():
+    streams = IncomingStreams()
+    reader = streams.open(1, timeout=1)
+    streams.deliver(0x01, 1, b'partial')
+    streams.failAll()
+    chunks = iter(reader)
+    assert next(chunks) == b'partial'
+    with pytest.raises(StreamError):
+        next(chunks)
+
+
+def test_reader_times_out():
+    with pytest.raises(StreamError, match='no segment'):
+        StreamReader(1, timeout=0.05).read()
+
+
+def test_stream_response_over_connection(connections):
+    server, client = connections
+    payload = bytes(range(256)) * 4096  # 1 MiB, four segments
+    result = {}
+
+    def invoke():
+        response_type, data, stream = server.invokeStreamAction('get_blob', {})
+        result['response'] = (response_type, data)
+        result['payload'] = b''.join(stream)
+
+    thread = threading.Thread(target=invoke)
+    thread.start()
+    action = client.recvAction()
+    assert action[0] == 'get_blob'
+    client.sendResponse('blob', {'size': len(payload)})
+    with client.openStream() as writer:
+        writer.writeFrom(io.BytesIO(payload))
+    # Ordinary responses still work after a stream
+    thread.join(timeout=5)
+    assert result['response'] == ('blob', {'size': len(payload)})
+    assert result['payload'] == payload
+
+
+def test_stream_interrupted_by_connection_close(connections):
+    server, client = connections
+    result = {}
+
+    def invoke():
+        _, _, stream = server.invokeStreamAction('get_blob', {})
+        try:
+            for _ in stream:
+                pass
+        except StreamError as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=invoke)
+    thread.start()
+    client.recvAction()
+    client.sendResponse('blob', {})
+    writer = client.openStream()
+    writer.write(b'x' * (writer.segmentSize + 1))
+    client.closeConnection()
+    thread.join(timeout=5)
+    assert 'error' in result
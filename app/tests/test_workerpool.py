@@ -0,0 +1,160 @@
+import json
+import os
+import socket
+import threading
+import time
+import pytest
+from Crypto.PublicKey import RSA
+
+from apiserver.apiserver import ApiServer
+from apiserver.router import RoutingApiServer
+from client.clientconnection import ClientConnection
+from network.protocolconnection import ClientProtocolConnection
+from server.flitifyserver import FlitifyServer
+from server.sharedregistry import WorkerDirectory, SharedClientRegistry
+from server.workerpool import WorkerPool
+
+
+class DummyDB:
+    def getSharedSecret(self, client_id):
+        return 'secret'
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_directory_rejects_client_owned_by_another_worker(tmp_path):
+    path = str(tmp_path / 'clients.db')
+    first, second = WorkerDirectory(path), WorkerDirectory(path)
+    assert first.claim('client1', 0)
+    assert not second.claim('client1', 1)
+    assert second.owner('client1') == 0
+    # Only the owner releases a client
+    second.release('client1', 1)
+    assert first.owner('client1') == 0
+    first.release('client1', 0)
+    assert second.owner('client1') is None
+    assert second.claim('client1', 1) and second.claim('client2', 1)
+    assert sorted(first.clientIds()) == ['client1', 'client2']
+    first.clearWorker(1)
+    assert first.clientIds() == []
+
+
+def test_shared_registry_publishes_clients(tmp_path):
+    directory = WorkerDirectory(str(tmp_path / 'clients.db'))
+    first, second = SharedClientRegistry(directory, 0), SharedClientRegistry(directory, 1)
+    handler, duplicate = object(), object()
+    assert first.register('client1', handler)
+    assert not second.register('client1', duplicate)
+    assert second.get('client1') is None
+    first.unregister('client1', duplicate)
+    assert directory.owner('client1') == 0
+    first.unregister('client1', handler)
+    assert directory.owner('client1') is None
+    assert second.register('client1', duplicate)
+
+
+def run_worker(worker, directoryPath, socketPath, port, rsaKey, stagingDir):
+    registry = SharedClientRegistry(WorkerDirectory(directoryPath), worker)
+    server = FlitifyServer('localhost', port, rsaKey, DummyDB(), handshakeWorkers=0, registry=registry, reusePort=True)
+    threading.Thread(target=server.start, daemon=True).start()
+    ApiServer(server, unixSocket=socketPath, secret='apisecret', stagingDir=stagingDir).start()
+
+
+@pytest.fixture(scope="module")
+def rsa_keypair():
+    key = RSA.generate(2048)
+    return key.export_key(), key.publickey().export_key()
+
+
+@pytest.fixture(scope="module")
+def workers(rsa_keypair, tmp_path_factory):
+    probe = socket.socket()
+    probe.bind(('localhost', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    # The workers share the staging directory of the routing API server
+    stagingDir = str(tmp_path_factory.mktemp('staging'))
+    pool = WorkerPool(2, lambda *args: run_worker(*args, port, rsa_keypair[0], stagingDir), rsa_keypair[0])
+    pool.start()
+    assert wait_for(lambda: all(os.path.exists(pool.socketPath(worker)) for worker in range(2)))
+    api = RoutingApiServer(pool, secret='apisecret', stagingDir=stagingDir)
+    yield pool, port, api.app.test_client()
+    pool.stop()
+
+
+def serve_until_closed(connection):
+    try:
+        ClientConnection(connection)
+    except BrokenPipeError:
+        pass
+
+
+def connect_agents(port, rsa_public_key, clientIds):
+    connections = []
+    for clientId in clientIds:
+        connection = None
+        # Agents are spread over the workers by the kernel, which may still be starting
+        while connection is None:
+            try:
+                sock = socket.create_connection(('localhost', port))
+                connection = ClientProtocolConnection(sock, ('localhost', port), rsa_public_key, clientId, 'secret')
+            except (ConnectionRefusedError, BrokenPipeError):
+                time.sleep(0.05)
+        threading.Thread(target=serve_until_closed, args=(connection,), daemon=True).start()
+        connections.append(connection)
+    return connections
+
+
+def test_requests_are_routed_to_the_owning_worker(workers, rsa_keypair, tmp_path):
+    pool, port, api = workers
+    headers = {'X-Api-Secret': 'apisecret'}
+    clientIds = [f'agent{n}' for n in range(8)]
+    connections = connect_agents(port, rsa_keypair[1], clientIds)
+    assert wait_for(lambda: sorted(api.get('/clients', headers=headers).json['client_list']) == clientIds)
+    assert {pool.ownerOf(clientId) for clientId in clientIds} <= {0, 1}
+
+    data = os.urandom(300_000)
+    for clientId in clientIds[:2]:
+        target = str(tmp_path / f'{clientId}.bin')
+        response = api.post(f'/{clientId}/uploadfile?path={target}', data=data, headers=headers)
+        assert response.status_code == 200
+        response = api.get(f'/{clientId}/getfile?file_path={target}', headers=headers)
+        assert response.status_code == 200 and response.data == data
+        assert response.headers['Content-Length'] == str(len(data))
+    response = api.get(f'/{clientIds[0]}/listdir?path={tmp_path}', headers=headers)
+    assert f'{clientIds[1]}.bin' in str(response.json['entries'])
+
+    assert api.get('/missing/listdir', headers=headers).status_code == 404
+    assert api.get(f'/{clientIds[0]}/listdir', headers={'X-Api-Secret': 'wrong'}).status_code == 401
+    for connection in connections:
+        connection.closeConnection()
+    assert wait_for(lambda: api.get('/clients', headers=headers).json['client_list'] == [])
+
+
+def test_bulk_upload_is_split_by_worker(workers, rsa_keypair, tmp_path):
+    pool, port, api = workers
+    headers = {'X-Api-Secret': 'apisecret'}
+    clientIds = [f'bulk{n}' for n in range(6)]
+    connections = connect_agents(port, rsa_keypair[1], clientIds)
+    assert wait_for(lambda: all(pool.ownerOf(clientId) is not None for clientId in clientIds))
+    staged = api.post('/staging', data=b'bulk contents', headers=headers).json
+
+    target = str(tmp_path / 'bulk.txt')
+    response = api.post('/bulkupload', json={'hash': staged['hash'], 'path': target, 'clients': clientIds[:1]}, headers=headers)
+    assert json.loads(response.data.decode().splitlines()[0]) == {'client_id': clientIds[0], 'status': 'ok'}
+    # All agents run on this machine, so the others find the file in place
+    response = api.post('/bulkupload', json={'hash': staged['hash'], 'path': target, 'clients': clientIds + ['offline1']}, headers=headers)
+    lines = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert {result['client_id']: result['status'] for result in lines[:-1]} == {**{clientId: 'ok' for clientId in clientIds}, 'offline1': 'offline'}
+    assert lines[-1]['summary'] == {'ok': 6, 'offline': 1}
+    with open(target, 'rb') as f:
+        assert f.read() == b'bulk contents'
+    for connection in connections:
+        connection.closeConnection()